@@ -0,0 +1,175 @@
+"""
+Compact storage of the consensus statistics of family alignments.
+
+build_consensus_sequences stores the statistics of the alignment of every protein family in AlignmentConsensus.
+Instead of the pickled Alignment object only the arrays behind the consensus lookups are stored, one row per
+alignment position (generic number): the segment, amino acid and feature counts, consensus and forced consensus
+residue and the conservation. The blob is a small JSON header (schema version, number of proteins, alphabet,
+features and the dtype, shape and offset of each array) followed by the raw array data, a reader only decodes the
+arrays it uses. Blobs of another schema version (e.g. pickled Alignment objects of older builds) are not loaded, the
+callers then build the alignment as before.
+"""
+from collections import OrderedDict
+import json
+import struct
+
+import numpy as np
+
+from common.alignment_matrix import ALPHABET, FEATURES, FEATURE_MATRIX, frequency_interval
+
+CONSENSUS_SCHEMA_VERSION = 1
+MAGIC = b'GPCRDB-CONSENSUS'
+HEADER_SIZE = struct.Struct('<I')
+
+# array data is aligned to this many bytes
+ARRAY_ALIGNMENT = 8
+
+
+def consensus_blob(slug):
+    """Stored statistics of a family, None if there are none"""
+    from alignment.models import AlignmentConsensus
+    return AlignmentConsensus.objects.filter(slug=slug).values_list('alignment', flat=True).first()
+
+def load_consensus_stats(slug):
+    """ConsensusStats of a family, None if there are none in the current format"""
+    data = consensus_blob(slug)
+    if data is None:
+        return None
+    try:
+        return ConsensusStats.from_bytes(data)
+    except ValueError:
+        return None
+
+
+class ConsensusStats:
+    """Consensus statistics of an alignment, positions are in the order of Alignment.consensus
+
+    segments are the segment slugs and positions segment_starts[i]:segment_starts[i+1] belong to segment i. Per
+    position are the labels (generic numbers), consensus ('+' for ties), forced_consensus and frequencies (percentage
+    of the most frequent residue), aa_counts (positions x ALPHABET) and feature_counts (positions x FEATURES).
+    Loaded from a blob the arrays are decoded when they are first used.
+    """
+
+    ARRAYS = ['segments', 'segment_starts', 'labels', 'consensus', 'forced_consensus', 'frequencies', 'aa_counts',
+              'feature_counts']
+
+    def __init__(self, num_proteins, arrays=None, data=None, layout=None):
+        self.num_proteins = num_proteins
+        self.data = data
+        self.layout = layout or {}
+        for name, array in (arrays or {}).items():
+            setattr(self, name, array)
+
+    def __getattr__(self, name):
+        layout = self.__dict__.get('layout') or {}
+        if name not in layout:
+            raise AttributeError(name)
+        dtype, shape, offset = layout[name]
+        count = int(np.prod(shape))
+        if count:
+            array = np.frombuffer(self.data, dtype=dtype, count=count, offset=offset).reshape(shape)
+        else:
+            array = np.zeros(shape, dtype=dtype)
+        setattr(self, name, array)
+        return array
+
+    @classmethod
+    def from_alignment(cls, a):
+        """Statistics of an Alignment after calculate_statistics"""
+        segments, segment_starts, labels, consensus, forced_consensus, frequencies, counts = [], [0], [], [], [], [], []
+        for segment, positions in a.consensus.items():
+            for label, values in positions.items():
+                labels.append(label)
+                consensus.append(values[0])
+                forced_consensus.append(a.forced_consensus[segment][label])
+                frequencies.append(values[2])
+                counts.append([a.aa_count[segment][label].get(aa, 0) for aa in ALPHABET])
+            segments.append(segment)
+            segment_starts.append(len(labels))
+
+        num_proteins = len(a.proteins)
+        aa_counts = np.array(counts, dtype=np.int64).reshape(-1, len(ALPHABET))
+        count_dtype = np.uint16 if num_proteins < 2 ** 16 else np.uint32
+        return cls(num_proteins, {
+            'segments': np.array(segments, dtype=str),
+            'segment_starts': np.array(segment_starts, dtype=np.int32),
+            'labels': np.array(labels, dtype=str),
+            'consensus': np.array(consensus, dtype='U1'),
+            'forced_consensus': np.array(forced_consensus, dtype='U1'),
+            'frequencies': np.array(frequencies, dtype=np.uint8),
+            'aa_counts': aa_counts.astype(count_dtype),
+            'feature_counts': aa_counts.dot(FEATURE_MATRIX).astype(count_dtype),
+        })
+
+    def to_bytes(self):
+        layout, chunks, offset = {}, [], 0
+        for name in self.ARRAYS:
+            array = np.ascontiguousarray(getattr(self, name))
+            layout[name] = [array.dtype.str, list(array.shape), offset]
+            padding = -array.nbytes % ARRAY_ALIGNMENT
+            chunks.append(array.tobytes() + b'\0' * padding)
+            offset += array.nbytes + padding
+        header = json.dumps({
+            'version': CONSENSUS_SCHEMA_VERSION,
+            'num_proteins': self.num_proteins,
+            'alphabet': ALPHABET,
+            'features': FEATURES,
+            'arrays': layout,
+        }).encode()
+        header += b' ' * (-(len(MAGIC) + HEADER_SIZE.size + len(header)) % ARRAY_ALIGNMENT)
+        return b''.join([MAGIC, HEADER_SIZE.pack(len(header)), header] + chunks)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Statistics stored with to_bytes, raises ValueError for other data or another schema version"""
+        view = memoryview(data)
+        start = len(MAGIC) + HEADER_SIZE.size
+        if len(view) < start or bytes(view[:len(MAGIC)]) != MAGIC:
+            raise ValueError('Not a consensus statistics blob')
+        (header_size,) = HEADER_SIZE.unpack_from(view, len(MAGIC))
+        header = json.loads(bytes(view[start:start + header_size]).decode())
+        if header['version'] != CONSENSUS_SCHEMA_VERSION:
+            raise ValueError('Consensus statistics of schema version {}, expected {}'.format(
+                header['version'], CONSENSUS_SCHEMA_VERSION))
+        if header['alphabet'] != ALPHABET or header['features'] != FEATURES:
+            raise ValueError('Consensus statistics stored with another alphabet or features')
+        return cls(header['num_proteins'], data=view[start + header_size:], layout=header['arrays'])
+
+    def segment_positions(self):
+        """(segment, positions slice) in order"""
+        starts = self.segment_starts.tolist()
+        return [(segment, slice(starts[i], starts[i + 1])) for i, segment in enumerate(self.segments.tolist())]
+
+    def conserved_positions(self, min_interval=6):
+        """Consensus residue and conservation interval of the positions with at least min_interval (6 is 60%), as
+        {label: [aa, interval]}"""
+        positions = {}
+        for label, aa, frequency in zip(self.labels.tolist(), self.consensus.tolist(), self.frequencies.tolist()):
+            interval = frequency_interval(str(frequency))
+            if int(interval) >= min_interval:
+                positions[label] = [aa, interval]
+        return positions
+
+    def gn_conservation(self):
+        """Consensus residue, conservation interval and the amino acid counts and fractions of every generic number
+        position, as {generic number: [aa, interval, {aa: (count, fraction)}]}"""
+        conservation = {}
+        labels = self.labels.tolist()
+        consensus = self.consensus.tolist()
+        frequencies = self.frequencies.tolist()
+        aa_counts = self.aa_counts
+        for i, label in enumerate(labels):
+            # only positions with generic numbers, e.g. 1x50
+            if 'x' not in label:
+                continue
+            counts = dict([(ALPHABET[j], (num, round(num / self.num_proteins, 3))) for j, num in
+                           zip(np.flatnonzero(aa_counts[i]).tolist(), aa_counts[i][aa_counts[i] > 0].tolist())])
+            conservation[label] = [consensus[i], frequency_interval(str(frequencies[i])), counts]
+        return conservation
+
+    def forced_consensus_sequence(self):
+        """Forced consensus as {segment: {label: aa}}, as Alignment.forced_consensus"""
+        forced_consensus = self.forced_consensus.tolist()
+        labels = self.labels.tolist()
+        return OrderedDict([(segment, OrderedDict(zip(labels[positions], forced_consensus[positions])))
+                            for segment, positions in self.segment_positions()])
@@ -12,6 +12,7 @@ except:
 
 from alignment.functions import get_proteins_from_selection
 from common import definitions
+from common.instrumentation import timed_section
 from common.selection import Selection
 from common.views import AbsTargetSelection, AbsTargetSelectionTable
 from common.views import AbsSegmentSelection
@@ -292,8 +293,9 @@ def render_alignment(request):
         num_of_sequences = len(a.proteins)
         num_residue_columns = len(a.positions) + len(a.segments)
 
-        return_html = render(request, 'alignment/alignment.html', {'a': a, 'num_of_sequences': num_of_sequences,
-            'num_residue_columns': num_residue_columns})
+        with timed_section('rendering'):
+            return_html = render(request, 'alignment/alignment.html', {'a': a, 'num_of_sequences': num_of_sequences,
+                'num_residue_columns': num_residue_columns})
 
     cache_alignment.set(key, return_html, 60*60*24*7) #set alignment cache one week
 
@@ -361,8 +363,9 @@ def render_family_alignment(request, slug):
         num_of_sequences = len(a.proteins)
         num_residue_columns = len(a.positions) + len(a.segments)
 
-        return_html = render(request, 'alignment/alignment.html', {'a': a, 'num_of_sequences': num_of_sequences,
-        'num_residue_columns': num_residue_columns})
+        with timed_section('rendering'):
+            return_html = render(request, 'alignment/alignment.html', {'a': a, 'num_of_sequences': num_of_sequences,
+            'num_residue_columns': num_residue_columns})
 
     #update it if used
     cache_alignment.set(key,return_html, 60*60*24*7) #set alignment cache one week
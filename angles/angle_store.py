@@ -0,0 +1,151 @@
+"""
+Columnar per-structure residue angle store.
+
+The ResidueAngle values of a structure that are used for group statistics are stored as one structured array (one
+record per residue: generic number label and one float column per value, NaN for missing values) in a .npy file in
+the build cache. Tables are written by build_structure_angles and filled from the database for structures that are
+not in the store yet. Statistics of structure groups (min, max, mean and dispersion per generic number, circular for
+the angle columns) are calculated for all columns at once with NumPy.
+"""
+from django.conf import settings
+
+import os
+import numpy as np
+
+ANGLE_COLUMNS = ['a_angle', 'b_angle', 'outer_angle', 'hse', 'sasa', 'rsa', 'phi', 'psi', 'theta', 'tau', 'core_distance']
+
+# columns that are averaged with circular statistics (degrees)
+CIRCULAR_COLUMNS = ['a_angle', 'b_angle', 'outer_angle', 'phi', 'psi', 'theta', 'tau']
+
+ANGLE_DTYPE = np.dtype([('label', 'U12')] + [(column, np.float64) for column in ANGLE_COLUMNS])
+
+
+def angle_store_dir():
+    return os.sep.join([settings.BUILD_CACHE_DIR, 'residue_angles'])
+
+def angle_table_path(structure_id):
+    return os.sep.join([angle_store_dir(), '{}.npy'.format(structure_id)])
+
+def angle_rows_to_table(rows):
+    """Table from (generic number label, value columns...) rows, None values are stored as NaN"""
+    table = np.zeros(len(rows), dtype=ANGLE_DTYPE)
+    for i, row in enumerate(rows):
+        table[i] = tuple([row[0] or '']) + tuple(np.nan if value is None else value for value in row[1:])
+    return table
+
+def query_angle_tables(structure_ids):
+    """Angle tables of the given structures from the database"""
+    from angles.models import ResidueAngle
+
+    rows = {structure_id: [] for structure_id in structure_ids}
+    for row in ResidueAngle.objects.filter(structure_id__in=structure_ids) \
+            .values_list('structure_id', 'residue__generic_number__label', *ANGLE_COLUMNS):
+        rows[row[0]].append(row[1:])
+    return dict([(structure_id, angle_rows_to_table(rows[structure_id])) for structure_id in structure_ids])
+
+def save_angle_table(structure_id, table=None):
+    """Store the angle table of a structure (atomically replacing an older version), read from the database if no
+    table is given"""
+    if table is None:
+        table = query_angle_tables([structure_id])[structure_id]
+    os.makedirs(angle_store_dir(), exist_ok=True)
+    path = angle_table_path(structure_id)
+    tmp_path = '{}.{}.tmp.npy'.format(path, os.getpid())
+    np.save(tmp_path, table)
+    os.replace(tmp_path, path)
+
+def load_angle_tables(structure_ids):
+    """Angle tables of the given structures, the tables of structures that are not in the store yet are read from
+    the database (with a single query) and stored"""
+    tables = {}
+    missing = []
+    for structure_id in structure_ids:
+        path = angle_table_path(structure_id)
+        if os.path.isfile(path):
+            tables[structure_id] = np.load(path)
+        else:
+            missing.append(structure_id)
+    if missing:
+        for structure_id, table in query_angle_tables(missing).items():
+            tables[structure_id] = table
+            try:
+                save_angle_table(structure_id, table)
+            except OSError:
+                # the store is an optimization only
+                pass
+    return [tables[structure_id] for structure_id in structure_ids]
+
+def delete_angle_tables():
+    directory = angle_store_dir()
+    if os.path.isdir(directory):
+        for filename in os.listdir(directory):
+            if filename.endswith('.npy'):
+                os.remove(os.sep.join([directory, filename]))
+
+
+class AngleStatistics:
+    """Statistics per generic number of all value columns for a group of structures
+
+    For every column the arrays min, max, mean, dispersion and count are indexed like labels. Circular columns have
+    a circular mean and the circular dispersion (1 - mean resultant length), the other columns the arithmetic mean
+    and standard deviation. Statistics of generic numbers without values are NaN.
+    """
+
+    def __init__(self, tables):
+        records = np.concatenate(tables) if tables else np.zeros(0, dtype=ANGLE_DTYPE)
+        self.labels, index = np.unique(records['label'], return_inverse=True)
+        n = len(self.labels)
+        self.min = {}
+        self.max = {}
+        self.mean = {}
+        self.dispersion = {}
+        self.count = {}
+        for column in ANGLE_COLUMNS:
+            values = records[column]
+            valid = ~np.isnan(values)
+            values = values[valid]
+            column_index = index[valid]
+            count = np.bincount(column_index, minlength=n)
+
+            minimum = np.full(n, np.inf)
+            np.minimum.at(minimum, column_index, values)
+            maximum = np.full(n, -np.inf)
+            np.maximum.at(maximum, column_index, values)
+
+            total = np.bincount(column_index, weights=values, minlength=n)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                if column in CIRCULAR_COLUMNS:
+                    radians = np.radians(values)
+                    sines = np.bincount(column_index, weights=np.sin(radians), minlength=n)
+                    cosines = np.bincount(column_index, weights=np.cos(radians), minlength=n)
+                    # a single angle is kept as it is
+                    mean = np.where(count == 1, total, np.degrees(np.arctan2(sines, cosines)))
+                    dispersion = 1 - np.sqrt(sines**2 + cosines**2) / count
+                else:
+                    mean = total / count
+                    squares = np.bincount(column_index, weights=values**2, minlength=n)
+                    dispersion = np.sqrt(np.maximum(squares / count - mean**2, 0))
+
+            empty = count == 0
+            minimum[empty] = maximum[empty] = mean[empty] = dispersion[empty] = np.nan
+            self.min[column] = minimum
+            self.max[column] = maximum
+            self.mean[column] = mean
+            self.dispersion[column] = dispersion
+            self.count[column] = count
+
+    @classmethod
+    def load(cls, structure_ids):
+        return cls(load_angle_tables(structure_ids))
+
+    def difference(self, other):
+        """Differences of the means (self - other) for the generic numbers in both groups, angle differences are
+        wrapped to [-180, 180)"""
+        labels, own_index, other_index = np.intersect1d(self.labels, other.labels, return_indices=True)
+        differences = {}
+        for column in ANGLE_COLUMNS:
+            difference = self.mean[column][own_index] - other.mean[column][other_index]
+            if column in CIRCULAR_COLUMNS:
+                difference = (difference + 180) % 360 - 180
+            differences[column] = difference
+        return labels, differences
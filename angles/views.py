@@ -1,7 +1,6 @@
 from django.conf import settings
-from django.contrib.postgres.aggregates import ArrayAgg
 from django.shortcuts import render
-from django.db.models import Count, Avg, Min, Max, Q
+from django.db.models import Count, Q
 from django.http import HttpResponse, JsonResponse, HttpResponseRedirect
 from django.views.decorators.cache import cache_page
 from django.views.generic import TemplateView, View
@@ -10,12 +9,11 @@ import contactnetwork.pdb as pdb
 from structure.models import Structure
 from residue.models import Residue
 from angles.models import ResidueAngle as Angle
+from angles.angle_store import AngleStatistics, ANGLE_COLUMNS, CIRCULAR_COLUMNS
 
 import Bio.PDB
 import copy
 import io
-import math
-import cmath
 from collections import OrderedDict
 import numpy as np
 # from sklearn.decomposition import PCA
@@ -45,9 +43,6 @@ def structureCheck(request):
 def get_angles(request):
     data = {'error': 0}
 
-    # angle names for custom averaging
-    angles = ['avg_aangle', 'avg_bangle', 'avg_outer', 'avg_phi', 'avg_psi', 'avg_theta', 'avg_tau']
-
     # Request selection
     try:
     #if True:
@@ -74,47 +69,8 @@ def get_angles(request):
                     data['data'].append(["-",q.residue.sequence_number, q.a_angle, q.b_angle, q.outer_angle, q.hse, q.sasa, q.rsa, q.phi, q.psi, q.theta, q.tau, q.core_distance, q.ss_dssp, q.ss_stride ])
             data['headers'] = [{"title" : "Value"}]
         else: # always a grouping or a comparison
-            query = Angle.objects.filter(structure__pdb_code__index__in=pdbs).prefetch_related("residue__generic_number") \
-                    .values("residue__generic_number__label") \
-                    .order_by('residue__generic_number__label') \
-                    .annotate(min_aangle = Min('a_angle'), avg_aangle=ArrayAgg('a_angle'), max_aangle = Max('a_angle'), \
-                        min_bangle = Min('b_angle'), avg_bangle=ArrayAgg('b_angle'), max_bangle = Max('b_angle'), \
-                        min_outer = Min('outer_angle'), avg_outer=ArrayAgg('outer_angle'), max_outer = Max('outer_angle'), \
-                        min_hse = Min('hse'), avg_hse=Avg('hse'), max_hse = Max('hse'), \
-                        min_sasa = Min('sasa'), avg_sasa=Avg('sasa'), max_sasa = Max('sasa'), \
-                        min_rsa = Min('rsa'), avg_rsa=Avg('rsa'), max_rsa = Max('rsa'), \
-                        min_phi = Min('phi'), avg_phi=ArrayAgg('phi'), max_phi = Max('phi'), \
-                        min_psi = Min('psi'), avg_psi=ArrayAgg('psi'), max_psi = Max('psi'), \
-                        min_theta = Min('theta'), avg_theta=ArrayAgg('theta'), max_theta = Max('theta'), \
-                        min_tau = Min('tau'), avg_tau=ArrayAgg('tau'), max_tau = Max('tau'), \
-                        min_distance = Min('core_distance'), avg_distance=Avg('core_distance'), max_distance = Max('core_distance'))
-
-            # Process angle aggregates to angle averages
-            for q in query:
-                for angle in angles:
-                    q[angle] = [ qa for qa in q[angle] if qa != None]
-                    if angle in q and len(q[angle]) > 1:
-                        # Sensible average for multiple angles (circular statistics: https://rosettacode.org/wiki/Averages/Mean_angle)
-                        q[angle] = math.degrees(cmath.phase(sum(cmath.rect(1, math.radians(float(d))) for d in q[angle])/len(q[angle])))
-                    elif len(q[angle]) == 1:
-                        q[angle] = q[angle][0]
+            data['data'] = group_angle_statistics(pdbs)
 
-            # Prep data
-            data['data'] = [ [q["residue__generic_number__label"], " ", \
-                            [q["min_aangle"], q["avg_aangle"], q["max_aangle"]], \
-                            [q["min_bangle"], q["avg_bangle"], q["max_bangle"]], \
-                            [q["min_outer"], q["avg_outer"], q["max_outer"]], \
-                            [q["min_hse"], q["avg_hse"], q["max_hse"]], \
-                            [q["min_sasa"], q["avg_sasa"], q["max_sasa"]], \
-                            [q["min_rsa"], q["avg_rsa"], q["max_rsa"]], \
-                            [q["min_phi"], q["avg_phi"], q["max_phi"]], \
-                            [q["min_psi"], q["avg_psi"], q["max_psi"]], \
-                            [q["min_theta"], q["avg_theta"], q["max_theta"]], \
-                            [q["min_tau"], q["avg_tau"], q["max_tau"]], \
-                            [q["min_distance"], q["avg_distance"], q["max_distance"]], \
-                            ] for q in query]
-
-            print(data)
             if len(pdbs2)==0:
                 data['headers'] = [{"title" : "Group<br/>Min"},{"title" : "Group<br/>Avg"},{"title" : "Group<br/>Max"}]
             else:
@@ -140,46 +96,7 @@ def get_angles(request):
 
             data['headers2'] = [{"title" : "Class<br/>Min"},{"title" : "Class<br/>Avg"},{"title" : "Class<br/>Max"}]
 
-        query = Angle.objects.filter(structure__pdb_code__index__in=pdbs2).prefetch_related("residue__generic_number") \
-                .values("residue__generic_number__label") \
-                .annotate(min_aangle = Min('a_angle'), avg_aangle=ArrayAgg('a_angle'), max_aangle = Max('a_angle'), \
-                    min_bangle = Min('b_angle'), avg_bangle=ArrayAgg('b_angle'), max_bangle = Max('b_angle'), \
-                    min_outer = Min('outer_angle'), avg_outer=ArrayAgg('outer_angle'), max_outer = Max('outer_angle'), \
-                    min_hse = Min('hse'), avg_hse=Avg('hse'), max_hse = Max('hse'), \
-                    min_sasa = Min('sasa'), avg_sasa=Avg('sasa'), max_sasa = Max('sasa'), \
-                    min_rsa = Min('rsa'), avg_rsa=Avg('rsa'), max_rsa = Max('rsa'), \
-                    min_phi = Min('phi'), avg_phi=ArrayAgg('phi'), max_phi = Max('phi'), \
-                    min_psi = Min('psi'), avg_psi=ArrayAgg('psi'), max_psi = Max('psi'), \
-                    min_theta = Min('theta'), avg_theta=ArrayAgg('theta'), max_theta = Max('theta'), \
-                    min_tau = Min('tau'), avg_tau=ArrayAgg('tau'), max_tau = Max('tau'), \
-                    min_distance = Min('core_distance'), avg_distance=Avg('core_distance'), max_distance = Max('core_distance'))
-
-        # Process angle aggregates to angle averages
-        for q in query:
-            for angle in angles:
-                q[angle] = [ q for q in q[angle] if q != None]
-                if angle in q and len(q[angle]) > 1:
-                    # Sensible average for multiple angles (circular statistics: https://rosettacode.org/wiki/Averages/Mean_angle)
-                    q[angle] = math.degrees(cmath.phase(sum(cmath.rect(1, math.radians(float(d))) for d in q[angle])/len(q[angle])))
-                elif len(q[angle]) == 1:
-                    q[angle] = q[angle][0]
-
-        # Prep data
-        data['data2'] = { q["residue__generic_number__label"]: [q["residue__generic_number__label"], " ", \
-                        [q["min_aangle"], q["avg_aangle"], q["max_aangle"]], \
-                        [q["min_bangle"], q["avg_bangle"], q["max_bangle"]], \
-                        [q["min_outer"], q["avg_outer"], q["max_outer"]], \
-                        [q["min_hse"], q["avg_hse"], q["max_hse"]], \
-                        [q["min_sasa"], q["avg_sasa"], q["max_sasa"]], \
-                        [q["min_rsa"], q["avg_rsa"], q["max_rsa"]], \
-                        [q["min_phi"], q["avg_phi"], q["max_phi"]], \
-                        [q["min_psi"], q["avg_psi"], q["max_psi"]], \
-                        [q["min_theta"], q["avg_theta"], q["max_theta"]], \
-                        [q["min_tau"], q["avg_tau"], q["max_tau"]], \
-                        [q["min_distance"], q["avg_distance"], q["max_distance"]], \
-                        ] for q in query}
-
-
+        data['data2'] = { row[0]: row for row in group_angle_statistics(pdbs2) }
 
     except IndexError:
     #else:
@@ -188,6 +105,25 @@ def get_angles(request):
 
     return JsonResponse(data)
 
+def group_angle_statistics(pdbs):
+    """Min, average and max of the angle values per generic number for a group of structures"""
+    structure_ids = list(Structure.objects.filter(pdb_code__index__in=pdbs).values_list('pk', flat=True))
+    statistics = AngleStatistics.load(structure_ids)
+
+    rows = []
+    for i, label in enumerate(statistics.labels.tolist()):
+        row = [label if label else None, " "]
+        for column in ANGLE_COLUMNS:
+            if statistics.count[column][i] == 0:
+                row.append([None, [] if column in CIRCULAR_COLUMNS else None, None])
+            else:
+                row.append([float(statistics.min[column][i]), float(statistics.mean[column][i]), float(statistics.max[column][i])])
+        rows.append(row)
+
+    # residues without a generic number last
+    rows.sort(key=lambda row: row[0] is None)
+    return rows
+
 def ServePDB(request, pdbname):
     # query = Angle.objects.filter(residue__protein_segment__slug__in=['TM1','TM2','TM3','TM4','TM5','TM6','TM7','H8']).prefetch_related("residue__generic_number") \
     #         .aggregate(total=Count('ss_stride'), \
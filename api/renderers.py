@@ -1,4 +1,7 @@
 from rest_framework import renderers
+from rest_framework.utils.encoders import JSONEncoder
+
+import json
 
 class PDBRenderer(renderers.BaseRenderer):
     media_type = 'chemical/x-pdb'
@@ -7,4 +10,19 @@ class PDBRenderer(renderers.BaseRenderer):
     filename = 'output.pdb'
 
     def render(self, data, media_type=None, renderer_context=None):
-        return data
\ No newline at end of file
+        return data
+
+class NDJSONRenderer(renderers.BaseRenderer):
+    """Newline delimited JSON, one line per item of a list"""
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+
+    def render(self, data, media_type=None, renderer_context=None):
+        return ''.join(self.stream(data)).encode(self.charset)
+
+    def stream(self, data):
+        if isinstance(data, dict):
+            data = [data]
+        for item in data:
+            yield json.dumps(item, cls=JSONEncoder, ensure_ascii=False) + '\n'
@@ -3,11 +3,19 @@ from rest_framework import views, generics, viewsets
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser, FileUploadParser
 from rest_framework.renderers import JSONRenderer
-from django.template.loader import render_to_string
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.settings import api_settings
 from django.db.models import Q
 from django.conf import settings
-
-from interaction.models import ResidueFragmentInteraction
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.core.cache import cache
+from django.core.cache import caches
+try:
+    cache_alignment = caches['alignments']
+except:
+    cache_alignment = cache
+
+from interaction.models import ResidueFragmentInteraction, StructureLigandInteraction
 from mutation.models import MutationRaw
 from protein.models import Protein, ProteinConformation, ProteinFamily, Species, ProteinSegment
 from residue.models import Residue, ResidueGenericNumber, ResidueNumberingScheme, ResidueGenericNumberEquivalent
@@ -18,15 +26,18 @@ from api.serializers import (ProteinSerializer, ProteinFamilySerializer, Species
                              ResidueExtendedSerializer, StructureSerializer,
                              StructureLigandInteractionSerializer,
                              MutationSerializer)
-from api.renderers import PDBRenderer
+from api.renderers import PDBRenderer, NDJSONRenderer
 from common.alignment import Alignment
+from common.cache_warming import build_version
 from common.definitions import *
 from drugs.models import Drugs
 
+import hashlib
 import json, os
 from io import StringIO
 from Bio.PDB import PDBIO, parse_pdb_header
 from collections import OrderedDict
+from string import Template
 
 # FIXME add
 # getMutations
@@ -207,12 +218,63 @@ class NumberPDBStructureView(views.APIView):
     pass
 
 
+# fields of the structure listing and the values() lookups they are built from
+STRUCTURE_FIELDS = OrderedDict([
+    ('pdb_code', 'pdb_code__index'),
+    ('protein', 'protein_conformation__protein__parent__entry_name'),
+    ('family', 'protein_conformation__protein__parent__family__slug'),
+    ('species', 'protein_conformation__protein__parent__species__latin_name'),
+    ('preferred_chain', 'preferred_chain'),
+    ('resolution', 'resolution'),
+    ('publication_date', 'publication_date'),
+    ('type', 'structure_type__name'),
+    ('state', 'state__name'),
+    ('distance', 'distance'),
+])
+
+def structure_rows(structures):
+    """Listing data of a structure queryset, built with one query for the structures and one for their ligands"""
+    rows = OrderedDict()
+    for values in structures.order_by('id').values('id', 'publication__web_link__index',
+            'publication__web_link__web_resource__url', *STRUCTURE_FIELDS.values()):
+        structure_data = OrderedDict([(field, values[lookup]) for field, lookup in STRUCTURE_FIELDS.items()])
+
+        # publication
+        if values['publication__web_link__index'] is not None:
+            structure_data['publication'] = Template(values['publication__web_link__web_resource__url']).substitute(
+                index=values['publication__web_link__index'])
+        else:
+            structure_data['publication'] = None
+        structure_data['ligands'] = []
+        rows[values['id']] = structure_data
+
+    # ligand
+    interactions = StructureLigandInteraction.objects.filter(structure_id__in=structures.values('id'), annotated=True) \
+        .order_by('id').values_list('structure_id', 'ligand__name', 'ligand__properities__ligand_type__name', 'ligand_role__name')
+    for structure_id, name, ligand_type, function in interactions:
+        ligand = {}
+        if name:
+            ligand['name'] = name
+        if ligand_type:
+            ligand['type'] = ligand_type
+        if function:
+            ligand['function'] = function
+        if ligand and structure_id in rows:
+            rows[structure_id]['ligands'].append(ligand)
+    return list(rows.values())
+
+
 class StructureList(views.APIView):
     """
     Get a list of structures
     \n/structure/
+    \nOptional query parameters: fields (comma separated list of the fields to include, e.g. pdb_code,resolution,ligands),
+    limit and offset (pagination). The list can be streamed as newline delimited JSON with format=ndjson.
     """
 
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [NDJSONRenderer]
+    cache_timeout = 60*60*24*30
+
     def get(self, request, pdb_code=None, entry_name=None, representative=None):
         if pdb_code:
             structures = Structure.objects.filter(pdb_code__index=pdb_code)
@@ -226,53 +288,27 @@ class StructureList(views.APIView):
         else:
             structures = Structure.objects.all()
 
-        structures = structures.prefetch_related('protein_conformation__protein__parent__species', 'pdb_code',
-            'protein_conformation__protein__parent__family', 'protein_conformation__protein__parent__species',
-            'publication__web_link', 'structureligandinteraction_set__ligand__properities', 'structure_type',
-            'structureligandinteraction_set__ligand__properities__ligand_type',
-            'structureligandinteraction_set__ligand_role')
-
-        # structures = self.get_structures(pdb_code, entry_name, representative)
-
-        # convert objects to a list of dictionaries
-        # normal serializers can not be used because of abstraction of tables (e.g. protein_conformation)
-        s = []
-        for structure in structures:
-            # essential fields
-            structure_data = {
-                'pdb_code': structure.pdb_code.index,
-                'protein': structure.protein_conformation.protein.parent.entry_name,
-                'family': structure.protein_conformation.protein.parent.family.slug,
-                'species': structure.protein_conformation.protein.parent.species.latin_name,
-                'preferred_chain': structure.preferred_chain,
-                'resolution': structure.resolution,
-                'publication_date': structure.publication_date,
-                'type': structure.structure_type.name,
-                'state': structure.state.name,
-                'distance': structure.distance,
-            }
-
-            # publication
-            if structure.publication:
-                structure_data['publication'] = structure.publication.web_link.__str__()
-            else:
-                structure_data['publication'] = None
-
-            # ligand
-            ligands = []
-            for interaction in structure.structureligandinteraction_set.filter(annotated=True):
-                ligand = {}
-                if interaction.ligand.name:
-                    ligand['name'] = interaction.ligand.name
-                if interaction.ligand.properities.ligand_type and interaction.ligand.properities.ligand_type.name:
-                    ligand['type'] = interaction.ligand.properities.ligand_type.name
-                if interaction.ligand_role and interaction.ligand_role.name:
-                    ligand['function'] = interaction.ligand_role.name
-                if ligand:
-                    ligands.append(ligand)
-            structure_data['ligands'] = ligands
-
-            s.append(structure_data)
+        # the listing data is cached per build
+        cache_key = 'api_structures_' + hashlib.md5('{}:{}:{}:{}'.format(build_version(), pdb_code, entry_name,
+            representative).encode('utf-8')).hexdigest()
+        s = cache.get(cache_key)
+        if s is None:
+            s = structure_rows(structures)
+            cache.set(cache_key, s, self.cache_timeout)
+
+        # field selection
+        fields = request.query_params.get('fields')
+        if fields:
+            fields = fields.split(',')
+            s = [OrderedDict([(field, row[field]) for field in fields if field in row]) for row in s]
+
+        if request.accepted_renderer.format == 'ndjson':
+            return StreamingHttpResponse(request.accepted_renderer.stream(s), content_type=NDJSONRenderer.media_type)
+
+        paginator = LimitOffsetPagination()
+        page = paginator.paginate_queryset(s, request, view=self)
+        if page is not None:
+            return paginator.get_paginated_response(page)
 
         # if a structure is selected, return a single dict rather then a list of dicts
         if len(s) == 1:
@@ -315,14 +351,97 @@ class StructureDetail(StructureList):
         return Structure.objects.filter(pdb_code__index=pdb_code)
 
 
-class FamilyAlignment(views.APIView):
+def alignment_sequence(protein):
+    """Aligned sequence of a protein conformation of an alignment, gaps are written as -"""
+    return ''.join([p[2] for segment in protein.alignment.values() for p in segment]).replace('_', '-')
+
+def alignment_rows(a):
+    """(entry name, aligned sequence) of the proteins of an alignment, proteins without residues are left out"""
+    rows = OrderedDict()
+    for protein in a.proteins:
+        rows[protein.protein.entry_name] = protein
+    for entry_name, protein in rows.items():
+        sequence = alignment_sequence(protein)
+        if sequence:
+            yield entry_name, sequence
+
+def alignment_statistics(a):
+    """Feature and amino acid frequencies of all positions of an alignment"""
+    feat = {}
+    for i, feature in enumerate(AMINO_ACID_GROUPS):
+        feature_stats = a.feature_stats[i]
+        feature_stats_clean = []
+        for d in feature_stats:
+            sub_list = [x[0] for x in d]
+            feature_stats_clean.append(sub_list) # remove feature frequencies
+        feat[feature] = [item for sublist in feature_stats_clean for item in sublist]
+
+    for i, AA in enumerate(AMINO_ACIDS):
+        feature_stats = a.amino_acid_stats[i]
+        feature_stats_clean = []
+        for d in feature_stats:
+            sub_list = [x[0] for x in d]
+            feature_stats_clean.append(sub_list) # remove feature frequencies
+        feat[AA] = [item for sublist in feature_stats_clean for item in sublist]
+    return feat
+
+
+class AlignmentView(views.APIView):
+    """
+    Base class of the alignment endpoints. Subclasses implement get_alignment_items, which builds the alignment and
+    returns an iterator over the (key, value) pairs of the output. JSON responses are serialized row by row while
+    they are streamed, the serialized payload is cached per request path and build version, which is also used as
+    ETag for conditional requests.
+    """
+
+    cache_timeout = 60*60*24*30
+
+    def get(self, request, *args, **kwargs):
+        digest = hashlib.md5('{}:{}'.format(build_version(), request.path).encode('utf-8')).hexdigest()
+        etag = '"{}"'.format(digest)
+        if etag in [tag.strip() for tag in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+
+        cache_key = 'api_alignment_' + digest
+        if request.accepted_renderer.format != 'json':
+            response = Response(OrderedDict(self.get_alignment_items(*args, **kwargs)))
+        else:
+            payload = cache_alignment.get(cache_key)
+            if payload is not None:
+                response = HttpResponse(payload, content_type='application/json')
+            else:
+                items = self.get_alignment_items(*args, **kwargs)
+                response = StreamingHttpResponse(self.stream_json(items, cache_key), content_type='application/json')
+        response['ETag'] = etag
+        return response
+
+    def get_alignment_items(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def stream_json(self, items, cache_key):
+        """Serialize the items as a JSON object, the complete payload is cached when the stream has finished"""
+        chunks = []
+        separator = '{'
+        for key, value in items:
+            chunk = separator + json.dumps(key, ensure_ascii=False) + ':' + json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+            chunks.append(chunk)
+            yield chunk
+            separator = ','
+        chunks.append('}' if chunks else '{}')
+        yield chunks[-1]
+        cache_alignment.set(cache_key, ''.join(chunks), self.cache_timeout)
+
+
+class FamilyAlignment(AlignmentView):
     """
     Get a full sequence alignment of a protein family including a consensus sequence
     \n/alignment/family/{slug}/
     \n{slug} is a protein family identifier, e.g. 001_001_001
     """
 
-    def get(self, request, slug=None, segments=None, latin_name=None, statistics=False):
+    def get_alignment_items(self, slug=None, segments=None, latin_name=None, statistics=False):
         if slug is not None:
             # Check for specific species
             if latin_name is not None:
@@ -384,50 +503,15 @@ class FamilyAlignment(views.APIView):
 
             a.calculate_statistics()
 
-            residue_list = []
-            for aa in a.full_consensus:
-                residue_list.append(aa.amino_acid)
-
-            # render the fasta template as string
-            response = render_to_string('alignment/alignment_fasta.html', {'a': a}).split("\n")
+            return self.family_items(a, statistics)
 
-            # convert the list to a dict
-            ali_dict = OrderedDict({})
-            protein = "reference"
-            for row in response:
-                if row.strip() != "":
-                    if row.startswith(">"):
-                        protein = row[1:]
-                    else:
-                        ali_dict[protein] = row
-                        protein = False
+    def family_items(self, a, statistics):
+        yield from alignment_rows(a)
+        yield "CONSENSUS", "".join([aa.amino_acid for aa in a.full_consensus])
 
-            ali_dict["CONSENSUS"] = "".join(residue_list)
-
-            # render statistics for output
-            if statistics == True:
-                feat = {}
-                for i, feature in enumerate(AMINO_ACID_GROUPS):
-                    feature_stats = a.feature_stats[i]
-                    feature_stats_clean = []
-                    for d in feature_stats:
-                        sub_list = [x[0] for x in d]
-                        feature_stats_clean.append(sub_list) # remove feature frequencies
-                    # print(feature_stats_clean)
-                    feat[feature] = [item for sublist in feature_stats_clean for item in sublist]
-
-                for i, AA in enumerate(AMINO_ACIDS):
-                    feature_stats = a.amino_acid_stats[i]
-                    feature_stats_clean = []
-                    for d in feature_stats:
-                        sub_list = [x[0] for x in d]
-                        feature_stats_clean.append(sub_list) # remove feature frequencies
-                    # print(feature_stats_clean)
-                    feat[AA] = [item for sublist in feature_stats_clean for item in sublist]
-
-                ali_dict["statistics"] = feat
-
-            return Response(ali_dict)
+        # render statistics for output
+        if statistics == True:
+            yield "statistics", alignment_statistics(a)
 
 class FamilyAlignmentPartial(FamilyAlignment):
     """
@@ -457,7 +541,7 @@ class FamilyAlignmentPartialSpecies(FamilyAlignment):
     """
 
 
-class ProteinSimilaritySearchAlignment(views.APIView):
+class ProteinSimilaritySearchAlignment(AlignmentView):
     """
     Get a segment sequence alignment of two or more proteins ranked by similarity
     \n/alignment/similarity/{proteins}/{segments}/
@@ -467,7 +551,7 @@ class ProteinSimilaritySearchAlignment(views.APIView):
     generic GPCRdb numbers, e.g. TM2,TM3,ECL2,4x50
     """
 
-    def get(self, request, proteins=None, segments=None):
+    def get_alignment_items(self, proteins=None, segments=None):
         if proteins is not None:
             protein_list = proteins.split(",")
             # first in API should be reference
@@ -527,39 +611,30 @@ class ProteinSimilaritySearchAlignment(views.APIView):
             # calculate identity and similarity of each row compared to the reference
             a.calculate_similarity()
 
-            # render the fasta template as string
-            response = render_to_string('alignment/alignment_fasta.html', {'a': a}).split("\n")
-
-            # convert the list to a dict
-            ali_dict = {}
-            k = False
-            num = 0
-            for i, row in enumerate(response):
-                if row.startswith(">"):
-                    k = row[1:]
-                elif k:
-                    # add the query as 100 identical/similar to the beginning (like on the website)
-                    if num == 0:
-                        a.proteins[num].identity = 100
-                        a.proteins[num].similarity = 100
-                    # order dict after custom list
-                    keyorder = ["similarity","identity","AA"]
-                    ali_dict[k] = {"AA": row, "identity": int(str(a.proteins[num].identity).replace(" ","")),
-                    "similarity": int(str(a.proteins[num].similarity).replace(" ",""))}
-                    ali_dict[k] = OrderedDict(sorted(ali_dict[k].items(), key=lambda t: keyorder.index(t[0])))
-                    num+=1
-                    k = False
-            ali_dict_ordered = OrderedDict(sorted(ali_dict.items(), key=lambda x: x[1]['similarity'], reverse=True))
-            return Response(ali_dict_ordered)
-
-class ProteinAlignment(views.APIView):
+            return self.similarity_items(a)
+
+    def similarity_items(self, a):
+        rows = OrderedDict()
+        for num, protein in enumerate(a.proteins):
+            # add the query as 100 identical/similar to the beginning (like on the website)
+            if num == 0:
+                protein.identity = 100
+                protein.similarity = 100
+            rows[protein.protein.entry_name] = (int(str(protein.similarity).replace(" ","")),
+                int(str(protein.identity).replace(" ","")), protein)
+
+        # rows ordered by similarity, the aligned sequences are only created when they are serialized
+        for entry_name, (similarity, identity, protein) in sorted(rows.items(), key=lambda x: x[1][0], reverse=True):
+            yield entry_name, OrderedDict([("similarity", similarity), ("identity", identity), ("AA", alignment_sequence(protein))])
+
+class ProteinAlignment(AlignmentView):
     """
     Get a full sequence alignment of two or more proteins
     \n/alignment/protein/{proteins}/
     \n{proteins} is a comma separated list of protein identifiers, e.g. adrb2_human,5ht2a_human
     """
 
-    def get(self, request, proteins=None, segments=None, statistics=False):
+    def get_alignment_items(self, proteins=None, segments=None, statistics=False):
         if proteins is not None:
             protein_list = proteins.split(",")
             ps = Protein.objects.filter(sequence_type__slug='wt', entry_name__in=protein_list)
@@ -618,43 +693,16 @@ class ProteinAlignment(views.APIView):
             if statistics == True:
                 a.calculate_statistics()
 
-            # render the fasta template as string
-            response = render_to_string('alignment/alignment_fasta.html', {'a': a}).split("\n")
+            return self.protein_items(a, statistics)
 
-            # convert the list to a dict
-            ali_dict = {}
-            k = False
-            for row in response:
-                if row.startswith(">"):
-                    k = row[1:]
-                elif k:
-                    ali_dict[k] = row
-                    k = False
+    def protein_items(self, a, statistics):
+        rows = OrderedDict([(protein.protein.entry_name, protein) for protein in a.proteins])
+        for entry_name, protein in rows.items():
+            yield entry_name, alignment_sequence(protein)
 
-            # render statistics for output
-            if statistics == True:
-                feat = {}
-                for i, feature in enumerate(AMINO_ACID_GROUPS):
-                    feature_stats = a.feature_stats[i]
-                    feature_stats_clean = []
-                    for d in feature_stats:
-                        sub_list = [x[0] for x in d]
-                        feature_stats_clean.append(sub_list) # remove feature frequencies
-                    # print(feature_stats_clean)
-                    feat[feature] = [item for sublist in feature_stats_clean for item in sublist]
-
-                for i, AA in enumerate(AMINO_ACIDS):
-                    feature_stats = a.amino_acid_stats[i]
-                    feature_stats_clean = []
-                    for d in feature_stats:
-                        sub_list = [x[0] for x in d]
-                        feature_stats_clean.append(sub_list) # remove feature frequencies
-                    # print(feature_stats_clean)
-                    feat[AA] = [item for sublist in feature_stats_clean for item in sublist]
-
-                ali_dict["statistics"] = feat
-
-            return Response(ali_dict)
+        # render statistics for output
+        if statistics == True:
+            yield "statistics", alignment_statistics(a)
 
 class ProteinAlignmentStatistics(ProteinAlignment):
     """
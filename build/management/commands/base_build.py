@@ -4,7 +4,11 @@ from django.conf import settings
 from django.db import connection
 
 import datetime
+import json
 import logging
+import os
+import queue
+import time
 from multiprocessing import Queue, Process, Value, Lock
 
 
@@ -13,6 +17,10 @@ class Command(BaseCommand):
 
     logger = logging.getLogger(__name__)
 
+    # task queue settings (used by commands that implement process_item)
+    retries = 1 # number of times failed items are retried
+    progress_interval = 30 # seconds between progress reports
+
     def add_arguments(self, parser):
         parser.add_argument('-p', '--proc',
             type=int,
@@ -27,6 +35,10 @@ class Command(BaseCommand):
             help='Include only a subset of data for testing')
 
     def prepare_input(self, proc, items, iteration=1):
+        # commands that process one item at a time run on a shared task queue
+        if type(self).process_item is not Command.process_item:
+            return self.run_queue(proc, items, iteration)
+
         q = Queue()
         procs = list()
         num_items = len(items)
@@ -54,4 +66,132 @@ class Command(BaseCommand):
             p.start()
 
         for p in procs:
-            p.join()
\ No newline at end of file
+            p.join()
+
+    def process_item(self, item, iteration=1):
+        """Process a single item, implement this instead of main_func to run the command on the task queue"""
+        raise NotImplementedError
+
+    def queue_worker(self, items, tasks, results, iteration):
+        while True:
+            index = tasks.get()
+            if index is None:
+                break
+            start = time.time()
+            try:
+                self.process_item(items[index], iteration)
+                results.put((index, None, time.time() - start))
+            except Exception as msg:
+                results.put((index, '{}: {}'.format(type(msg).__name__, msg), time.time() - start))
+        connection.close()
+
+    def run_queue(self, proc, items, iteration=1):
+        """Process items on a shared task queue: idle workers pick up the next item, so slow items do not hold back
+        a whole chunk. Failed items are retried, and a progress/throughput report is written to the build cache."""
+        items = list(items)
+        if not items:
+            return False
+
+        self.queue_start = time.time()
+        self.queue_times = {}
+        self.queue_errors = {}
+        self.queue_attempts = dict([(index, 0) for index in range(len(items))])
+        pending = list(range(len(items)))
+        for attempt in range(self.retries + 1):
+            if not pending:
+                break
+            if attempt:
+                self.logger.info('Retrying {} failed items'.format(len(pending)))
+            pending = self.run_queue_round(proc, items, pending, iteration)
+
+        report = self.queue_report(items, proc, iteration)
+        self.logger.info('Completed {} of {} items in {}s ({} items/s), {} failed'.format(report['completed'],
+            report['items'], report['wall_time'], report['throughput'], report['failed']))
+        return report
+
+    def run_queue_round(self, proc, items, indexes, iteration):
+        """Run one pass over the given item indexes, returns the indexes of the items that failed"""
+        tasks = Queue()
+        results = Queue()
+        for index in indexes:
+            tasks.put(index)
+            self.queue_attempts[index] += 1
+        num_workers = min(proc, len(indexes))
+        for i in range(num_workers):
+            tasks.put(None)
+
+        connection.close()
+        procs = [Process(target=self.queue_worker, args=(items, tasks, results, iteration)) for i in range(num_workers)]
+        for p in procs:
+            p.start()
+
+        failed = []
+        remaining = set(indexes)
+        last_report = time.time()
+        while remaining:
+            try:
+                index, error, seconds = results.get(timeout=5)
+            except queue.Empty:
+                if not any(p.is_alive() for p in procs):
+                    # workers exited without reporting (e.g. killed), count their items as failed
+                    for index in remaining:
+                        self.queue_errors[index] = 'Worker exited before finishing the item'
+                    failed += sorted(remaining)
+                    break
+                continue
+
+            remaining.discard(index)
+            self.queue_times[index] = seconds
+            if error:
+                self.queue_errors[index] = error
+                failed.append(index)
+                self.logger.error('Failed processing {}: {}'.format(items[index], error))
+            else:
+                self.queue_errors.pop(index, None)
+
+            if time.time() - last_report > self.progress_interval or not remaining:
+                last_report = time.time()
+                done = len(self.queue_times)
+                elapsed = time.time() - self.queue_start
+                self.logger.info('Progress {}/{} items, {:.2f} items/s, {} failed'.format(done, len(items),
+                    done / elapsed if elapsed else 0, len(self.queue_errors)))
+
+        for p in procs:
+            p.join()
+        return failed
+
+    def queue_report_details(self, items):
+        """Command specific fields of the task queue report"""
+        return {}
+
+    def queue_report(self, items, proc, iteration):
+        """Machine readable report of the last task queue run, stored in the build cache as JSON"""
+        wall_time = time.time() - self.queue_start
+        times = sorted(self.queue_times.items(), key=lambda x: -x[1])
+        completed = len(items) - len(self.queue_errors)
+        report = {
+            'command': self.__module__.split('.')[-1],
+            'date': datetime.datetime.now().isoformat(),
+            'iteration': iteration,
+            'processes': proc,
+            'items': len(items),
+            'completed': completed,
+            'failed': len(self.queue_errors),
+            'retried': sum(1 for attempts in self.queue_attempts.values() if attempts > 1),
+            'wall_time': round(wall_time, 2),
+            'throughput': round(completed / wall_time, 3) if wall_time else 0,
+            'mean_item_time': round(sum(self.queue_times.values()) / len(times), 3) if times else 0,
+            'slowest_items': [[str(items[index]), round(seconds, 3)] for index, seconds in times[:10]],
+            'failures': [{'item': str(items[index]), 'error': error, 'attempts': self.queue_attempts[index]}
+                for index, error in sorted(self.queue_errors.items())],
+        }
+        report.update(self.queue_report_details(items))
+
+        report_dir = os.sep.join([settings.BUILD_CACHE_DIR, 'build_reports'])
+        try:
+            os.makedirs(report_dir, exist_ok=True)
+            with open(os.sep.join([report_dir, report['command'] + '.json']), 'w') as f:
+                json.dump(report, f, indent=2)
+        except OSError as msg:
+            self.logger.warning('Could not write build report: {}'.format(msg))
+        return report
@@ -1,6 +1,12 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.core.management import call_command
 
+from common.build_stamp import start_build
+from common.cache_warming import BUILD_DEPENDENCY, invalidate_dependency
+from common.reference_data import clear_loaded_reference_data, remove_reference_data
+from common.similarity_index import remove_similarity_index
+from residue.vectors import delete_residue_vectors
+
 import datetime
 
 
@@ -47,6 +53,7 @@ class Command(BaseCommand):
             ['build_construct_proteins'],
             ['build_structures', {'proc': options['proc']}],
             ['build_endogenous_ligands'],
+            ['build_residue_vectors', {'proc': options['proc']}],
             ['build_consensus_sequences', {'proc': options['proc']}],
             ['build_g_proteins'],
             ['build_consensus_sequences', {'proc': options['proc'], 'signprot': 'Alpha'}],
@@ -55,6 +62,7 @@ class Command(BaseCommand):
             ['build_signprot_complex'],
             ['build_g_protein_structures'],
             ['build_structure_extra_proteins'],
+            ['build_residue_vectors', {'proc': options['proc']}],
             ['build_structure_model_rmsd'],
             ['build_blast_database']
         ]
@@ -75,11 +83,15 @@ class Command(BaseCommand):
             ['build_dynamine_annotation', {'proc': options['proc']}],
             ['build_blast_database'],
             ['build_complex_interactions'],
+            ['build_contact_fingerprints', {'proc': options['proc']}],
             ['assign_structure_states'],
             ['build_mammalian_representative'],
             # ['build_homology_models', ['--update', '-z'], {'proc': options['proc'], 'test_run': options['test']}],
             ['build_text'],
             ['build_release_notes'],
+            ['build_reference_data'],
+            ['build_similarity_index', {'rebuild': True}],
+            ['warm_caches'],
         ]
 
         if options['phase']:
@@ -90,6 +102,16 @@ class Command(BaseCommand):
         else:
             commands = phase1+phase2
 
+        # the reference data snapshot of the previous build is outdated as soon as the tables are rebuilt
+        remove_reference_data()
+        # a new build starts with the first phase (the second phase continues it), data of the previous build in the
+        # build cache is no longer used
+        if options['phase'] != 2:
+            start_build()
+            # residue vectors are keyed by conformation id, which may belong to another protein in the new database
+            delete_residue_vectors()
+        remove_similarity_index()
+
         for c in commands:
             print('{} Running {}'.format(
                 datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d %H:%M:%S'), c[0]))
@@ -99,6 +121,11 @@ class Command(BaseCommand):
                 call_command(c[0], *c[1], **c[2])
             else:
                 call_command(c[0])
+            # reference tables changed by this step are read again by the next one
+            clear_loaded_reference_data()
+
+        # responses that are cached per build (e.g. API alignments) are rebuilt
+        invalidate_dependency(BUILD_DEPENDENCY)
 
         print('{} Build completed'.format(datetime.datetime.strftime(
             datetime.datetime.now(), '%Y-%m-%d %H:%M:%S')))
@@ -8,10 +8,10 @@ from residue.functions import *
 from protein.models import Protein, ProteinConformation, ProteinFamily, ProteinSegment, ProteinSequenceType
 from common.alignment import Alignment
 from alignment.models import AlignmentConsensus
+from alignment.consensus_store import ConsensusStats
 
 import os
 import yaml
-import pickle
 from collections import OrderedDict
 
 class Command(BuildHumanProteins):
@@ -133,14 +133,15 @@ class Command(BuildHumanProteins):
             a.calculate_statistics()
 
             try:
-                # Save alignment
-                AlignmentConsensus.objects.create(slug=family.slug, alignment=pickle.dumps(a))
+                # Save the consensus statistics of the alignment
+                AlignmentConsensus.objects.create(slug=family.slug,
+                    alignment=ConsensusStats.from_alignment(a).to_bytes())
 
-                # Load alignment to ensure it works
-                a = pickle.loads(AlignmentConsensus.objects.get(slug=family.slug).alignment)
-                self.logger.info('Succesfully pickled {}'.format(family))
+                # Load them to ensure it works
+                ConsensusStats.from_bytes(AlignmentConsensus.objects.get(slug=family.slug).alignment)
+                self.logger.info('Succesfully stored consensus statistics for {}'.format(family))
             except:
-                self.logger.error('Failed pickle for {}'.format(family))
+                self.logger.error('Failed to store consensus statistics for {}'.format(family))
 
             self.logger.info('Completed building alignment for {}'.format(family))
 
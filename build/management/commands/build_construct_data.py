@@ -10,6 +10,7 @@ from construct.models import (Construct,Crystallization,CrystallizationLigandCon
 CrystallizationMethods,CrystallizationTypes,ChemicalListName,ContributorInfo,ConstructMutation,ConstructInsertion,ConstructInsertionType,
 ConstructDeletion,ConstructModification,CrystalInfo,ExpressionSystem,Solubilization,PurificationStep,Purification)
 from construct.functions import add_construct, fetch_pdb_info
+from common.cache_warming import invalidate_dependency
 
 from ligand.models import Ligand, LigandType, LigandRole
 from ligand.functions import get_or_make_ligand
@@ -54,6 +55,8 @@ class Command(BaseCommand):
             self.create_construct_data(filenames)
         else:
             self.create_construct_local_data()
+        # cached products built from the constructs are rebuilt
+        invalidate_dependency('constructs')
         # except Exception as msg:
         #     print("ERROR: "+str(msg))
         #     self.logger.error(msg)
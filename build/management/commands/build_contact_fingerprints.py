@@ -0,0 +1,27 @@
+from build.management.commands.base_build import Command as BaseBuild
+from structure.models import Structure
+from contactnetwork.contact_fingerprints import save_contact_fingerprint, delete_contact_fingerprints
+
+
+class Command(BaseBuild):
+    help = 'Builds the contact fingerprints of all structures (used for contact frequencies of structure sets)'
+
+    structures = Structure.objects.order_by('id')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-p', '--proc', type=int, action='store', dest='proc', default=1, help='Number of processes to run')
+        parser.add_argument('--purge', action='store_true', dest='purge', default=False, help='Purge all contact fingerprints before building')
+
+    def handle(self, *args, **options):
+        try:
+            if options['purge']:
+                delete_contact_fingerprints()
+            self.logger.info('CREATING CONTACT FINGERPRINTS')
+            self.prepare_input(options['proc'], self.structures)
+            self.logger.info('COMPLETED CREATING CONTACT FINGERPRINTS')
+        except Exception as msg:
+            print(msg)
+            self.logger.error(msg)
+
+    def process_item(self, structure, iteration=1):
+        save_contact_fingerprint(structure)
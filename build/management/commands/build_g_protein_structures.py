@@ -11,6 +11,7 @@ from signprot.models import SignprotComplex, SignprotStructure, SignprotStructur
 from common.models import WebResource, WebLink, Publication
 from structure.models import StructureType, StructureStabilizingAgent, PdbData, Rotamer
 from structure.functions import get_pdb_ids
+from structure.parsed_structures import get_parsed_structure
 
 import re
 from Bio import pairwise2
@@ -18,8 +19,7 @@ from collections import OrderedDict
 import logging
 import shlex, subprocess
 from io import StringIO
-from Bio.PDB import PDBParser, PPBuilder, PDBIO, Polypeptide
-from Bio import pairwise2
+from Bio.PDB import PPBuilder, PDBIO, Polypeptide
 import pprint
 import json
 import yaml
@@ -99,8 +99,7 @@ class Command(BaseBuild):
                         alpha_protconf.state = ProteinState.objects.get(slug="active")
                         alpha_protconf.save()
 
-                    pdbp = PDBParser(PERMISSIVE=True, QUIET=True)
-                    s = pdbp.get_structure("struct", StringIO(sc.structure.pdb_data.pdb))
+                    s = get_parsed_structure(sc.structure.pdb_code.index, sc.structure.pdb_data, "struct")
                     chain = s[0][sc.alpha]
                     nums = []
                     for res in chain:
@@ -10,6 +10,7 @@ from structure.models import *
 from structure.functions import HSExposureCB, PdbStateIdentifier, update_template_source, StructureSeqNumOverwrite
 from common.alignment import AlignedReferenceTemplate, GProteinAlignment
 from common.definitions import *
+from common.instrumentation import timed, timed_section
 from common.models import WebLink
 from signprot.models import SignprotComplex
 import structure.structural_superposition as sp
@@ -17,12 +18,17 @@ import structure.assign_generic_numbers_gpcr as as_gn
 import structure.homology_models_tests as tests
 from structure.signprot_modeling import SignprotModeling
 from structure.homology_modeling_functions import GPCRDBParsingPDB, ImportHomologyModel, Remodeling
+from structure.homology_model_jobs import ModelJob, ModelJobTable, run_job, phase_report
+from structure.structure_array import StructureArray, residue_name, residue_views
 
 import Bio.PDB as PDB
 from modeller import *
 from modeller.automodel import *
 from collections import OrderedDict
+import gc
 import glob
+import hashlib
+import json
 import os
 import shlex
 import logging
@@ -33,11 +39,11 @@ import re
 import zipfile
 import shutil
 import math
-from copy import deepcopy
 from datetime import datetime, date
 import yaml
 import traceback
 import subprocess
+import time
 
 
 startTime = datetime.now()
@@ -65,6 +71,12 @@ warnings.filterwarnings("ignore")
 class Command(BaseBuild):
     help = 'Build automated chimeric GPCR homology models'
 
+    # failed models are not retried in the same run, the job table keeps track of them for the next run
+    retries = 0
+
+    # classes whose structures can be used as templates for a class (default: the class itself)
+    template_classes = {'003':['002','003'], '007':['001','007']}
+
     def add_arguments(self, parser):
         super(Command, self).add_arguments(parser=parser)
         parser.add_argument('--update', help='Upload model to GPCRdb, overwrites existing entry', default=False,
@@ -89,6 +101,8 @@ class Command(BaseBuild):
         parser.add_argument('--fast_refinement', help='Chose fastest refinement option in MODELLER', default=False, action='store_true')
         parser.add_argument('--keep_hetatoms', help='Keep hetero atoms from main template, this includes ligands', default=False, action='store_true')
         parser.add_argument('--skip_existing', help='Skip models with matching zip archives and only run the missing models.', default=False, action='store_true')
+        parser.add_argument('--force', help='Rebuild all models, also those that were built from the same inputs before', default=False, action='store_true')
+        parser.add_argument('--timeout', help='Maximum time (seconds) for building one model, 0 for no limit', default=7200, type=int)
 
 
     def handle(self, *args, **options):
@@ -116,6 +130,8 @@ class Command(BaseBuild):
         self.fast_refinement = options['fast_refinement']
         self.keep_hetatoms = options['keep_hetatoms']
         self.skip_existing = options['skip_existing']
+        self.job_timeout = options['timeout']
+        self.jobs = ModelJobTable()
 
         GPCR_class_codes = {'A':'001', 'B1':'002', 'B2':'003', 'C':'004', 'D1':'005', 'F':'006', 'T':'007'}
         self.modeller_iterations = options['i']
@@ -128,6 +144,7 @@ class Command(BaseBuild):
             StructureModel.objects.all().delete()
             StructureModelSeqSim.objects.all().delete()
             StructureModelStatsRotamer.objects.all().delete()
+            self.jobs.clear()
         if options['purge_zips']:
             print("Delete existing local homology model zips")
             hommod_zip_path = './structure/homology_models_zip/'
@@ -184,10 +201,16 @@ class Command(BaseBuild):
             self.receptor_list = self.receptor_list[:5]
             self.receptor_list_entry_names = self.receptor_list_entry_names[:5]
 
-        # Model building
-        print("receptors to do",len(self.receptor_list))
-        self.processors = options['proc']
-        self.prepare_input(options['proc'], self.receptor_list)
+        # Model building, skipping models that were built from the same inputs
+        self.template_fingerprints = {}
+        jobs = [ModelJob(r.entry_name, state, self.signprot, self.input_hash(r, state), self.complex) for r, state in self.receptor_list]
+        if not options['force']:
+            # uploaded models are built again if they are no longer in the database
+            jobs = self.jobs.pending(jobs, self.imported_models() if self.update else None)
+        self.skipped_jobs = len(self.receptor_list) - len(jobs)
+        print("receptors to do",len(jobs),"unchanged",self.skipped_jobs)
+        self.run_id = datetime.now().isoformat()
+        self.prepare_input(options['proc'], jobs)
 
         # Cleanup
         missing_models = []
@@ -219,38 +242,82 @@ class Command(BaseBuild):
             shutil.rmtree('homology_models')
             shutil.rmtree('PIR')
 
-    def main_func(self, positions, iteration, count, lock):
-        processor_id = round(self.processors*positions[0]/len(self.receptor_list))+1
-        i = 0
-        while count.value<len(self.receptor_list):
-            i += 1
-            with lock:
-                receptor = self.receptor_list[count.value]
-                count.value +=1
-
-            # SKIP EXISTING: if a model zip file already exists, skip it and move to the next
-            if self.skip_existing:
-                # Init temporary model object for checks regarding signaling protein complexes etc.
-                temp_model_check = HomologyModeling(receptor[0].entry_name, receptor[1], [receptor[1]], iterations=self.modeller_iterations, complex_model=self.complex, signprot=self.signprot, debug=self.debug,
-                                                  force_main_temp=self.force_main_temp, fast_refinement=self.fast_refinement, keep_hetatoms=self.keep_hetatoms)
-
-                path = './structure/complex_models_zip/' if temp_model_check.complex else './structure/homology_models_zip/'
-                # Differentiate between structure refinement and homology modeling
-                if temp_model_check.revise_xtal:
-                    filepath = "{}*{}_refined_*.zip".format(path, receptor[0].entry_name.upper())
-                else:
-                    filepath = "{}*{}_{}_*.zip".format(path, receptor[0].entry_name, receptor[1])
-
-                # Check if model zip file exists
-                if len(glob.glob(filepath)) > 0:
-                    continue
+    def input_hash(self, receptor, state):
+        """Hash of everything a model is built from: receptor sequence, available templates and build options"""
+        inputs = [receptor.entry_name, state, receptor.sequence, self.template_fingerprint(receptor), self.complex,
+                  self.signprot, self.force_main_temp, self.modeller_iterations, self.fast_refinement,
+                  self.keep_hetatoms, self.update]
+        return hashlib.md5(json.dumps(inputs, default=str).encode('utf-8')).hexdigest()
 
-            mod_startTime = datetime.now()
-            logger.info('Generating model for  \'{}\' ({})... ({} out of {}) (processor:{} count:{})'.format(receptor[0].entry_name, receptor[1],count.value, len(self.receptor_list),processor_id,i))
-            chm = CallHomologyModeling(receptor[0].entry_name, receptor[1], iterations=self.modeller_iterations, debug=self.debug,
-                                       update=self.update, complex_model=self.complex, signprot=self.signprot, force_main_temp=self.force_main_temp, keep_hetatoms=self.keep_hetatoms)
-            chm.run(fast_refinement=self.fast_refinement)
-            logger.info('Model finished for  \'{}\' ({})... (processor:{} count:{}) (Time: {})'.format(receptor[0].entry_name, receptor[1],processor_id,i,datetime.now() - mod_startTime))
+    def imported_models(self):
+        """Function telling whether the model of a job is in the database"""
+        if self.complex:
+            models = set(StructureComplexModel.objects.values_list('receptor_protein__entry_name', 'sign_protein__entry_name'))
+            receptors = set([receptor for receptor, signprot in models])
+            # without a given signaling protein it is chosen when the model is built
+            return lambda job: (job.receptor, job.signprot) in models if job.signprot else job.receptor in receptors
+        models = set(StructureModel.objects.values_list('protein__entry_name', 'state__name'))
+        return lambda job: (job.receptor, job.state) in models
+
+    def template_fingerprint(self, receptor):
+        """Hash of the structures that can be used as templates for the class of a receptor"""
+        class_slug = receptor.family.slug[:3]
+        if class_slug not in self.template_fingerprints:
+            class_filter = Q()
+            for slug in self.template_classes.get(class_slug, [class_slug]):
+                class_filter |= Q(protein_conformation__protein__parent__family__slug__startswith=slug)
+            templates = list(Structure.objects.filter(annotated=True).filter(class_filter).order_by('pdb_code__index').values_list(
+                'pdb_code__index', 'state__name', 'resolution', 'representative'))
+            if self.complex:
+                templates += list(SignprotComplex.objects.order_by('structure__pdb_code__index').values_list(
+                    'structure__pdb_code__index', 'protein__entry_name'))
+            self.template_fingerprints[class_slug] = hashlib.md5(json.dumps(templates, default=str).encode('utf-8')).hexdigest()
+        return self.template_fingerprints[class_slug]
+
+    def process_item(self, job, iteration=1):
+        """Build one model in a separate process and record the result in the job table"""
+        self.jobs.start(job, self.run_id)
+        start = time.time()
+        logger.info('Generating model for  \'{}\' ({})...'.format(job.receptor, job.state))
+        output, error, phases = run_job(self.build_model, job, self.job_timeout)
+        self.jobs.finish(job, output, error, time.time() - start, phases)
+        if error:
+            raise Exception(error)
+        logger.info('Model finished for  \'{}\' ({})... (Time: {:.0f}s)'.format(job.receptor, job.state, time.time() - start))
+
+    def build_model(self, job):
+        """Build a model, returns the path of its zip archive"""
+        # SKIP EXISTING: if a model zip file already exists, skip it and move to the next
+        if self.skip_existing:
+            # Init temporary model object for checks regarding signaling protein complexes etc.
+            temp_model_check = HomologyModeling(job.receptor, job.state, [job.state], iterations=self.modeller_iterations, complex_model=self.complex, signprot=self.signprot, debug=self.debug,
+                                              force_main_temp=self.force_main_temp, fast_refinement=self.fast_refinement, keep_hetatoms=self.keep_hetatoms)
+
+            path = './structure/complex_models_zip/' if temp_model_check.complex else './structure/homology_models_zip/'
+            # Differentiate between structure refinement and homology modeling
+            if temp_model_check.revise_xtal:
+                filepath = "{}*{}_refined_*.zip".format(path, job.receptor.upper())
+            else:
+                filepath = "{}*{}_{}_*.zip".format(path, job.receptor, job.state)
+
+            # Check if model zip file exists
+            existing = glob.glob(filepath)
+            if len(existing) > 0:
+                return existing[0]
+
+        chm = CallHomologyModeling(job.receptor, job.state, iterations=self.modeller_iterations, debug=self.debug,
+                                   update=self.update, complex_model=self.complex, signprot=self.signprot, force_main_temp=self.force_main_temp, keep_hetatoms=self.keep_hetatoms)
+        output = chm.run(fast_refinement=self.fast_refinement)
+        if output is None:
+            raise ValueError('Failed to build model {} {}, see the homology modeling log'.format(job.receptor, job.state))
+        return output
+
+    def queue_report_details(self, items):
+        """Unchanged models and the time spent per modeling phase"""
+        phases = phase_report(self.jobs.run_jobs(self.run_id))
+        for phase, times in phases.items():
+            logger.info('Phase {}: {}s total, {}s mean, {}s max'.format(phase, times['total'], times['mean'], times['max']))
+        return {'unchanged': self.skipped_jobs, 'phases': phases}
 
     def get_states_to_model(self, receptor):
         rec_class = ProteinFamily.objects.get(name=receptor.get_protein_class())
@@ -347,7 +414,8 @@ class CallHomologyModeling():
                     rm = Remodeling('./structure/homology_models/{}.pdb'.format(Homology_model.modelname), gaps=hse.remodel_resis, receptor=self.receptor, signprot=Homology_model.signprot,
                                     icl3_delete=Homology_model.icl3_delete)
                     rm.make_pirfile()
-                    rm.run()
+                    with timed_section('modeller'):
+                        rm.run()
                     logger.info('Remodeled {} {} at {}'.format(self.receptor, Homology_model.signprot, hse.remodel_resis))
                     with open('./structure/homology_models/{}.pdb'.format(Homology_model.modelname), 'r') as remodeled_pdb:
                         formatted_model = remodeled_pdb.read()
@@ -450,7 +518,8 @@ class CallHomologyModeling():
                 else:
                     new_args = shlex.split((manage_call + ' build_homology_models_zip -f {}.zip').format(Homology_model.modelname))
 
-                subprocess.call(new_args)
+                with timed_section('db_import'):
+                    subprocess.call(new_args)
 
                 # logger.info('{} ({}) homology model uploaded to db'.format(Homology_model.reference_entry_name,self.state))
                 if self.debug:
@@ -459,6 +528,8 @@ class CallHomologyModeling():
             with open('./structure/homology_models/done_models.txt','a') as f:
                 f.write(self.receptor+'\n')
 
+            return '{}{}.zip'.format(path, Homology_model.modelname)
+
         except Exception as msg:
             try:
                 exc_type, exc_obj, exc_tb = sys.exc_info()
@@ -901,6 +972,7 @@ class HomologyModeling(object):
 
         return first_line+second_line+ssbond+content[:-4]+beta_gamma+conect+'END'
 
+    @timed('alignment')
     def run_alignment(self, query_states, core_alignment=True,
                       segments=['TM1','ICL1','TM2','ECL1','TM3','ICL2','TM4','TM5','TM6','TM7','H8'],
                       order_by='similarity'):
@@ -1537,8 +1609,8 @@ class HomologyModeling(object):
                 for gn, res in segment.items():
                     try:
                         if (res==PDB.Polypeptide.three_to_one(
-                                            main_pdb_array[seg_label][gn.replace('x','.')][0].get_parent().get_resname()) and
-                                            main_pdb_array[seg_label][gn.replace('x','.')][0].get_parent().get_resname()!='YCM'):
+                                            residue_name(main_pdb_array[seg_label][gn.replace('x','.')])) and
+                                            residue_name(main_pdb_array[seg_label][gn.replace('x','.')])!='YCM'):
                             pass
                         elif 'x' in gn:
                             try:
@@ -1574,7 +1646,7 @@ class HomologyModeling(object):
                         temp_array[seg_id] = segment
                 main_pdb_array = temp_array
                 a.template_dict[seg][list(incons.keys())[0]] = PDB.Polypeptide.three_to_one(
-                            main_pdb_array[seg][list(incons.keys())[0].replace('x','.')][0].get_parent().get_resname())
+                            residue_name(main_pdb_array[seg][list(incons.keys())[0].replace('x','.')]))
                 if a.reference_dict[seg][list(incons.keys())[0]]==a.template_dict[seg][list(incons.keys())[0]]:
                     a.alignment_dict[seg][list(incons.keys())[0]] = a.reference_dict[seg][list(incons.keys())[0]]
                 else:
@@ -1583,10 +1655,10 @@ class HomologyModeling(object):
         for seg in main_pdb_array:
             for gn, atoms in main_pdb_array[seg].items():
                 try:
-                    if atoms[0].get_parent().get_resname() in ['YCM','CSD','SEP','TYS']:
-                        non_ess_res = atoms[0].get_parent().get_resname()
+                    if residue_name(atoms) in ['YCM','CSD','SEP','TYS']:
+                        non_ess_res = residue_name(atoms)
                         if self.debug:
-                            print(gn, atoms[0].get_parent().get_resname(), atoms[0].get_parent().get_id())
+                            print(gn, non_ess_res)
                         if non_ess_res=='SEP':
                             a.template_dict[seg][gn.replace('.','x')] = 'S'
                         elif non_ess_res=='TYS':
@@ -1998,6 +2070,10 @@ class HomologyModeling(object):
         else:
             post_file = path+self.reference_entry_name+'_'+self.state+"_post.pdb"
 
+        # Only the coordinates of the model are needed from here on. Releasing the Biopython atoms (and the template
+        # structures they belong to) before MODELLER runs keeps the peak memory of the worker down.
+        self.main_pdb_array = StructureArray.from_pdb_array(self.main_pdb_array)
+        gc.collect()
         trimmed_res_nums, helix_restraints, icl3_mid, disulfide_nums, complex_start, beta_start, gamma_start = self.write_homology_model_pdb(post_file,
                                                                                                                     self.main_pdb_array, self.alignment,
                                                                                                                     trimmed_residues=self.trimmed_residues,
@@ -2287,6 +2363,9 @@ class HomologyModeling(object):
             @param template_dict: template dictionary of AlignedReferenceTemplate.o2
             @param alignment_dict: alignment dictionary of AlignedReferenceTemplate.
         '''
+        # From here on the residues of the model are views into one StructureArray, which releases the Biopython atoms
+        # (and the parsed template structures they belong to). Switched rotamers are inserted as views as well.
+        main_pdb_array = StructureArray.from_pdb_array(main_pdb_array).as_pdb_array()
         atom_num_dict = {'E':9, 'S':6, 'Y':12, 'G':4, 'A':5, 'V':7, 'M':8, 'L':8, 'I':8, 'T':7, 'F':11, 'H':10, 'K':9,
                          'D':8, 'C':6, 'R':11, 'P':7, 'Q':9, 'N':8, 'W':14, '-':0}
         parse = GPCRDBParsingPDB()
@@ -2461,9 +2540,8 @@ class HomologyModeling(object):
         ######################
         for struct in similarity_table:
             try:
-                alt_temp = parse.fetch_residues_from_pdb(struct, [gn])
-                if reference_dict[ref_seg][ref_res]==PDB.Polypeptide.three_to_one(
-                                                        alt_temp[gn_][0].get_parent().get_resname()):
+                alt_temp = residue_views(parse.fetch_residues_from_pdb(struct, [gn]))
+                if reference_dict[ref_seg][ref_res]==PDB.Polypeptide.three_to_one(residue_name(alt_temp[gn_])):
                     orig_res = main_pdb_array[ref_seg][str(ref_res).replace('x','.')]
                     alt_res = alt_temp[gn_]
                     if len(alt_res)!=atom_num_dict[reference_dict[ref_seg][ref_res]]:
@@ -2522,7 +2600,7 @@ class HomologyModeling(object):
 
             @param filename: str, filename of output file \n
             @param main_pdb_array: OrderedDict(), of atoms of pdb, where keys are generic numbers/residue numbers and
-            values are list of atoms. Output of GPCRDBParsingPDB.pdb_array_creator().
+            values are list of atoms. Output of GPCRDBParsingPDB.pdb_array_creator(), or the same as StructureArray.
             @param alignment: AlignedReferenceTemplate class, alignment of reference and template.
             @trimmed_residues: list, list of generic numbers that are trimmed/to be modeled by MODELLER.
         '''
@@ -2536,13 +2614,17 @@ class HomologyModeling(object):
         icl3_mid = None
         disulfide_nums = [[0,0],[0,0]]
         complex_start, beta_start, gamma_start = None, None, None
+        if not isinstance(main_pdb_array, StructureArray):
+            main_pdb_array = StructureArray.from_pdb_array(main_pdb_array)
         with open(filename,'w+') as f:
-            for seg_id, segment in main_pdb_array.items():
+            for seg_id in main_pdb_array:
                 if seg_id!='TM1' and prev_seg!='0' and seg_id.startswith('T') and prev_seg.startswith('T'):
                     atom_num+=1
                     # f.write("\nTER{}      {} {}{}".format(str(atom_num).rjust(8),atom.get_parent().get_resname(),str(self.main_template_preferred_chain)[0],str(res_num).rjust(4)))
                 trimmed_segment = OrderedDict()
-                for key in segment:
+                for key in main_pdb_array.segment_keys(seg_id):
+                    # gap and break markers, '' for residues
+                    placeholder = main_pdb_array.placeholder(seg_id, key) or ''
                     res_num+=1
                     counter_num+=1
                     for i, d_p in enumerate(disulfide_pairs):
@@ -2575,7 +2657,7 @@ class HomologyModeling(object):
                     if seg_id=='Gamma':
                         if gamma_start==None:
                             gamma_start = counter_num
-                    if segment[key]=='/':
+                    if placeholder=='/':
                         atom_num+=1
                         icl3_mid = counter_num
                         res_num-=1
@@ -2583,52 +2665,54 @@ class HomologyModeling(object):
                         continue
                     if key in trimmed_residues:
                         trimmed_segment[key] = counter_num
-                        if 'x' in segment[key]:
+                        if 'x' in placeholder:
                             if '?' in key:
                                 atom_num+=1
                                 continue
                             else:
                                 helix_restraints.append(counter_num)
                                 continue
-                    if 'x' in segment[key]:
+                    if 'x' in placeholder:
                         atom_num+=1
                         continue
-                    if '?' in key and '-' in segment[key]:
+                    if '?' in key and '-' in placeholder:
                         atom_num+=1
                         continue
-                    if '-term' in seg_id and segment[key]=='-':
+                    if '-term' in seg_id and placeholder=='-':
                         continue
-                    for atom in main_pdb_array[seg_id][key]:
+                    atoms = main_pdb_array.atom_slice(seg_id, key)
+                    for name, resname, coord, bfactor, occupancy in zip(main_pdb_array.names[atoms],
+                            main_pdb_array.resnames[atoms], main_pdb_array.coords[atoms],
+                            main_pdb_array.bfactors[atoms], main_pdb_array.occupancies[atoms]):
                         atom_num+=1
-                        coord = list(atom.get_coord())
                         coord1 = "%8.3f"% (coord[0])
                         coord2 = "%8.3f"% (coord[1])
                         coord3 = "%8.3f"% (coord[2])
-                        if str(atom.get_id())=='CA':
+                        if name=='CA':
                             if len(key)==4:
                                 bfact = "%6.2f"% (float(key))
                             elif '.' not in key:
-                                bfact = "%6.2f"% (float(atom.get_bfactor()))
+                                bfact = "%6.2f"% (bfactor)
                             else:
                                 key_split = key.split('.')
                                 if '.' in key and len(key_split[1])==3:
                                     bfact = " -%4.2f"% (float(key))
                                 elif len(key_split)==3:
-                                    bfact = "%6.2f"% (float(atom.get_bfactor()))
+                                    bfact = "%6.2f"% (bfactor)
                                 else:
                                     bfact = " %5.2f"% (float(key))
                         else:
-                            bfact = "%6.2f"% (float(atom.get_bfactor()))
-                        occupancy = "%6.2f"% (atom.get_occupancy())
+                            bfact = "%6.2f"% (bfactor)
+                        occupancy = "%6.2f"% (occupancy)
                         template="""
 ATOM{atom_num}  {atom}{res} {chain}{res_num}{coord1}{coord2}{coord3}{occupancy}{bfactor}{atom_s}  """
-                        context={"atom_num":str(atom_num).rjust(7), "atom":str(atom.get_id()).ljust(4),
-                                 "res":atom.get_parent().get_resname(),
+                        context={"atom_num":str(atom_num).rjust(7), "atom":str(name).ljust(4),
+                                 "res":resname,
                                  "chain":str(self.main_template_preferred_chain)[0],
                                  "res_num":str(res_num).rjust(4), "coord1":coord1.rjust(12),
                                  "coord2":coord2.rjust(8), "coord3":coord3.rjust(8),
                                  "occupancy":str(occupancy).rjust(3),
-                                 "bfactor":str(bfact).rjust(4), "atom_s":str(str(atom.get_id())[0]).rjust(12)}
+                                 "bfactor":str(bfact).rjust(4), "atom_s":str(name[0]).rjust(12)}
                         f.write(template.format(**context))
                 trimmed_resi_nums[seg_id] = trimmed_segment
                 prev_seg = seg_id[:4]
@@ -2710,6 +2794,7 @@ sequence:{uniprot}::::::::
                      "ref_sequence":ref_sequence}
             output_file.write(template.format(**context))
 
+    @timed('modeller')
     def run_MODELLER(self, pir_file, template, reference, number_of_models, output_file_name, atom_dict=None,
                      helix_restraints=[], icl3_mid=None, disulfide_nums=[], complex_start=None, beta_start=None, gamma_start=None):
         ''' Build homology model with MODELLER.
@@ -3312,7 +3397,7 @@ class HelixEndsModeling(HomologyModeling):
                     continue
             offset = 0
             increase_offset = True
-            full_template_dict_seg = deepcopy(a.template_dict[temp_seg])
+            full_template_keys = list(a.template_dict[temp_seg])
 
             delete_r = set()
             delete_t = set()
@@ -3334,7 +3419,7 @@ class HelixEndsModeling(HomologyModeling):
                 if a.template_dict[temp_seg][temp_res]=='-':
                     continue
                 if a.reference_dict[ref_seg][ref_res]=='x':
-                    if list(full_template_dict_seg.keys()).index(ref_res)<mid+offset:
+                    if full_template_keys.index(ref_res)<mid+offset:
                         modifications['removed'][ref_seg][0].append(ref_res)
                     else:
                         modifications['removed'][ref_seg][1].append(ref_res)
@@ -3344,7 +3429,7 @@ class HelixEndsModeling(HomologyModeling):
                     delete_ar.add((ref_seg, ref_res.replace('x','.')))
                 elif a.template_dict[temp_seg][temp_res]=='x' or (temp_seg[0]=='T' and temp_res.replace('x','.') not in
                                                                                         list(main_pdb_array[temp_seg])):
-                    if list(full_template_dict_seg.keys()).index(temp_res)<mid+offset:
+                    if full_template_keys.index(temp_res)<mid+offset:
                         modifications['added'][temp_seg][0].append(temp_res)
                     else:
                         modifications['added'][temp_seg][1].append(temp_res)
@@ -3384,7 +3469,7 @@ class HelixEndsModeling(HomologyModeling):
                                     all_keys = list(a.reference_dict[ref_seg].keys())[:len(modifications['added'][ref_seg][0])+4]
                                     ref_keys = [i for i in all_keys if i not in modifications['added'][ref_seg][0]]
                                     reference = parser.fetch_residues_from_array(main_pdb_array[ref_seg],ref_keys)
-                                    template = parser.fetch_residues_from_pdb(struct,all_keys)
+                                    template = residue_views(parser.fetch_residues_from_pdb(struct,all_keys))
                                     superpose = sp.OneSidedSuperpose(reference,template,4,0)
                                     sup_residues = superpose.run()
                                     new_residues = OrderedDict()
@@ -3392,8 +3477,7 @@ class HelixEndsModeling(HomologyModeling):
                                         gn_ = gn.replace('.','x')
                                         if gn_ not in ref_keys:
                                             new_residues[gn] = atoms
-                                            a.template_dict[temp_seg][gn_] = PDB.Polypeptide.three_to_one(
-                                                                             atoms[0].get_parent().get_resname())
+                                            a.template_dict[temp_seg][gn_] = PDB.Polypeptide.three_to_one(residue_name(atoms))
                                             if a.template_dict[temp_seg][gn_]==a.reference_dict[ref_seg][gn_]:
                                                 a.alignment_dict[ref_seg][gn_] = a.reference_dict[ref_seg][gn_]
                                             else:
@@ -3430,7 +3514,7 @@ class HelixEndsModeling(HomologyModeling):
                                     all_keys = list(a.reference_dict[ref_seg].keys())[-1*(len(modifications['added'][ref_seg][1])+4):]
                                     ref_keys = [i for i in all_keys if i not in modifications['added'][ref_seg][1]]
                                     reference = parser.fetch_residues_from_array(main_pdb_array[ref_seg],ref_keys)
-                                    template = parser.fetch_residues_from_pdb(struct,all_keys)
+                                    template = residue_views(parser.fetch_residues_from_pdb(struct,all_keys))
                                     superpose = sp.OneSidedSuperpose(reference,template,4,1)
                                     sup_residues = superpose.run()
                                     new_residues = OrderedDict()
@@ -3441,8 +3525,7 @@ class HelixEndsModeling(HomologyModeling):
                                         gn_ = gn.replace('.','x')
                                         if gn_ in modifications['added'][ref_seg][1]:
                                             main_pdb_array[ref_seg][gn] = atoms
-                                            a.template_dict[ref_seg][gn_] = PDB.Polypeptide.three_to_one(
-                                                                            atoms[0].get_parent().get_resname())
+                                            a.template_dict[ref_seg][gn_] = PDB.Polypeptide.three_to_one(residue_name(atoms))
                                             if a.template_dict[ref_seg][gn_]==a.reference_dict[ref_seg][gn_]:
                                                 a.alignment_dict[ref_seg][gn_] = a.reference_dict[ref_seg][gn_]
                                             else:
@@ -3495,6 +3578,7 @@ class Loops(object):
         self.excluded_loops = {'ICL1':[],'ECL1':[],'ICL2':['5ZKP'],'ECL2':[],'ECL2_1':[],'ECL2_mid':[],'ECL2_2':[],'ICL3':['3VW7'],'ECL3':['4DJH','6KJV','6KK1','6KK7','5VEW']}
         self.evade_chain_break = False
 
+    @timed('loop_insertion')
     def fetch_loop_residues(self, main_pdb_array, superpose_modded_loop=False):
         ''' Fetch list of Atom objects of the loop when there is an available template. Returns an OrderedDict().
         '''
@@ -3891,6 +3975,7 @@ class Loops(object):
         else:
             return None
 
+    @timed('loop_insertion')
     def insert_loop_to_arrays(self, loop_output_structure, main_pdb_array, loop_template, reference_dict,
                               template_dict, alignment_dict):
         ''' Updates the homology model with loop segments. Inserts previously fetched lists of loop Atom objects to
@@ -3903,6 +3988,9 @@ class Loops(object):
             @param template_dict: template dictionary of AlignedReferenceTemplate.
             @param alignment_dict: alignment dictionary of AlignedReferenceTemplate.
         '''
+        # the loop residues are inserted as views into a StructureArray, not as atoms of the parsed loop template
+        if loop_template!=None:
+            loop_template = residue_views(loop_template)
         shorter_ref, shorter_temp = False, False
         try:
             for r,t in zip(reference_dict[self.loop_label],template_dict[self.loop_label]):
@@ -3990,7 +4078,7 @@ class Loops(object):
                                     loop_gn = self.loop_label+'?'+str(l_res)
                             ref_loop_seg[loop_gn] = r_res
                             try:
-                                temp_loop_seg[loop_gn] = PDB.Polypeptide.three_to_one(loop_template[r_id][0].get_parent().get_resname())
+                                temp_loop_seg[loop_gn] = PDB.Polypeptide.three_to_one(residue_name(loop_template[r_id]))
                             except:
                                 temp_loop_seg[loop_gn] = '-'
                             if ref_loop_seg[loop_gn]==temp_loop_seg[loop_gn]:
@@ -4111,7 +4199,7 @@ class Loops(object):
                             except:
                                 ref_loop_seg[loop_gn] = r_res
                             try:
-                                temp_loop_seg[loop_gn] = PDB.Polypeptide.three_to_one(loop_template[r_id][0].get_parent().get_resname())
+                                temp_loop_seg[loop_gn] = PDB.Polypeptide.three_to_one(residue_name(loop_template[r_id]))
                             except:
                                 temp_loop_seg[loop_gn] = '-'
                             if ref_loop_seg[loop_gn]==temp_loop_seg[loop_gn]:
@@ -4152,6 +4240,7 @@ class Loops(object):
                 pass
         return self
 
+    @timed('loop_insertion')
     def insert_ECL2_to_arrays(self, loop_output_structure, main_pdb_array, loop_template, reference_dict,
                               template_dict, alignment_dict, partialECL2_1=False, partialECL2_2=False):
         temp_array = OrderedDict()
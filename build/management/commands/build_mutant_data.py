@@ -10,6 +10,7 @@ from mutation.models import *
 from common.views import AbsTargetSelection
 from common.views import AbsSegmentSelection
 from common.tools import fetch_from_cache, save_to_cache, fetch_from_web_api
+from common.cache_warming import invalidate_dependency
 from residue.models import Residue
 from protein.models import Protein
 from ligand.models import Ligand, LigandProperities, LigandRole, LigandType
@@ -108,6 +109,9 @@ class Command(BaseBuild):
             traceback.print_exc()
             self.logger.error(msg)
 
+        # cached products built from the mutations are rebuilt
+        invalidate_dependency('mutations')
+
     def purge_mutants(self):
         Mutation.objects.all().delete()
         MutationRaw.objects.all().delete()
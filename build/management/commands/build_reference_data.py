@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from common.reference_data import save_reference_data
+
+import logging
+
+
+class Command(BaseCommand):
+    help = 'Writes the shared reference data snapshot (generic numbers, segments, families) used by the web processes'
+
+    logger = logging.getLogger(__name__)
+
+    def handle(self, *args, **options):
+        self.logger.info('CREATING REFERENCE DATA SNAPSHOT')
+        save_reference_data()
+        self.logger.info('COMPLETED CREATING REFERENCE DATA SNAPSHOT')
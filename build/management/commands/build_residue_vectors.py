@@ -0,0 +1,31 @@
+from build.management.commands.base_build import Command as BaseBuild
+from protein.models import ProteinConformation
+from residue.vectors import save_residue_vector, delete_residue_vectors
+from common.alignment_cache import segment_block_cache
+
+
+class Command(BaseBuild):
+    help = 'Builds packed residue vectors for all protein conformations (used to assemble alignments)'
+
+    pconfs = ProteinConformation.objects.order_by('id')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-p', '--proc', type=int, action='store', dest='proc', default=1, help='Number of processes to run')
+        parser.add_argument('--purge', action='store_true', dest='purge', default=False, help='Purge all residue vectors before building')
+
+    def handle(self, *args, **options):
+        try:
+            if options['purge']:
+                delete_residue_vectors()
+            self.logger.info('CREATING RESIDUE VECTORS')
+            self.prepare_input(options['proc'], self.pconfs)
+
+            # cached alignment blocks were built from the previous residue data
+            segment_block_cache.invalidate()
+            self.logger.info('COMPLETED CREATING RESIDUE VECTORS')
+        except Exception as msg:
+            print(msg)
+            self.logger.error(msg)
+
+    def process_item(self, pconf, iteration=1):
+        save_residue_vector(pconf)
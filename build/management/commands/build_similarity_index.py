@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from common.similarity_index import update_similarity_index
+
+import logging
+
+
+class Command(BaseCommand):
+    help = 'Updates the similarity index of all receptors against all structure templates used for template selection'
+
+    logger = logging.getLogger(__name__)
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild',
+            action='store_true',
+            dest='rebuild',
+            default=False,
+            help='Compare all proteins again instead of only new proteins and templates')
+
+    def handle(self, *args, **options):
+        self.logger.info('UPDATING SIMILARITY INDEX')
+        proteins, templates = update_similarity_index(rebuild=options['rebuild'])
+        self.logger.info('Compared {} new proteins and {} new templates'.format(proteins, templates))
+        self.logger.info('COMPLETED UPDATING SIMILARITY INDEX')
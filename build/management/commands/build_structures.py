@@ -27,6 +27,7 @@ from ligand.models import Ligand, LigandType, LigandRole, LigandProperities, Lig
 from interaction.models import *
 from interaction.views import runcalculation,parsecalculation
 from residue.functions import dgn
+from common.cache_warming import invalidate_dependency
 
 import logging
 import os
@@ -149,6 +150,10 @@ class Command(BaseBuild):
             print(msg)
             self.logger.error(msg)
 
+        # cached products built from the structures and their ligand interactions are rebuilt
+        invalidate_dependency('structures')
+        invalidate_dependency('ligand_interactions')
+
     def purge_structures(self):
         Structure.objects.all().delete()
         ResidueFragmentInteraction.objects.all().delete()
@@ -7,6 +7,7 @@ from protein.models import (Protein, ProteinConformation, ProteinSequenceType, P
     ProteinConformationTemplateStructure)
 from structure.models import Structure
 from common.alignment import Alignment
+from common.similarity_index import similarity_index
 
 from cProfile import Profile
 
@@ -83,7 +84,7 @@ class Command(BaseBuild):
 
             # overall
             template = self.find_segment_template(pconf, sps, self.segments)
-            template_structure = self.fetch_template_structure(self.structures, template.protein.entry_name)
+            template_structure = self.fetch_template_structure(self.structures, template.entry_name)
             pconf.template_structure = template_structure
             pconf.save()
             self.logger.info("Assigned {} as overall template for {}".format(template_structure, pconf))
@@ -91,7 +92,7 @@ class Command(BaseBuild):
             # for each segment
             for segment in self.segments:
                 template = self.find_segment_template(pconf, sps_str, [segment])
-                template_structure = self.fetch_template_structure(self.structures, template.protein.parent.entry_name)
+                template_structure = self.fetch_template_structure(self.structures, template.parent.entry_name)
                 pcts, created = ProteinConformationTemplateStructure.objects.get_or_create(protein_conformation=pconf,
                     protein_segment=segment, defaults={'structure': template_structure})
                 if pcts.structure != template_structure:
@@ -100,6 +101,15 @@ class Command(BaseBuild):
                 self.logger.info("Assigned {} as {} template for {}".format(template_structure, segment, pconf))
 
     def find_segment_template(self, pconf, sconfs, segments):
+            # look up the most similar template in the similarity index, the templates are ordered like in an alignment
+            index = similarity_index()
+            templates = dict([(protein.entry_name, protein) for protein in sconfs])
+            template_names = sorted(templates, key=lambda x: (templates[x].family.slug, x))
+            segment_slugs = [segment.slug for segment in segments]
+            if index is not None and index.covers(pconf.protein.entry_name, template_names, segment_slugs):
+                ranked = index.ranked_templates(pconf.protein.entry_name, template_names, segment_slugs)
+                return templates[ranked[0][0]]
+
             a = Alignment()
             a.load_reference_protein(pconf.protein)
             a.load_proteins(sconfs)
@@ -107,7 +117,7 @@ class Command(BaseBuild):
             a.build_alignment()
             a.calculate_similarity()
 
-            return a.proteins[1]
+            return a.proteins[1].protein
 
     def fetch_template_structure(self, structures, template_protein):
         for structure in structures:
@@ -8,6 +8,7 @@ from structure.models import StructureSegment
 from residue.models import Residue
 from residue.functions import *
 from common.alignment import Alignment
+from common.alignment_cache import segment_block_cache
 
 import os
 from collections import OrderedDict
@@ -41,6 +42,7 @@ class Command(BaseBuild):
         try:
             self.logger.info('UPDATING PROTEIN ALIGNMENTS')
             self.prepare_input(options['proc'], self.pconfs)
+            segment_block_cache.invalidate()
             self.logger.info('COMPLETED UPDATING PROTEIN ALIGNMENTS')
         except Exception as msg:
             print(msg)
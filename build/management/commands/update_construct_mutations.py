@@ -10,6 +10,7 @@ from structure.models import Structure
 from construct.functions import  fetch_pdb_info
 from construct.models import *
 from residue.models import Residue
+from common.cache_warming import invalidate_dependency
 
 from ligand.models import Ligand, LigandType, LigandRole
 from ligand.functions import get_or_make_ligand
@@ -68,6 +69,9 @@ class Command(BaseCommand):
         self.import_puri()
         self.import_xtal()
 
+        # cached products built from the constructs are rebuilt
+        invalidate_dependency('constructs')
+
     def purge_construct_data(self):
         Construct.objects.all().delete()
         Crystallization.objects.all().delete()
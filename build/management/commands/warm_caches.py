@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+
+from common.cache_warming import products, warm_products, invalidate_dependency
+
+import importlib
+import logging
+
+# modules registering cached products
+PRODUCT_MODULES = ['common.views', 'mutation.views']
+
+
+class Command(BaseCommand):
+    help = 'Builds the registered cached data products (e.g. class data of the mutation design tools)'
+
+    logger = logging.getLogger(__name__)
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', nargs='+', dest='products', default=None, help='Only build these products')
+        parser.add_argument('--changed', nargs='+', dest='changed', default=None,
+            help='Only build the products depending on this data (e.g. mutations constructs), stale values are served until then')
+        parser.add_argument('--list', action='store_true', dest='list', default=False, help='List the registered products')
+
+    def handle(self, *args, **options):
+        for module in PRODUCT_MODULES:
+            importlib.import_module(module)
+
+        if options['list']:
+            for product in products.values():
+                print(product.name, product.key, ', '.join(product.dependencies))
+            return
+
+        if options['changed']:
+            for dependency in options['changed']:
+                invalidate_dependency(dependency)
+
+        self.logger.info('WARMING CACHED PRODUCTS')
+        failed = warm_products(options['products'], options['changed'])
+        if failed:
+            self.logger.warning('{} cached products could not be built, they are built when they are first requested'.format(failed))
+        self.logger.info('COMPLETED WARMING CACHED PRODUCTS')
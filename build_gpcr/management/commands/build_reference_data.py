@@ -0,0 +1,5 @@
+from build.management.commands.build_reference_data import Command as BuildReferenceData
+
+
+class Command(BuildReferenceData):
+    pass
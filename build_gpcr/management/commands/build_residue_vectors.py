@@ -0,0 +1,5 @@
+from build.management.commands.build_residue_vectors import Command as BuildResidueVectors
+
+
+class Command(BuildResidueVectors):
+    pass
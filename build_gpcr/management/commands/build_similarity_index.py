@@ -0,0 +1,5 @@
+from build.management.commands.build_similarity_index import Command as BuildSimilarityIndex
+
+
+class Command(BuildSimilarityIndex):
+    pass
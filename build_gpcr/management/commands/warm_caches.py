@@ -0,0 +1,5 @@
+from build.management.commands.warm_caches import Command as WarmCaches
+
+
+class Command(WarmCaches):
+    pass
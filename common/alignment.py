@@ -10,11 +10,17 @@ from operator import itemgetter
 import numpy as np
 
 from alignment.functions import prepare_aa_group_preference
-from Bio.Align import substitution_matrices
+from common.alignment_cache import (cache_alignments, residue_record,
+                                    segment_block_cache)
+from common.alignment_matrix import AlignmentMatrix
 from common.definitions import *
+from common.instrumentation import timed
+from common.reference_data import reference_data
 from common.selection import Selection
+from common.similarity import (encode_alignment_row, gap_mask, pairwise_scores,
+                               similarity_matrix, substitution_table)
+from common.similarity_index import similarity_index
 from django.conf import settings
-from django.core.cache import cache, caches
 from django.db.models import Q
 from protein.models import (Protein, ProteinConformation, ProteinFamily,
                             ProteinFusionProtein, ProteinSegment, ProteinState)
@@ -22,15 +28,11 @@ from residue.functions import dgn, ggn
 from residue.models import (Residue, ResidueGenericNumber,
                             ResidueGenericNumberEquivalent,
                             ResidueNumberingScheme)
+from residue.vectors import ResidueVectors
 # from structure.functions import StructureSeqNumOverwrite
 from signprot.models import SignprotComplex
 from structure.models import Rotamer, Structure
 
-try:
-    cache_alignments = caches['alignment_core']
-except:
-    cache_alignments = cache
-
 
 class Alignment:
     """A class representing a protein sequence alignment, with or without a reference sequence"""
@@ -66,9 +68,19 @@ class Alignment:
         self.stats_done = False
         self.zscales = OrderedDict()
 
+        # columnar engine for the statistics, when False the statistics are collected residue by residue
+        self.use_matrix_engine = True
+        self.matrix = None
+
+        # assemble the alignment from the packed residue vectors when they have been built
+        self.use_residue_vectors = True
+
         # refers to which ProteinConformation attribute to order by (identity, similarity or similarity score)
         self.order_by = 'similarity'
 
+        # substitution matrix used for similarity calculations (any matrix from Bio.Align.substitution_matrices)
+        self.substitution_matrix = 'BLOSUM62'
+
         # name of custom segment, where individually selected postions are collected
         self.custom_segment_label = 'Custom'
         self.interaction_segment_label = 'I'
@@ -88,6 +100,37 @@ class Alignment:
     def __str__(self):
         return str(self.__dict__)
 
+    # The following statistics are only created from the alignment matrix when they are requested
+    @property
+    def aa_count_with_protein(self):
+        if self._aa_count_with_protein is None and self.matrix is not None:
+            self._aa_count_with_protein = self.matrix.aa_count_with_protein()
+        return self._aa_count_with_protein
+
+    @aa_count_with_protein.setter
+    def aa_count_with_protein(self, value):
+        self._aa_count_with_protein = value
+
+    @property
+    def amino_acid_stats(self):
+        if self._amino_acid_stats is None and self.matrix is not None:
+            self._amino_acid_stats = self.matrix.amino_acid_stats()
+        return self._amino_acid_stats
+
+    @amino_acid_stats.setter
+    def amino_acid_stats(self, value):
+        self._amino_acid_stats = value
+
+    @property
+    def feature_stats(self):
+        if self._feature_stats is None and self.matrix is not None:
+            self._feature_stats = self.matrix.feature_stats()
+        return self._feature_stats
+
+    @feature_stats.setter
+    def feature_stats(self, value):
+        self._feature_stats = value
+
     def _assign_preferred_features(self, signature, segment, ref_matrix):
 
         new_signature = []
@@ -208,12 +251,12 @@ class Alignment:
             normal_segments.append(selected_segment)
             segment_positions_lookup[selected_segment.slug] = []
         if normal_segments:
-            # If normal segments, prepare all ResidueGenericNumber for less overhead
-            segment_positions = ResidueGenericNumber.objects.filter(protein_segment__in=normal_segments,
-                                                                    scheme=self.default_numbering_scheme).select_related('protein_segment').order_by('label')
-            for segment_residue in segment_positions:
-                segment = segment_residue.protein_segment.slug
-                segment_positions_lookup[segment].append(segment_residue)
+            # If normal segments, look up their generic numbers in the shared reference data
+            segment_ids = OrderedDict()
+            for selected_segment in normal_segments:
+                segment_ids.setdefault(selected_segment.slug, set()).add(selected_segment.pk)
+            for slug, ids in segment_ids.items():
+                segment_positions_lookup[slug] = reference_data().segment_generic_numbers(ids, self.default_numbering_scheme.id)
 
         for s in selected_segments:
             if hasattr(s, 'item'):
@@ -236,8 +279,7 @@ class Alignment:
             unsorted_segments[selected_segment.pk] = []
             segment_lookup[selected_segment.pk] = selected_segment.slug
             segment_lookup_positions[selected_segment.pk] = segment_positions_lookup[selected_segment.slug]
-            for segment_residue in segment_positions_lookup[selected_segment.slug]:
-                unsorted_segments[selected_segment.pk].append(segment_residue.label)
+            unsorted_segments[selected_segment.pk].extend(segment_positions_lookup[selected_segment.slug])
 
         # Use PK values of segments to sort them before making alignment to ensure logical order
         sorted_segments = sorted(unsorted_segments)
@@ -283,7 +325,10 @@ class Alignment:
         self.stats_done = False
 
     def load_generic_numbers(self, segment_slug, residues):
-        """Loads generic numbers in the schemes of all selected proteins"""
+        """Loads generic numbers in the schemes of all selected proteins
+
+        residues are the generic number labels of a segment, or the selected positions of a custom segment
+        """
         for ns in self.numbering_schemes:
             if ns[0] not in self.generic_numbers:
                 self.generic_numbers[ns[0]] = OrderedDict()
@@ -292,7 +337,7 @@ class Alignment:
                 if segment_slug == self.custom_segment_label or self.use_residue_groups:
                     residue_position = segment_residue[0].default_generic_number.label
                 else:
-                    residue_position = segment_residue.label
+                    residue_position = segment_residue
                 self.generic_numbers[ns[0]][segment_slug][residue_position] = []
         self.stats_done = False
 
@@ -330,44 +375,59 @@ class Alignment:
         return hashlib.md5(hash_key.encode('utf-8')).hexdigest()
 
     # AJK: point for optimization - primary bottleneck (#1 cleaning, #2 last for-loop in this function)
+    @timed('alignment_build')
     def build_alignment(self):
-        """Fetch selected residues from DB and build an alignment"""
-
-        # AJK: prevent prefetching all data for large alignments before checking #residues (DB + memory killer)
-        rs = Residue.objects.filter(protein_segment__slug__in=self.segments, protein_conformation__in=self.proteins)
-
-
-        self.number_of_residues_total = len(rs)
-        if self.number_of_residues_total>120000: #300 receptors, 400 residues limit
-            return "Too large"
+        """Fetch selected residues and build an alignment. The alignment is stitched together from segment blocks
+        (all positions of one protein conformation in one segment), which are taken from the block cache and
+        otherwise created from the residue vectors or the DB."""
+        alternative_numbers = not self.ignore_alternative_residue_numbering_schemes and len(self.numbering_schemes) > 1
+        pconfs = list(OrderedDict([(pc.id, pc) for pc in self.proteins]).values())
+        block_segments = [segment for segment in self.segments
+                          if not (segment == self.custom_segment_label or self.use_residue_groups)]
+
+        # fetch cached blocks
+        segment_block_cache.current_version()
+        block_keys = OrderedDict()
+        for pc in pconfs:
+            for ps in block_segments:
+                block_keys[(pc.id, ps)] = segment_block_cache.key(pc.id, ps, ps in self.segments_only_alignable,
+                                                                  alternative_numbers)
+        cached_blocks = segment_block_cache.get_blocks(list(block_keys.values()))
+        blocks = dict([(pcs, cached_blocks[key]) for pcs, key in block_keys.items() if key in cached_blocks])
+
+        # create and cache missing blocks
+        missing = [pcs for pcs in block_keys if pcs not in blocks]
+        if missing:
+            missing_pconf_ids = set([pcs[0] for pcs in missing])
+            missing_pconfs = [pc for pc in pconfs if pc.id in missing_pconf_ids]
+            missing_segments = set([pcs[1] for pcs in missing])
+            created_blocks = self.create_segment_blocks(missing_pconfs, missing_segments, alternative_numbers)
+            if created_blocks == "Too large":
+                return "Too large"
+            new_blocks = {}
+            for pcs in missing:
+                blocks[pcs] = created_blocks.get(pcs, OrderedDict())
+                new_blocks[block_keys[pcs]] = blocks[pcs]
+            segment_block_cache.set_blocks(new_blocks)
+
+        self.number_of_residues_total = sum([len(block) for block in blocks.values()])
 
         # AJK: performance boost -> Internal caching (not for very small alignments)
-        # AJK: note -> ideally we would have fully cached alignments and only select the relevant segments afterwards.
         cache_key = "ALIGNMENTS_"+self.get_hash()
 
         #cache_alignments.set(cache_key, 0, 0)
         if self.number_of_residues_total < 2500 or not cache_alignments.has_key(cache_key):
-            # fetch segment residues
-            if not self.ignore_alternative_residue_numbering_schemes and len(self.numbering_schemes) > 1:
-                rs = Residue.objects.filter(
-                    protein_segment__slug__in=self.segments, protein_conformation__in=self.proteins).prefetch_related(
-                    'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
-                    'generic_number__scheme', 'display_generic_number__scheme', 'alternative_generic_numbers__scheme')
-            else:
-                rs = Residue.objects.filter(
-                    protein_segment__slug__in=self.segments, protein_conformation__in=self.proteins).prefetch_related(
-                    'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
-                    'generic_number__scheme', 'display_generic_number__scheme')
-
-            # If segment flagged to only include the alignable residues, exclude the ones with no GN
-            for s in self.segments_only_alignable:
-                rs = rs.exclude(protein_segment__slug=s, generic_number=None)
+            custom_vectors = None
+            if self.use_residue_vectors and not alternative_numbers and len(block_segments) < len(self.segments):
+                custom_vectors = ResidueVectors.load(pconfs)
 
             # fetch individually selected residues (Custom segment)
             crs = {}
             for segment in self.segments:
                 if segment == self.custom_segment_label or self.use_residue_groups:
-                    if not self.ignore_alternative_residue_numbering_schemes and len(self.numbering_schemes) > 1:
+                    if custom_vectors:
+                        crs[segment] = custom_vectors.residues_by_generic_number(self.segments[segment])
+                    elif alternative_numbers:
                         crs[segment] = Residue.objects.filter(
                             generic_number__label__in=self.segments[segment],
                             protein_conformation__in=self.proteins).prefetch_related(
@@ -380,150 +440,22 @@ class Alignment:
                             'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
                             'generic_number__scheme', 'display_generic_number__scheme')
 
-            # create a dict of proteins, segments and residues
+            # stitch the alignment together from the blocks
             proteins = {}
-            segment_counters = {}
-            aligned_residue_encountered = {}
-            fusion_protein_inserted = {}
-            for r in rs:
-                ps = r.protein_segment.slug
-
-                # identifiers for protein/state
-                pcid = r.protein_conformation.protein.entry_name + "-" + r.protein_conformation.state.slug
-
-                # update protein dict
-                if pcid not in proteins:
-                    proteins[pcid] = {}
-                if ps not in proteins[pcid]:
-                    proteins[pcid][ps] = {}
-
-                # update aligned residue tracker
-                if pcid not in aligned_residue_encountered:
-                    aligned_residue_encountered[pcid] = {}
-                if ps not in aligned_residue_encountered[pcid]:
-                    aligned_residue_encountered[pcid][ps] = False
-
-                # what part of the segment is this? There are 4 possibilities:
-                # 1. The aligned part (for both fully and partially aligned segments)
-                # 2. The part before the aligned part in a partially aligned segment
-                # 3. The part after the aligned part in a partially aligned segment
-                # 4. An unaligned segment (then there is only one part)
-                if r.generic_number:
-                    segment_part = 1
-                elif ps in settings.REFERENCE_POSITIONS and not aligned_residue_encountered[pcid][ps]:
-                    segment_part = 2
-                elif ps in settings.REFERENCE_POSITIONS and aligned_residue_encountered[pcid][ps]:
-                    segment_part = 3
-                else:
-                    segment_part = 4
-
-                # update segment counters
-                if pcid not in segment_counters:
-                    segment_counters[pcid] = {}
-                if segment_part == 3:
-                    part_ps = ps + '_after'
-                else:
-                    part_ps = ps
-                if part_ps not in segment_counters[pcid]:
-                    segment_counters[pcid][part_ps] = 1
-                else:
-                    segment_counters[pcid][part_ps] += 1
-
-
-                # update fusion protein tracker
-                if pcid not in fusion_protein_inserted:
-                    fusion_protein_inserted[pcid] = {}
-                if ps not in fusion_protein_inserted[pcid]:
-                    fusion_protein_inserted[pcid][ps] = False
-
-                # user generic numbers as keys for aligned segments
-                if r.generic_number:
-                    proteins[pcid][ps][r.generic_number.label] = r
-
-                    # register the presence of an aligned residue
-                    aligned_residue_encountered[pcid][ps] = True
-                # use custom keys for non-aligned segments
-                else:
-                    # label prefix + index
-                    # Unaligned segments should be split in the middle, with the first part "left aligned", and the second
-                    # "right aligned". If there is an aligned part of the segment, it goes in the middle.
-                    if segment_part == 2:
-                        prefix = '00-'
-                    elif segment_part == 3:
-                        prefix = 'zz-'
-                    else:
-                        prefix = '01-'
-
-                    # Note that there is not enough information to assign correct indicies to "right aligned" residues, but
-                    # those are corrected below
-                    index = str("%04d" % (segment_counters[pcid][part_ps],))
-
-                    # position label
-                    pos_label =  prefix + ps + "-" + index
-
-                    # insert fusion protein FIXME add this
-                    # if not fusion_protein_inserted[pcid][ps] and aligned_residue_encountered[pcid][ps]:
-                    #     fp = ProteinFusionProtein.objects.get(protein=r.protein_conformation.protein,
-                    #         segment_after=r.protein_segment)
-                    #     fusion_pos_label = ps + "-" + str("%04d" % (segment_counters[pcid][ps]-1,)) + "-fusion"
-                    #     proteins[pcid][ps][fusion_pos_label] = Residue(amino_acid=fp.protein_fusion.name)
-                    #     if fusion_pos_label not in self.segments[ps]:
-                    #         self.segments[ps].append(fusion_pos_label)
-                    #     fusion_protein_inserted[pcid][ps] = True
-
-                    # residue
-                    proteins[pcid][ps][pos_label] = r
-
-            # correct alignment of split segments
-            for pcid, segments in proteins.items():
-                for ps, positions in segments.items():
-                    pos_num = 1
-                    pos_num_after = 1
-                    for pos_label in sorted(positions):
-                        res_obj = proteins[pcid][ps][pos_label]
-                        right_align = False
-                        # In a "normal", non split, unaligned segment, is this past the middle?
-                        if (pos_label.startswith('01-')
-                                and res_obj.protein_segment.category != 'terminus'
-                                and pos_num > (segment_counters[pcid][ps] / 2 + 0.5)):
-                            right_align = True
-                        # In an partially aligned segment (prefixed with 00), where conserved residues are lacking, treat
-                        # as an unaligned segment
-                        elif (pos_label.startswith('00-')
-                              and not aligned_residue_encountered[pcid][ps]
-                              and pos_num > (segment_counters[pcid][ps] / 2 + 0.5)
-                              or res_obj.protein_segment.slug == 'N-term'):
-                            right_align = True
-                        # In an N-terminus, always right align everything
-                        elif pos_label.startswith('01-') and res_obj.protein_segment.slug == 'N-term':
-                            right_align = True
-
-                        if right_align:
-                            # if so, "right align" from here using a zz prefixed label
-                            updated_index = 'zz' + pos_label[2:]
-                            proteins[pcid][ps][updated_index] = proteins[pcid][ps].pop(pos_label)
-                            pos_label = updated_index
-
-                        if pos_label.startswith('zz-'):
-                            segment_label_after = ps + '_after' # parts after a partly aligned segment start with zz
-                            if segment_label_after in segment_counters[pcid]:
-                                segment_length = segment_counters[pcid][segment_label_after]
-                                counter = pos_num_after
-
-                            # this might be the "second part" of an unaligned segment, e.g.
-                            # AAAA----AAAAA
-                            # AAAAAAAAAAAAA
-                            else:
-                                segment_length = segment_counters[pcid][ps]
-                                counter = pos_num
-
-                            updated_index = pos_label[:-4] + str(9999 - (segment_length - counter))
-                            proteins[pcid][ps][updated_index] = proteins[pcid][ps].pop(pos_label)
-                            pos_label = updated_index
-                            pos_num_after += 1
-                        if pos_label not in self.segments[ps]:
+            for pc in pconfs:
+                pcid = pc.protein.entry_name + "-" + pc.state.slug
+                proteins[pcid] = {}
+                for ps in block_segments:
+                    proteins[pcid][ps] = blocks[(pc.id, ps)]
+
+            # register all positions of the segments
+            for ps in block_segments:
+                known_positions = set(self.segments[ps])
+                for pc in pconfs:
+                    for pos_label in blocks[(pc.id, ps)]:
+                        if pos_label not in known_positions:
                             self.segments[ps].append(pos_label)
-                        pos_num += 1
+                            known_positions.add(pos_label)
 
             # individually selected residues (Custom segment)
             for segment in self.segments:
@@ -535,7 +467,7 @@ class Alignment:
                             proteins[pcid] = {}
                         if ps not in proteins[pcid]:
                             proteins[pcid][ps] = {}
-                        proteins[pcid][ps][r.generic_number.label] = r
+                        proteins[pcid][ps][r.generic_number.label] = residue_record(r, alternative_numbers)
 
             # remove split segments from segment list and order segment positions
             for segment, positions in self.segments.items():
@@ -549,6 +481,9 @@ class Alignment:
                         sorted_segment.append(gn)
                     self.segments[segment] = sorted_segment
 
+            # display generic number of each position, objects are fetched after the alignment is built
+            generic_number_ids = OrderedDict()
+
             self.unique_proteins = list(set(self.proteins))
             for pc in self.unique_proteins:
                 row = OrderedDict()
@@ -579,19 +514,19 @@ class Alignment:
                             if r.display_generic_number:
                                 if pos not in self.generic_numbers[ns_slug][segment]:
                                     self.generic_numbers[ns_slug][segment][pos] = []
-                                if r.display_generic_number.label not in self.generic_numbers[ns_slug][segment][pos]:
-                                    self.generic_numbers[ns_slug][segment][pos].append(r.display_generic_number.label)
+                                if r.display_generic_number not in self.generic_numbers[ns_slug][segment][pos]:
+                                    self.generic_numbers[ns_slug][segment][pos].append(r.display_generic_number)
                             else:
                                 if pos not in self.generic_numbers[ns_slug][segment]:
                                     self.generic_numbers[ns_slug][segment][pos] = []
 
                             # add display numbers for other numbering schemes of selected proteins
-                            if (not self.ignore_alternative_residue_numbering_schemes and len(self.numbering_schemes) > 1):
+                            if alternative_numbers:
                                 if r.generic_number:
-                                    for arn in r.alternative_generic_numbers.all():
+                                    for arn_scheme, arn_label in r.alternative_generic_numbers:
                                         for ns in self.numbering_schemes:
-                                            if (arn.scheme.slug == ns[0] and arn.scheme.slug != ns_slug):
-                                                self.generic_numbers[arn.scheme.slug][segment][pos].append(arn.label)
+                                            if (arn_scheme == ns[0] and arn_scheme != ns_slug):
+                                                self.generic_numbers[arn_scheme][segment][pos].append(arn_label)
                                                 break
                                 else:
                                     for ns in self.numbering_schemes:
@@ -603,13 +538,14 @@ class Alignment:
                                 # s.append([pos, r.display_generic_number.label, r.amino_acid,
                                 #   r.display_generic_number.scheme.short_name, r.sequence_number])
 
-                                s.append([pos, r.display_generic_number.label, r.amino_acid,
-                                          r.display_generic_number.scheme.short_name, r.sequence_number, r.generic_number.label])
+                                s.append([pos, r.display_generic_number, r.amino_acid,
+                                          r.display_scheme, r.sequence_number, r.generic_number])
 
 
                                 # update generic residue object dict
-                                if pos not in self.generic_number_objs:
-                                    self.generic_number_objs[pos] = r.display_generic_number
+                                if (r.display_generic_number_id is not None and pos not in self.generic_number_objs
+                                        and pos not in generic_number_ids):
+                                    generic_number_ids[pos] = r.display_generic_number_id
                             else:
                                 s.append([pos, "", r.amino_acid, "", r.sequence_number])
 
@@ -644,6 +580,11 @@ class Alignment:
                 pc.alignment = row
             #                pc.alignment_list = row_list # FIXME redundant, remove when dependecies are removed
 
+            generic_number_objs = ResidueGenericNumber.objects.filter(
+                id__in=set(generic_number_ids.values())).select_related('scheme').in_bulk()
+            for pos, gn_id in generic_number_ids.items():
+                self.generic_number_objs[pos] = generic_number_objs[gn_id]
+
             self.sort_generic_numbers()
             self.merge_generic_numbers()
             self.clear_empty_positions()
@@ -699,6 +640,189 @@ class Alignment:
         # Adapt alignment to order in current self.proteins
         self.proteins = [prot2 for prot1 in self.proteins for prot2 in self.unique_proteins if prot1.id==prot2.id]
 
+    def create_segment_blocks(self, pconfs, segments, alternative_numbers):
+        """Create alignment blocks for protein conformations and segments from residue vectors or the DB"""
+        residue_vectors = None
+        if self.use_residue_vectors and not alternative_numbers:
+            residue_vectors = ResidueVectors.load(pconfs)
+
+        if residue_vectors:
+            rs = residue_vectors.residues(segments, self.segments_only_alignable)
+        else:
+            # AJK: prevent prefetching all data for large alignments before checking #residues (DB + memory killer)
+            rs = Residue.objects.filter(protein_segment__slug__in=segments, protein_conformation__in=pconfs)
+            if rs.count() > 120000: #300 receptors, 400 residues limit
+                return "Too large"
+
+            if alternative_numbers:
+                rs = rs.prefetch_related(
+                    'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
+                    'generic_number__scheme', 'display_generic_number__scheme', 'alternative_generic_numbers__scheme')
+            else:
+                rs = rs.prefetch_related(
+                    'protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
+                    'generic_number__scheme', 'display_generic_number__scheme')
+
+            # If segment flagged to only include the alignable residues, exclude the ones with no GN
+            for s in self.segments_only_alignable:
+                rs = rs.exclude(protein_segment__slug=s, generic_number=None)
+
+        return self.segment_blocks_from_residues(rs, alternative_numbers)
+
+    def segment_blocks_from_residues(self, rs, alternative_numbers=False):
+        """Assign position labels to residues, returns a dict of (protein conformation id, segment) -> positions"""
+        proteins = {}
+        pconf_ids = {}
+        segment_objs = {}
+        segment_counters = {}
+        aligned_residue_encountered = {}
+        fusion_protein_inserted = {}
+        for r in rs:
+            ps = r.protein_segment.slug
+
+            # identifiers for protein/state
+            pcid = r.protein_conformation.protein.entry_name + "-" + r.protein_conformation.state.slug
+
+            # update protein dict
+            if pcid not in proteins:
+                proteins[pcid] = {}
+                pconf_ids[pcid] = r.protein_conformation.id
+            if ps not in proteins[pcid]:
+                proteins[pcid][ps] = {}
+                segment_objs[(pcid, ps)] = r.protein_segment
+
+            # update aligned residue tracker
+            if pcid not in aligned_residue_encountered:
+                aligned_residue_encountered[pcid] = {}
+            if ps not in aligned_residue_encountered[pcid]:
+                aligned_residue_encountered[pcid][ps] = False
+
+            # what part of the segment is this? There are 4 possibilities:
+            # 1. The aligned part (for both fully and partially aligned segments)
+            # 2. The part before the aligned part in a partially aligned segment
+            # 3. The part after the aligned part in a partially aligned segment
+            # 4. An unaligned segment (then there is only one part)
+            if r.generic_number:
+                segment_part = 1
+            elif ps in settings.REFERENCE_POSITIONS and not aligned_residue_encountered[pcid][ps]:
+                segment_part = 2
+            elif ps in settings.REFERENCE_POSITIONS and aligned_residue_encountered[pcid][ps]:
+                segment_part = 3
+            else:
+                segment_part = 4
+
+            # update segment counters
+            if pcid not in segment_counters:
+                segment_counters[pcid] = {}
+            if segment_part == 3:
+                part_ps = ps + '_after'
+            else:
+                part_ps = ps
+            if part_ps not in segment_counters[pcid]:
+                segment_counters[pcid][part_ps] = 1
+            else:
+                segment_counters[pcid][part_ps] += 1
+
+
+            # update fusion protein tracker
+            if pcid not in fusion_protein_inserted:
+                fusion_protein_inserted[pcid] = {}
+            if ps not in fusion_protein_inserted[pcid]:
+                fusion_protein_inserted[pcid][ps] = False
+
+            # user generic numbers as keys for aligned segments
+            if r.generic_number:
+                proteins[pcid][ps][r.generic_number.label] = residue_record(r, alternative_numbers)
+
+                # register the presence of an aligned residue
+                aligned_residue_encountered[pcid][ps] = True
+            # use custom keys for non-aligned segments
+            else:
+                # label prefix + index
+                # Unaligned segments should be split in the middle, with the first part "left aligned", and the second
+                # "right aligned". If there is an aligned part of the segment, it goes in the middle.
+                if segment_part == 2:
+                    prefix = '00-'
+                elif segment_part == 3:
+                    prefix = 'zz-'
+                else:
+                    prefix = '01-'
+
+                # Note that there is not enough information to assign correct indicies to "right aligned" residues, but
+                # those are corrected below
+                index = str("%04d" % (segment_counters[pcid][part_ps],))
+
+                # position label
+                pos_label =  prefix + ps + "-" + index
+
+                # insert fusion protein FIXME add this
+                # if not fusion_protein_inserted[pcid][ps] and aligned_residue_encountered[pcid][ps]:
+                #     fp = ProteinFusionProtein.objects.get(protein=r.protein_conformation.protein,
+                #         segment_after=r.protein_segment)
+                #     fusion_pos_label = ps + "-" + str("%04d" % (segment_counters[pcid][ps]-1,)) + "-fusion"
+                #     proteins[pcid][ps][fusion_pos_label] = Residue(amino_acid=fp.protein_fusion.name)
+                #     if fusion_pos_label not in self.segments[ps]:
+                #         self.segments[ps].append(fusion_pos_label)
+                #     fusion_protein_inserted[pcid][ps] = True
+
+                # residue
+                proteins[pcid][ps][pos_label] = residue_record(r, alternative_numbers)
+
+        # correct alignment of split segments
+        for pcid, segments in proteins.items():
+            for ps, positions in segments.items():
+                pos_num = 1
+                pos_num_after = 1
+                for pos_label in sorted(positions):
+                    right_align = False
+                    # In a "normal", non split, unaligned segment, is this past the middle?
+                    if (pos_label.startswith('01-')
+                            and segment_objs[(pcid, ps)].category != 'terminus'
+                            and pos_num > (segment_counters[pcid][ps] / 2 + 0.5)):
+                        right_align = True
+                    # In an partially aligned segment (prefixed with 00), where conserved residues are lacking, treat
+                    # as an unaligned segment
+                    elif (pos_label.startswith('00-')
+                          and not aligned_residue_encountered[pcid][ps]
+                          and pos_num > (segment_counters[pcid][ps] / 2 + 0.5)
+                          or ps == 'N-term'):
+                        right_align = True
+                    # In an N-terminus, always right align everything
+                    elif pos_label.startswith('01-') and ps == 'N-term':
+                        right_align = True
+
+                    if right_align:
+                        # if so, "right align" from here using a zz prefixed label
+                        updated_index = 'zz' + pos_label[2:]
+                        proteins[pcid][ps][updated_index] = proteins[pcid][ps].pop(pos_label)
+                        pos_label = updated_index
+
+                    if pos_label.startswith('zz-'):
+                        segment_label_after = ps + '_after' # parts after a partly aligned segment start with zz
+                        if segment_label_after in segment_counters[pcid]:
+                            segment_length = segment_counters[pcid][segment_label_after]
+                            counter = pos_num_after
+
+                        # this might be the "second part" of an unaligned segment, e.g.
+                        # AAAA----AAAAA
+                        # AAAAAAAAAAAAA
+                        else:
+                            segment_length = segment_counters[pcid][ps]
+                            counter = pos_num
+
+                        updated_index = pos_label[:-4] + str(9999 - (segment_length - counter))
+                        proteins[pcid][ps][updated_index] = proteins[pcid][ps].pop(pos_label)
+                        pos_label = updated_index
+                        pos_num_after += 1
+                    pos_num += 1
+
+        # split into blocks per protein conformation and segment
+        blocks = {}
+        for pcid, segments in proteins.items():
+            for ps, positions in segments.items():
+                blocks[(pconf_ids[pcid], ps)] = positions
+        return blocks
+
     def remove_non_generic_numbers_from_alignment(self):
         """Remove all positions without a generic number from the protein alignment property"""
         to_delete = {}
@@ -801,10 +925,13 @@ class Alignment:
         """A placeholder for an instance specific function"""
         return generic_number
 
+    @timed('alignment_statistics')
     def calculate_statistics(self, ignore={}):
         """Calculate consensus sequence and amino acid and feature frequency"""
 
-        if not self.stats_done:
+        if not self.stats_done and self.use_matrix_engine:
+            self.calculate_statistics_matrix(ignore)
+        elif not self.stats_done:
             feature_count = OrderedDict()
             most_freq_aa = OrderedDict()
             amino_acids = OrderedDict([(a, 0) for a in AMINO_ACIDS]) # from common.definitions
@@ -1036,6 +1163,83 @@ class Alignment:
             self.calculate_zscales(True)
             self.stats_done = True
 
+    def calculate_statistics_matrix(self, ignore={}):
+        """Calculate the alignment statistics as vectorized reductions over the integer coded alignment matrix"""
+        num_proteins = len(self.unique_proteins)
+        self.matrix = AlignmentMatrix.from_proteins(self.unique_proteins, self.gaps)
+        self.matrix.calculate_statistics(num_proteins, ignore)
+
+        self.amino_acids = list(AMINO_ACIDS.keys())
+        self.aa_count = self.matrix.aa_count()
+        self.features_combo = [(x, y['display_name_short'], y['length']) for x,y in zip(list(AMINO_ACID_GROUP_NAMES.values()), list(AMINO_ACID_GROUP_PROPERTIES.values()))]
+        self.features = list(AMINO_ACID_GROUP_NAMES.values())
+
+        # created on request from the matrix
+        self.aa_count_with_protein = None
+        self.amino_acid_stats = None
+        self.feature_stats = None
+
+        # merge the amino acid counts into a consensus sequence
+        max_counts, ties = self.matrix.most_frequent()
+        labels = self.matrix.column_labels
+        sequence_counter = 1
+        for i, columns in self.matrix.segment_columns_sorted.items():
+            self.consensus[i] = OrderedDict()
+            self.forced_consensus[i] = OrderedDict()
+            for c in columns:
+                p = labels[c]
+                most_freq_aa = [self.amino_acids[a] for a in np.where(ties[c])[0]]
+                frequency = round(int(max_counts[c])/num_proteins*100)
+                conservation = str(frequency)
+                if len(conservation) == 1:
+                    cons_interval = '0'
+                else:
+                    cons_interval = conservation[:-1]
+
+                # forced consensus sequence uses the first residue to break ties
+                self.forced_consensus[i][p] = most_freq_aa[0]
+
+                # consensus sequence displays + in tie situations (unless positions are ignored)
+                if len(most_freq_aa) == 1:
+                    self.consensus[i][p] = [most_freq_aa[0], cons_interval, frequency, ""]
+                elif ignore:
+                    self.consensus[i][p] = [most_freq_aa[0], cons_interval, frequency, ", ".join(most_freq_aa)]
+                else:
+                    self.consensus[i][p] = ['+', cons_interval, frequency, ", ".join(most_freq_aa)]
+
+                # create a residue object full consensus
+                res = Residue()
+                res.sequence_number = sequence_counter
+                if p in self.generic_number_objs:
+                    res.display_generic_number = self.generic_number_objs[p]
+                res.family_generic_number = p
+                res.segment_slug = i
+                res.amino_acid = most_freq_aa[0]
+                res.frequency = frequency
+                self.full_consensus.append(res)
+                sequence_counter += 1
+
+        # process feature frequency
+        feature_percentages = self.matrix.feature_percentages()
+        feats = OrderedDict()
+        self.feat_consensus = OrderedDict([(x, []) for x in self.segments])
+        for sid, segment in enumerate(self.segments):
+            feats[segment] = feature_percentages[sid]
+            feat_cons_tmp = feats[segment].argmax(axis=0)
+            feat_cons_tmp = self._assign_preferred_features(feat_cons_tmp, segment, feats)
+            for col, pos in enumerate(list(feat_cons_tmp)):
+                self.feat_consensus[segment].append([
+                    list(AMINO_ACID_GROUP_PROPERTIES.values())[pos]['display_name_short'],
+                    list(AMINO_ACID_GROUP_NAMES.values())[pos],
+                    feats[segment][pos][col],
+                    int(feats[segment][pos][col]/20)+5,
+                    list(AMINO_ACID_GROUP_PROPERTIES.values())[pos]['length'],
+                    list(AMINO_ACID_GROUPS.keys())[pos]
+                ])
+
+        self.zscales = self.matrix.zscales()
+        self.stats_done = True
+
     def calculate_aa_count_per_generic_number(self):
         ''' Small function to return a dictionary of display_generic_number and the frequency of each AA '''
         generic_lookup_aa_freq = {}
@@ -1052,9 +1256,11 @@ class Alignment:
 
     def calculate_similarity(self, normalized=False):
         """Calculate the sequence identity/similarity of every selected protein compared to a selected reference"""
+        # look the values up in the similarity index if it covers the proteins and segments
+        indexed = self.similarity_from_index(normalized)
         for i, protein in enumerate(self.proteins):
             # skip the first row, as it is the reference
-            if i == 0:
+            if i == 0 or indexed:
                 continue
 
             # calculate identity, similarity and similarity score to the reference
@@ -1069,7 +1275,7 @@ class Alignment:
                 self.pairwise_similarity_normalized(self.proteins[0], self.proteins[i])
 
         # calculate normalized identity, similarity and similarity score, removes columns where reference is gapped, gaps in templates are removed from the specific pairwise alignment
-        if normalized:
+        if normalized and not indexed:
             i = 1
             for protein_2, values in self.normalized_scores.items():
                 for j in range(0, 3):
@@ -1094,6 +1300,22 @@ class Alignment:
             self.proteins.sort(key=lambda x: getattr(x, self.order_by), reverse=True)
         self.proteins.insert(0, ref)
 
+    def similarity_from_index(self, normalized=False):
+        """Set the identity, similarity and similarity score of the proteins from the similarity index (see
+        common.similarity_index), returns False if there is no index of the current build or it does not cover all
+        proteins and segments"""
+        index = similarity_index()
+        if index is None or len(self.proteins) < 2:
+            return False
+        entry_names = [protein.protein.entry_name for protein in self.proteins]
+        segments = list(self.segments)
+        if not index.covers(entry_names[0], entry_names[1:], segments):
+            return False
+        for protein, values in zip(self.proteins[1:], index.similarities(entry_names[0], entry_names[1:], segments,
+                                                                         normalized)):
+            protein.identity, protein.similarity, protein.similarity_score = values
+        return True
+
     def calculate_similarity_matrix(self):
         """Calculate a matrix of sequence identity/similarity for every selected protein"""
 
@@ -1104,17 +1326,29 @@ class Alignment:
             protein_name = "[" + protein.protein.species.common_name + "] " + protein.protein.name
             self.similarity_matrix[protein_key] = {'name': protein_name, 'values': [None] * len(self.proteins)}
 
-        # similarity comparisons
+        if not self.proteins:
+            return
+
+        # similarity comparisons of all pairs in one batch
+        segments = self.proteins[0].alignment
+        codes = np.array([encode_alignment_row(protein, segments) for protein in self.proteins], dtype=np.uint8)
+        identities, similarities, similarity_scores, totals = similarity_matrix(codes, self.gaps,
+                                                                                substitution_table(self.substitution_matrix))
+
         for i, protein in enumerate(self.proteins):
             protein_key = protein.protein.entry_name
             self.similarity_matrix[protein_key]['values'][i] = ['-', '-']
 
             for k in range(i+1, len(self.proteins)):
-                # calculate identity, similarity and similarity score to the reference
-                calc_values = self.pairwise_similarity(self.proteins[i], self.proteins[k])
+                total = int(totals[i][k])
+                if total:
+                    identity = "{:10.0f}".format(int(identities[i][k]) / total * 100)
+                    similarity = "{:10.0f}".format(int(similarities[i][k]) / total * 100)
+                else:
+                    identity = similarity = "{:10.0f}".format(-1)
 
                 # Identity
-                value = calc_values[1].strip()
+                value = similarity.strip()
                 if int(value) < 10:
                     color_class = 0
                 else:
@@ -1122,7 +1356,7 @@ class Alignment:
                 self.similarity_matrix[self.proteins[k].protein.entry_name]['values'][i] = [value, color_class]
 
                 # Similarity
-                value = calc_values[0].strip()
+                value = identity.strip()
                 if int(value) < 10:
                     color_class = 0
                 else:
@@ -1226,32 +1460,16 @@ class Alignment:
 
     def pairwise_similarity(self, protein_1, protein_2):
         """Calculate the identity, similarity and similarity score between a pair of proteins"""
-        identityscore = 0
-        similarityscore = 0
-        totalcount = 0
-        totalsimilarity = 0
-        for j, s in protein_2.alignment.items():
-            for k, p in enumerate(s):
-                reference_residue = protein_1.alignment[j][k][2]
-                protein_residue = protein_2.alignment[j][k][2]
-                if not (reference_residue in self.gaps and protein_residue in self.gaps):
-                    totalcount += 1
-                    # identity
-                    if protein_residue == reference_residue:
-                        identityscore += 1
-
-                    # similarity
-                    if not (reference_residue in self.gaps or protein_residue in self.gaps):
-                        pair = (protein_residue, reference_residue)
-                        # Similarity lookup is slow -> disabling results in 1/3 reduction calc. time
-                        similarity = self.score_match(pair, substitution_matrices.load("BLOSUM62"))
-                        #                        similarity = 1
-                        if similarity > 0:
-                            similarityscore += 1
-                            totalsimilarity += similarity
+        reference_codes = encode_alignment_row(protein_1, protein_2.alignment)
+        protein_codes = encode_alignment_row(protein_2)
+        identical, similar, counted, scores = pairwise_scores(reference_codes, protein_codes, self.gaps,
+                                                              substitution_table(self.substitution_matrix))
+        identityscore = int(identical.sum())
+        similarityscore = int(similar.sum())
+        totalcount = int(counted.sum())
+        totalsimilarity = float(scores[similar].sum())
 
         # format the calculated values
-        #if identityscore and similarityscore:
         if totalcount:
             identity = "{:10.0f}".format(identityscore / totalcount * 100)
             similarity = "{:10.0f}".format(similarityscore / totalcount * 100)
@@ -1269,38 +1487,31 @@ class Alignment:
         identities = OrderedDict()
         similarities = OrderedDict()
         similarity_scores = OrderedDict()
-        ref_seq, temp_seq = '',''
-        for j, s in protein_2.alignment.items():
-            for k, p in enumerate(s):
-                reference_residue = protein_1.alignment[j][k][2]
-                protein_residue = protein_2.alignment[j][k][2]
-                ref_seq+=reference_residue
-                temp_seq+=protein_residue
-                if not (reference_residue in self.gaps and protein_residue in self.gaps):
-                    # identity
-                    if protein_residue == reference_residue:
-                        identities[p[0]] = 1
-                    else:
-                        identities[p[0]] = 0
-
-                    # similarity
-                    if reference_residue in self.gaps:
-                        if p[0] not in self.residues_to_delete:
-                            self.residues_to_delete.append(p[0])
-                    elif protein_residue in self.gaps:
-                        del identities[p[0]]
-                        pass
-                    else:
-                        pair = (protein_residue, reference_residue)
-                        similarity = self.score_match(pair, substitution_matrices.load("BLOSUM62"))
-                        if similarity > 0:
-                            similarities[p[0]] = 1
-                        else:
-                            similarities[p[0]] = 0
-                        similarity_scores[p[0]] = similarity
+
+        reference_codes = encode_alignment_row(protein_1, protein_2.alignment)
+        protein_codes = encode_alignment_row(protein_2)
+        identical, similar, counted, scores = pairwise_scores(reference_codes, protein_codes, self.gaps,
+                                                              substitution_table(self.substitution_matrix))
+        reference_gaps = gap_mask(reference_codes, self.gaps)
+        protein_gaps = gap_mask(protein_codes, self.gaps)
+
+        to_delete = set(self.residues_to_delete)
+        labels = [p[0] for s in protein_2.alignment.values() for p in s]
+        for k, label in enumerate(labels):
+            if counted[k]:
+                identities[label] = int(identical[k])
+                if reference_gaps[k]:
+                    if label not in to_delete:
+                        self.residues_to_delete.append(label)
+                        to_delete.add(label)
+                elif protein_gaps[k]:
+                    del identities[label]
                 else:
-                    if p[0] not in self.residues_to_delete:
-                        self.residues_to_delete.append(p[0])
+                    similarities[label] = int(similar[k])
+                    similarity_scores[label] = float(scores[k])
+            elif label not in to_delete:
+                self.residues_to_delete.append(label)
+                to_delete.add(label)
         self.normalized_scores[protein_2] = [identities, similarities, similarity_scores]
 
     def score_match(self, pair, matrix):
@@ -1426,9 +1637,10 @@ class AlignedReferenceTemplate(Alignment):
                 if main_st.protein_conformation.protein.parent.entry_name in self.main_temp_ban_list:
                     self.main_temp_ban_list.remove(main_st.protein_conformation.protein.parent.entry_name)
             self.structures_data = self.structures_data.exclude(protein_conformation__protein__parent__entry_name__in=self.main_temp_ban_list)
-        self.load_proteins(
-            [Protein.objects.get(id=target.protein_conformation.protein.parent.id) for target in self.structures_data])
+        self.load_proteins(Protein.objects.filter(
+            id__in=set(self.structures_data.values_list('protein_conformation__protein__parent', flat=True))))
 
+    @timed('template_selection')
     def get_main_template(self):
         ''' Returns main template structure after checking for matching helix start and end positions.
         '''
@@ -1471,15 +1683,20 @@ class AlignedReferenceTemplate(Alignment):
         self.changes_on_db = True
         self.logger.info('Structure {} residue table sequence number overwrite pdb to wt'.format(structure))
 
+    @timed('template_selection')
     def create_helix_similarity_table(self):
         ''' Creates an ordered dictionary of structure objects, where templates are sorted by similarity and resolution.
         '''
         temp_list = []
         self.ordered_proteins = [self.proteins[0]]
         similarity_table = OrderedDict()
+        # structures grouped by protein, fetched with a single query
+        protein_structures = OrderedDict()
+        for m in self.structures_data.select_related('protein_conformation__protein__parent', 'pdb_code'):
+            protein_structures.setdefault(m.protein_conformation.protein.parent_id, []).append(m)
         for protein in self.proteins:
             try:
-                matches = self.structures_data.filter(protein_conformation__protein__parent=protein.protein)
+                matches = protein_structures.get(protein.protein.id, [])
                 for m in matches:
                     if m.protein_conformation.protein.parent==self.reference_protein.protein and int(protein.similarity)==0:
                         continue
@@ -1503,6 +1720,7 @@ class AlignedReferenceTemplate(Alignment):
             self.ordered_proteins.append(i[3])
         return similarity_table
 
+    @timed('template_selection')
     def create_loop_similarity_table(self):
         ''' Creates an ordered dictionary of structure objects, where templates are sorted by similarity and resolution.
             Only templates that have the same loop length as the reference are considered.
@@ -1916,11 +2134,28 @@ class ClosestReceptorHomolog():
             else:
                 structures = Structure.objects.filter(protein_conformation__protein__parent__family__slug__istartswith=self.family_mapping[p.family.slug[:3]]).exclude(
                     annotated=False).exclude(protein_conformation__protein__parent__entry_name__in=exclusion_list)
-            a.load_reference_protein(p)
             structure_proteins = []
             for i in structures:
                 if i.protein_conformation.protein.parent not in structure_proteins:
                     structure_proteins.append(i.protein_conformation.protein.parent)
+
+            # rank the templates with the similarity index, in the protein order of an alignment
+            index = similarity_index()
+            template_proteins = list(Protein.objects.filter(id__in=[i.id for i in structure_proteins]).filter(
+                proteinconformation__isnull=False).order_by('family__slug', 'entry_name').distinct())
+            template_names = [i.entry_name for i in template_proteins]
+            if index is not None and template_names and index.covers(p.entry_name, template_names, self.protein_segments):
+                ranked = index.ranked_templates(p.entry_name, template_names, self.protein_segments, self.normalized)
+                proteins = dict([(i.entry_name, i) for i in template_proteins])
+                max_sim, max_id, max_i = 0, 0, 0
+                for i, (entry_name, values) in enumerate(ranked):
+                    if int(values[1])>max_sim or int(values[1])==max_sim and int(values[0])>max_id:
+                        max_sim = int(values[1])
+                        max_id = int(values[0])
+                        max_i = i
+                return proteins[ranked[max_i][0]]
+
+            a.load_reference_protein(p)
             a.load_proteins(structure_proteins)
             a.load_segments(ProteinSegment.objects.filter(slug__in=self.protein_segments))
             a.build_alignment()
@@ -0,0 +1,133 @@
+"""
+Segment-granular alignment cache.
+
+An alignment block holds the aligned positions of one protein conformation in one segment (for a given residue
+selection mode), so any selection of proteins and segments can be stitched together from cached blocks. Blocks are
+kept in a size bounded in-process LRU (ALIGNMENT_BLOCK_CACHE_SIZE residues per process) in front of the persistent
+alignment cache. All block keys contain the build stamp (see common.build_stamp), so blocks of a previous build are
+never read, and a version number, which is bumped by the build steps that change residue data.
+"""
+from django.conf import settings
+from django.core.cache import cache, caches
+
+from collections import OrderedDict, namedtuple
+
+from common.build_stamp import build_stamp
+
+try:
+    cache_alignments = caches['alignments']
+except:
+    cache_alignments = cache
+
+# Plain representation of an aligned residue, as stored in the alignment blocks
+ResidueRecord = namedtuple('ResidueRecord', ['generic_number', 'display_generic_number_id', 'display_generic_number',
+                                             'display_scheme', 'amino_acid', 'sequence_number',
+                                             'alternative_generic_numbers'])
+
+VERSION_KEY = 'ALIGNMENT_BLOCKS_VERSION'
+
+# default number of residues kept in the memory of each process
+DEFAULT_MAX_SIZE = 100000
+
+
+def residue_record(r, alternative_numbers=False):
+    """Create a ResidueRecord from a Residue (or PackedResidue) object"""
+    if r.display_generic_number:
+        display = (r.display_generic_number.id, r.display_generic_number.label, r.display_generic_number.scheme.short_name)
+    else:
+        display = (None, None, None)
+    alternative_generic_numbers = ()
+    if alternative_numbers and r.generic_number:
+        alternative_generic_numbers = tuple((arn.scheme.slug, arn.label) for arn in r.alternative_generic_numbers.all())
+    return ResidueRecord(r.generic_number.label if r.generic_number else None, display[0], display[1], display[2],
+                         r.amino_acid, r.sequence_number, alternative_generic_numbers)
+
+
+class SegmentBlockCache:
+    """Two level (process LRU and persistent cache) store for alignment blocks"""
+
+    def __init__(self, backend, max_size=DEFAULT_MAX_SIZE, timeout=60*60*24*14):
+        self.backend = backend
+        self.max_size = max_size # maximum number of residues kept in process memory
+        self.timeout = timeout
+        self.blocks = OrderedDict()
+        self.size = 0
+        self.version = None
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def current_version(self):
+        version = self.backend.get(VERSION_KEY)
+        if version is None:
+            version = 1
+            self.backend.set(VERSION_KEY, version, None)
+        version = '{}_{}'.format(build_stamp(), version)
+        if version != self.version:
+            # blocks of an older build are no longer valid
+            self.clear_local()
+            self.version = version
+        return version
+
+    def key(self, pconf_id, segment, only_aligned=False, alternative_numbers=False):
+        return 'ALIGNMENT_BLOCK_{}_{}_{}_{}{}'.format(self.version, pconf_id, segment, int(only_aligned),
+                                                      int(alternative_numbers))
+
+    def get_blocks(self, keys):
+        """Fetch blocks for a list of keys, returns a dict with the blocks that were found"""
+        found = {}
+        backend_keys = []
+        for key in keys:
+            if key in self.blocks:
+                self.blocks.move_to_end(key)
+                found[key] = self.blocks[key]
+            else:
+                backend_keys.append(key)
+
+        if backend_keys:
+            stored = self.backend.get_many(backend_keys)
+            for key, block in stored.items():
+                found[key] = block
+                self.store_local(key, block)
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def set_blocks(self, blocks):
+        """Store a dict of key -> block"""
+        for key, block in blocks.items():
+            self.store_local(key, block)
+        self.backend.set_many(blocks, self.timeout)
+
+    def store_local(self, key, block):
+        if key in self.blocks:
+            self.size -= len(self.blocks.pop(key))
+        self.blocks[key] = block
+        self.size += len(block)
+
+        # evict least recently used blocks
+        while self.size > self.max_size and len(self.blocks) > 1:
+            old_key, old_block = self.blocks.popitem(last=False)
+            self.size -= len(old_block)
+            self.evictions += 1
+
+    def clear_local(self):
+        self.blocks = OrderedDict()
+        self.size = 0
+
+    def invalidate(self):
+        """Invalidate all blocks (called by build steps that change residue data)"""
+        version = self.backend.get(VERSION_KEY) or 1
+        self.backend.set(VERSION_KEY, version + 1, None)
+        self.clear_local()
+        self.version = None
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'blocks': len(self.blocks), 'size': self.size, 'max_size': self.max_size}
+
+
+segment_block_cache = SegmentBlockCache(cache_alignments, getattr(settings, 'ALIGNMENT_BLOCK_CACHE_SIZE', DEFAULT_MAX_SIZE))
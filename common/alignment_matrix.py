@@ -0,0 +1,212 @@
+"""
+A columnar representation of a protein alignment.
+
+The alignment is stored as a compact integer coded matrix (proteins x positions) together with side tables holding
+the segment and generic number of every column. Amino acid counts, feature frequencies, consensus sequences and
+Z-scales are calculated as reductions over this matrix, the nested dictionaries used by the templates are only
+created when they are requested.
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+from common.definitions import AA_ZSCALES, AMINO_ACID_GROUPS, AMINO_ACIDS, ZSCALES
+
+# Residue alphabet, the code of each amino acid is its index in this list
+ALPHABET = list(AMINO_ACIDS.keys())
+AA_CODES = dict([(aa, i) for i, aa in enumerate(ALPHABET)])
+GAP_CODE = AA_CODES['-']
+
+# Code for residues that are not counted (unknown amino acids, ignored positions, missing cells)
+SKIP_CODE = -1
+
+# Feature membership of each amino acid (alphabet x features)
+FEATURES = list(AMINO_ACID_GROUPS.keys())
+FEATURE_MATRIX = np.array([[int(aa in members) for members in AMINO_ACID_GROUPS.values()] for aa in ALPHABET],
+                          dtype=np.int32)
+
+# Z-scale values of the amino acids in the alphabet (alphabet x Z-scales), rows without values are zero
+ZSCALE_MASK = np.array([aa in AA_ZSCALES and aa != '-' for aa in ALPHABET])
+ZSCALE_MATRIX = np.array([AA_ZSCALES[aa] if aa in AA_ZSCALES else [0.0] * len(ZSCALES) for aa in ALPHABET],
+                         dtype=np.float64)
+
+
+def frequency_interval(frequency):
+    """Color interval of a frequency string. The intervals are defined as 0-10, where 0 is 0-9, 1 is 10-19 etc."""
+    if len(frequency) == 1:
+        return '0'
+    return frequency[:-1]
+
+
+class AlignmentMatrix:
+    """Integer coded alignment matrix with side tables for segments and generic numbers"""
+
+    def __init__(self, codes, entry_names, segments, column_segments, column_labels):
+        self.codes = codes # proteins x positions, int8
+        self.entry_names = np.array(entry_names)
+        self.segments = segments # segment slugs in alignment order
+        self.column_segments = column_segments # index in self.segments of each column
+        self.column_labels = column_labels # position label (generic number) of each column
+
+        # statistics, filled by calculate_statistics
+        self.num_proteins = len(entry_names)
+        self.aa_counts = None
+        self.feature_counts = None
+        self.stats_codes = None
+        self.segment_columns = OrderedDict()
+        self.segment_columns_sorted = OrderedDict()
+
+    @classmethod
+    def from_proteins(cls, proteins, gaps=('-', '_')):
+        """Encode the alignment rows of a list of ProteinConformations (as populated by Alignment.build_alignment)"""
+        segments = []
+        segment_index = {}
+        column_index = {}
+        column_segments = []
+        column_labels = []
+
+        # register all columns in order of appearance
+        for pc in proteins:
+            for segment, positions in pc.alignment.items():
+                if segment not in segment_index:
+                    segment_index[segment] = len(segments)
+                    segments.append(segment)
+                for p in positions:
+                    key = (segment, p[0])
+                    if key not in column_index:
+                        column_index[key] = len(column_labels)
+                        column_segments.append(segment_index[segment])
+                        column_labels.append(p[0])
+
+        codes = np.full((len(proteins), len(column_labels)), SKIP_CODE, dtype=np.int8)
+        for row, pc in enumerate(proteins):
+            for segment, positions in pc.alignment.items():
+                columns = [column_index[(segment, p[0])] for p in positions]
+                codes[row, columns] = [GAP_CODE if p[2] in gaps else AA_CODES.get(p[2], SKIP_CODE) for p in positions]
+
+        entry_names = [pc.protein.entry_name for pc in proteins]
+        return cls(codes, entry_names, segments, np.array(column_segments, dtype=np.int32), column_labels)
+
+    def masked_codes(self, ignore={}):
+        """Codes with ignored residues (and gaps when something is ignored) set to SKIP_CODE
+
+        @param ignore: dict of position label -> list of entry names to leave out at that position
+        """
+        codes = self.codes
+        if ignore:
+            codes = codes.copy()
+            codes[codes == GAP_CODE] = SKIP_CODE
+            for column, label in enumerate(self.column_labels):
+                ignore_list = ignore.get(label, [])
+                if ignore_list:
+                    codes[np.isin(self.entry_names, list(ignore_list)), column] = SKIP_CODE
+        return codes
+
+    @staticmethod
+    def count_codes(codes):
+        """Amino acid counts per column (positions x alphabet)"""
+        counts = np.zeros((codes.shape[1], len(ALPHABET)), dtype=np.int32)
+        for code in range(len(ALPHABET)):
+            counts[:, code] = (codes == code).sum(axis=0)
+        return counts
+
+    def calculate_statistics(self, num_proteins=None, ignore={}):
+        """Calculate amino acid and feature counts for all columns in one pass"""
+        if num_proteins:
+            self.num_proteins = num_proteins
+        self.stats_codes = self.masked_codes(ignore)
+        self.aa_counts = self.count_codes(self.stats_codes)
+        self.feature_counts = self.aa_counts @ FEATURE_MATRIX
+
+        # only columns with at least one counted residue are part of the statistics
+        included = self.aa_counts.sum(axis=1) > 0
+        self.segment_columns = OrderedDict()
+        self.segment_columns_sorted = OrderedDict()
+        for sid, segment in enumerate(self.segments):
+            columns = np.where((self.column_segments == sid) & included)[0]
+            self.segment_columns[segment] = columns
+            self.segment_columns_sorted[segment] = np.array(sorted(columns, key=lambda c: self.column_labels[c]),
+                                                            dtype=np.int64)
+
+    def percentages(self, counts):
+        """Counts converted to rounded integer percentages of the number of proteins"""
+        return np.rint(counts / self.num_proteins * 100).astype(int)
+
+    def aa_count(self):
+        """Nested dict view: segment -> position -> amino acid -> count"""
+        aa_count = OrderedDict()
+        for segment, columns in self.segment_columns.items():
+            aa_count[segment] = OrderedDict()
+            for c in columns:
+                aa_count[segment][self.column_labels[c]] = OrderedDict(zip(ALPHABET, self.aa_counts[c].tolist()))
+        return aa_count
+
+    def aa_count_with_protein(self):
+        """Nested dict view: position -> amino acid -> set of entry names"""
+        aa_count_with_protein = OrderedDict()
+        for segment, columns in self.segment_columns.items():
+            for c in columns:
+                label = self.column_labels[c]
+                if label not in aa_count_with_protein:
+                    aa_count_with_protein[label] = {}
+                column = self.stats_codes[:, c]
+                for code in np.unique(column[column != SKIP_CODE]):
+                    aa = ALPHABET[code]
+                    names = set(self.entry_names[column == code].tolist())
+                    aa_count_with_protein[label].setdefault(aa, set()).update(names)
+        return aa_count_with_protein
+
+    def most_frequent(self):
+        """Most frequent amino acids (ties in alphabet order) and their count for every column"""
+        max_counts = self.aa_counts.max(axis=1)
+        ties = self.aa_counts == max_counts[:, None]
+        return max_counts, ties
+
+    def frequency_stats(self, counts):
+        """Frequency table as used by the templates: [item][segment][sorted position] = [frequency, interval]"""
+        percentages = self.percentages(counts)
+        stats = []
+        for i in range(counts.shape[1]):
+            stats.append([])
+            for columns in self.segment_columns_sorted.values():
+                values = [str(v) for v in percentages[columns, i].tolist()]
+                stats[i].append([[v, frequency_interval(v)] for v in values])
+        return stats
+
+    def amino_acid_stats(self):
+        return self.frequency_stats(self.aa_counts)
+
+    def feature_stats(self):
+        return self.frequency_stats(self.feature_counts)
+
+    def feature_percentages(self):
+        """Per segment array of feature percentages (features x sorted positions)"""
+        percentages = self.percentages(self.feature_counts)
+        return [percentages[columns].T for columns in self.segment_columns_sorted.values()]
+
+    def zscales(self):
+        """Z-scale mean, standard deviation, count and display string for every column"""
+        counts = self.aa_counts * ZSCALE_MASK
+        n = counts.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = (counts @ ZSCALE_MATRIX) / n[:, None]
+            deviations = ((ZSCALE_MATRIX[None, :, :] - means[:, None, :]) ** 2 * counts[:, :, None]).sum(axis=1)
+            stds = np.sqrt(deviations / (n - 1)[:, None])
+
+        zscales = OrderedDict([(zscale, OrderedDict()) for zscale in ZSCALES])
+        for segment, columns in self.segment_columns.items():
+            for zscale in ZSCALES:
+                zscales[zscale][segment] = OrderedDict()
+            for c in columns:
+                label = self.column_labels[c]
+                count = int(n[c])
+                for key, zscale in enumerate(ZSCALES):
+                    z_mean = float(means[c, key])
+                    if count == 1:
+                        display = str(round(z_mean, 2)) + " ± " + str(0) + " (1)"
+                        zscales[zscale][segment][label] = [z_mean, 0, 1, display]
+                    else:
+                        z_std = float(stds[c, key]) if count else float('nan')
+                        display = str(round(z_mean, 2)) + " ± " + str(round(z_std, 2)) + " (" + str(count) + ")"
+                        zscales[zscale][segment][label] = [z_mean, z_std, count, display]
+        return zscales
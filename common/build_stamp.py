@@ -0,0 +1,34 @@
+"""
+Stamp of the current database build.
+
+build_all writes a new stamp to the build cache when a build starts. Data that is derived from the database and kept
+in the build cache (e.g. the similarity index) stores the stamp of the build it was created in and is only used while
+that stamp is current, so a new build never reads the data of the previous one.
+"""
+from django.conf import settings
+
+import os
+import time
+
+
+def build_stamp_path():
+    return os.sep.join([settings.BUILD_CACHE_DIR, 'build_stamp'])
+
+def start_build():
+    """Write a new stamp (atomically replacing the old one) and return it"""
+    os.makedirs(settings.BUILD_CACHE_DIR, exist_ok=True)
+    stamp = '{:.6f}'.format(time.time())
+    path = build_stamp_path()
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(stamp)
+    os.replace(tmp_path, path)
+    return stamp
+
+def build_stamp():
+    """Stamp of the current build, an empty string if no build has been started with build_all"""
+    try:
+        with open(build_stamp_path()) as f:
+            return f.read().strip()
+    except OSError:
+        return ''
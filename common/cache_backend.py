@@ -0,0 +1,242 @@
+"""
+Sharded, size-aware local cache backend.
+
+Entries are stored in a number of SQLite databases (shards) below LOCATION, the shard of a key is chosen from its hash.
+Every shard keeps track of the size of its entries and when it grows beyond its part of MAX_SIZE, the least recently
+used entries are evicted. Values larger than COMPRESS_MIN_SIZE are compressed with zlib.
+
+Usage in settings.CACHES:
+
+    'default': {
+        'BACKEND': 'common.cache_backend.ShardedCache',
+        'LOCATION': '/tmp/django_cache',
+        'OPTIONS': {
+            'MAX_SIZE': 20 * 1024**3,       # bytes, for all shards together
+            'SHARDS': 16,
+            'COMPRESS_MIN_SIZE': 16 * 1024, # bytes, 0 disables compression
+        }
+    }
+"""
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+
+import hashlib
+import os
+import pickle
+import sqlite3
+import time
+import zlib
+
+from common.instrumentation import count_event
+
+# access times are only updated when they are older than this (seconds), which avoids a write for every read
+ACCESS_RESOLUTION = 60
+
+# fraction of the shard size that is kept when culling
+CULL_TARGET = 0.9
+
+
+class ShardedCache(BaseCache):
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self.location = location
+        self.num_shards = int(options.get('SHARDS', 16))
+        self.max_size = int(options.get('MAX_SIZE', 10 * 1024**3))
+        self.compress_min_size = int(options.get('COMPRESS_MIN_SIZE', 16 * 1024))
+        self.shard_max_size = self.max_size // self.num_shards
+        self.connections = {}
+        self.pid = None
+
+        # counters of this process
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Storage
+
+    def shard(self, key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:8], 16) % self.num_shards
+
+    def connection(self, shard):
+        # connections can not be shared with forked processes
+        if self.pid != os.getpid():
+            self.connections = {}
+            self.pid = os.getpid()
+        if shard not in self.connections:
+            os.makedirs(self.location, exist_ok=True)
+            path = os.path.join(self.location, 'shard_{:03d}.sqlite'.format(shard))
+            db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, compressed INTEGER, '
+                       'size INTEGER, expires REAL, accessed REAL)')
+            db.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+            db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)')
+            db.execute("INSERT OR IGNORE INTO meta VALUES ('size', 0), ('evictions', 0)")
+            self.connections[shard] = db
+        return self.connections[shard]
+
+    def encode(self, value):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if self.compress_min_size and len(data) >= self.compress_min_size:
+            return zlib.compress(data, 1), 1
+        return data, 0
+
+    def decode(self, data, compressed):
+        if compressed:
+            data = zlib.decompress(data)
+        return pickle.loads(data)
+
+    def write(self, key, value, timeout, only_new=False):
+        data, compressed = self.encode(value)
+        expires = self.get_backend_timeout(timeout)
+        now = time.time()
+        db = self.connection(self.shard(key))
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute('SELECT size, expires FROM cache WHERE key = ?', (key,)).fetchone()
+            if row and only_new and (row[1] is None or row[1] > now):
+                return False
+            old_size = row[0] if row else 0
+            db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)',
+                       (key, sqlite3.Binary(data), compressed, len(data), expires, now))
+            db.execute("UPDATE meta SET value = value + ? WHERE name = 'size'", (len(data) - old_size,))
+            self.cull(db)
+        return True
+
+    def cull(self, db):
+        """Evict expired and least recently used entries when the shard is over its size limit"""
+        size = db.execute("SELECT value FROM meta WHERE name = 'size'").fetchone()[0]
+        if size <= self.shard_max_size:
+            return
+        removed_size, removed = db.execute('SELECT COALESCE(SUM(size), 0), COUNT(*) FROM cache WHERE expires <= ?',
+                                           (time.time(),)).fetchone()
+        db.execute('DELETE FROM cache WHERE expires <= ?', (time.time(),))
+        size -= removed_size
+        target = int(self.shard_max_size * CULL_TARGET)
+        if size > target:
+            keys = []
+            evicted_size = 0
+            for key, entry_size in db.execute('SELECT key, size FROM cache ORDER BY accessed'):
+                if size - evicted_size <= target:
+                    break
+                keys.append(key)
+                evicted_size += entry_size
+            db.executemany('DELETE FROM cache WHERE key = ?', [(key,) for key in keys])
+            size -= evicted_size
+            removed += len(keys)
+        db.execute("UPDATE meta SET value = ? WHERE name = 'size'", (size,))
+        db.execute("UPDATE meta SET value = value + ? WHERE name = 'evictions'", (removed,))
+        self.evictions += removed
+
+    def read(self, keys):
+        """Fetch the values of a list of keys from one shard, returns a dict with the keys that were found"""
+        found = {}
+        if not keys:
+            return found
+        now = time.time()
+        db = self.connection(self.shard(keys[0]))
+        touched = []
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = db.execute('SELECT key, value, compressed, expires, accessed FROM cache WHERE key IN ({})'.format(
+                ','.join('?' * len(chunk))), chunk).fetchall()
+            for key, data, compressed, expires, accessed in rows:
+                if expires is not None and expires <= now:
+                    continue
+                found[key] = self.decode(data, compressed)
+                if now - accessed > ACCESS_RESOLUTION:
+                    touched.append((now, key))
+        if touched:
+            with db:
+                db.executemany('UPDATE cache SET accessed = ? WHERE key = ?', touched)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        count_event('cache_hits', len(found))
+        count_event('cache_misses', len(keys) - len(found))
+        return found
+
+    # Cache API
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return self.write(key, value, timeout, only_new=True)
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return self.read([key]).get(key, default)
+
+    def get_many(self, keys, version=None):
+        key_map = {}
+        shards = {}
+        for k in keys:
+            key = self.make_key(k, version=version)
+            self.validate_key(key)
+            key_map[key] = k
+            shards.setdefault(self.shard(key), []).append(key)
+        result = {}
+        for shard_keys in shards.values():
+            for key, value in self.read(shard_keys).items():
+                result[key_map[key]] = value
+        return result
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        self.write(key, value, timeout)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        db = self.connection(self.shard(key))
+        with db:
+            updated = db.execute('UPDATE cache SET expires = ?, accessed = ? WHERE key = ? AND (expires IS NULL OR expires > ?)',
+                                 (self.get_backend_timeout(timeout), time.time(), key, time.time())).rowcount
+        return updated > 0
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        db = self.connection(self.shard(key))
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute('SELECT size FROM cache WHERE key = ?', (key,)).fetchone()
+            if not row:
+                return False
+            db.execute('DELETE FROM cache WHERE key = ?', (key,))
+            db.execute("UPDATE meta SET value = value - ? WHERE name = 'size'", (row[0],))
+        return True
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        row = self.connection(self.shard(key)).execute('SELECT expires FROM cache WHERE key = ?', (key,)).fetchone()
+        return bool(row) and (row[0] is None or row[0] > time.time())
+
+    def clear(self):
+        for shard in range(self.num_shards):
+            db = self.connection(shard)
+            with db:
+                db.execute('DELETE FROM cache')
+                db.execute("UPDATE meta SET value = 0 WHERE name = 'size'")
+
+    def close(self, **kwargs):
+        # connections are kept open for the lifetime of the process
+        pass
+
+    def stats(self):
+        """Counters of this process and the size of all shards"""
+        entries = 0
+        size = 0
+        evictions = 0
+        for shard in range(self.num_shards):
+            db = self.connection(shard)
+            entries += db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+            meta = dict(db.execute('SELECT name, value FROM meta').fetchall())
+            size += meta['size']
+            evictions += meta['evictions']
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'total_evictions': evictions,
+                'entries': entries, 'size': size, 'max_size': self.max_size}
@@ -0,0 +1,141 @@
+"""
+Cache warming for expensive cached data products.
+
+A product is a function that builds cached data (e.g. the class conservation used by the mutation design tools), the
+cache key it is stored under and the data it depends on. Products are registered with the register_product decorator
+and read with get_product. Values are stored without expiry next to a freshness marker, which expires after the
+product timeout or when one of its dependencies is invalidated (by the build steps that change the data, e.g.
+build_mutant_data invalidates mutations). A stale value is still served while it is rebuilt in a background thread,
+so requests only wait for a product that has never been built. The warm_caches command builds all products after
+the build steps, so this does not happen in production.
+"""
+from django.core.cache import cache
+from django.db import connection
+
+from collections import OrderedDict
+import threading
+import time
+import logging
+
+logger = logging.getLogger('protwis')
+
+# maximum time (seconds) a background rebuild is expected to take, a new one can be started afterwards
+REBUILD_LOCK_TIMEOUT = 60*60
+
+# dependency that is invalidated when a build has completed (see build_version)
+BUILD_DEPENDENCY = 'build'
+
+products = OrderedDict()
+
+
+class CacheProduct:
+
+    def __init__(self, name, key, builder, dependencies, parameters, timeout):
+        self.name = name
+        self.key = key
+        self.builder = builder
+        self.dependencies = list(dependencies)
+        self.parameters = parameters
+        self.timeout = timeout
+
+    def cache_key(self, *args):
+        return self.key.format(*args)
+
+    def arguments(self):
+        """Argument tuples of all variants of the product (e.g. one per class)"""
+        if self.parameters is None:
+            return [()]
+        return [args if isinstance(args, tuple) else (args,) for args in self.parameters()]
+
+
+def register_product(name, key, dependencies=(), parameters=None, timeout=60*60*24*7):
+    """Register the decorated function as the builder of a cached product
+
+    @param key: cache key, formatted with the builder arguments
+    @param dependencies: names of the data the product is built from (see invalidate_dependency)
+    @param parameters: function returning the arguments of all variants of the product
+    @param timeout: seconds after which the product is rebuilt
+    """
+    def decorator(builder):
+        products[name] = CacheProduct(name, key, builder, dependencies, parameters, timeout)
+        return builder
+    return decorator
+
+def dependency_versions(product):
+    versions = cache.get_many(['cache_warming_version_' + dependency for dependency in product.dependencies])
+    return [versions.get('cache_warming_version_' + dependency, 0) for dependency in product.dependencies]
+
+def invalidate_dependency(dependency):
+    """Mark all products built from the given data as stale"""
+    cache.set('cache_warming_version_' + dependency, time.time(), None)
+
+def build_version():
+    """Version of the data of the last completed build, a new version is started if it is not known (e.g. after the
+    cache has been cleared)"""
+    key = 'cache_warming_version_' + BUILD_DEPENDENCY
+    cache.add(key, time.time(), None)
+    return cache.get(key, 0)
+
+def build_product(name, *args):
+    """Build a product and store it in the cache"""
+    product = products[name]
+    key = product.cache_key(*args)
+    versions = dependency_versions(product)
+    value = product.builder(*args)
+    cache.set(key, value, None)
+    cache.set(key + '_fresh', versions, product.timeout)
+    return value
+
+def rebuild_in_background(name, *args):
+    key = products[name].cache_key(*args)
+    # only one rebuild per product at a time (across processes)
+    if not cache.add(key + '_rebuilding', True, REBUILD_LOCK_TIMEOUT):
+        return
+
+    def rebuild():
+        try:
+            build_product(name, *args)
+        except Exception as msg:
+            logger.error('Rebuilding cached product {} {} failed: {}'.format(name, args, msg))
+        finally:
+            cache.delete(key + '_rebuilding')
+            connection.close()
+
+    threading.Thread(target=rebuild, daemon=True).start()
+
+def get_product(name, *args):
+    """Cached value of a product, stale values are returned while they are rebuilt in the background"""
+    product = products[name]
+    key = product.cache_key(*args)
+    value = cache.get(key)
+    if value is None:
+        return build_product(name, *args)
+    if cache.get(key + '_fresh') != dependency_versions(product):
+        rebuild_in_background(name, *args)
+    return value
+
+def warm_products(names=None, dependencies=None):
+    """Build all variants of the given products (default: all), optionally only those depending on the given data.
+    Products that fail are logged and skipped, returns the number of failed builds."""
+    failed = 0
+    for product in list(products.values()):
+        if names and product.name not in names:
+            continue
+        if dependencies and not set(dependencies) & set(product.dependencies):
+            continue
+        try:
+            arguments = product.arguments()
+        except Exception as msg:
+            logger.error('Listing the variants of cached product {} failed: {}'.format(product.name, msg))
+            failed += 1
+            continue
+        for args in arguments:
+            start = time.time()
+            try:
+                build_product(product.name, *args)
+            except Exception as msg:
+                logger.error('Building cached product {} {} failed: {}'.format(product.name, ' '.join(map(str, args)), msg))
+                failed += 1
+                continue
+            logger.info('Built cached product {} {} in {:.1f}s'.format(product.name, ' '.join(map(str, args)), time.time() - start))
+    return failed
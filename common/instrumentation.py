@@ -0,0 +1,150 @@
+"""
+Lightweight request instrumentation.
+
+StatsMiddleware starts a RequestStats for every request. While the request is handled, code can record the time
+spent in named sections and count events:
+
+    with timed_section('alignment_build'):
+        ...
+
+    @timed('alignment_statistics')
+    def calculate_statistics(self):
+        ...
+
+    count_event('cache_hits', len(found))
+
+Outside of a request (e.g. in build commands) these calls only cost a thread local lookup. SQL queries are counted
+and timed through a database execute wrapper, so this also works without DEBUG. Nested sections are each counted
+with their full time, a section nested in itself (e.g. a recursive function) is only counted once.
+
+SamplingProfiler is an opt-in sampling profiler for slow endpoints: a background thread records the stack of the
+request thread at a fixed interval, the result is written as collapsed stacks (the input format of flame graph tools).
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+import sys
+import threading
+import time
+
+local = threading.local()
+
+
+class RequestStats:
+    """Statistics of the request handled by the current thread"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.sections = defaultdict(float)
+        self.section_calls = defaultdict(int)
+        self.active_sections = set()
+        self.counters = defaultdict(int)
+
+    def as_dict(self):
+        return {
+            'sql_count': self.sql_count,
+            'sql_time': round(self.sql_time, 4),
+            'sections': dict([(name, {'time': round(seconds, 4), 'calls': self.section_calls[name]})
+                              for name, seconds in self.sections.items()]),
+            'counters': dict(self.counters),
+        }
+
+
+def current_stats():
+    return getattr(local, 'stats', None)
+
+def start_request():
+    local.stats = RequestStats()
+    return local.stats
+
+def finish_request():
+    stats = current_stats()
+    local.stats = None
+    return stats
+
+@contextmanager
+def timed_section(name):
+    """Add the time spent in the block to the named section of the current request"""
+    stats = current_stats()
+    if stats is None or name in stats.active_sections:
+        yield
+        return
+    stats.active_sections.add(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.active_sections.discard(name)
+        stats.sections[name] += time.perf_counter() - start
+        stats.section_calls[name] += 1
+
+def timed(name):
+    """Decorator recording the time spent in a function as a named section"""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with timed_section(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count_event(name, n=1):
+    stats = current_stats()
+    if stats is not None:
+        stats.counters[name] += n
+
+def sql_timer(execute, sql, params, many, context):
+    """Database execute wrapper (see connection.execute_wrapper) counting and timing the queries of a request"""
+    stats = current_stats()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.sql_count += 1
+        stats.sql_time += time.perf_counter() - start
+
+
+class SamplingProfiler:
+    """Samples the stack of a thread at a fixed interval (seconds) until it is stopped"""
+
+    def __init__(self, thread_id=None, interval=0.005):
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval
+        self.samples = defaultdict(int)
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples[self.collapse(frame)] += 1
+            time.sleep(self.interval)
+
+    @staticmethod
+    def collapse(frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{} ({}:{})'.format(code.co_name, code.co_filename, frame.f_lineno))
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+    def collapsed_stacks(self):
+        """Samples as collapsed stacks, one 'frame;frame;... count' line per distinct stack"""
+        return ''.join(['{} {}\n'.format(stack, count) for stack, count in
+                        sorted(self.samples.items(), key=lambda x: x[1], reverse=True)])
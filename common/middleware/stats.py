@@ -1,37 +1,131 @@
 from django.conf import settings
 from django.db import connection
 
-import time
+from common.instrumentation import start_request, finish_request, sql_timer, SamplingProfiler
+
+from collections import defaultdict
+import atexit
 import datetime
+import json
 import os
-#import uuid
+import queue
+import random
+import re
+import threading
+import time
+
+# requests slower than this (seconds) are also written to the slow logs
+SLOW_REQUEST_TIME = 5
+
+# maximum number of log records waiting to be written, records are dropped when the writer falls behind
+LOG_QUEUE_SIZE = 10000
+
+
+class LogWriter:
+    """
+    Writes log lines in a background thread, so requests never wait for the disk.
+
+    Lines are queued without blocking and written in batches (one open per file per batch).
+    """
+
+    def __init__(self, max_size=LOG_QUEUE_SIZE):
+        self.queue = queue.Queue(max_size)
+        self.dropped = 0
+        self.pid = None
+        self.lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def start(self):
+        # (re)start the writer thread in every worker process (threads do not survive a fork)
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                threading.Thread(target=self.run, daemon=True).start()
+
+    def write(self, log_file, line):
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait((log_file, line))
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < 1000:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.write_batch(batch)
+
+    def write_batch(self, batch):
+        lines = defaultdict(list)
+        for log_file, line in batch:
+            lines[log_file].append(line)
+        for log_file, file_lines in lines.items():
+            try:
+                with open(log_file, "a") as text_file:
+                    text_file.writelines(file_lines)
+            except OSError:
+                pass
+
+    def flush(self):
+        """Write the remaining lines (at exit)"""
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        self.write_batch(batch)
+
+
+log_writer = LogWriter()
 
 
 class StatsMiddleware:
     """
     Class that handles request and error logging.
 
-    Each response is timed and the user agent is checked for a bot/crawler tag.
-    Slow responses are separately logged and so are errors.
+    Each response is timed and the user agent is checked for a bot/crawler tag. Requests are logged as JSON lines with
+    the number and time of SQL queries, cache hits and misses, timed code sections (see common.instrumentation) and
+    other counters. Slow responses are separately logged and so are errors. Log lines are written in the background.
+
+    Requests to paths matching one of the regular expressions in settings.STATS_PROFILE_PATHS can be profiled with a
+    sampling profiler (a fraction STATS_PROFILE_SAMPLE_RATE of them, sampling every STATS_PROFILE_INTERVAL seconds).
+    Profiles of requests taking longer than STATS_PROFILE_MIN_TIME seconds are written to logs/profiles as collapsed
+    stacks.
     """
 
     def __init__(self, get_response):
         self.get_response = get_response
         # One-time configuration and initialization.
+        self.profile_paths = [re.compile(path) for path in getattr(settings, 'STATS_PROFILE_PATHS', [])]
+        self.profile_sample_rate = getattr(settings, 'STATS_PROFILE_SAMPLE_RATE', 1.0)
+        self.profile_interval = getattr(settings, 'STATS_PROFILE_INTERVAL', 0.005)
+        self.profile_min_time = getattr(settings, 'STATS_PROFILE_MIN_TIME', 1)
 
     def __call__(self, request):
         """Handling protwis request logs."""
-#       # Start/top logger - not needed as we do slow query logging instead
-#        request_id = uuid.uuid4().hex
-#        text_file = open(os.path.join(settings.BASE_DIR, "logs/stats_start_stop.log"), "a")
-#        text_file.write('%s %s %s START %s %s\n' % (datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),request.META.get('REMOTE_ADDR'),request_id, request.method, request.path ))
-#        text_file.close()
-
         # start timer
         start_time = time.time()
+        stats = start_request()
+        profiler = None
+        if self.profile_paths and random.random() < self.profile_sample_rate \
+                and any(path.search(request.path) for path in self.profile_paths):
+            profiler = SamplingProfiler(interval=self.profile_interval)
+            profiler.start()
 
         # Handle request
-        response = self.get_response(request)
+        try:
+            with connection.execute_wrapper(sql_timer):
+                response = self.get_response(request)
+        finally:
+            finish_request()
+            if profiler:
+                profiler.stop()
 
         # CODE BELOW is executed after handling the request
         # End timer
@@ -39,38 +133,37 @@ class StatsMiddleware:
 
         if settings.DEBUG:
             print(request.path, "Time to execute", round(
-                total, 2), "SQL queries", len(connection.queries))
+                total, 2), "SQL queries", stats.sql_count)
 
         bot_user = self.bot_detection(request)
-        log_file = os.path.join(settings.BASE_DIR, "logs/stats.log")
-        if bot_user:
-            log_file = os.path.join(settings.BASE_DIR, "logs/stats_bots.log")
-
-        text_file = open(log_file, "a")
+        record = {
+            'time': datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+            'duration': round(total, 3),
+            'ip': request.META.get('HTTP_X_FORWARDED_FOR'),
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+        }
+        record.update(stats.as_dict())
+        record['cache_hits'] = record['counters'].pop('cache_hits', 0)
+        record['cache_misses'] = record['counters'].pop('cache_misses', 0)
         if bot_user:
-            text_file.write('%s %s %s %s %s %s\n' % (datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), round(total, 2),
-                                                     request.META.get('HTTP_X_FORWARDED_FOR'), request.method, request.path, request.META.get('HTTP_USER_AGENT')))
-        else:
-            text_file.write('%s %s %s %s %s\n' % (datetime.datetime.utcnow().strftime(
-                "%Y-%m-%d %H:%M:%S"), round(total, 2), request.META.get('HTTP_X_FORWARDED_FOR'), request.method, request.path))
+            record['user_agent'] = request.META.get('HTTP_USER_AGENT')
+        line = json.dumps(record) + '\n'
 
-        text_file.close()
-
-#       # Start/top logger - not needed as we do slow query logging instead
-#        text_file = open(os.path.join(settings.BASE_DIR, "logs/stats_start_stop.log"), "a")
-#        text_file.write('%s %s %s FINISH %s %s %s\n' % (datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),request.META.get('REMOTE_ADDR'),request_id, round(total,2), request.method, request.path ))
-#        text_file.close()
+        log_file = "logs/stats_bots.log" if bot_user else "logs/stats.log"
+        log_writer.write(os.path.join(settings.BASE_DIR, log_file), line)
 
         # Extended logging of queries that are slower than 5 seconds
-        if total > 5:
-            log_file = os.path.join(settings.BASE_DIR, "logs/stats_slow.log")
-            if bot_user:
-                log_file = os.path.join(
-                    settings.BASE_DIR, "logs/stats_slow_bots.log")
-            text_file = open(log_file, "a")
-            text_file.write('%s %s %s %s %s %s\n' % (datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), round(total, 2),
-                                                     request.META.get('HTTP_X_FORWARDED_FOR'), request.method, request.path, request.META.get('HTTP_USER_AGENT')))
-            text_file.close()
+        if total > SLOW_REQUEST_TIME:
+            if not bot_user:
+                record['user_agent'] = request.META.get('HTTP_USER_AGENT')
+                line = json.dumps(record) + '\n'
+            log_file = "logs/stats_slow_bots.log" if bot_user else "logs/stats_slow.log"
+            log_writer.write(os.path.join(settings.BASE_DIR, log_file), line)
+
+        if profiler and total >= self.profile_min_time:
+            self.write_profile(request, profiler)
 
         return response
 
@@ -79,10 +172,17 @@ class StatsMiddleware:
         if self.bot_detection(request):
             log_file = os.path.join(settings.BASE_DIR, "logs/errors_bots.log")
 
-        text_file = open(log_file, "a")
-        text_file.write('%s %s - %s %s - %s "%s" "%s"\n' % (datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), request.method, request.path,
-                                                            request.META.get('HTTP_REFERER'), request.META.get('HTTP_X_FORWARDED_FOR'), request.META.get('HTTP_USER_AGENT'), str(exception)))
-        text_file.close()
+        log_writer.write(log_file, '%s %s - %s %s - %s "%s" "%s"\n' % (datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), request.method, request.path,
+                                                                       request.META.get('HTTP_REFERER'), request.META.get('HTTP_X_FORWARDED_FOR'), request.META.get('HTTP_USER_AGENT'), str(exception)))
+
+    @staticmethod
+    def write_profile(request, profiler):
+        """Write the collapsed stacks of a profiled request to logs/profiles (in the background)"""
+        profile_dir = os.path.join(settings.BASE_DIR, "logs/profiles")
+        os.makedirs(profile_dir, exist_ok=True)
+        name = '%s_%s_%s.txt' % (datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S"), os.getpid(),
+                                 re.sub(r'[^A-Za-z0-9]+', '_', request.path).strip('_')[:100])
+        log_writer.write(os.path.join(profile_dir, name), profiler.collapsed_stacks())
 
     @staticmethod
     def bot_detection(request):
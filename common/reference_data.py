@@ -0,0 +1,216 @@
+"""
+Shared read-only reference data: generic numbers, numbering schemes, protein segments and families.
+
+These tables only change at build time. build_reference_data writes them as structured arrays (.npy) to the build
+cache at the end of build_all. Every process maps the files read-only, so the pages are shared by all web workers,
+and resolves lookups without the database. Without a snapshot the tables are read from the database once per
+process. build_all removes the snapshot of the previous build when it starts, so the build steps that change the
+tables read them from the database, and the tables loaded by the build process are dropped after every step.
+Generic numbers are stored in the label order of the database and their position in that order is used as a dense
+integer id across all schemes.
+"""
+from django.conf import settings
+
+from collections import OrderedDict
+import os
+
+import numpy as np
+
+# id of a missing foreign key
+NO_ID = -1
+
+GENERIC_NUMBER_DTYPE = np.dtype([('id', np.int32), ('label', 'U12'), ('scheme_id', np.int32), ('segment_id', np.int32)])
+EQUIVALENT_DTYPE = np.dtype([('id', np.int32), ('default_generic_number_id', np.int32), ('label', 'U12'),
+                             ('scheme_id', np.int32)])
+SCHEME_DTYPE = np.dtype([('id', np.int32), ('slug', 'U20'), ('parent_id', np.int32)])
+SEGMENT_DTYPE = np.dtype([('id', np.int32), ('slug', 'U100'), ('name', 'U50'), ('category', 'U50'),
+                          ('fully_aligned', bool), ('partial', bool), ('proteinfamily', 'U20')])
+FAMILY_DTYPE = np.dtype([('id', np.int32), ('slug', 'U100'), ('name', 'U200'), ('parent_id', np.int32)])
+
+
+def query_generic_numbers():
+    from residue.models import ResidueGenericNumber
+    return ResidueGenericNumber.objects.order_by('label', 'id').values_list('id', 'label', 'scheme_id',
+                                                                              'protein_segment_id')
+
+def query_equivalents():
+    from residue.models import ResidueGenericNumberEquivalent
+    return ResidueGenericNumberEquivalent.objects.order_by('id').values_list('id', 'default_generic_number_id',
+                                                                              'label', 'scheme_id')
+
+def query_schemes():
+    from residue.models import ResidueNumberingScheme
+    return ResidueNumberingScheme.objects.order_by('id').values_list('id', 'slug', 'parent_id')
+
+def query_segments():
+    from protein.models import ProteinSegment
+    return ProteinSegment.objects.order_by('id').values_list('id', 'slug', 'name', 'category', 'fully_aligned',
+                                                              'partial', 'proteinfamily')
+
+def query_families():
+    from protein.models import ProteinFamily
+    return ProteinFamily.objects.order_by('id').values_list('id', 'slug', 'name', 'parent_id')
+
+# tables of the snapshot, families are written last and their file marks the version of the snapshot
+TABLES = OrderedDict([
+    ('generic_numbers', (GENERIC_NUMBER_DTYPE, query_generic_numbers)),
+    ('equivalents', (EQUIVALENT_DTYPE, query_equivalents)),
+    ('schemes', (SCHEME_DTYPE, query_schemes)),
+    ('segments', (SEGMENT_DTYPE, query_segments)),
+    ('families', (FAMILY_DTYPE, query_families)),
+])
+
+
+def reference_data_dir():
+    return os.sep.join([settings.BUILD_CACHE_DIR, 'reference_data'])
+
+def reference_table_path(name):
+    return os.sep.join([reference_data_dir(), '{}.npy'.format(name)])
+
+def query_reference_table(name):
+    """Table from the database, missing foreign keys are stored as NO_ID"""
+    dtype, query = TABLES[name]
+    rows = [tuple(NO_ID if value is None else value for value in row) for row in query()]
+    return np.array(rows, dtype=dtype)
+
+def save_reference_data():
+    """Write a snapshot of all reference tables (each file is atomically replaced)"""
+    os.makedirs(reference_data_dir(), exist_ok=True)
+    for name in TABLES:
+        path = reference_table_path(name)
+        tmp_path = '{}.{}.tmp.npy'.format(path, os.getpid())
+        np.save(tmp_path, query_reference_table(name))
+        os.replace(tmp_path, path)
+
+def remove_reference_data():
+    """Remove the snapshot, e.g. before a build changes the reference tables"""
+    for name in TABLES:
+        try:
+            os.remove(reference_table_path(name))
+        except FileNotFoundError:
+            pass
+    clear_loaded_reference_data()
+
+def snapshot_version():
+    """Modification time of the snapshot, None if there is none"""
+    try:
+        return os.path.getmtime(reference_table_path(next(reversed(TABLES))))
+    except OSError:
+        return None
+
+def load_reference_tables():
+    """Memory-mapped tables of the snapshot, tables without a snapshot are read from the database"""
+    tables = {}
+    for name in TABLES:
+        path = reference_table_path(name)
+        if os.path.isfile(path):
+            tables[name] = np.load(path, mmap_mode='r')
+        else:
+            tables[name] = query_reference_table(name)
+    return tables
+
+
+class ReferenceData:
+    """Lookups on the reference tables, derived indexes are created when they are first used"""
+
+    def __init__(self, tables):
+        self.generic_numbers = tables['generic_numbers']
+        self.equivalents = tables['equivalents']
+        self.schemes = tables['schemes']
+        self.segments = tables['segments']
+        self.families = tables['families']
+        self._indexes = {}
+
+    def index(self, name, builder):
+        if name not in self._indexes:
+            self._indexes[name] = builder()
+        return self._indexes[name]
+
+    # Generic numbers
+
+    def generic_number_index(self, ids):
+        """Dense ids (positions in label order) of generic number ids"""
+        ids = np.asarray(ids)
+        order = self.index('generic_number_order', lambda: np.argsort(self.generic_numbers['id']))
+        return order[np.searchsorted(self.generic_numbers['id'], ids, sorter=order)]
+
+    def generic_number_labels(self, ids):
+        return self.generic_numbers['label'][self.generic_number_index(ids)].tolist()
+
+    def scheme_id(self, slug):
+        schemes = self.index('scheme_ids', lambda: dict(zip(self.schemes['slug'].tolist(), self.schemes['id'].tolist())))
+        return schemes[slug]
+
+    def segment_generic_numbers(self, segment_ids, scheme_id):
+        """Generic number labels of the given segments in a numbering scheme, ordered by label"""
+        scheme_numbers = self.index('scheme_generic_numbers_{}'.format(scheme_id),
+                                    lambda: self.generic_numbers[self.generic_numbers['scheme_id'] == scheme_id])
+        return scheme_numbers['label'][np.isin(scheme_numbers['segment_id'], list(segment_ids))].tolist()
+
+    def equivalent_labels(self, scheme_slug):
+        """Labels in a numbering scheme of the default generic numbers (by id)"""
+        def builder():
+            records = self.equivalents[self.equivalents['scheme_id'] == self.scheme_id(scheme_slug)]
+            return dict(zip(records['default_generic_number_id'].tolist(), records['label'].tolist()))
+        return self.index('equivalent_labels_' + scheme_slug, builder)
+
+    # Segments
+
+    def segment_records(self, **conditions):
+        """Segments (as dicts, ordered by id) matching all conditions, e.g. proteinfamily='GPCR', partial=False"""
+        mask = np.ones(len(self.segments), dtype=bool)
+        for field, value in conditions.items():
+            mask &= self.segments[field] == value
+        return [dict(zip(SEGMENT_DTYPE.names, record)) for record in self.segments[mask].tolist()]
+
+    def segment_slugs(self, **conditions):
+        return [segment['slug'] for segment in self.segment_records(**conditions)]
+
+    # Families
+
+    def family_slugs(self):
+        return self.index('family_slugs', lambda: dict(zip(self.families['id'].tolist(), self.families['slug'].tolist())))
+
+    def family_children(self, slug):
+        """Slugs of the child families of a family, ordered by id"""
+        families = self.families
+        parent_ids = families['id'][families['slug'] == slug]
+        if not len(parent_ids):
+            return []
+        return families['slug'][families['parent_id'] == parent_ids[0]].tolist()
+
+    def family_name(self, slug):
+        names = self.index('family_names', lambda: dict(zip(self.families['slug'].tolist(), self.families['name'].tolist())))
+        return names[slug]
+
+    def family_ancestors(self, slug):
+        """Slugs of the parent families of a family, starting with the direct parent"""
+        parents = self.index('family_parents', lambda: dict(zip(self.families['slug'].tolist(),
+                                                                 self.families['parent_id'].tolist())))
+        slugs = self.family_slugs()
+        ancestors = []
+        parent_id = parents[slug]
+        while parent_id != NO_ID:
+            ancestors.append(slugs[parent_id])
+            parent_id = parents[slugs[parent_id]]
+        return ancestors
+
+
+# reference data of this process and the version of the snapshot it was loaded from
+loaded_reference_data = None
+loaded_version = None
+
+def reference_data():
+    """Reference data of this process, reloaded when a new snapshot has been written"""
+    global loaded_reference_data, loaded_version
+    version = snapshot_version()
+    if loaded_reference_data is None or version != loaded_version:
+        loaded_reference_data = ReferenceData(load_reference_tables())
+        loaded_version = version
+    return loaded_reference_data
+
+def clear_loaded_reference_data():
+    """Forget the reference data of this process, it is loaded again when it is next used"""
+    global loaded_reference_data, loaded_version
+    loaded_reference_data = None
+    loaded_version = None
@@ -0,0 +1,112 @@
+"""
+Vectorized sequence identity/similarity kernels for alignments.
+
+Residues are encoded by their ASCII code, so a substitution matrix becomes a 128x128 lookup table that is loaded once
+per process. Aligned rows are scored as whole arrays and full NxN similarity matrices are computed with matrix
+products over one-hot encoded blocks of the alignment.
+"""
+import numpy as np
+
+from Bio.Align import substitution_matrices
+
+DEFAULT_SUBSTITUTION_MATRIX = 'BLOSUM62'
+
+# lookup tables of the substitution matrices that have been loaded in this process
+substitution_tables = {}
+
+
+def substitution_table(name=DEFAULT_SUBSTITUTION_MATRIX):
+    """Score lookup table of a substitution matrix (e.g. BLOSUM62, PAM250) indexed by ASCII codes"""
+    if name not in substitution_tables:
+        matrix = substitution_matrices.load(name)
+        codes = [ord(letter) for letter in matrix.alphabet]
+        table = np.zeros((128, 128), dtype=np.float64)
+        table[np.ix_(codes, codes)] = np.array(matrix)
+        substitution_tables[name] = table
+    return substitution_tables[name]
+
+def encode_residues(residues):
+    """ASCII codes of a list of one letter residues"""
+    return np.array([ord(residue[0]) & 127 if residue else 0 for residue in residues], dtype=np.uint8)
+
+def encode_alignment_row(protein, segments=None):
+    """ASCII codes of the alignment row of a ProteinConformation, optionally in the segment order of another row"""
+    if segments is None:
+        segments = protein.alignment
+    return encode_residues([p[2] for segment in segments for p in protein.alignment[segment]])
+
+def gap_mask(codes, gaps):
+    return np.isin(codes, encode_residues(gaps))
+
+def pairwise_scores(reference_codes, codes, gaps, table):
+    """Compare two aligned rows
+
+    Returns (identical, similar, counted, scores), where identical and similar are boolean arrays of the
+    columns with an identical or similar (positive scoring) residue pair, counted is a boolean array of the columns
+    that are not gapped in both rows, and scores holds the substitution score of the columns without gaps (0
+    elsewhere).
+    """
+    reference_gaps = gap_mask(reference_codes, gaps)
+    protein_gaps = gap_mask(codes, gaps)
+    counted = ~(reference_gaps & protein_gaps)
+    aligned = ~(reference_gaps | protein_gaps)
+    identical = (reference_codes == codes) & counted
+    scores = np.where(aligned, table[codes, reference_codes], 0)
+    similar = scores > 0
+    return identical, similar, counted, scores
+
+def similarity_matrix(codes, gaps, table, block_size=256):
+    """Identity, similarity and similarity score counts for all pairs of rows of an encoded alignment
+
+    Returns (identities, similarities, similarity_scores, totals) as NxN arrays, where totals is the number of
+    columns that are not gapped in both rows. The columns are processed in blocks to keep memory bounded.
+    """
+    num_rows, num_columns = codes.shape
+    gapped = gap_mask(codes, gaps)
+    letters = np.unique(codes[~gapped])
+    letter_scores = table[np.ix_(letters, letters)]
+    positive = (letter_scores > 0).astype(np.float64)
+    positive_scores = np.where(letter_scores > 0, letter_scores, 0)
+
+    gapped = gapped.astype(np.float64)
+    totals = num_columns - gapped @ gapped.T
+    identities = np.zeros((num_rows, num_rows))
+    similarities = np.zeros((num_rows, num_rows))
+    similarity_scores = np.zeros((num_rows, num_rows))
+    for start in range(0, num_columns, block_size):
+        block = codes[:, start:start + block_size]
+        onehot = (block[:, :, None] == letters[None, None, :]).astype(np.float64)
+        flat = onehot.reshape(num_rows, -1)
+        identities += flat @ flat.T
+        similarities += (onehot @ positive).reshape(num_rows, -1) @ flat.T
+        similarity_scores += (onehot @ positive_scores).reshape(num_rows, -1) @ flat.T
+
+    return (np.rint(identities).astype(int), np.rint(similarities).astype(int), similarity_scores,
+            np.rint(totals).astype(int))
+
+def cross_similarity_counts(codes, template_codes, table):
+    """Identity and similarity counts of all rows of an encoded alignment against all rows of another one (same
+    columns, 0 for a missing residue)
+
+    Returns (identical, similar, aligned, counted, scores, aligned_scores) as NxM arrays, where aligned is the number
+    of columns with a residue in both rows, counted the number of columns with a residue in at least one row, scores
+    the summed substitution score of the similar pairs and aligned_scores the summed score of all aligned pairs.
+    """
+    num_rows = codes.shape[0]
+    num_templates = template_codes.shape[0]
+    present = (codes > 0).astype(np.float64)
+    template_present = (template_codes > 0).astype(np.float64)
+    aligned = present @ template_present.T
+    counted = present.sum(axis=1)[:, None] + template_present.sum(axis=1)[None, :] - aligned
+
+    letters = np.union1d(np.unique(codes[codes > 0]), np.unique(template_codes[template_codes > 0]))
+    letter_scores = table[np.ix_(letters, letters)]
+    onehot = (codes[:, :, None] == letters[None, None, :]).astype(np.float64)
+    template_onehot = (template_codes[:, :, None] == letters[None, None, :]).astype(np.float64).reshape(num_templates, -1)
+
+    identical = onehot.reshape(num_rows, -1) @ template_onehot.T
+    similar = (onehot @ (letter_scores > 0)).reshape(num_rows, -1) @ template_onehot.T
+    scores = (onehot @ np.where(letter_scores > 0, letter_scores, 0)).reshape(num_rows, -1) @ template_onehot.T
+    aligned_scores = (onehot @ letter_scores).reshape(num_rows, -1) @ template_onehot.T
+    return tuple(np.rint(values).astype(int) for values in (identical, similar, aligned, counted, scores,
+                                                             aligned_scores))
@@ -0,0 +1,265 @@
+"""
+Precomputed sequence similarity of all receptors to all structure templates.
+
+For every fully aligned segment (the TM helices and H8, whose alignment columns are the generic numbers) the counts
+behind Alignment.calculate_similarity are stored for every pair of a protein and a template: identical and similar
+residues, aligned columns (a residue in both), counted columns (a residue in at least one) and the summed
+substitution scores. Sums over any set of indexed segments give exactly the identity, similarity and similarity score
+of an alignment of these segments, without building it. Templates are the wild-type proteins of all structures and
+the structure sequences of the representative structures.
+
+build_similarity_index writes the index to the build cache. Updates only compare new proteins and new templates (e.g.
+after new structures have been added), a full rebuild is needed when the residues of indexed proteins change. The index
+stores the build stamp (see common.build_stamp) it was created with and is neither used nor updated after a new build
+has started, build_all also removes it when it starts.
+"""
+from django.conf import settings
+
+import os
+
+import numpy as np
+
+from common.build_stamp import build_stamp
+from common.reference_data import reference_data
+from common.similarity import cross_similarity_counts, encode_residues, substitution_table
+
+SCORE_DTYPE = np.dtype([('identical', np.uint8), ('similar', np.uint8), ('aligned', np.uint8), ('counted', np.uint8),
+                        ('score', np.int16), ('aligned_score', np.int16)])
+
+# the index arrays, the scores are written last and their file marks the version of the index
+INDEX_FILES = ['proteins', 'templates', 'segments', 'build', 'scores']
+
+# number of proteins compared to the templates at once
+ROW_BLOCK_SIZE = 1000
+
+
+def similarity_index_dir():
+    return os.sep.join([settings.BUILD_CACHE_DIR, 'similarity_index'])
+
+def similarity_index_path(name):
+    return os.sep.join([similarity_index_dir(), '{}.npy'.format(name)])
+
+def index_segments():
+    """Slugs of the segments that are indexed (GPCR segments aligned by generic number)"""
+    return reference_data().segment_slugs(proteinfamily='GPCR', fully_aligned=True)
+
+def query_index_proteins(segments):
+    """Entry names of all proteins with generic numbered residues in the segments"""
+    from residue.models import Residue
+    return sorted(set(Residue.objects.filter(protein_segment__slug__in=segments, generic_number__isnull=False)
+                      .values_list('protein_conformation__protein__entry_name', flat=True).distinct()))
+
+def query_templates():
+    """Entry names of the template proteins"""
+    from structure.models import Structure
+    parents = Structure.objects.values_list('protein_conformation__protein__parent__entry_name', flat=True).distinct()
+    representatives = Structure.objects.filter(representative=True).values_list(
+        'protein_conformation__protein__entry_name', flat=True)
+    return set(parents) | set(representatives)
+
+def query_segment_codes(entry_names, segments, all_proteins=False):
+    """Encoded residues of the proteins in every segment, as {segment: array (proteins x generic numbers)} with 0
+    for missing residues (the columns of a segment are only consistent within one call)
+
+    @param all_proteins: entry_names are all indexed proteins, so they do not have to be filtered in the query
+    """
+    from residue.models import Residue
+    rows = dict([(entry_name, i) for i, entry_name in enumerate(entry_names)])
+    residue_rows = Residue.objects.filter(protein_segment__slug__in=segments, generic_number__isnull=False)
+    if not all_proteins:
+        residue_rows = residue_rows.filter(protein_conformation__protein__entry_name__in=entry_names)
+    residues = dict([(segment, ([], [], [])) for segment in segments])
+    columns = dict([(segment, {}) for segment in segments])
+    for entry_name, segment, generic_number_id, amino_acid in residue_rows.values_list(
+            'protein_conformation__protein__entry_name', 'protein_segment__slug', 'generic_number_id', 'amino_acid'):
+        segment_columns = columns[segment]
+        if generic_number_id not in segment_columns:
+            segment_columns[generic_number_id] = len(segment_columns)
+        residues[segment][0].append(rows[entry_name])
+        residues[segment][1].append(segment_columns[generic_number_id])
+        residues[segment][2].append(amino_acid)
+
+    codes = {}
+    for segment in segments:
+        row_positions, column_positions, amino_acids = residues[segment]
+        codes[segment] = np.zeros((len(entry_names), len(columns[segment])), dtype=np.uint8)
+        codes[segment][row_positions, column_positions] = encode_residues(amino_acids)
+    return codes
+
+def fill_scores(scores, rows, columns, codes, code_rows, code_columns, table):
+    """Compare proteins to templates and store the counts in the scores (proteins x segments x templates)
+
+    rows and columns are the positions of the proteins and templates in the scores, code_rows and code_columns their
+    positions in the encoded segments.
+    """
+    if not len(rows) or not len(columns):
+        return
+    for k, segment in enumerate(codes):
+        segment_codes = codes[segment]
+        templates = segment_codes[code_columns]
+        for start in range(0, len(rows), ROW_BLOCK_SIZE):
+            block_rows = rows[start:start + ROW_BLOCK_SIZE]
+            counts = cross_similarity_counts(segment_codes[code_rows[start:start + ROW_BLOCK_SIZE]], templates, table)
+            for field, values in zip(SCORE_DTYPE.names, counts):
+                scores[field][np.ix_(block_rows, [k], columns)] = values[:, None, :]
+
+def update_similarity_index(rebuild=False, substitution_matrix='BLOSUM62'):
+    """Bring the index up to date with the database, comparing only new proteins and templates unless rebuild is
+    set. Returns the number of compared proteins and templates."""
+    segments = index_segments()
+    proteins = query_index_proteins(segments)
+    templates = sorted(query_templates() & set(proteins))
+
+    old = None if rebuild else load_similarity_index()
+    # the residues may have changed since the index of another build was created
+    if old is not None and (old.segments != segments or old.stamp != build_stamp()):
+        old = None
+    if old is not None and old.proteins == proteins and old.templates == templates:
+        return 0, 0
+
+    protein_positions = dict([(entry_name, i) for i, entry_name in enumerate(proteins)])
+    template_positions = dict([(entry_name, i) for i, entry_name in enumerate(templates)])
+    scores = np.zeros((len(proteins), len(segments), len(templates)), dtype=SCORE_DTYPE)
+    if old is None:
+        new_proteins, new_templates = proteins, templates
+    else:
+        new_proteins = [entry_name for entry_name in proteins if entry_name not in old.protein_index]
+        new_templates = [entry_name for entry_name in templates if entry_name not in old.template_index]
+        kept_proteins = [entry_name for entry_name in proteins if entry_name in old.protein_index]
+        kept_templates = [entry_name for entry_name in templates if entry_name in old.template_index]
+        if kept_proteins and kept_templates:
+            scores[np.ix_([protein_positions[p] for p in kept_proteins], range(len(segments)),
+                          [template_positions[t] for t in kept_templates])] = \
+                old.scores[np.ix_([old.protein_index[p] for p in kept_proteins], range(len(segments)),
+                                  [old.template_index[t] for t in kept_templates])]
+
+    # new templates are compared to all proteins, otherwise only the new proteins are needed
+    if new_templates:
+        loaded = proteins
+    else:
+        loaded = sorted(set(new_proteins) | set(templates))
+    codes = query_segment_codes(loaded, segments, all_proteins=bool(new_templates))
+    loaded_positions = dict([(entry_name, i) for i, entry_name in enumerate(loaded)])
+    table = substitution_table(substitution_matrix)
+
+    # new proteins against all templates
+    fill_scores(scores, [protein_positions[p] for p in new_proteins], [template_positions[t] for t in templates],
+                codes, [loaded_positions[p] for p in new_proteins], [loaded_positions[t] for t in templates], table)
+    # the other proteins against the new templates
+    compared = set(new_proteins)
+    old_proteins = [entry_name for entry_name in proteins if entry_name not in compared]
+    fill_scores(scores, [protein_positions[p] for p in old_proteins], [template_positions[t] for t in new_templates],
+                codes, [loaded_positions[p] for p in old_proteins], [loaded_positions[t] for t in new_templates], table)
+
+    save_similarity_index(proteins, templates, segments, scores)
+    return len(new_proteins), len(new_templates)
+
+def save_similarity_index(proteins, templates, segments, scores):
+    """Write the index (each file is atomically replaced)"""
+    os.makedirs(similarity_index_dir(), exist_ok=True)
+    arrays = {
+        'proteins': np.array(proteins, dtype='U100'),
+        'templates': np.array(templates, dtype='U100'),
+        'segments': np.array(segments, dtype='U100'),
+        'build': np.array(build_stamp(), dtype='U100'),
+        'scores': scores,
+    }
+    for name in INDEX_FILES:
+        path = similarity_index_path(name)
+        tmp_path = '{}.{}.tmp.npy'.format(path, os.getpid())
+        np.save(tmp_path, arrays[name])
+        os.replace(tmp_path, path)
+
+def remove_similarity_index():
+    """Remove the index, e.g. before a build changes the residues"""
+    for name in INDEX_FILES:
+        try:
+            os.remove(similarity_index_path(name))
+        except FileNotFoundError:
+            pass
+
+def index_version():
+    """Modification time of the index, None if there is none"""
+    try:
+        return os.path.getmtime(similarity_index_path(INDEX_FILES[-1]))
+    except OSError:
+        return None
+
+def load_similarity_index():
+    """The index with memory-mapped scores, None if it has not been built"""
+    if index_version() is None:
+        return None
+    # indexes written before the build stamp was stored belong to no build
+    stamp = None
+    if os.path.isfile(similarity_index_path('build')):
+        stamp = str(np.load(similarity_index_path('build')))
+    return SimilarityIndex(np.load(similarity_index_path('proteins')).tolist(),
+                           np.load(similarity_index_path('templates')).tolist(),
+                           np.load(similarity_index_path('segments')).tolist(),
+                           np.load(similarity_index_path('scores'), mmap_mode='r'), stamp)
+
+
+class SimilarityIndex:
+    """Similarity of proteins to templates, looked up by entry name"""
+
+    def __init__(self, proteins, templates, segments, scores, stamp=None):
+        self.proteins = proteins
+        self.templates = templates
+        self.segments = segments
+        self.scores = scores
+        self.stamp = stamp
+        self.protein_index = dict([(entry_name, i) for i, entry_name in enumerate(proteins)])
+        self.template_index = dict([(entry_name, i) for i, entry_name in enumerate(templates)])
+        self.segment_index = dict([(slug, i) for i, slug in enumerate(segments)])
+
+    def covers(self, entry_name, templates, segments):
+        return (entry_name in self.protein_index and all(template in self.template_index for template in templates)
+                and all(segment in self.segment_index for segment in segments))
+
+    def similarities(self, entry_name, templates, segments, normalized=False):
+        """Identity, similarity and similarity score of a protein to each template in the given segments, in the
+        format of Alignment.pairwise_similarity (normalized: Alignment.pairwise_similarity_normalized, only columns
+        with a residue in both sequences)"""
+        if not templates:
+            return []
+        block = self.scores[self.protein_index[entry_name]][np.ix_(
+            [self.segment_index[segment] for segment in segments],
+            [self.template_index[template] for template in templates])]
+        sums = dict([(field, block[field].sum(axis=0, dtype=np.int64)) for field in SCORE_DTYPE.names])
+        totals = sums['aligned'] if normalized else sums['counted']
+        scores = sums['aligned_score'] if normalized else sums['score']
+
+        values = []
+        for identical, similar, total, score in zip(sums['identical'], sums['similar'], totals, scores):
+            if total:
+                values.append(("{:10.0f}".format(identical / total * 100), "{:10.0f}".format(similar / total * 100),
+                               float(score)))
+            else:
+                values.append(("{:10.0f}".format(-1), "{:10.0f}".format(-1), 0))
+        return values
+
+    def ranked_templates(self, entry_name, templates, segments, normalized=False, order_by='similarity'):
+        """Templates with their (identity, similarity, similarity score), in the order of
+        Alignment.calculate_similarity for an alignment with the templates in the given order"""
+        ranked = list(zip(templates, self.similarities(entry_name, templates, segments, normalized)))
+        position = {'identity': 0, 'similarity': 1, 'similarity_score': 2}[order_by]
+        if ranked and int(ranked[0][1][position]):
+            ranked.sort(key=lambda x: x[1][position], reverse=True)
+        return ranked
+
+
+# index of this process and the version it was loaded from
+loaded_index = None
+loaded_version = None
+
+def similarity_index():
+    """Similarity index of this process (None if it has not been built in the current build), reloaded when a new
+    version is written"""
+    global loaded_index, loaded_version
+    version = index_version()
+    if version != loaded_version:
+        loaded_index = load_similarity_index()
+        loaded_version = version
+    if loaded_index is None or loaded_index.stamp != build_stamp():
+        return None
+    return loaded_index
@@ -8,6 +8,7 @@ from django.db.models import Count, Case, When, Min
 from django.core.cache import cache
 
 from common import definitions
+from common.cache_warming import register_product, get_product
 Alignment = getattr(__import__('common.alignment_' + settings.SITE_NAME, fromlist=['Alignment']), 'Alignment')
 
 from common.selection import SimpleSelection, Selection, SelectionItem
@@ -32,203 +33,204 @@ import json
 
 default_schemes_excluded = ["cgn", "ecd", "can"]
 
-def getTargetTable():
-    data_table = cache.get("target_table")
-    if data_table == None:
-        proteins = Protein.objects.filter(sequence_type__slug="wt",
-                                          family__slug__startswith="00",
-                                          species__common_name="Human").prefetch_related(
+@register_product('target_table', 'target_table', dependencies=['proteins', 'structures', 'ligands', 'couplings'])
+def buildTargetTable():
+    proteins = Protein.objects.filter(sequence_type__slug="wt",
+                                      family__slug__startswith="00",
+                                      species__common_name="Human").prefetch_related(
+        "family",
+        "family__parent__parent__parent"
+    )
+    # Acquired slugs
+    slug_list = [ p.family.slug for p in proteins ]
+
+    # Acquire all targets that do not have a human ortholog
+    missing_slugs = list(Protein.objects.filter(sequence_type__slug="wt", family__slug__startswith="00")\
+                                     .exclude(family__slug__in=slug_list)\
+                                     .distinct("family__slug")\
+                                     .values_list("family__slug", flat=True))
+
+    for i in missing_slugs:
+        missing = Protein.objects.filter(family__slug=i)\
+                                    .order_by("id")\
+                                    .prefetch_related(
             "family",
             "family__parent__parent__parent"
         )
-        # Acquired slugs
-        slug_list = [ p.family.slug for p in proteins ]
-
-        # Acquire all targets that do not have a human ortholog
-        missing_slugs = list(Protein.objects.filter(sequence_type__slug="wt", family__slug__startswith="00")\
-                                         .exclude(family__slug__in=slug_list)\
-                                         .distinct("family__slug")\
-                                         .values_list("family__slug", flat=True))
-
-        for i in missing_slugs:
-            missing = Protein.objects.filter(family__slug=i)\
-                                        .order_by("id")\
-                                        .prefetch_related(
-                "family",
-                "family__parent__parent__parent"
-            )
-            proteins = proteins | missing[:1]
-
-        pdbids = list(Structure.objects.all().values_list("pdb_code__index", "protein_conformation__protein__family_id"))
-
-        allpdbs = {}
-        for pdb in pdbids:
-            if pdb[1] not in allpdbs:
-                allpdbs[pdb[1]] = [pdb[0]]
-            else:
-                allpdbs[pdb[1]].append(pdb[0])
-
-        drugtargets_approved = list(Protein.objects.filter(drugs__status="approved").values_list("entry_name", flat=True))
-        drugtargets_trials = list(Protein.objects.filter(drugs__status__in=["in trial"],
-                                                         drugs__clinicalstatus__in=["completed", "not open yet",
-                                                                                    "ongoing", "recruiting",
-                                                                                    "suspended"]).values_list(
-            "entry_name", flat=True))
-
-        ligand_set = list(AssayExperiment.objects.values("protein__family__slug")\
-            .annotate(num_ligands=Count("ligand", distinct=True)))
-
-        ligand_count = {}
-        for entry in ligand_set:
-            ligand_count[entry["protein__family__slug"]] = entry["num_ligands"]
-
-        # Filter data source to Guide to Pharmacology until other coupling transduction sources are "consolidated".
-        couplings = ProteinGProteinPair.objects.filter(source="GuideToPharma").values_list("protein__entry_name",
-                                                                                           "g_protein__name",
-                                                                                           "transduction")
-
-        signaling_data = {}
-        for pairing in couplings:
-            if pairing[0] not in signaling_data:
-                signaling_data[pairing[0]] = {}
-            signaling_data[pairing[0]][pairing[1]] = pairing[2]
-
-        data_table = "<table id='uniprot_selection' class='uniprot_selection stripe compact'> \
-            <thead>\
-              <tr> \
-                <th colspan=1>&nbsp;</th> \
-                <th colspan=5>Receptor classification</th> \
-                <th colspan=1>Ligands</th> \
-                <th colspan=2>Structures</th> \
+        proteins = proteins | missing[:1]
+
+    pdbids = list(Structure.objects.all().values_list("pdb_code__index", "protein_conformation__protein__family_id"))
+
+    allpdbs = {}
+    for pdb in pdbids:
+        if pdb[1] not in allpdbs:
+            allpdbs[pdb[1]] = [pdb[0]]
+        else:
+            allpdbs[pdb[1]].append(pdb[0])
+
+    drugtargets_approved = list(Protein.objects.filter(drugs__status="approved").values_list("entry_name", flat=True))
+    drugtargets_trials = list(Protein.objects.filter(drugs__status__in=["in trial"],
+                                                     drugs__clinicalstatus__in=["completed", "not open yet",
+                                                                                "ongoing", "recruiting",
+                                                                                "suspended"]).values_list(
+        "entry_name", flat=True))
+
+    ligand_set = list(AssayExperiment.objects.values("protein__family__slug")\
+        .annotate(num_ligands=Count("ligand", distinct=True)))
+
+    ligand_count = {}
+    for entry in ligand_set:
+        ligand_count[entry["protein__family__slug"]] = entry["num_ligands"]
+
+    # Filter data source to Guide to Pharmacology until other coupling transduction sources are "consolidated".
+    couplings = ProteinGProteinPair.objects.filter(source="GuideToPharma").values_list("protein__entry_name",
+                                                                                       "g_protein__name",
+                                                                                       "transduction")
+
+    signaling_data = {}
+    for pairing in couplings:
+        if pairing[0] not in signaling_data:
+            signaling_data[pairing[0]] = {}
+        signaling_data[pairing[0]][pairing[1]] = pairing[2]
+
+    data_table = "<table id='uniprot_selection' class='uniprot_selection stripe compact'> \
+        <thead>\
+          <tr> \
+            <th colspan=1>&nbsp;</th> \
+            <th colspan=5>Receptor classification</th> \
+            <th colspan=1>Ligands</th> \
+            <th colspan=2>Structures</th> \
 <!--                <th colspan=2>Drugs</th> -->\
-                <th colspan=4>G protein coupling</th> \
-              </tr> \
-              <tr> \
-                <th><br><br><input class ='form-check-input' type='checkbox' onclick='return check_all_targets();'></th> \
-                <th>Class<br>&nbsp;</th> \
-                <th>Ligand type<br>&nbsp;</th> \
-                <th style=\"width; 100px;\">Family<br>&nbsp;</th> \
-                <th class=\"text-highlight\">Receptor<br>(UniProt)</th> \
-                <th class=\"text-highlight\">Receptor<br>(GtP)</th> \
-                <th>Count</th> \
-                <th>Count</th> \
-                <th>PDB(s)<br>&nbsp;</th> \
+            <th colspan=4>G protein coupling</th> \
+          </tr> \
+          <tr> \
+            <th><br><br><input class ='form-check-input' type='checkbox' onclick='return check_all_targets();'></th> \
+            <th>Class<br>&nbsp;</th> \
+            <th>Ligand type<br>&nbsp;</th> \
+            <th style=\"width; 100px;\">Family<br>&nbsp;</th> \
+            <th class=\"text-highlight\">Receptor<br>(UniProt)</th> \
+            <th class=\"text-highlight\">Receptor<br>(GtP)</th> \
+            <th>Count</th> \
+            <th>Count</th> \
+            <th>PDB(s)<br>&nbsp;</th> \
 <!--                <th>Target of an approved drug</th> \
-                <th>Target in clinical trials</th> --> \
-                <th>Gs<br>&nbsp;</th> \
-                <th>Gi/o<br>&nbsp;</th> \
-                <th>Gq/11<br>&nbsp;</th> \
-                <th>G12/13<br>&nbsp;</th> \
-              </tr> \
-            </thead>\
-            \n \
-            <tbody>\n"
-
-        slug_list = []
-        #link_setup = "<a target=\"_blank\" href=\"{}\"><span class=\"glyphicon glyphicon-new-window btn-xs\"></span></a>"
-        link_setup = "<a target=\"_blank\" href=\"{}\">{}</a>"
-        for p in proteins:
-            # Do not repeat slugs (only unhuman proteins)
-            if p.family.slug in slug_list:
-                continue
-            slug_list.append(p.family.slug)
-            t = {}
-            t['accession'] = p.accession
-            t['name'] = p.entry_name.split("_")[0]
-            t['slug'] = p.family.slug
-            t['class'] = p.family.parent.parent.parent.short().split(' ')[0]
-            t['ligandtype'] = p.family.parent.parent.short()
-            t['family'] = p.family.parent.short()
-            t['uniprot'] = p.entry_short()
-            t['iuphar'] = p.family.name.replace("receptor", '').strip()
-
-            # Web resource links
-            #t['uniprot_link'] = ""
-            #t['gtp_link'] = ""
-            uniprot_links = p.web_links.filter(web_resource__slug='uniprot')
-            if uniprot_links.count() > 0:
-                #t['uniprot_link'] = link_setup.format(p.web_links.filter(web_resource__slug='uniprot')[0])
-                t['uniprot'] = link_setup.format(p.web_links.filter(web_resource__slug='uniprot')[0], t['uniprot'])
-
-            gtop_links = p.web_links.filter(web_resource__slug='gtop')
-            if gtop_links.count() > 0:
-                #t['gtp_link'] = link_setup.format(p.web_links.filter(web_resource__slug='gtop')[0])
-                t['iuphar'] = link_setup.format(p.web_links.filter(web_resource__slug='gtop')[0], t['iuphar'])
-
-            # Ligand count
-            t['ligand_count'] = 0
-            if t['slug'] in ligand_count:
-                t['ligand_count'] = link_setup.format("/ligand/target/all/" + t['slug'], ligand_count[t['slug']])
-
-            t['pdbid'] = t['pdbid_two'] = t['pdbid_tooltip'] = "-"
-            t['pdb_count'] = 0
-            if p.family_id in allpdbs:
-                t['pdb_count'] = len(allpdbs[p.family_id])
-
-                pdb_entries = allpdbs[p.family_id]
-                pdb_entries.sort()
-                t['pdbid'] = ",".join(pdb_entries)
-                t['pdbid_two'] = ",".join(pdb_entries[:2])
-                if len(allpdbs[p.family_id]) > 2:
-                    t['pdbid_two'] += ",..."
-                    n = 4 # Number of PDBs per line
-                    pdb_sets = ["&nbsp;&nbsp;".join(pdb_entries[i:i + n]) for i in range(0, len(pdb_entries), n)]
-                    t['pdbid_tooltip'] = "<br>".join(pdb_sets)
-
-            t['approved_target'] = "Yes" if p.entry_name in drugtargets_approved else "No"
-            t['clinical_target'] = "Yes" if p.entry_name in drugtargets_trials else "No"
-
-            gprotein_families = ["Gs family", "Gi/Go family", "Gq/G11 family", "G12/G13 family"]
-            for gprotein in gprotein_families:
-                if p.entry_name in signaling_data and gprotein in signaling_data[p.entry_name]:
-                    t[gprotein] = signaling_data[p.entry_name][gprotein]
-                else:
-                    t[gprotein] = "-"
-
-            data_table += "<tr> \
-            <td data-sort=\"0\"><input class=\"form-check-input\" type=\"checkbox\" name=\"targets\" id=\"{}\" data-entry=\"{}\" data-human=\"{}\"></td> \
-            <td>{}</td> \
-            <td>{}</td> \
-            <td>{}</td> \
-            <td><span class=\"expand\">{}</span></td> \
-            <td><span class=\"expand\">{}</span></td> \
-            <td>{}</td> \
-            <td>{}</td> \
-            <td><span {} data-html=\"true\" data-placement=\"bottom\" title=\"{}\" data-search=\"{}\" >{}</span></td> \
-            <!--<td>{}</td> \
-            <td>{}</td>--> \
-            <td>{}</td> \
-            <td>{}</td> \
-            <td>{}</td> \
-            <td>{}</td> \
-            </tr> \n".format(
-                t['slug'],
-                t['name'],
-                ("No" if t['slug'] in missing_slugs else "Yes"),
-                t['class'],
-                t['ligandtype'],
-                t['family'],
-                t['uniprot'],
-                t['iuphar'],
-                t['ligand_count'],
-                t['pdb_count'],
-                ("data-toggle=\"tooltip\"" if t['pdbid_tooltip']!="-" else ""),
-                t['pdbid_tooltip'],
-                t['pdbid'],      # This one hidden used for search box.
-                t['pdbid_two'],  # This one shown. Show only first two pdb's.
-                t['approved_target'],
-                t['clinical_target'],
-                t[gprotein_families[0]].capitalize(),
-                t[gprotein_families[1]].capitalize(),
-                t[gprotein_families[2]].capitalize(),
-                t[gprotein_families[3]].capitalize(),
-            )
-
-        data_table += "</tbody></table>"
-        cache.set("target_table", data_table, 60*60*24*7)
+            <th>Target in clinical trials</th> --> \
+            <th>Gs<br>&nbsp;</th> \
+            <th>Gi/o<br>&nbsp;</th> \
+            <th>Gq/11<br>&nbsp;</th> \
+            <th>G12/13<br>&nbsp;</th> \
+          </tr> \
+        </thead>\
+        \n \
+        <tbody>\n"
+
+    slug_list = []
+    #link_setup = "<a target=\"_blank\" href=\"{}\"><span class=\"glyphicon glyphicon-new-window btn-xs\"></span></a>"
+    link_setup = "<a target=\"_blank\" href=\"{}\">{}</a>"
+    for p in proteins:
+        # Do not repeat slugs (only unhuman proteins)
+        if p.family.slug in slug_list:
+            continue
+        slug_list.append(p.family.slug)
+        t = {}
+        t['accession'] = p.accession
+        t['name'] = p.entry_name.split("_")[0]
+        t['slug'] = p.family.slug
+        t['class'] = p.family.parent.parent.parent.short().split(' ')[0]
+        t['ligandtype'] = p.family.parent.parent.short()
+        t['family'] = p.family.parent.short()
+        t['uniprot'] = p.entry_short()
+        t['iuphar'] = p.family.name.replace("receptor", '').strip()
+
+        # Web resource links
+        #t['uniprot_link'] = ""
+        #t['gtp_link'] = ""
+        uniprot_links = p.web_links.filter(web_resource__slug='uniprot')
+        if uniprot_links.count() > 0:
+            #t['uniprot_link'] = link_setup.format(p.web_links.filter(web_resource__slug='uniprot')[0])
+            t['uniprot'] = link_setup.format(p.web_links.filter(web_resource__slug='uniprot')[0], t['uniprot'])
+
+        gtop_links = p.web_links.filter(web_resource__slug='gtop')
+        if gtop_links.count() > 0:
+            #t['gtp_link'] = link_setup.format(p.web_links.filter(web_resource__slug='gtop')[0])
+            t['iuphar'] = link_setup.format(p.web_links.filter(web_resource__slug='gtop')[0], t['iuphar'])
+
+        # Ligand count
+        t['ligand_count'] = 0
+        if t['slug'] in ligand_count:
+            t['ligand_count'] = link_setup.format("/ligand/target/all/" + t['slug'], ligand_count[t['slug']])
+
+        t['pdbid'] = t['pdbid_two'] = t['pdbid_tooltip'] = "-"
+        t['pdb_count'] = 0
+        if p.family_id in allpdbs:
+            t['pdb_count'] = len(allpdbs[p.family_id])
+
+            pdb_entries = allpdbs[p.family_id]
+            pdb_entries.sort()
+            t['pdbid'] = ",".join(pdb_entries)
+            t['pdbid_two'] = ",".join(pdb_entries[:2])
+            if len(allpdbs[p.family_id]) > 2:
+                t['pdbid_two'] += ",..."
+                n = 4 # Number of PDBs per line
+                pdb_sets = ["&nbsp;&nbsp;".join(pdb_entries[i:i + n]) for i in range(0, len(pdb_entries), n)]
+                t['pdbid_tooltip'] = "<br>".join(pdb_sets)
+
+        t['approved_target'] = "Yes" if p.entry_name in drugtargets_approved else "No"
+        t['clinical_target'] = "Yes" if p.entry_name in drugtargets_trials else "No"
+
+        gprotein_families = ["Gs family", "Gi/Go family", "Gq/G11 family", "G12/G13 family"]
+        for gprotein in gprotein_families:
+            if p.entry_name in signaling_data and gprotein in signaling_data[p.entry_name]:
+                t[gprotein] = signaling_data[p.entry_name][gprotein]
+            else:
+                t[gprotein] = "-"
+
+        data_table += "<tr> \
+        <td data-sort=\"0\"><input class=\"form-check-input\" type=\"checkbox\" name=\"targets\" id=\"{}\" data-entry=\"{}\" data-human=\"{}\"></td> \
+        <td>{}</td> \
+        <td>{}</td> \
+        <td>{}</td> \
+        <td><span class=\"expand\">{}</span></td> \
+        <td><span class=\"expand\">{}</span></td> \
+        <td>{}</td> \
+        <td>{}</td> \
+        <td><span {} data-html=\"true\" data-placement=\"bottom\" title=\"{}\" data-search=\"{}\" >{}</span></td> \
+        <!--<td>{}</td> \
+        <td>{}</td>--> \
+        <td>{}</td> \
+        <td>{}</td> \
+        <td>{}</td> \
+        <td>{}</td> \
+        </tr> \n".format(
+            t['slug'],
+            t['name'],
+            ("No" if t['slug'] in missing_slugs else "Yes"),
+            t['class'],
+            t['ligandtype'],
+            t['family'],
+            t['uniprot'],
+            t['iuphar'],
+            t['ligand_count'],
+            t['pdb_count'],
+            ("data-toggle=\"tooltip\"" if t['pdbid_tooltip']!="-" else ""),
+            t['pdbid_tooltip'],
+            t['pdbid'],      # This one hidden used for search box.
+            t['pdbid_two'],  # This one shown. Show only first two pdb's.
+            t['approved_target'],
+            t['clinical_target'],
+            t[gprotein_families[0]].capitalize(),
+            t[gprotein_families[1]].capitalize(),
+            t[gprotein_families[2]].capitalize(),
+            t[gprotein_families[3]].capitalize(),
+        )
+
+    data_table += "</tbody></table>"
 
     return data_table
 
+def getTargetTable():
+    return get_product('target_table')
+
 class AbsTargetSelectionTable(TemplateView):
     """An abstract class for the tablew target selection page used in many apps.
 
@@ -0,0 +1,194 @@
+"""
+Batched contact detection.
+
+Instead of creating an InteractingPair (and running all interaction checks atom pair by atom pair) for every residue
+pair within the neighbour cut-off, the atoms of a set of residues are stored as NumPy arrays with per atom property
+tables (hydrophobic atoms, Van der Waals radii, charged atoms, H-bond donors and acceptors). All atom pairs within the
+largest interaction cut-off are found with a KD-tree and the distance based interaction types are classified with
+masks. The geometric checks (H-bond angles, ring orientations) are only run for residue pairs that pass the distance
+masks, using the same functions as InteractingPair. ORM objects are only created when the pairs are saved.
+"""
+from contactnetwork.interaction import *
+from contactnetwork.models import InteractingResiduePair, Interaction
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Largest atom-atom distance of the distance based interaction types (ionic/hydrophobic 4.5, loose H-bond 4.0,
+# Van der Waals (1.8 + 1.8) * 1.1)
+ATOM_PAIR_CUTOFF = 4.5
+
+# Ring centroid distance below which aromatic residue pairs are checked for aromatic interactions
+RING_CUTOFF = 5.5
+
+
+class AtomTable:
+    """Coordinates and interaction properties of the atoms of a list of residues"""
+
+    def __init__(self, residues):
+        self.residues = residues
+        coords = []
+        residue_index = []
+        names = []
+        elements = []
+        charges = []
+        charge_ranks = []
+        donors = []
+        acceptors = []
+        for i, res in enumerate(residues):
+            donor_names = get_hbond_donor_references(res)
+            acceptor_names = get_hbond_acceptors(res)
+            charged_names = get_charged_atom_names(res)
+            charge = 1 if is_pos_charged(res) else -1
+            for atom in res:
+                coords.append(atom.coord)
+                residue_index.append(i)
+                names.append(atom.name)
+                elements.append(atom.element)
+                if atom.name in charged_names:
+                    charges.append(charge)
+                    charge_ranks.append(charged_names.index(atom.name))
+                else:
+                    charges.append(0)
+                    charge_ranks.append(0)
+                donors.append(atom.name in donor_names)
+                acceptors.append(atom.name in acceptor_names)
+
+        self.coords = np.array(coords, dtype=np.float32).reshape(-1, 3)
+        self.residue_index = np.array(residue_index, dtype=np.int64)
+        self.names = names
+        self.hydrophobic = np.array([e == 'C' or e == 'S' for e in elements], dtype=bool)
+        self.vdw_radii = np.array([VDW_RADII.get(e, np.nan) for e in elements], dtype=np.float64)
+        self.charges = np.array(charges, dtype=np.int8)
+        self.charge_ranks = np.array(charge_ranks, dtype=np.int8)
+        self.donors = np.array(donors, dtype=bool)
+        self.acceptors = np.array(acceptors, dtype=bool)
+        self.tree = cKDTree(self.coords) if len(self.coords) else None
+
+        # ring centroids of the aromatic residues
+        self.ring_centers = {}
+        for i, res in enumerate(residues):
+            if is_aromatic_aa(res):
+                descriptors = get_ring_descriptors(res)
+                if descriptors:
+                    self.ring_centers[i] = np.array([d[0] for d in descriptors])
+
+    def atom_pairs(self, other, cutoff):
+        """Atom pairs (index in self, index in other) within cutoff, for the same table only pairs of atoms in
+        different residues with the first residue before the second one"""
+        if self.tree is None or other.tree is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        pairs = self.tree.sparse_distance_matrix(other.tree, cutoff, output_type='ndarray')
+        atoms1 = pairs['i'].astype(np.int64)
+        atoms2 = pairs['j'].astype(np.int64)
+        if other is self:
+            keep = self.residue_index[atoms1] < self.residue_index[atoms2]
+            atoms1 = atoms1[keep]
+            atoms2 = atoms2[keep]
+        return atoms1, atoms2
+
+    def residue_pairs(self, other, cutoff):
+        """Sorted unique residue pairs with at least one atom pair within cutoff"""
+        atoms1, atoms2 = self.atom_pairs(other, cutoff)
+        pairs = np.stack([self.residue_index[atoms1], other.residue_index[atoms2]], axis=1)
+        if not len(pairs):
+            return []
+        return [tuple(p) for p in np.unique(pairs, axis=0).tolist()]
+
+
+def compute_contacts(table1, table2, residue_pairs, dbres1, dbres2, structure):
+    """Classify the interactions of the given residue pairs (indices in table1 and table2)
+
+    Returns an InteractingPair for each residue pair with at least one interaction.
+    """
+    if not residue_pairs:
+        return []
+
+    # All atom pairs in the candidate residue pairs within the largest distance cut-off
+    atoms1, atoms2 = table1.atom_pairs(table2, ATOM_PAIR_CUTOFF + 0.01)
+    residue_codes = table1.residue_index[atoms1] * len(table2.residues) + table2.residue_index[atoms2]
+    candidate_codes = np.array([p[0] * len(table2.residues) + p[1] for p in residue_pairs], dtype=np.int64)
+    keep = np.isin(residue_codes, candidate_codes)
+    atoms1 = atoms1[keep]
+    atoms2 = atoms2[keep]
+
+    # Order as the nested atom loops of InteractingPair
+    order = np.lexsort((atoms2, atoms1))
+    atoms1 = atoms1[order]
+    atoms2 = atoms2[order]
+    residues1 = table1.residue_index[atoms1]
+    residues2 = table2.residue_index[atoms2]
+
+    # float32 distances, as calculated from Biopython coordinates
+    distances = np.linalg.norm(table1.coords[atoms1] - table2.coords[atoms2], axis=1)
+
+    ionic = (table1.charges[atoms1] * table2.charges[atoms2] == -1) & (distances <= 4.5)
+    hbond_candidates = ((table1.donors[atoms1] & table2.acceptors[atoms2]) |
+                        (table1.acceptors[atoms1] & table2.donors[atoms2])) & (distances <= 4)
+    hydrophobic = table1.hydrophobic[atoms1] & table2.hydrophobic[atoms2] & (distances <= 4.5)
+    with np.errstate(invalid='ignore'):
+        vdw = distances <= (table1.vdw_radii[atoms1] + table2.vdw_radii[atoms2]) * VDW_TRESHOLD_FACTOR
+
+    ionic_pairs = {}
+    for a1, a2, r1, r2 in zip(atoms1[ionic].tolist(), atoms2[ionic].tolist(), residues1[ionic].tolist(), residues2[ionic].tolist()):
+        ionic_pairs.setdefault((r1, r2), []).append((table1.charge_ranks[a1], table2.charge_ranks[a2], a1, a2))
+    hbond_pairs = set(zip(residues1[hbond_candidates].tolist(), residues2[hbond_candidates].tolist()))
+    hydrophobic_pairs = {}
+    for a1, a2, r1, r2 in zip(atoms1[hydrophobic].tolist(), atoms2[hydrophobic].tolist(), residues1[hydrophobic].tolist(), residues2[hydrophobic].tolist()):
+        hydrophobic_pairs.setdefault((r1, r2), []).append((a1, a2))
+    vdw_pairs = {}
+    for a1, a2, r1, r2 in zip(atoms1[vdw].tolist(), atoms2[vdw].tolist(), residues1[vdw].tolist(), residues2[vdw].tolist()):
+        vdw_pairs.setdefault((r1, r2), []).append((a1, a2))
+
+    classified = []
+    for r1, r2 in residue_pairs:
+        res1 = table1.residues[r1]
+        res2 = table2.residues[r2]
+        pair = InteractingPair(res1, res2, dbres1[res1.id[1]], dbres2[res2.id[1]], structure, compute=False)
+
+        # Ionic interactions, in the order of the charged atom lists
+        for rank1, rank2, a1, a2 in sorted(ionic_pairs.get((r1, r2), [])):
+            if table1.charges[a1] > 0:
+                pair.add_interactions(PosNegIonicInteraction(table1.names[a1], table2.names[a2]))
+            else:
+                pair.add_interactions(NegPosIonicInteraction(table1.names[a1], table2.names[a2]))
+
+        # Polar interactions (angle checks only for pairs with a donor-acceptor pair in reach)
+        if (r1, r2) in hbond_pairs:
+            pair.hbond_interactions()
+
+        # Aromatic interactions
+        aromatic_count = is_aromatic_aa(res1) + is_aromatic_aa(res2)
+        if aromatic_count == 1:
+            if is_pos_charged(res1) or is_pos_charged(res2):
+                pair.aromatic_interactions()
+        elif aromatic_count == 2 and r1 in table1.ring_centers and r2 in table2.ring_centers:
+            centers1 = table1.ring_centers[r1]
+            centers2 = table2.ring_centers[r2]
+            if (np.linalg.norm(centers1[:, None, :] - centers2[None, :, :], axis=2) <= RING_CUTOFF).any():
+                pair.aromatic_interactions()
+
+        for a1, a2 in hydrophobic_pairs.get((r1, r2), []):
+            pair.add_interactions(HydrophobicInteraction(table1.names[a1], table2.names[a2]))
+        for a1, a2 in vdw_pairs.get((r1, r2), []):
+            pair.add_interactions(VanDerWaalsInteraction(table1.names[a1], table2.names[a2]))
+
+        if pair.get_interactions():
+            classified.append(pair)
+
+    return classified
+
+
+def save_interacting_pairs(pairs):
+    """Store interacting pairs and their interactions with two bulk inserts (existing pairs of the structure have
+    to be removed first)"""
+    db_pairs = InteractingResiduePair.objects.bulk_create([InteractingResiduePair(res1=p.dbres1, res2=p.dbres2,
+        referenced_structure=p.structure) for p in pairs], batch_size=5000)
+
+    bulk = []
+    for pair, db_pair in zip(pairs, db_pairs):
+        for i in pair.get_interactions():
+            bulk.append(Interaction(interaction_type=i.get_type(), specific_type=i.get_details(), interacting_pair=db_pair,
+                                    atomname_residue1=i.atomname_residue1, atomname_residue2=i.atomname_residue2,
+                                    interaction_level=i.get_level()))
+    Interaction.objects.bulk_create(bulk, batch_size=5000)
@@ -0,0 +1,211 @@
+"""
+Per-structure contact fingerprints.
+
+The classified contacts between the residues with a generic number within a single protein chain of a structure are
+stored at build time as one record per generic number pair in a .npy file: the residue labels and amino acids, whether
+both residues are in the same segment, and the number of interacting atom pairs per interaction type and atom class
+(side chain, C-alpha or backbone atom in either residue), in total and of level 0 only (without the loose H-bond and
+aromatic interactions). Water-mediated interactions (stored as polar interactions) are counted separately, as the
+contact browser leaves them out and the contact frequencies of the mutation design tools include them. A bitmask of
+the non-zero counts is stored with each record, so filters on interaction types and atom classes are bit operations.
+Contact statistics of a set of structures are calculated from the concatenated records with NumPy instead of
+Interaction queries.
+"""
+from django.conf import settings
+from django.db.models import F
+
+import os
+import numpy as np
+
+INTERACTION_TYPES = ['ionic', 'polar', 'aromatic', 'hydrophobic', 'van-der-waals']
+
+# atoms of a residue: side chain, C-alpha and backbone atoms
+ATOM_TYPES = ['SC', 'CA', 'BB']
+BACKBONE_ATOMS = ['C', 'O', 'N']
+
+# atom classes of an interacting atom pair (residue 1 - residue 2)
+ATOM_CLASSES = ['-'.join([type1, type2]) for type1 in ATOM_TYPES for type2 in ATOM_TYPES]
+
+# backbone (BB) and side chain (SC) atom pairs of the contact options of the contact views, CA counts as both
+CONTACT_OPTIONS = {'bbbb': [('BB', 'BB')], 'scbb': [('SC', 'BB'), ('BB', 'SC')], 'scsc': [('SC', 'SC')]}
+OPTION_ATOM_TYPES = {'BB': ['BB', 'CA'], 'SC': ['SC', 'CA']}
+
+# strict settings: polar and aromatic interactions of level 0, a minimum number of atom pairs for the contacts
+LEVEL_STRICT_TYPES = ['polar', 'aromatic']
+STRICT_MINIMUM_COUNTS = {'hydrophobic': 4, 'van-der-waals': 4}
+
+# specific type and interaction type of the water-mediated interactions
+WATER_MEDIATED = 'water-mediated'
+WATER_MEDIATED_TYPE = 'polar'
+
+CONTACT_DTYPE = np.dtype([
+    ('gn1', 'U12'),
+    ('gn2', 'U12'),
+    ('aa1', 'U1'),
+    ('aa2', 'U1'),
+    ('intra_segment', bool),
+    ('bits', np.uint64),
+    ('counts', np.uint16, (len(INTERACTION_TYPES), len(ATOM_CLASSES))),
+    ('strict_counts', np.uint16, (len(INTERACTION_TYPES), len(ATOM_CLASSES))),
+    ('water_counts', np.uint16, (len(ATOM_CLASSES),)),
+    ('strict_water_counts', np.uint16, (len(ATOM_CLASSES),)),
+])
+
+
+def contact_fingerprint_dir():
+    return os.sep.join([settings.BUILD_CACHE_DIR, 'contact_fingerprints'])
+
+def contact_fingerprint_path(structure_id):
+    return os.sep.join([contact_fingerprint_dir(), '{}.npy'.format(structure_id)])
+
+def contact_bits(interaction_types=INTERACTION_TYPES, atom_classes=ATOM_CLASSES):
+    """Bitmask of the given interaction types and atom classes"""
+    bits = 0
+    for interaction_type in interaction_types:
+        for atom_class in atom_classes:
+            bits |= 1 << (INTERACTION_TYPES.index(interaction_type) * len(ATOM_CLASSES) + ATOM_CLASSES.index(atom_class))
+    return bits
+
+def atom_type(atomname):
+    if atomname in BACKBONE_ATOMS:
+        return 'BB'
+    return 'CA' if atomname == 'CA' else 'SC'
+
+def atom_class(atomname1, atomname2):
+    return ATOM_CLASSES.index('-'.join([atom_type(atomname1), atom_type(atomname2)]))
+
+def option_classes(options):
+    """Atom classes selected by a list of contact options (bbbb, scbb, scsc)"""
+    classes = set()
+    for option in options:
+        for part1, part2 in CONTACT_OPTIONS[option]:
+            classes |= set(['-'.join([type1, type2]) for type1 in OPTION_ATOM_TYPES[part1] for type2 in OPTION_ATOM_TYPES[part2]])
+    return [c for c in ATOM_CLASSES if c in classes]
+
+def build_contact_fingerprint(structure):
+    """Contact records of a structure from its stored interactions"""
+    from contactnetwork.models import Interaction
+
+    interactions = Interaction.objects.filter(
+            interacting_pair__referenced_structure=structure,
+            interacting_pair__res1__generic_number__isnull=False,
+            interacting_pair__res2__generic_number__isnull=False,
+            interacting_pair__res1__protein_conformation_id=F('interacting_pair__res2__protein_conformation_id'),
+            interacting_pair__res1__pk__lt=F('interacting_pair__res2__pk')
+        ).values_list(
+            'interacting_pair__res1__generic_number__label',
+            'interacting_pair__res1__amino_acid',
+            'interacting_pair__res1__protein_segment_id',
+            'interacting_pair__res2__generic_number__label',
+            'interacting_pair__res2__amino_acid',
+            'interacting_pair__res2__protein_segment_id',
+            'interaction_type',
+            'specific_type',
+            'atomname_residue1',
+            'atomname_residue2',
+            'interaction_level',
+        )
+
+    contacts = {}
+    for gn1, aa1, segment1, gn2, aa2, segment2, interaction_type, specific_type, atomname1, atomname2, level in interactions:
+        if (gn1, gn2) not in contacts:
+            contacts[(gn1, gn2)] = [aa1, aa2, segment1 == segment2, np.zeros((2, len(INTERACTION_TYPES), len(ATOM_CLASSES)), dtype=np.uint16),
+                                    np.zeros((2, len(ATOM_CLASSES)), dtype=np.uint16)]
+        if specific_type == WATER_MEDIATED:
+            position = atom_class(atomname1, atomname2)
+            contacts[(gn1, gn2)][4][0][position] += 1
+            if level == 0:
+                contacts[(gn1, gn2)][4][1][position] += 1
+        elif interaction_type in INTERACTION_TYPES:
+            position = (INTERACTION_TYPES.index(interaction_type), atom_class(atomname1, atomname2))
+            contacts[(gn1, gn2)][3][0][position] += 1
+            if level == 0:
+                contacts[(gn1, gn2)][3][1][position] += 1
+
+    records = np.zeros(len(contacts), dtype=CONTACT_DTYPE)
+    for i, ((gn1, gn2), (aa1, aa2, intra_segment, counts, water_counts)) in enumerate(sorted(contacts.items())):
+        records[i] = (gn1, gn2, aa1, aa2, intra_segment, 0, counts[0], counts[1], water_counts[0], water_counts[1])
+    if len(records):
+        weights = (1 << np.arange(len(INTERACTION_TYPES) * len(ATOM_CLASSES), dtype=np.uint64))
+        records['bits'] = ((records['counts'].reshape(len(records), -1) > 0) * weights).sum(axis=1, dtype=np.uint64)
+    return records
+
+def save_contact_fingerprint(structure):
+    """Build and store the contact fingerprint of a structure (atomically replacing an older version)"""
+    os.makedirs(contact_fingerprint_dir(), exist_ok=True)
+    path = contact_fingerprint_path(structure.id)
+    tmp_path = path + '.tmp.npy'
+    np.save(tmp_path, build_contact_fingerprint(structure))
+    os.replace(tmp_path, path)
+
+def load_contact_fingerprint(structure_id):
+    """Contact records of a structure, returns None if its fingerprint has not been built (or in an older format)"""
+    path = contact_fingerprint_path(structure_id)
+    if not os.path.isfile(path):
+        return None
+    fingerprint = np.load(path)
+    if fingerprint.dtype != CONTACT_DTYPE:
+        return None
+    return fingerprint
+
+def delete_contact_fingerprints():
+    directory = contact_fingerprint_dir()
+    if os.path.isdir(directory):
+        for filename in os.listdir(directory):
+            if filename.endswith('.npy'):
+                os.remove(os.sep.join([directory, filename]))
+
+
+class ContactFingerprints:
+    """Contact records of a set of structures"""
+
+    def __init__(self, structure_ids, fingerprints):
+        self.structure_ids = structure_ids
+        self.contacts = np.concatenate(fingerprints) if fingerprints else np.zeros(0, dtype=CONTACT_DTYPE)
+        # index of the structure of every record
+        self.structure_index = np.repeat(np.arange(len(fingerprints), dtype=np.int64),
+                                         [len(f) for f in fingerprints]) if fingerprints else np.zeros(0, dtype=np.int64)
+
+    @classmethod
+    def load(cls, structure_ids):
+        """Load the fingerprints of the given structure ids, returns None if any of them is missing"""
+        fingerprints = []
+        for structure_id in structure_ids:
+            fingerprint = load_contact_fingerprint(structure_id)
+            if fingerprint is None:
+                return None
+            fingerprints.append(fingerprint)
+        return cls(list(structure_ids), fingerprints)
+
+    def in_gns(self, gns):
+        """Mask of the records with both residues in the given generic numbers"""
+        gns = np.array(list(gns), dtype=CONTACT_DTYPE['gn1'])
+        return np.isin(self.contacts['gn1'], gns) & np.isin(self.contacts['gn2'], gns)
+
+    def has_contact(self, bits):
+        """Mask of the records with an interaction of the types and atom classes in the bitmask"""
+        return (self.contacts['bits'] & np.uint64(bits)) != 0
+
+    def type_counts(self, inter_segment_classes=ATOM_CLASSES, intra_segment_classes=ATOM_CLASSES, strict_types=(),
+                    water_mediated=False):
+        """Number of interacting atom pairs per record and interaction type, counting only the given atom classes
+        for pairs of residues in different or the same segment (and only level 0 interactions of strict polar and
+        aromatic types), water-mediated interactions are counted as polar interactions if water_mediated is set"""
+        inter = np.array([c in inter_segment_classes for c in ATOM_CLASSES])
+        intra = np.array([c in intra_segment_classes for c in ATOM_CLASSES])
+        classes = np.where(self.contacts['intra_segment'][:, None], intra, inter)
+        level_strict = np.array([t in strict_types and t in LEVEL_STRICT_TYPES for t in INTERACTION_TYPES])
+        counts = np.where(level_strict[:, None], self.contacts['strict_counts'], self.contacts['counts']).astype(np.int64)
+        if water_mediated:
+            water = INTERACTION_TYPES.index(WATER_MEDIATED_TYPE)
+            counts[:, water] += self.contacts['strict_water_counts' if level_strict[water] else 'water_counts']
+        return (counts * classes[:, None, :]).sum(axis=2)
+
+    def interaction_mask(self, interaction_types=INTERACTION_TYPES, strict_types=(),
+                         inter_segment_classes=ATOM_CLASSES, intra_segment_classes=ATOM_CLASSES, water_mediated=False):
+        """Mask (records x INTERACTION_TYPES) of the selected interaction types found in each record, with the
+        strict settings for strict_types (see type_counts and STRICT_MINIMUM_COUNTS)"""
+        minimum_counts = np.array([STRICT_MINIMUM_COUNTS.get(t, 1) if t in strict_types else 1 for t in INTERACTION_TYPES])
+        selected = np.array([t in interaction_types for t in INTERACTION_TYPES])
+        return (self.type_counts(inter_segment_classes, intra_segment_classes, strict_types, water_mediated)
+                >= minimum_counts) & selected
@@ -1,14 +1,16 @@
-from Bio.PDB import Selection, PDBParser
+from Bio.PDB import Selection
 from Bio.PDB.NeighborSearch import NeighborSearch
 
 from contactnetwork.interaction import *
+from contactnetwork.contact_engine import AtomTable, compute_contacts, save_interacting_pairs
+from contactnetwork.contact_fingerprints import save_contact_fingerprint
 from contactnetwork.pdb import *
 from contactnetwork.models import *
-from io import StringIO
 
 from protein.models import ProteinConformation
 
 from structure.models import Structure
+from structure.parsed_structures import get_parsed_structure
 
 from signprot.models import SignprotComplex
 
@@ -31,12 +33,11 @@ def compute_interactions(pdb_name,save_to_db = False):
 
     # Get the pdb structure
     struc = Structure.objects.get(protein_conformation__protein__entry_name=pdb_name)
-    pdb_io = StringIO(struc.pdb_data.pdb)
     # Get the preferred chain
     preferred_chain = struc.preferred_chain.split(',')[0]
 
     # Get the Biopython structure for the PDB
-    s = PDBParser(PERMISSIVE=True, QUIET=True).get_structure('ref', pdb_io)[0]
+    s = get_parsed_structure(struc.pdb_code.index, struc.pdb_data)[0]
     #s = pdb_get_structure(pdb_name)[0]
     chain = s[preferred_chain]
     #return classified, distances
@@ -67,21 +68,17 @@ def compute_interactions(pdb_name,save_to_db = False):
     if do_interactions:
         atom_list = Selection.unfold_entities(s[preferred_chain], 'A')
 
-        # Search for all neighbouring residues
-        ns = NeighborSearch(atom_list)
-        all_neighbors = ns.search_all(6.6, "R")
+        # Atom arrays of all amino acid residues (waters and other hetero groups are no AA)
+        aa_table = AtomTable([residue for residue in s[preferred_chain] if is_aa(residue)])
 
-        # Filter all pairs containing non AA residues
-        all_aa_neighbors = [pair for pair in all_neighbors if is_aa(pair[0]) and is_aa(pair[1])]
+        # Search for all neighbouring residues
+        all_aa_neighbors = aa_table.residue_pairs(aa_table, 6.6)
 
         # Only include contacts between residues more than NUM_SKIP_RESIDUES sequence steps apart
-        all_aa_neighbors = [pair for pair in all_aa_neighbors if abs(pair[0].id[1] - pair[1].id[1]) > NUM_SKIP_RESIDUES]
-
-        # For each pair of interacting residues, determine the type of interaction
-        interactions = [InteractingPair(res_pair[0], res_pair[1], dbres[res_pair[0].id[1]], dbres[res_pair[1].id[1]], struc) for res_pair in all_aa_neighbors if not is_water(res_pair[0]) and not is_water(res_pair[1]) ]
+        all_aa_neighbors = [pair for pair in all_aa_neighbors if abs(aa_table.residues[pair[0]].id[1] - aa_table.residues[pair[1]].id[1]) > NUM_SKIP_RESIDUES]
 
-        # Split unto classified and unclassified.
-        classified = [interaction for interaction in interactions if len(interaction.get_interactions()) > 0]
+        # For each pair of interacting residues, determine the type of interaction and keep the classified ones
+        classified = compute_contacts(aa_table, aa_table, all_aa_neighbors, dbres, dbres, struc)
 
     if do_complexes:
         try:
@@ -89,20 +86,19 @@ def compute_interactions(pdb_name,save_to_db = False):
             complex = SignprotComplex.objects.get(structure=struc)
 
             # Get all GPCR residue atoms based on preferred chain
-            gpcr_atom_list = [ atom for residue in Selection.unfold_entities(s[preferred_chain], 'R') if is_aa(residue) \
-                            for atom in residue.get_atoms()]
+            gpcr_table = AtomTable([residue for residue in Selection.unfold_entities(s[preferred_chain], 'R') if is_aa(residue)])
+            gpcr_atom_list = [ atom for residue in gpcr_table.residues for atom in residue.get_atoms()]
 
             # Get all residue atoms from the coupled protein (e.g. G-protein)
             # NOW: select alpha subnit protein chain using complex model
-            sign_atom_list = [ atom for residue in Selection.unfold_entities(s[complex.alpha], 'R') if is_aa(residue) \
-                                for atom in residue.get_atoms()]
+            sign_table = AtomTable([residue for residue in Selection.unfold_entities(s[complex.alpha], 'R') if is_aa(residue)])
+            sign_atom_list = [ atom for residue in sign_table.residues for atom in residue.get_atoms()]
 
             ns_gpcr = NeighborSearch(gpcr_atom_list)
             ns_sign = NeighborSearch(sign_atom_list)
 
-            # For each GPCR atom perform the neighbor search on the signaling protein
-            all_neighbors = {(gpcr_atom.parent, match_res) for gpcr_atom in gpcr_atom_list
-                            for match_res in ns_sign.search(gpcr_atom.coord, 4.5, "R")}
+            # Residue pairs between the GPCR and the signaling protein
+            all_neighbors = gpcr_table.residue_pairs(sign_table, 4.5)
 
             # For each pair of interacting residues, determine the type of interaction
             #residues_sign = ProteinConformation.objects.get(protein__entry_name=pdb_name+"_"+complex.alpha.lower()).residue_set.exclude(generic_number=None).all().prefetch_related('generic_number')
@@ -116,11 +112,9 @@ def compute_interactions(pdb_name,save_to_db = False):
                 dbres_sign[r.sequence_number] = r
                 dblabel_sign[r.sequence_number] = r.generic_number.label
 
-            # Find interactions
-            interactions = [InteractingPair(res_pair[0], res_pair[1], dbres[res_pair[0].id[1]], dbres_sign[res_pair[1].id[1]], struc) for res_pair in all_neighbors if res_pair[0].id[1] in dbres and res_pair[1].id[1] in dbres_sign ]
-
-            # Filter unclassified interactions
-            classified_complex = [interaction for interaction in interactions if len(interaction.get_interactions()) > 0]
+            # Find interactions and filter unclassified interactions
+            all_neighbors = [pair for pair in all_neighbors if gpcr_table.residues[pair[0]].id[1] in dbres and sign_table.residues[pair[1]].id[1] in dbres_sign]
+            classified_complex = compute_contacts(gpcr_table, sign_table, all_neighbors, dbres, dbres_sign, struc)
 
             # Convert to dictionary for water calculations
             interaction_pairs = {}
@@ -198,6 +192,7 @@ def compute_interactions(pdb_name,save_to_db = False):
             ## Obtain list of water molecules
             water_list = { water for residue in s[preferred_chain] if residue.get_resname() == "HOH" for water in residue.get_atoms() }
             if len(water_list) > 0:
+                ns = NeighborSearch(atom_list)
                 ## Iterate water molecules over residue atom list
                 water_neighbors = [(water, match_res) for water in water_list
                                 for match_res in ns.search(water.coord, 3.5, "R") if not is_water(match_res) and (is_hba(match_res) or is_hbd(match_res))]
@@ -226,12 +221,11 @@ def compute_interactions(pdb_name,save_to_db = False):
                                 # HACK: store water ID as part of first atom name
                                 interaction_pairs[key].interactions.append(WaterMediated(a + "|" + str(water_pair_one[0].get_parent().get_id()[1]), b))
 
-            for p in classified:
-                p.save_into_database()
+            save_interacting_pairs(classified)
+            save_contact_fingerprint(struc)
 
         if do_complexes:
-            for pair in classified_complex:
-                pair.save_into_database()
+            save_interacting_pairs(classified_complex)
 
         # if do_distances:
         #     # Distance.objects.filter(structure=struc).all().delete()
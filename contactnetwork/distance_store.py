@@ -0,0 +1,163 @@
+"""
+Binary per-structure distance store.
+
+The pairwise CA, CB and helix center distances between all residues with a generic number in a structure are stored at
+build time as one int32 array (distance types x residue pairs, upper triangle in residue order) in a .npy file, next
+to a small residue table with the generic number label and amino acid of every residue. The files are memory-mapped
+when read, so statistics across structures can be calculated with NumPy without one database row per residue pair.
+Distances are scaled by distance_scaling_factor like in the Distance model.
+"""
+from django.conf import settings
+
+import os
+import numpy as np
+
+DISTANCE_TYPES = ['CA', 'CB', 'HC']
+
+# value used for distances that could not be calculated (e.g. residues without a helix center)
+NO_DISTANCE = -1
+
+DISTANCE_RESIDUE_DTYPE = np.dtype([
+    ('label', 'U12'),
+    ('amino_acid', 'U1'),
+])
+
+# generic number segments that are left out of the TM distance statistics
+EXCLUDED_SEGMENTS = ('8x', '12x', '23x', '34x', '45x')
+
+
+def distance_store_dir():
+    return os.sep.join([settings.BUILD_CACHE_DIR, 'distance_maps'])
+
+def distance_map_paths(structure_id):
+    directory = distance_store_dir()
+    return (os.sep.join([directory, '{}_residues.npy'.format(structure_id)]),
+            os.sep.join([directory, '{}_distances.npy'.format(structure_id)]))
+
+def save_distance_map(structure_id, labels, amino_acids, distances):
+    """Write the distance map of a structure (atomically replacing an older version)
+
+    @param distances: int32 array of shape (len(DISTANCE_TYPES), number of residue pairs), with the pairs in the order
+    of np.triu_indices(len(labels), 1)
+    """
+    os.makedirs(distance_store_dir(), exist_ok=True)
+    residues = np.zeros(len(labels), dtype=DISTANCE_RESIDUE_DTYPE)
+    residues['label'] = labels
+    residues['amino_acid'] = amino_acids
+    for path, data in zip(distance_map_paths(structure_id), (residues, np.asarray(distances, dtype=np.int32))):
+        tmp_path = path + '.tmp.npy'
+        np.save(tmp_path, data)
+        os.replace(tmp_path, path)
+
+def load_distance_map(structure_id):
+    """Memory-map the distance map of a structure, returns None if it has not been built"""
+    residue_path, distance_path = distance_map_paths(structure_id)
+    if not os.path.isfile(residue_path) or not os.path.isfile(distance_path):
+        return None
+    return DistanceMap(np.load(residue_path), np.load(distance_path, mmap_mode='r'))
+
+def delete_distance_maps():
+    directory = distance_store_dir()
+    if os.path.isdir(directory):
+        for filename in os.listdir(directory):
+            if filename.endswith('.npy'):
+                os.remove(os.sep.join([directory, filename]))
+
+def excluded_pair(pair):
+    return any(segment in pair for segment in EXCLUDED_SEGMENTS)
+
+
+class DistanceMap:
+    """Distances between the residues of a single structure"""
+
+    def __init__(self, residues, distances):
+        self.labels = residues['label']
+        self.amino_acids = residues['amino_acid']
+        self.distances = distances
+        self.rows, self.columns = np.triu_indices(len(self.labels), 1)
+
+    def values(self, distance_type='CA'):
+        """Distances as floats, missing distances are NaN"""
+        values = self.distances[DISTANCE_TYPES.index(distance_type)].astype(np.float64)
+        values[values == NO_DISTANCE] = np.nan
+        return values
+
+
+class DistanceMaps:
+    """Distance maps of a set of structures on a shared generic number axis"""
+
+    def __init__(self, structure_ids, maps):
+        self.structure_ids = structure_ids
+        self.maps = maps
+        self.labels = sorted(set(label for m in maps for label in m.labels.tolist()))
+        self.label_index = dict([(label, i) for i, label in enumerate(self.labels)])
+        # position of the residues of every structure on the shared axis
+        self.axis_index = [np.array([self.label_index[label] for label in m.labels.tolist()], dtype=np.int64)
+                           for m in maps]
+
+    @classmethod
+    def load(cls, structure_ids):
+        """Load the maps of the given structure ids, returns None if any of them is missing"""
+        maps = []
+        for structure_id in structure_ids:
+            distance_map = load_distance_map(structure_id)
+            if distance_map is None:
+                return None
+            maps.append(distance_map)
+        return cls(list(structure_ids), maps)
+
+    def pair_codes(self, s):
+        """Codes (row * number of labels + column on the shared axis) of all residue pairs of a structure"""
+        axis = self.axis_index[s]
+        m = self.maps[s]
+        return axis[m.rows] * len(self.labels) + axis[m.columns]
+
+    def pair_label(self, code):
+        return '_'.join([self.labels[code // len(self.labels)], self.labels[code % len(self.labels)]])
+
+    def pair_code(self, pair):
+        """Code of a 'gn1_gn2' pair label, None if one of the residues is not in any of the maps"""
+        label1, label2 = pair.split('_')
+        if label1 not in self.label_index or label2 not in self.label_index:
+            return None
+        return self.label_index[label1] * len(self.labels) + self.label_index[label2]
+
+    def all_pairs(self, distance_type='CA'):
+        """Sorted codes of all pairs with a distance in at least one structure, and the number of structures
+        with a distance for each of them"""
+        codes = []
+        for s, m in enumerate(self.maps):
+            present = m.distances[DISTANCE_TYPES.index(distance_type)] != NO_DISTANCE
+            codes.append(self.pair_codes(s)[present])
+        if not codes:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        return np.unique(np.concatenate(codes), return_counts=True)
+
+    def values(self, codes, distance_type='CA'):
+        """Distances (structures x requested pair codes), NaN where a structure has no distance"""
+        codes = np.asarray(codes, dtype=np.int64)
+        order = np.argsort(codes)
+        sorted_codes = codes[order]
+        values = np.full((len(self.maps), len(codes)), np.nan)
+        if not len(codes):
+            return values
+        for s, m in enumerate(self.maps):
+            structure_codes = self.pair_codes(s)
+            positions = np.searchsorted(sorted_codes, structure_codes)
+            positions[positions == len(sorted_codes)] = 0
+            found = sorted_codes[positions] == structure_codes
+            values[s, order[positions[found]]] = m.values(distance_type)[found]
+        return values
+
+    def amino_acids(self, codes):
+        """Amino acid pairs (structures x requested pair codes), empty strings where a residue is missing"""
+        codes = np.asarray(codes, dtype=np.int64)
+        n = len(self.labels)
+        aa1 = np.full((len(self.maps), len(codes)), '', dtype='U1')
+        aa2 = np.full((len(self.maps), len(codes)), '', dtype='U1')
+        for s, m in enumerate(self.maps):
+            residue_aa = np.full(n, '', dtype='U1')
+            residue_aa[self.axis_index[s]] = m.amino_acids
+            aa1[s] = residue_aa[codes // n]
+            aa2[s] = residue_aa[codes % n]
+        return aa1, aa2
@@ -1,10 +1,10 @@
 from django.db.models import Avg, Variance, Count, Value, StdDev
 from django.contrib.postgres.aggregates import ArrayAgg
-from django.core.cache import cache
 
 from structure.models import Structure
 from contactnetwork.models import *
-from residue.models import Residue, ResidueGenericNumber
+from contactnetwork.distance_store import DistanceMaps, excluded_pair
+from residue.models import Residue
 
 from collections import OrderedDict
 
@@ -73,13 +73,32 @@ class Distances():
         print(len(self.stats))
 
     def fetch_and_calculate(self, with_arr = False):
+        distance_maps = DistanceMaps.load([s.pk for s in self.structures])
+        if distance_maps is not None:
+            ds = self.calculate_from_maps(distance_maps, with_arr)
+        else:
+            ds = self.aggregate_from_database(with_arr)
+        ds_with_key = dict([(d[0], d) for d in ds])
+
+        # # print(ds.query)
+        # print(ds[1])
+        # Assume that dispersion is always 4
+        if len(self.structures)>1:
+            stats_sorted = sorted(ds, key=lambda k: -k[3])
+        else:
+            stats_sorted = sorted(ds, key=lambda k: -k[1])
+        #print(ds[1])
+
+        self.stats_key = ds_with_key
+        self.stats = stats_sorted
+
+    def aggregate_from_database(self, with_arr = False):
         ## REQUIRES PSQL SETTINGS TO HAVE MORE MEMORY
         # sudo nano /etc/postgresql/9.3/main/postgresql.conf
         # shared_buffers = 2GB
         # work_mem = 100MB
         # temp_buffers = 500MB
         # sudo /etc/init.d/postgresql restart
-        ds_with_key = {}
         if with_arr:
             ds = list(Distance.objects.filter(structure__in=self.structures).exclude(gns_pair__contains='8x').exclude(gns_pair__contains='12x').exclude(gns_pair__contains='23x').exclude(gns_pair__contains='34x').exclude(gns_pair__contains='45x') \
                             .values('gns_pair') \
@@ -90,25 +109,39 @@ class Distances():
                 ds[i][2] = ds[i][2] / distance_scaling_factor
                 ds[i][5] = [x / distance_scaling_factor for x in ds[i][5]]
                 ds[i][3] = d[2]/d[1]
-                ds_with_key[d[0]] = ds[i]
         else:
             ds = list(Distance.objects.filter(structure__in=self.structures).exclude(gns_pair__contains='8x').exclude(gns_pair__contains='12x').exclude(gns_pair__contains='23x').exclude(gns_pair__contains='34x').exclude(gns_pair__contains='45x') \
                             .values('gns_pair') \
                             .annotate(mean = Avg('distance'), std = StdDev('distance'), c = Count('distance')).values_list('gns_pair','mean','std','c').filter(c__gte=int(len(self.structures)*0.8)))
             for i,d in enumerate(ds):
                 ds[i] += (d[2]/d[1],)
-                ds_with_key[d[0]] = ds[i]
-        # # print(ds.query)
-        # print(ds[1])
-        # Assume that dispersion is always 4
-        if len(self.structures)>1:
-            stats_sorted = sorted(ds, key=lambda k: -k[3])
-        else:
-            stats_sorted = sorted(ds, key=lambda k: -k[1])
-        #print(ds[1])
-
-        self.stats_key = ds_with_key
-        self.stats = stats_sorted
+        return ds
+
+    def calculate_from_maps(self, distance_maps, with_arr = False):
+        """Mean, standard deviation and dispersion of the TM residue pairs found in at least 80% of the structures,
+        calculated from the binary distance store. Returns rows in the same format as aggregate_from_database"""
+        codes, counts = distance_maps.all_pairs()
+        labels = [distance_maps.pair_label(code) for code in codes]
+        keep = np.array([not excluded_pair(label) for label in labels], dtype=bool) & (counts >= int(0.8*len(self.structures)))
+        codes = codes[keep]
+        counts = counts[keep]
+        labels = [label for label, k in zip(labels, keep) if k]
+
+        values = distance_maps.values(codes)
+        means = np.nanmean(values, axis=0) if len(codes) else np.array([])
+        stds = np.nanstd(values, axis=0) if len(codes) else np.array([])
+
+        ds = []
+        pdbs = np.array(self.pdbs)
+        for i, label in enumerate(labels):
+            if with_arr:
+                present = ~np.isnan(values[:, i])
+                ds.append([label, means[i] / distance_scaling_factor, stds[i] / distance_scaling_factor, stds[i] / means[i],
+                           int(counts[i]), (values[present, i] / distance_scaling_factor).tolist(), pdbs[present].tolist(),
+                           [label] * int(counts[i])])
+            else:
+                ds.append((label, float(means[i]), float(stds[i]), int(counts[i]), float(stds[i] / means[i])))
+        return ds
 
     def fetch_common_gns_tm(self):
 
@@ -399,103 +432,70 @@ class Distances():
     def get_distance_matrix(self, normalize = True, cache_enabled = True):
         # common GNs
         common_gn = self.fetch_common_gns_tm()
-
-#            .filter(label__in=self.filter_gns) \
-        all_gns = ResidueGenericNumber.objects.filter(scheme__slug='gpcrdb')\
-            .exclude(label__startswith='8x') \
-            .exclude(label__startswith='12x') \
-            .exclude(label__startswith='23x') \
-            .exclude(label__startswith='34x') \
-            .exclude(label__startswith='45x') \
-            .values_list('label',flat=True)
-
-        if self.filtered_gns:
-            all_gns = all_gns.filter(label__in=self.filter_gns)
-
-        all_gns = sorted(list(all_gns))
-
-        pdb_distance_maps = {}
-        pdb_gns = {}
-        for pdb in self.pdbs:
-            cache_key = "distanceMap-" + pdb
-
-            # Cached?
-            if cache.has_key(cache_key) and cache_enabled:
-                cached_data = cache.get(cache_key)
-                distance_map = cached_data["map"]
-                structure_gn = cached_data["gns"]
-            else:
-                # grab raw distance data per structure
-                temp = Distances()
-                temp.load_pdbs([pdb])
-                temp.fetch_distances_tm()
-
-#                    .filter(generic_number__label__in=self.filter_gns) \
-                structure_gn = Residue.objects.filter(protein_conformation__in=temp.pconfs) \
-                    .exclude(generic_number=None) \
-                    .exclude(generic_number__label__startswith='8x') \
-                    .exclude(generic_number__label__startswith='12x') \
-                    .exclude(generic_number__label__startswith='23x') \
-                    .exclude(generic_number__label__startswith='34x') \
-                    .exclude(generic_number__label__startswith='45x') \
-                    .values_list('generic_number__label',flat=True)
-
-                if self.filtered_gns:
-                    structure_gn = structure_gn.filter(generic_number__label__in=self.filter_gns)
-
-                structure_gn = list(structure_gn)
-
-                # create distance map
-                distance_map = np.full((len(all_gns), len(all_gns)), 0.0)
-
-                for i,res1 in enumerate(all_gns):
-                    for j in range(i+1, len(all_gns)):
-                        # grab average value
-                        res2 = all_gns[j]
-                        if res1+"_"+res2 in temp.data:
-                            distance_map[i][j] = temp.data[res1+"_"+res2][0]
-
-                # store in cache
-                if cache_enabled:
-                    store = {
-                        "map" : distance_map,
-                        "gns" : structure_gn
-                        }
-                    cache.set(cache_key, store, 60*60*24*14)
-
-            pdb_gns[pdb] = structure_gn
-
-            # Filtering indices to map to common_gns
-            gn_indices = np.array([ all_gns.index(residue) for residue in common_gn ])
-            pdb_distance_maps[pdb] = distance_map[gn_indices,:][:, gn_indices]
-
-            if "average" in pdb_distance_maps:
-                pdb_distance_maps["average"] +=  pdb_distance_maps[pdb]/len(self.pdbs)
-            else:
-                pdb_distance_maps["average"] =  pdb_distance_maps[pdb]/len(self.pdbs)
+        rows, columns = np.triu_indices(len(common_gn), 1)
+
+        # presence of the common GNs in every structure
+        gn_index = dict([(gn, i) for i, gn in enumerate(common_gn)])
+        pconf_index = dict([(pconf.pk, i) for i, pconf in enumerate(self.pconfs)])
+        present = np.zeros((len(self.pdbs), len(common_gn)), dtype=bool)
+        structure_gns = Residue.objects.filter(protein_conformation__in=self.pconfs, generic_number__label__in=common_gn) \
+            .values_list('protein_conformation_id', 'generic_number__label')
+        for pconf_id, gn in structure_gns:
+            present[pconf_index[pconf_id], gn_index[gn]] = True
+
+        # distances of the common GN pairs (structures x pairs, upper triangle of the GN x GN maps)
+        distance_maps = DistanceMaps.load([s.pk for s in self.structures]) if cache_enabled else None
+        if distance_maps is not None:
+            codes = [distance_maps.pair_code(common_gn[i] + "_" + common_gn[j]) for i, j in zip(rows, columns)]
+            codes = [-1 if code is None else code for code in codes]
+            distance_maps = np.nan_to_num(distance_maps.values(codes)) / distance_scaling_factor
+        else:
+            distance_maps = self.fetch_distance_maps(common_gn, rows, columns)
 
         # store distance map
         if normalize:
-            for pdb in self.pdbs:
-                pdb_distance_maps[pdb] = np.nan_to_num(pdb_distance_maps[pdb]/pdb_distance_maps["average"])
-
-        # calculate distance matrix
-        distance_matrix = np.full((len(self.pdbs), len(self.pdbs)), 0.0)
-        for i, pdb1 in enumerate(self.pdbs):
-            for j in range(i+1, len(self.pdbs)):
-                pdb2 = self.pdbs[j]
-
-                # Get common GNs between two PDBs
-                common_between_pdbs = sorted(list(set(pdb_gns[pdb1]).intersection(pdb_gns[pdb2])))
-
-                # Get common between above set and the overall common set of GNs
-                common_with_query_gns = sorted(list(set(common_gn).intersection(common_between_pdbs)))
-
-                # Get the indices of positions that are shared between two PDBs
-                gn_indices = np.array([ common_gn.index(residue) for residue in common_with_query_gns ])
-
-                # Get distance between cells that have both GNs.
-                distance = np.sum(np.absolute(pdb_distance_maps[pdb1][gn_indices,:][:, gn_indices] - pdb_distance_maps[pdb2][gn_indices,:][:, gn_indices]))
-                distance_matrix[i, j] = distance_matrix[j, i] = distance * distance/(len(gn_indices)*len(gn_indices))
+            average = np.mean(distance_maps, axis=0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                distance_maps = np.nan_to_num(distance_maps / average)
+
+        # calculate distance matrix: L1 distance over the GN pairs present in both structures, normalized by the
+        # number of shared GNs
+        distance = masked_l1_distances(distance_maps, present[:, rows] & present[:, columns])
+        shared = present.astype(np.int64) @ present.T.astype(np.int64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distance_matrix = np.where(shared > 0, distance * distance / (shared * shared), 0.0)
+        np.fill_diagonal(distance_matrix, 0.0)
 
         return distance_matrix
+
+    def fetch_distance_maps(self, common_gn, rows, columns):
+        """Distances of the given GN pairs for all structures from the database (structures x pairs, 0 if missing)"""
+        pair_index = dict([(common_gn[i] + "_" + common_gn[j], p) for p, (i, j) in enumerate(zip(rows, columns))])
+        structure_index = dict([(s.pk, i) for i, s in enumerate(self.structures)])
+        distance_maps = np.zeros((len(self.structures), len(pair_index)))
+        ds = Distance.objects.filter(structure__in=self.structures, gn1__in=common_gn, gn2__in=common_gn) \
+            .values_list('structure_id', 'gns_pair', 'distance')
+        for structure_id, pair, distance in ds:
+            if pair in pair_index:
+                distance_maps[structure_index[structure_id], pair_index[pair]] = distance
+        return distance_maps / distance_scaling_factor
+
+
+def masked_l1_distances(values, masks, max_chunk_elements = 2**24):
+    """Pairwise L1 distances between the rows of values, only counting the columns where both rows are unmasked
+
+    The rows are compared in chunks, so that no more than max_chunk_elements differences are kept in memory.
+    """
+    n = len(values)
+    distances = np.zeros((n, n))
+    if not n or not values.shape[1]:
+        return distances
+    values = np.asarray(values, dtype=np.float64)
+    chunk_size = max(1, max_chunk_elements // (n * values.shape[1]))
+    for start in range(0, n, chunk_size):
+        end = min(start + chunk_size, n)
+        # only compare with the rows from start on, the matrix is symmetric
+        difference = np.abs(values[start:end, None, :] - values[None, start:, :])
+        difference *= masks[start:end, None, :] & masks[None, start:, :]
+        distances[start:end, start:] = difference.sum(axis=2)
+    return np.triu(distances) + np.triu(distances, 1).T
@@ -1,8 +1,8 @@
+from contactnetwork.distance_store import DistanceMaps
 from structure.models import Structure
 
 from django.db import models
 import numpy as np
-import statistics
 
 
 distance_scaling_factor = 10000
@@ -77,66 +77,63 @@ class Distance(models.Model):
 
 def get_distance_averages(pdbs,s_lookup, interaction_keys,normalized = False, standard_deviation = False, split_by_amino_acid = False):
     ## Returned dataset is in ClassA GNs...
-    matrix = {}
-    group_distances = {}
-
     if len(pdbs)==1:
         # Never get SD when only looking at a single pdb...
         standard_deviation = False
 
-    ds = list(Distance.objects.filter(structure__pdb_code__index__in=[ pdb.upper() for pdb in pdbs], gns_pair__in=interaction_keys) \
-                         .values('gns_pair','distance','res1__amino_acid','res2__amino_acid','structure__pk'))
-    if not normalized:
-        for d in ds:
-            if split_by_amino_acid:
-                key = '{}{}{}'.format(d['gns_pair'],d['res1__amino_acid'],d['res2__amino_acid']).replace("_",",")
-            else:
-                key = d['gns_pair']
-            if key not in matrix:
-                matrix[key] = []
-            matrix[key].append(d['distance'])
-
-        # Calculate the average of averages
-        for key,dists in matrix.items():
-            if standard_deviation and len(pdbs)>1:
-                if len(dists)==1:
-                    stdevdists = 0
-                else:
-                    stdevdists = statistics.stdev(dists)
-                group_distances[key] = stdevdists/distance_scaling_factor
-            else:
-                group_distances[key] = sum(dists)/len(dists)/distance_scaling_factor
+    structure_ids = list(Structure.objects.filter(pdb_code__index__in=[ pdb.upper() for pdb in pdbs]).values_list('pk', flat=True))
+    distance_maps = DistanceMaps.load(structure_ids)
+    if distance_maps is not None:
+        keys, structures, dists = distance_observations(distance_maps, interaction_keys, split_by_amino_acid)
     else:
+        ds = list(Distance.objects.filter(structure__in=structure_ids, gns_pair__in=interaction_keys) \
+                             .values_list('gns_pair','distance','res1__amino_acid','res2__amino_acid','structure__pk'))
+        if split_by_amino_acid:
+            keys = ['{}{}{}'.format(d[0],d[2],d[3]).replace("_",",") for d in ds]
+        else:
+            keys = [d[0] for d in ds]
+        structures = [d[4] for d in ds]
+        dists = np.array([d[1] for d in ds], dtype=float)
+
+    if len(keys)==0:
+        return {}
+
+    key_labels, key_index = np.unique(keys, return_inverse=True)
+    if normalized:
         # NORMALIZE CODE
-        for d in ds:
-            if split_by_amino_acid:
-                key = '{}{}{}'.format(d['gns_pair'],d['res1__amino_acid'],d['res2__amino_acid']).replace("_",",")
-            else:
-                key = d['gns_pair']
-            dist = d['distance']
-            pf = s_lookup[d['structure__pk']][2] # get the "receptor" level of the structure to group these regardless of species
-
-            if key not in matrix:
-                matrix[key] = {}
-            if pf not in matrix[key]:
-                matrix[key][pf] = []
-            matrix[key][pf].append(dist)
-
-        # Calculate the average of averages
-        for key,pfs in matrix.items():
-            # if key=='3x50_5x50':
-            #     print(pfs)
-            means = [sum(dists)/len(dists) for pf,dists in pfs.items() ]
-            if standard_deviation and len(pdbs)>1:
-                if len(means)==1:
-                    stdevofmeans = 0
-                else:
-                    # stdevofmeans = np.std(means, ddof=1)
-                    stdevofmeans = statistics.stdev(means)
-
-                group_distances[key] = stdevofmeans/distance_scaling_factor
-            else:
-                meanofmeans = sum(means)/len(means)
-                group_distances[key] = meanofmeans/distance_scaling_factor
-
-    return group_distances
+        # average per "receptor" level of the structure first to group these regardless of species
+        pfs = [s_lookup[pk][2] for pk in structures]
+        pf_labels, pf_index = np.unique(pfs, return_inverse=True)
+        cells, cell_index = np.unique(key_index * len(pf_labels) + pf_index, return_inverse=True)
+        values = np.bincount(cell_index, weights=dists) / np.bincount(cell_index)
+        key_index = cells // len(pf_labels)
+    else:
+        values = dists
+
+    # Calculate the average of averages
+    counts = np.bincount(key_index, minlength=len(key_labels))
+    means = np.bincount(key_index, weights=values, minlength=len(key_labels)) / counts
+    if standard_deviation:
+        squares = np.bincount(key_index, weights=(values - means[key_index])**2, minlength=len(key_labels))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            group_values = np.where(counts > 1, np.sqrt(squares / (counts - 1)), 0)
+    else:
+        group_values = means
+
+    return dict(zip(key_labels.tolist(), (group_values/distance_scaling_factor).tolist()))
+
+def distance_observations(distance_maps, interaction_keys, split_by_amino_acid = False):
+    """Distances of the requested pairs in all structures of a DistanceMaps set as flat arrays of key, structure id
+    and distance"""
+    pairs = [pair for pair in set(interaction_keys) if distance_maps.pair_code(pair) is not None]
+    codes = [distance_maps.pair_code(pair) for pair in pairs]
+    values = distance_maps.values(codes)
+    present = ~np.isnan(values)
+    structure_index, pair_index = np.nonzero(present)
+
+    keys = np.array(pairs, dtype=str)[pair_index] if pairs else np.array([], dtype=str)
+    if split_by_amino_acid:
+        aa1, aa2 = distance_maps.amino_acids(codes)
+        keys = np.char.replace(np.char.add(np.char.add(keys, aa1[present]), aa2[present]), "_", ",")
+    structures = np.array(distance_maps.structure_ids)[structure_index].tolist()
+    return keys, structures, values[present]
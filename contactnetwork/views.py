@@ -17,6 +17,8 @@ import copy
 from contactnetwork.models import *
 from contactnetwork.distances import *
 from contactnetwork.functions import *
+from contactnetwork.contact_fingerprints import (ContactFingerprints, INTERACTION_TYPES, LEVEL_STRICT_TYPES,
+    STRICT_MINIMUM_COUNTS, option_classes)
 from structure.models import Structure, StructureVectors, StructureExtraProteins
 from structure.templatetags.structure_extras import *
 from construct.models import Construct
@@ -529,6 +531,54 @@ def PdbTableData(request):
 
     # return render(request, 'contactnetwork/test.html', {'data_table':data_table})
 
+def fingerprint_interactions(fingerprints, i_types, strict_interactions, contact_options, s_lookup, r_gn_lookup):
+    # Interactions in the format of the InteractionBrowserData query (one per interaction type, structure and residue
+    # pair) from the contact fingerprints, with the same interaction type, strict and backbone/side chain filters
+    strict_types = [t for t in i_types if t in strict_interactions]
+    # strict types without a strict setting (ionic) are left out, as in the query filter
+    selected_types = [t for t in i_types if t not in strict_types or t in LEVEL_STRICT_TYPES or t in STRICT_MINIMUM_COUNTS]
+    inter_classes = option_classes([o[len('inter_'):] for o in contact_options if o in ['inter_bbbb', 'inter_scbb', 'inter_scsc']])
+    intra_classes = option_classes([o[len('intra_'):] for o in contact_options if o in ['intra_bbbb', 'intra_scbb', 'intra_scsc']])
+    records, types = np.nonzero(fingerprints.interaction_mask(selected_types, strict_types, inter_classes, intra_classes))
+
+    contacts = fingerprints.contacts[records]
+    structure_ids = [fingerprints.structure_ids[i] for i in fingerprints.structure_index[records].tolist()]
+    interactions = []
+    for structure_id, gn1, gn2, aa1, aa2, t in zip(structure_ids, contacts['gn1'].tolist(), contacts['gn2'].tolist(),
+                                                   contacts['aa1'].tolist(), contacts['aa2'].tolist(), types.tolist()):
+        pdb_name = s_lookup[structure_id][1]
+        if (pdb_name, gn1) not in r_gn_lookup or (pdb_name, gn2) not in r_gn_lookup:
+            continue
+        interactions.append({
+            'interaction_type': INTERACTION_TYPES[t],
+            'interacting_pair__referenced_structure__pk': structure_id,
+            'interacting_pair__res1__pk': r_gn_lookup[(pdb_name, gn1)]['pk'],
+            'interacting_pair__res2__pk': r_gn_lookup[(pdb_name, gn2)]['pk'],
+            'gn1': gn1, 'gn2': gn2, 'aa1': aa1, 'aa2': aa2,
+        })
+    # query order
+    interactions.sort(key=lambda x: (x['interacting_pair__referenced_structure__pk'], x['interacting_pair__res1__pk'], x['interacting_pair__res2__pk']))
+    return interactions
+
+def fingerprint_pair_rows(interactions, pdb_code_lookup, s_lookup, pdb_codes=None):
+    # Amino acid pairs of fingerprint interactions in the format of the tab 2 queries of InteractionBrowserData, for
+    # the structures with the given PDB codes (all if None)
+    rows = OrderedDict()
+    for i in interactions:
+        structure_id = i['interacting_pair__referenced_structure__pk']
+        if pdb_codes is not None and pdb_code_lookup[structure_id] not in pdb_codes:
+            continue
+        key = (i['gn1'], i['gn2'], i['aa1'], i['aa2'])
+        if key not in rows:
+            rows[key] = {'gn1': i['gn1'], 'gn2': i['gn2'], 'aa1': i['aa1'], 'aa2': i['aa2'], 'i_types': [], 'structures': [], 'pfs': []}
+        rows[key]['i_types'].append(i['interaction_type'])
+        rows[key]['structures'].append(pdb_code_lookup[structure_id])
+        rows[key]['pfs'].append(s_lookup[structure_id][2])
+    for row in rows.values():
+        row['structuresC'] = len(set(row['structures']))
+        row['pfsC'] = len(set(row['pfs']))
+    return list(rows.values())
+
 @csrf_exempt
 def InteractionBrowserData(request):
 
@@ -847,6 +897,10 @@ def InteractionBrowserData(request):
             class_mutations = {key: len(value) for key, value in class_mutations.items()}
             cache.set(cache_key, class_mutations, 3600 * 24 * 7)
 
+        # Contact fingerprints of the structures, the interactions are queried if any of them has not been built
+        fingerprints = ContactFingerprints.load(Structure.objects.filter(pdb_code__index__in=pdbs_upper
+            ).order_by('pk').values_list('pk', flat=True))
+
         # Get the relevant interactions
         # TODO MAKE SURE ITs only gpcr residues..
         interactions = Interaction.objects.filter(
@@ -881,16 +935,16 @@ def InteractionBrowserData(request):
 
         # FOR DEBUGGING interaction + strict filters
         # print(interactions.query)
-        interactions = list(interactions)
+        if fingerprints is None:
+            interactions = list(interactions)
 
-        # Grab unique interaction_IDs
-        interaction_ids = []
-        for entry in interactions:
-            interaction_ids.extend(entry['arr'])
+            # Grab unique interaction_IDs
+            interaction_ids = []
+            for entry in interactions:
+                interaction_ids.extend(entry['arr'])
 
         # Interaction type sort - optimize by statically defining interaction type order
         order = ['ionic', 'polar', 'aromatic', 'hydrophobic', 'van-der-waals','None']
-        interactions = sorted(interactions, key=lambda x: order.index(x['interaction_type']))
 
 
 
@@ -943,9 +997,11 @@ def InteractionBrowserData(request):
                             'protein_conformation__protein__entry_name')
         s_lookup = {}
         pdb_lookup = {}
+        pdb_code_lookup = {}
         for s in structures:
             protein, pdb_name,pf  = [s['protein_conformation__protein__parent__entry_name'],s['protein_conformation__protein__entry_name'],s['protein_conformation__protein__parent__family__slug']]
             s_lookup[s['pk']] = [protein, pdb_name,pf]
+            pdb_code_lookup[s['pk']] = s['pdb_code__index']
             pdb_lookup[pdb_name] = [protein, s['pk'],pf]
             data['pfs_lookup'][pf].append(pdb_name)
             # List PDB files that were found in dataset.
@@ -1056,10 +1112,12 @@ def InteractionBrowserData(request):
         r_presence_lookup = defaultdict(lambda: [])
         r_class_translate = {}
         r_class_translate_from_classA = {}
+        r_gn_lookup = {}
 
         distinct_gns = []
 
         for r in residues:
+            r_gn_lookup[(r['protein_conformation__protein__entry_name'], r['generic_number__label'])] = r
 
             # remove .50 number from the display number format (1.50x50), so only the GPCRdb number is left
             r['display_generic_number__label'] = re.sub(r'\.[\d]+', '', r['display_generic_number__label'])
@@ -1097,6 +1155,11 @@ def InteractionBrowserData(request):
 
         all_pdbs_pairs = updated_all_pdbs_pairs
 
+        if fingerprints is not None:
+            interactions = fingerprint_interactions(fingerprints, i_types, strict_interactions, contact_options, s_lookup, r_gn_lookup)
+            fingerprint_rows = interactions
+        interactions = sorted(interactions, key=lambda x: order.index(x['interaction_type']))
+
         # Dict to keep track of which residue numbers are in use
         number_dict = set()
 
@@ -1686,30 +1749,33 @@ def InteractionBrowserData(request):
 
             set_id = 'set1'
             aa_pair_data = data['tab2']
-            interactions = list(Interaction.objects.filter(
-                    interacting_pair__referenced_structure__pdb_code__index__in=[ pdb.upper() for pdb in data['pdbs1']]
-                ).filter(
-                    id__in=interaction_ids
-                ).exclude(
-                    interacting_pair__res1__generic_number=None,
-                    interacting_pair__res2__generic_number=None
-                ).annotate(
-                    gn1=F('interacting_pair__res1__generic_number__label'),
-                    gn2=F('interacting_pair__res2__generic_number__label'),
-                    aa1=F('interacting_pair__res1__amino_acid'),
-                    aa2=F('interacting_pair__res2__amino_acid'),
-                ).values(
-                    'gn1',
-                    'gn2',
-                    'aa1',
-                    'aa2',
-                ).distinct().annotate(
-                    i_types=ArrayAgg('interaction_type'),
-                    structures=ArrayAgg('interacting_pair__referenced_structure__pdb_code__index'),
-                    pfs=ArrayAgg('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__slug'),
-                    structuresC=Count('interacting_pair__referenced_structure',distinct=True),
-                    pfsC=Count('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__name',distinct=True)
-                ))
+            if fingerprints is not None:
+                interactions = fingerprint_pair_rows(fingerprint_rows, pdb_code_lookup, s_lookup, [ pdb.upper() for pdb in data['pdbs1']])
+            else:
+                interactions = list(Interaction.objects.filter(
+                        interacting_pair__referenced_structure__pdb_code__index__in=[ pdb.upper() for pdb in data['pdbs1']]
+                    ).filter(
+                        id__in=interaction_ids
+                    ).exclude(
+                        interacting_pair__res1__generic_number=None,
+                        interacting_pair__res2__generic_number=None
+                    ).annotate(
+                        gn1=F('interacting_pair__res1__generic_number__label'),
+                        gn2=F('interacting_pair__res2__generic_number__label'),
+                        aa1=F('interacting_pair__res1__amino_acid'),
+                        aa2=F('interacting_pair__res2__amino_acid'),
+                    ).values(
+                        'gn1',
+                        'gn2',
+                        'aa1',
+                        'aa2',
+                    ).distinct().annotate(
+                        i_types=ArrayAgg('interaction_type'),
+                        structures=ArrayAgg('interacting_pair__referenced_structure__pdb_code__index'),
+                        pfs=ArrayAgg('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__slug'),
+                        structuresC=Count('interacting_pair__referenced_structure',distinct=True),
+                        pfsC=Count('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__name',distinct=True)
+                    ))
             for i in interactions:
                 key = '{},{}{}{}'.format(r_class_translate_from_classA[i['gn1']],r_class_translate_from_classA[i['gn2']],i['aa1'],i['aa2'])
                 if key not in aa_pair_data:
@@ -1728,30 +1794,33 @@ def InteractionBrowserData(request):
             print('Gotten first set occurance calcs',time.time()-start_time)
 
             set_id = 'set2'
-            interactions = list(Interaction.objects.filter(
-                    interacting_pair__referenced_structure__pdb_code__index__in=[ pdb.upper() for pdb in data['pdbs2']]
-                ).filter(
-                    id__in=interaction_ids
-                ).exclude(
-                    interacting_pair__res1__generic_number=None,
-                    interacting_pair__res2__generic_number=None
-                ).annotate(
-                    gn1=F('interacting_pair__res1__generic_number__label'),
-                    gn2=F('interacting_pair__res2__generic_number__label'),
-                    aa1=F('interacting_pair__res1__amino_acid'),
-                    aa2=F('interacting_pair__res2__amino_acid'),
-                ).values(
-                    'gn1',
-                    'gn2',
-                    'aa1',
-                    'aa2',
-                ).distinct().annotate(
-                    i_types=ArrayAgg('interaction_type'),
-                    structures=ArrayAgg('interacting_pair__referenced_structure__pdb_code__index'),
-                    pfs=ArrayAgg('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__slug'),
-                    structuresC=Count('interacting_pair__referenced_structure',distinct=True),
-                    pfsC=Count('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__name',distinct=True)
-                ))
+            if fingerprints is not None:
+                interactions = fingerprint_pair_rows(fingerprint_rows, pdb_code_lookup, s_lookup, [ pdb.upper() for pdb in data['pdbs2']])
+            else:
+                interactions = list(Interaction.objects.filter(
+                        interacting_pair__referenced_structure__pdb_code__index__in=[ pdb.upper() for pdb in data['pdbs2']]
+                    ).filter(
+                        id__in=interaction_ids
+                    ).exclude(
+                        interacting_pair__res1__generic_number=None,
+                        interacting_pair__res2__generic_number=None
+                    ).annotate(
+                        gn1=F('interacting_pair__res1__generic_number__label'),
+                        gn2=F('interacting_pair__res2__generic_number__label'),
+                        aa1=F('interacting_pair__res1__amino_acid'),
+                        aa2=F('interacting_pair__res2__amino_acid'),
+                    ).values(
+                        'gn1',
+                        'gn2',
+                        'aa1',
+                        'aa2',
+                    ).distinct().annotate(
+                        i_types=ArrayAgg('interaction_type'),
+                        structures=ArrayAgg('interacting_pair__referenced_structure__pdb_code__index'),
+                        pfs=ArrayAgg('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__slug'),
+                        structuresC=Count('interacting_pair__referenced_structure',distinct=True),
+                        pfsC=Count('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__name',distinct=True)
+                    ))
 
             for i in interactions:
                 key = '{},{}{}{}'.format(r_class_translate_from_classA[i['gn1']],r_class_translate_from_classA[i['gn2']],i['aa1'],i['aa2'])
@@ -1851,28 +1920,31 @@ def InteractionBrowserData(request):
             # Single set!
             # TODO: fix the interaction filter subselection
             aa_pair_data = data['tab2']
-            interactions = list(Interaction.objects.filter(
-                    id__in=interaction_ids
-                ).exclude(
-                    interacting_pair__res1__generic_number=None,
-                    interacting_pair__res2__generic_number=None
-                ).annotate(
-                    gn1=F('interacting_pair__res1__generic_number__label'),
-                    gn2=F('interacting_pair__res2__generic_number__label'),
-                    aa1=F('interacting_pair__res1__amino_acid'),
-                    aa2=F('interacting_pair__res2__amino_acid'),
-                ).values(
-                    'gn1',
-                    'gn2',
-                    'aa1',
-                    'aa2',
-                ).distinct().annotate(
-                    i_types=ArrayAgg('interaction_type'),
-                    structures=ArrayAgg('interacting_pair__referenced_structure__pdb_code__index'),
-                    pfs=ArrayAgg('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__slug'),
-                    structuresC=Count('interacting_pair__referenced_structure',distinct=True),
-                    pfsC=Count('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__name',distinct=True)
-                ))
+            if fingerprints is not None:
+                interactions = fingerprint_pair_rows(fingerprint_rows, pdb_code_lookup, s_lookup)
+            else:
+                interactions = list(Interaction.objects.filter(
+                        id__in=interaction_ids
+                    ).exclude(
+                        interacting_pair__res1__generic_number=None,
+                        interacting_pair__res2__generic_number=None
+                    ).annotate(
+                        gn1=F('interacting_pair__res1__generic_number__label'),
+                        gn2=F('interacting_pair__res2__generic_number__label'),
+                        aa1=F('interacting_pair__res1__amino_acid'),
+                        aa2=F('interacting_pair__res2__amino_acid'),
+                    ).values(
+                        'gn1',
+                        'gn2',
+                        'aa1',
+                        'aa2',
+                    ).distinct().annotate(
+                        i_types=ArrayAgg('interaction_type'),
+                        structures=ArrayAgg('interacting_pair__referenced_structure__pdb_code__index'),
+                        pfs=ArrayAgg('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__slug'),
+                        structuresC=Count('interacting_pair__referenced_structure',distinct=True),
+                        pfsC=Count('interacting_pair__referenced_structure__protein_conformation__protein__parent__family__name',distinct=True)
+                    ))
 
             for i in interactions:
                 key = '{},{}{}{}'.format(r_class_translate_from_classA[i['gn1']],r_class_translate_from_classA[i['gn2']],i['aa1'],i['aa2'])
@@ -2881,19 +2953,15 @@ def ClusteringData(request):
     hclust = sch.linkage(ssd.squareform(distance_matrix), method='average')
     tree = sch.to_tree(hclust, False)
 
-    #inconsistency = sch.inconsistent(hclust)
-    #inconsistency = sch.maxinconsts(hclust, inconsistency)
-    silhouette_coefficient = {}
-    getSilhouetteIndex(tree, distance_matrix, silhouette_coefficient)
-    data['tree'] = getNewick(tree, "", tree.dist, pdbs, silhouette_coefficient)
-
     # Order distance_matrix by hclust
     N = len(distance_matrix)
     res_order = seriation(hclust, N, N + N-2)
-    seriated_dist = np.zeros((N,N))
-    a,b = np.triu_indices(N,k=1)
-    seriated_dist[a,b] = distance_matrix[ [res_order[i] for i in a], [res_order[j] for j in b]]
-    seriated_dist[b,a] = seriated_dist[a,b]
+    seriated_dist = np.asarray(distance_matrix)[np.ix_(res_order, res_order)]
+
+    #inconsistency = sch.inconsistent(hclust)
+    #inconsistency = sch.maxinconsts(hclust, inconsistency)
+    silhouette_coefficient = getSilhouetteIndex(hclust, seriated_dist)
+    data['tree'] = getNewick(tree, "", tree.dist, pdbs, silhouette_coefficient)
 
     data['distance_matrix'] = seriated_dist.tolist()
     data['dm_labels'] = [pdbs[i] for i in res_order]
@@ -2913,73 +2981,94 @@ def seriation(Z,N,cur_index):
 
         seriation computes the order implied by a hierarchical tree (dendrogram)
     '''
-    if cur_index < N:
-        return [cur_index]
-    else:
-        left = int(Z[cur_index-N,0])
-        right = int(Z[cur_index-N,1])
-        return (seriation(Z,N,left) + seriation(Z,N,right))
-
-def getNewick(node, newick, parentdist, leaf_names, silhouette_coefficient):
-    if node.is_leaf():
-        return "%s:%.2f%s" % (leaf_names[node.id], parentdist - node.dist, newick)
-    else:
-        si_node = silhouette_coefficient[node.id]
-        if len(newick) > 0:
-            newick = ")%.2f:%.2f%s" % (si_node, parentdist - node.dist, newick)
+    # iterative traversal, deep trees exceed the recursion limit
+    order = []
+    stack = [cur_index]
+    while stack:
+        index = stack.pop()
+        if index < N:
+            order.append(index)
         else:
-            newick = ");"
-        newick = getNewick(node.get_left(), newick, node.dist, leaf_names, silhouette_coefficient)
-        newick = getNewick(node.get_right(), ",%s" % (newick), node.dist, leaf_names, silhouette_coefficient)
-        newick = "(%s" % (newick)
-        return newick
-
-def getSilhouetteIndex(node, distance_matrix, results):
-    # set rootnode (DEBUG purposes)
-    if node.id not in results:
-        results[node.id] = 0
-
-    if not node.is_leaf():
-        # get list of indices cluster left (A)
-        a = node.get_left().pre_order(lambda x: x.id)
-
-        # get list of indices cluster right (B)
-        b = node.get_right().pre_order(lambda x: x.id)
+            stack.append(int(Z[index-N,1]))
+            stack.append(int(Z[index-N,0]))
+    return order
 
-        if len(a) > 1:
-            # calculate average Si - cluster A
-            si_a = calculateSilhouetteIndex(distance_matrix, a, b)
-            results[node.get_left().id] = si_a
+def getNewick(node, newick, parentdist, leaf_names, silhouette_coefficient):
+    # iterative traversal, deep trees exceed the recursion limit
+    root = len(newick) == 0
+    parts = []
+    stack = [newick, (node, parentdist)]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            parts.append(item)
+            continue
 
-            getSilhouetteIndex(node.get_left(), distance_matrix, results)
+        current, current_parentdist = item
+        if current.is_leaf():
+            parts.append("%s:%.2f" % (leaf_names[current.id], current_parentdist - current.dist))
+        else:
+            if current is node and root:
+                closing = ");"
+            else:
+                closing = ")%.2f:%.2f" % (silhouette_coefficient[current.id], current_parentdist - current.dist)
+            # right cluster first, as in the original recursive implementation
+            stack.extend([closing, (current.get_left(), current.dist), ",", (current.get_right(), current.dist), "("])
+    return "".join(parts)
 
-        if len(b) > 1:
-            # calculate average Si - cluster B
-            si_b = calculateSilhouetteIndex(distance_matrix, b, a)
-            results[node.get_right().id] = si_b
+def getSilhouetteIndex(Z, seriated_dist):
+    '''
+        input:
+            - Z is a hierarchical tree (linkage matrix)
+            - seriated_dist is the distance matrix ordered by seriation(Z, ...)
+        output:
+            - dictionary with the average silhouette index of every cluster (node id) with more than one member,
+              compared to its sibling cluster (root: 0)
 
-            getSilhouetteIndex(node.get_right(), distance_matrix, results)
+        In the seriated order every cluster is a contiguous block, so the sums of the distances of a point to all
+        members of a cluster are differences of row-wise prefix sums, which makes this a single pass over Z.
+    '''
+    N = len(seriated_dist)
+    results = {2*N-2: 0}
+
+    cumulative = np.zeros((N, N+1))
+    cumulative[:, 1:] = np.cumsum(seriated_dist, axis=1)
+
+    # size and first position in the seriated order of every node
+    sizes = np.ones(2*N-1, dtype=int)
+    sizes[N:] = Z[:, 3]
+    starts = np.zeros(2*N-1, dtype=int)
+    for k in range(N-2, -1, -1):
+        left = int(Z[k, 0])
+        right = int(Z[k, 1])
+        starts[left] = starts[N+k]
+        starts[right] = starts[N+k] + sizes[left]
+
+    for k in range(N-1):
+        left = int(Z[k, 0])
+        right = int(Z[k, 1])
+        if sizes[left] > 1:
+            results[left] = calculateSilhouetteIndex(cumulative, starts[left], sizes[left], starts[right], sizes[right])
+        if sizes[right] > 1:
+            results[right] = calculateSilhouetteIndex(cumulative, starts[right], sizes[right], starts[left], sizes[left])
+
+    return results
 
 # Implementation based on Rousseeuw, P.J. J. Comput. Appl. Math. 20 (1987): 53-65
-def calculateSilhouetteIndex(distance_matrix, a, b):
-    si = 0
-    for i in a:
-        # calculate ai - avg distance within cluster
-        ai = 0
-        for j in a:
-            if i != j:
-                ai += distance_matrix[i,j]/(len(a)-1)
+def calculateSilhouetteIndex(cumulative, a_start, a_size, b_start, b_size):
+    rows = cumulative[a_start:a_start+a_size]
 
-        # calculate bi - avg distance to closest cluster
-        bi = 0
-        for j in b:
-            bi += distance_matrix[i,j]/len(b)
+    # ai - avg distance within cluster
+    ai = (rows[:, a_start+a_size] - rows[:, a_start]) / (a_size-1)
 
-        # silhouette index (averaged)
-        si += (bi-ai)/max(ai,bi)/len(a)
+    # bi - avg distance to closest cluster
+    bi = (rows[:, b_start+b_size] - rows[:, b_start]) / b_size
 
-    return si
+    # silhouette index (averaged)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        si = np.nan_to_num((bi-ai) / np.maximum(ai, bi))
 
+    return float(np.mean(si))
 
 def DistanceData(request):
     def gpcrdb_number_comparator(e1, e2):
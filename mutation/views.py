@@ -15,16 +15,19 @@ from common.views import AbsTargetSelection
 from common.views import AbsTargetSelectionTable
 from common.views import AbsSegmentSelection
 from common.diagrams_gpcr import DrawHelixBox, DrawSnakePlot
+from common.cache_warming import register_product, get_product
+from common.reference_data import reference_data
 from common import definitions
 
 from construct.views import ConstructMutation
 from contactnetwork.models import Interaction, InteractingResiduePair
+from contactnetwork.contact_fingerprints import ContactFingerprints, option_classes
 
 from interaction.models import ResidueFragmentInteraction, StructureLigandInteraction
 from interaction.views import calculate
 from interaction.forms import PDBform
 
-from residue.models import Residue,ResidueNumberingScheme, ResidueGenericNumberEquivalent
+from residue.models import Residue,ResidueNumberingScheme
 from residue.views import ResidueTablesDisplay
 from protein.models import Protein, ProteinSegment, ProteinFamily, ProteinConformation, ProteinGProteinPair
 from structure.models import Structure
@@ -32,7 +35,7 @@ from structure.models import Structure
 from seqsign.sequence_signature import SequenceSignature
 
 from datetime import datetime
-from collections import OrderedDict
+from collections import OrderedDict, Counter
 import json
 import yaml
 import os
@@ -244,17 +247,11 @@ def render_mutations(request, protein = None, family = None, download = None, re
     context['number_of_schemes'] = ''
     context['longest_name'] = {'div' : 0, 'height': 0}
 
-    gn_lookup = {}
+    # class specific labels of the default generic numbers
+    gn_lookup = reference_data().equivalent_labels(used_scheme)
 
     residue_table_list = []
 
-    gn_labels = mutations.values_list('mutation__residue__generic_number__label', flat=True)
-    class_gns = ResidueGenericNumberEquivalent.objects.filter(default_generic_number__label__in = gn_labels, scheme__slug = used_scheme).prefetch_related('default_generic_number').all()
-
-    for class_gn in class_gns:
-        label = class_gn.default_generic_number
-        gn_lookup[label] = class_gn
-
     import urllib.parse
     mutation_tables = ''
     for mutation in mutations:
@@ -287,14 +284,9 @@ def render_mutations(request, protein = None, family = None, download = None, re
         mutations_list_seq[mutation.residue.sequence_number][0].append([mutation.foldchange,ligand.replace('\xe2', "").replace('\'', ""),qual])
         if mutation.residue.generic_number:
             mutations_list[mutation.residue.generic_number.label].append([mutation.foldchange,ligand.replace('\xe2', "").replace('\'', ""),qual])
-            if mutation.residue.generic_number not in gn_lookup:
-                class_gn = ResidueGenericNumberEquivalent.objects.filter(default_generic_number = mutation.residue.generic_number, scheme__slug = used_scheme).get()
-                gn_lookup[mutation.residue.generic_number] = class_gn
-            else:
-                class_gn = gn_lookup[mutation.residue.generic_number]
             mutations_display_generic_number[mutation.raw.id] = mutation.residue.display_generic_number.label
             mutations_generic_number[mutation.raw.id] = mutation.residue.generic_number.label
-            mutations_class_generic_number[mutation.raw.id] = class_gn.label
+            mutations_class_generic_number[mutation.raw.id] = gn_lookup[mutation.residue.generic_number_id]
             gn_display = mutation.residue.display_generic_number.label
         else:
             gn_display = ''
@@ -2106,205 +2098,207 @@ class designStateSelector(AbsReferenceSelection):
         },
     }
 
-def collectAndCacheClassData(target_class):
-    # Class conservation
-    cache_name = "Class_AA_conservation_"+target_class
-    class_gn_cons = cache.get(cache_name)
-    # class_gn_cons = None
-    if class_gn_cons == None:
-        class_aln = Alignment()
-        human_gpcrs_class = Protein.objects.filter(species__common_name = 'Human', sequence_type__slug = 'wt', family__slug__startswith=target_class)
-        class_aln.load_proteins(human_gpcrs_class)
-        #class_aln.load_segments(ProteinSegment.objects.filter(slug__in=['TM1', 'TM2', 'TM3', 'TM4','TM5','TM6', 'TM7', 'H8']))
-        class_aln.load_segments(ProteinSegment.objects.filter(partial=False, proteinfamily='GPCR'))
-        class_aln.build_alignment()
-        class_gn_cons = {}
-        for segment in class_aln.consensus:
-            for gn in class_aln.consensus[segment]:
+def gpcrClasses():
+    # only the GPCR classes, not the G protein and arrestin families
+    return [slug for slug in reference_data().family_children("000") if slug.startswith("00")]
+
+# Class conservation
+@register_product('class_aa_conservation', 'Class_AA_conservation_{}', dependencies=['proteins', 'residues'], parameters=gpcrClasses)
+def buildClassConservation(target_class):
+    class_aln = Alignment()
+    human_gpcrs_class = Protein.objects.filter(species__common_name = 'Human', sequence_type__slug = 'wt', family__slug__startswith=target_class)
+    class_aln.load_proteins(human_gpcrs_class)
+    #class_aln.load_segments(ProteinSegment.objects.filter(slug__in=['TM1', 'TM2', 'TM3', 'TM4','TM5','TM6', 'TM7', 'H8']))
+    class_aln.load_segments(ProteinSegment.objects.filter(partial=False, proteinfamily='GPCR'))
+    class_aln.build_alignment()
+    class_gn_cons = {}
+    for segment in class_aln.consensus:
+        for gn in class_aln.consensus[segment]:
+            class_gn_cons[gn] = class_aln.consensus[segment][gn]
+            if class_gn_cons[gn][0]=="+":
+                class_gn_cons[gn][0] = class_aln.forced_consensus[segment][gn]
+            else:
                 class_gn_cons[gn] = class_aln.consensus[segment][gn]
-                if class_gn_cons[gn][0]=="+":
-                    class_gn_cons[gn][0] = class_aln.forced_consensus[segment][gn]
-                else:
-                    class_gn_cons[gn] = class_aln.consensus[segment][gn]
-        cache.set(cache_name, class_gn_cons, 60*60*24*7) # cache a week
-
-    # Class mutation data
-    cache_name = "Class_mutation_counts_"+target_class
-    class_mutations = cache.get(cache_name)
-    #class_mutations = None
-    if class_mutations == None:
-        class_mutations = {}
-
-        # Collect raw counts
-        all_ligand_mutations = MutationExperiment.objects.filter(protein__family__slug__startswith=target_class)\
-                                .values("residue__generic_number__label").\
-                                annotate(unique_mutations=Count("pk")).annotate(unique_receptors=Count("protein__family_id", distinct=True))
-
-        for pair in all_ligand_mutations:
-            gn = pair["residue__generic_number__label"]
-            class_mutations[gn] = {}
-            class_mutations[gn]["unique_mutations"] = pair["unique_mutations"]
-            class_mutations[gn]["unique_receptors"] = pair["unique_receptors"]
-            # placeholder in case there are no mutations with >=5 fold effect
-            class_mutations[gn]["fold_mutations"] = class_mutations[gn]["fold_receptors"] = 0
-
-        # Collect counts with >=5 fold effect on ligand binding
-        fold_ligand_mutations = MutationExperiment.objects.filter(Q(foldchange__gte = 5) | Q(foldchange__lte = -5), protein__family__slug__startswith=target_class)\
-            .values("residue__generic_number__label").annotate(fold_mutations=Count("pk")).annotate(fold_receptors=Count("protein__family_id", distinct=True))
-
-        for pair in fold_ligand_mutations:
-            gn = pair["residue__generic_number__label"]
-            class_mutations[gn]["fold_mutations"] = pair["fold_mutations"]
-            class_mutations[gn]["fold_receptors"] = pair["fold_receptors"]
-
-        cache.set(cache_name, class_mutations, 60*60*24*7) # cache a week
-
-    # Class Thermostabilizing mutations
-    cache_name = "Class_thermo_muts"+target_class
-    class_thermo_muts = cache.get(cache_name)
-    #class_thermo_muts = None
-    if class_thermo_muts == None:
-        class_thermo_muts = {}
-        all_thermo = ConstructMutation.objects.filter(construct__protein__family__slug__startswith=target_class, effects__slug='thermostabilising', effects__effect="Increased")\
-                    .values("pk", "residue__generic_number__label", "wild_type_amino_acid", "mutated_amino_acid", "construct__structure__protein_conformation__protein__family__slug")\
-                    .order_by("residue__generic_number__label")
-        for pair in all_thermo:
-            gn = pair["residue__generic_number__label"]
-            wt = pair["wild_type_amino_acid"]
-            mutant = pair["mutated_amino_acid"]
-            receptor_slug = pair["construct__structure__protein_conformation__protein__family__slug"]
-            if gn not in class_thermo_muts:
-                class_thermo_muts[gn] = {}
-                class_thermo_muts[gn]["count"] = 0
-                class_thermo_muts[gn]["mutations"] = set()
-                class_thermo_muts[gn]["receptors"] = set()
-            if wt not in class_thermo_muts[gn]:
-                class_thermo_muts[gn][wt] = []
-            class_thermo_muts[gn][wt].append(mutant)
-            class_thermo_muts[gn]["count"] += 1
-            class_thermo_muts[gn]["mutations"].add(mutant)
-            class_thermo_muts[gn]["receptors"].add(receptor_slug)
-        cache.set(cache_name, class_thermo_muts, 60*60*24*7) # cache a week
-
-    # Class Expression increasing mutations from constructs
-    cache_name = "Class_struct_expr_incr_muts"+target_class
-    class_struct_expr_incr_muts = cache.get(cache_name)
-    #class_struct_expr_incr_muts = None
-    if class_struct_expr_incr_muts == None:
-        class_struct_expr_incr_muts = {}
-        all_expr = ConstructMutation.objects.filter(construct__protein__family__slug__startswith=target_class, effects__slug='receptor-expression', effects__effect="Increased")\
-                    .values("residue__generic_number__label", "wild_type_amino_acid", "mutated_amino_acid", "construct__structure__protein_conformation__protein__family__slug")\
-                    .order_by("residue__generic_number__label")
-
-        for pair in all_expr:
-            gn = pair["residue__generic_number__label"]
-            wt = pair["wild_type_amino_acid"]
-            mutant = pair["mutated_amino_acid"]
-            receptor_slug = pair["construct__structure__protein_conformation__protein__family__slug"]
-
-            if gn not in class_struct_expr_incr_muts:
-                class_struct_expr_incr_muts[gn] = {}
-                class_struct_expr_incr_muts[gn]["count"] = 0
-                class_struct_expr_incr_muts[gn]["mutations"] = set()
-                class_struct_expr_incr_muts[gn]["receptors"] = set()
-                class_struct_expr_incr_muts[gn]["sources"] = set()
-
-            if wt not in class_struct_expr_incr_muts[gn]:
-                class_struct_expr_incr_muts[gn][wt] = []
-            class_struct_expr_incr_muts[gn][wt].append(mutant)
-
-            class_struct_expr_incr_muts[gn]["count"] += 1
-            class_struct_expr_incr_muts[gn]["mutations"].add(mutant)
-            class_struct_expr_incr_muts[gn]["receptors"].add(receptor_slug)
-            class_struct_expr_incr_muts[gn]["sources"].add("Structure")
-
-        cache.set(cache_name, class_struct_expr_incr_muts, 60*60*24*7) # cache a week
-
-    # Class Expression increasing mutations from ligand binding mutagenesis data
-    cache_name = "Class_ligmut_expr_incr_muts"+target_class
-    class_ligmut_expr_incr_muts = cache.get(cache_name)
-    #class_ligmut_expr_incr_muts = None
-    if class_ligmut_expr_incr_muts == None:
-        class_ligmut_expr_incr_muts = {}
-        # Mininum increase in expression randomly set to 25%
-        all_mutant_expr = MutationExperiment.objects.filter(protein__family__slug__startswith=target_class, opt_receptor_expression__gt=130)\
-                    .exclude(residue__generic_number_id=None)\
-                    .values("residue__generic_number__label", "residue__amino_acid", "mutation__amino_acid", "protein__family__slug")\
-                    .order_by("residue__generic_number__label")
-
-        for pair in all_mutant_expr:
-            gn = pair["residue__generic_number__label"]
-            wt = pair["residue__amino_acid"]
-            mutant = pair["mutation__amino_acid"]
-            receptor_slug = pair["protein__family__slug"]
-
-            if gn not in class_ligmut_expr_incr_muts:
-                class_ligmut_expr_incr_muts[gn] = {}
-                class_ligmut_expr_incr_muts[gn]["count"] = 0
-                class_ligmut_expr_incr_muts[gn]["mutations"] = set()
-                class_ligmut_expr_incr_muts[gn]["receptors"] = set()
-                class_ligmut_expr_incr_muts[gn]["sources"] = set()
-
-            if wt not in class_ligmut_expr_incr_muts[gn]:
-                class_ligmut_expr_incr_muts[gn][wt] = []
-            class_ligmut_expr_incr_muts[gn][wt].append(mutant)
-
-            class_ligmut_expr_incr_muts[gn]["count"] += 1
-            class_ligmut_expr_incr_muts[gn]["mutations"].add(mutant)
-            class_ligmut_expr_incr_muts[gn]["receptors"].add(receptor_slug)
-            class_ligmut_expr_incr_muts[gn]["sources"].add("LigSiteMut")
-
-        cache.set(cache_name, class_ligmut_expr_incr_muts, 60*60*24*7) # cache a week
-
-    # Ligand interactions
-    cache_name = "Class_ligand_ints"+target_class
-    class_ligand_ints = cache.get(cache_name)
-    if class_ligand_ints == None:
-        class_ligand_ints = {}
-        ligand_interactions = ResidueFragmentInteraction.objects.filter(
-            structure_ligand_pair__structure__protein_conformation__protein__family__slug__startswith=target_class, structure_ligand_pair__annotated=True)\
-                    .exclude(interaction_type__type='hidden')\
-                    .values("rotamer__residue__generic_number__label")\
-                    .order_by("rotamer__residue__generic_number__label")\
-                    .annotate(unique_structures=Count("rotamer__residue__protein_conformation", distinct=True))\
-                    .annotate(unique_receptors=Count("rotamer__residue__protein_conformation__protein__family_id", distinct=True))
-
-        for pair in ligand_interactions:
-            gn = pair["rotamer__residue__generic_number__label"]
-            class_ligand_ints[gn] = {}
-            class_ligand_ints[gn]["unique_structures"] = pair["unique_structures"]
-            class_ligand_ints[gn]["unique_receptors"] = pair["unique_receptors"]
-        cache.set(cache_name, class_ligand_ints, 60*60*24*7) # cache a week
-
-    # G-protein interactions
-    cache_name = "Class_gprot_ints"+target_class
-    class_prot_ints = cache.get(cache_name)
-    if class_prot_ints == None:
-        class_prot_ints = {}
-
-        gprot_interactions = InteractingResiduePair.objects.filter(
-                referenced_structure__protein_conformation__protein__family__slug__startswith=target_class
-            ).exclude(
-                res1__protein_conformation_id=F('res2__protein_conformation_id')
-            ).values(
-                "res1__generic_number__label"
-            ).order_by(
-                'res1__generic_number__label',
-            ).annotate(
-                unique_structures=Count("referenced_structure__protein_conformation", distinct=True)
-            ).annotate(
-                unique_receptors=Count("referenced_structure__protein_conformation__protein__family_id", distinct=True)
-            ).annotate(
-                pdb_codes=ArrayAgg('referenced_structure__pdb_code__index')
-            )
+    return class_gn_cons
+
+
+# Class mutation data
+@register_product('class_mutation_counts', 'Class_mutation_counts_{}', dependencies=['mutations'], parameters=gpcrClasses)
+def buildClassMutationCounts(target_class):
+    class_mutations = {}
+
+    # Collect raw counts
+    all_ligand_mutations = MutationExperiment.objects.filter(protein__family__slug__startswith=target_class)\
+                            .values("residue__generic_number__label").\
+                            annotate(unique_mutations=Count("pk")).annotate(unique_receptors=Count("protein__family_id", distinct=True))
+
+    for pair in all_ligand_mutations:
+        gn = pair["residue__generic_number__label"]
+        class_mutations[gn] = {}
+        class_mutations[gn]["unique_mutations"] = pair["unique_mutations"]
+        class_mutations[gn]["unique_receptors"] = pair["unique_receptors"]
+        # placeholder in case there are no mutations with >=5 fold effect
+        class_mutations[gn]["fold_mutations"] = class_mutations[gn]["fold_receptors"] = 0
+
+    # Collect counts with >=5 fold effect on ligand binding
+    fold_ligand_mutations = MutationExperiment.objects.filter(Q(foldchange__gte = 5) | Q(foldchange__lte = -5), protein__family__slug__startswith=target_class)\
+        .values("residue__generic_number__label").annotate(fold_mutations=Count("pk")).annotate(fold_receptors=Count("protein__family_id", distinct=True))
+
+    for pair in fold_ligand_mutations:
+        gn = pair["residue__generic_number__label"]
+        class_mutations[gn]["fold_mutations"] = pair["fold_mutations"]
+        class_mutations[gn]["fold_receptors"] = pair["fold_receptors"]
+    return class_mutations
+
+
+# Class Thermostabilizing mutations
+@register_product('class_thermo_muts', 'Class_thermo_muts{}', dependencies=['constructs'], parameters=gpcrClasses)
+def buildClassThermoMutations(target_class):
+    class_thermo_muts = {}
+    all_thermo = ConstructMutation.objects.filter(construct__protein__family__slug__startswith=target_class, effects__slug='thermostabilising', effects__effect="Increased")\
+                .values("pk", "residue__generic_number__label", "wild_type_amino_acid", "mutated_amino_acid", "construct__structure__protein_conformation__protein__family__slug")\
+                .order_by("residue__generic_number__label")
+    for pair in all_thermo:
+        gn = pair["residue__generic_number__label"]
+        wt = pair["wild_type_amino_acid"]
+        mutant = pair["mutated_amino_acid"]
+        receptor_slug = pair["construct__structure__protein_conformation__protein__family__slug"]
+        if gn not in class_thermo_muts:
+            class_thermo_muts[gn] = {}
+            class_thermo_muts[gn]["count"] = 0
+            class_thermo_muts[gn]["mutations"] = set()
+            class_thermo_muts[gn]["receptors"] = set()
+        if wt not in class_thermo_muts[gn]:
+            class_thermo_muts[gn][wt] = []
+        class_thermo_muts[gn][wt].append(mutant)
+        class_thermo_muts[gn]["count"] += 1
+        class_thermo_muts[gn]["mutations"].add(mutant)
+        class_thermo_muts[gn]["receptors"].add(receptor_slug)
+    return class_thermo_muts
+
+
+# Class Expression increasing mutations from constructs
+@register_product('class_struct_expr_incr_muts', 'Class_struct_expr_incr_muts{}', dependencies=['constructs'], parameters=gpcrClasses)
+def buildClassStructExpressionMutations(target_class):
+    class_struct_expr_incr_muts = {}
+    all_expr = ConstructMutation.objects.filter(construct__protein__family__slug__startswith=target_class, effects__slug='receptor-expression', effects__effect="Increased")\
+                .values("residue__generic_number__label", "wild_type_amino_acid", "mutated_amino_acid", "construct__structure__protein_conformation__protein__family__slug")\
+                .order_by("residue__generic_number__label")
+
+    for pair in all_expr:
+        gn = pair["residue__generic_number__label"]
+        wt = pair["wild_type_amino_acid"]
+        mutant = pair["mutated_amino_acid"]
+        receptor_slug = pair["construct__structure__protein_conformation__protein__family__slug"]
+
+        if gn not in class_struct_expr_incr_muts:
+            class_struct_expr_incr_muts[gn] = {}
+            class_struct_expr_incr_muts[gn]["count"] = 0
+            class_struct_expr_incr_muts[gn]["mutations"] = set()
+            class_struct_expr_incr_muts[gn]["receptors"] = set()
+            class_struct_expr_incr_muts[gn]["sources"] = set()
+
+        if wt not in class_struct_expr_incr_muts[gn]:
+            class_struct_expr_incr_muts[gn][wt] = []
+        class_struct_expr_incr_muts[gn][wt].append(mutant)
+
+        class_struct_expr_incr_muts[gn]["count"] += 1
+        class_struct_expr_incr_muts[gn]["mutations"].add(mutant)
+        class_struct_expr_incr_muts[gn]["receptors"].add(receptor_slug)
+        class_struct_expr_incr_muts[gn]["sources"].add("Structure")
+    return class_struct_expr_incr_muts
+
+
+# Class Expression increasing mutations from ligand binding mutagenesis data
+@register_product('class_ligmut_expr_incr_muts', 'Class_ligmut_expr_incr_muts{}', dependencies=['mutations'], parameters=gpcrClasses)
+def buildClassLigmutExpressionMutations(target_class):
+    class_ligmut_expr_incr_muts = {}
+    # Mininum increase in expression randomly set to 25%
+    all_mutant_expr = MutationExperiment.objects.filter(protein__family__slug__startswith=target_class, opt_receptor_expression__gt=130)\
+                .exclude(residue__generic_number_id=None)\
+                .values("residue__generic_number__label", "residue__amino_acid", "mutation__amino_acid", "protein__family__slug")\
+                .order_by("residue__generic_number__label")
+
+    for pair in all_mutant_expr:
+        gn = pair["residue__generic_number__label"]
+        wt = pair["residue__amino_acid"]
+        mutant = pair["mutation__amino_acid"]
+        receptor_slug = pair["protein__family__slug"]
+
+        if gn not in class_ligmut_expr_incr_muts:
+            class_ligmut_expr_incr_muts[gn] = {}
+            class_ligmut_expr_incr_muts[gn]["count"] = 0
+            class_ligmut_expr_incr_muts[gn]["mutations"] = set()
+            class_ligmut_expr_incr_muts[gn]["receptors"] = set()
+            class_ligmut_expr_incr_muts[gn]["sources"] = set()
+
+        if wt not in class_ligmut_expr_incr_muts[gn]:
+            class_ligmut_expr_incr_muts[gn][wt] = []
+        class_ligmut_expr_incr_muts[gn][wt].append(mutant)
+
+        class_ligmut_expr_incr_muts[gn]["count"] += 1
+        class_ligmut_expr_incr_muts[gn]["mutations"].add(mutant)
+        class_ligmut_expr_incr_muts[gn]["receptors"].add(receptor_slug)
+        class_ligmut_expr_incr_muts[gn]["sources"].add("LigSiteMut")
+    return class_ligmut_expr_incr_muts
+
+
+# Ligand interactions
+@register_product('class_ligand_ints', 'Class_ligand_ints{}', dependencies=['ligand_interactions'], parameters=gpcrClasses)
+def buildClassLigandInteractions(target_class):
+    class_ligand_ints = {}
+    ligand_interactions = ResidueFragmentInteraction.objects.filter(
+        structure_ligand_pair__structure__protein_conformation__protein__family__slug__startswith=target_class, structure_ligand_pair__annotated=True)\
+                .exclude(interaction_type__type='hidden')\
+                .values("rotamer__residue__generic_number__label")\
+                .order_by("rotamer__residue__generic_number__label")\
+                .annotate(unique_structures=Count("rotamer__residue__protein_conformation", distinct=True))\
+                .annotate(unique_receptors=Count("rotamer__residue__protein_conformation__protein__family_id", distinct=True))
+
+    for pair in ligand_interactions:
+        gn = pair["rotamer__residue__generic_number__label"]
+        class_ligand_ints[gn] = {}
+        class_ligand_ints[gn]["unique_structures"] = pair["unique_structures"]
+        class_ligand_ints[gn]["unique_receptors"] = pair["unique_receptors"]
+    return class_ligand_ints
+
+
+# G-protein interactions
+@register_product('class_gprot_ints', 'Class_gprot_ints{}', dependencies=['interactions'], parameters=gpcrClasses)
+def buildClassGproteinInteractions(target_class):
+    class_prot_ints = {}
+
+    gprot_interactions = InteractingResiduePair.objects.filter(
+            referenced_structure__protein_conformation__protein__family__slug__startswith=target_class
+        ).exclude(
+            res1__protein_conformation_id=F('res2__protein_conformation_id')
+        ).values(
+            "res1__generic_number__label"
+        ).order_by(
+            'res1__generic_number__label',
+        ).annotate(
+            unique_structures=Count("referenced_structure__protein_conformation", distinct=True)
+        ).annotate(
+            unique_receptors=Count("referenced_structure__protein_conformation__protein__family_id", distinct=True)
+        ).annotate(
+            pdb_codes=ArrayAgg('referenced_structure__pdb_code__index')
+        )
 
-        for pair in gprot_interactions:
-            gn = pair["res1__generic_number__label"]
-            class_prot_ints[gn] = {}
-            class_prot_ints[gn]["unique_structures"] = pair["unique_structures"]
-            class_prot_ints[gn]["unique_receptors"] = pair["unique_receptors"]
-            class_prot_ints[gn]["structures"] = pair["pdb_codes"]
-        cache.set(cache_name, class_prot_ints, 60*60*24*7) # cache a week
+    for pair in gprot_interactions:
+        gn = pair["res1__generic_number__label"]
+        class_prot_ints[gn] = {}
+        class_prot_ints[gn]["unique_structures"] = pair["unique_structures"]
+        class_prot_ints[gn]["unique_receptors"] = pair["unique_receptors"]
+        class_prot_ints[gn]["structures"] = pair["pdb_codes"]
+    return class_prot_ints
+
+# Class level data of the mutation design tools, built by the warm_caches command
+CLASS_DATA_PRODUCTS = ['class_aa_conservation', 'class_mutation_counts', 'class_thermo_muts', 'class_struct_expr_incr_muts',
+                       'class_ligmut_expr_incr_muts', 'class_ligand_ints', 'class_gprot_ints']
+
+def collectAndCacheClassData(target_class):
+    for product in CLASS_DATA_PRODUCTS:
+        get_product(product, target_class)
 
 
 def contactMutationDesign(request, goal):
@@ -2892,22 +2886,66 @@ def designStateDetailsGN(request):
 
 # = pair / # structures
 def calculateResidueContactFrequency(pdbs, allowed_gns, detail_gn = None):
-    # Prepare list and caching
+    # Prepare list
     pdbs = list(set(pdbs))
     pdbs.sort()
-    cache_name = "Contact_freq_" + hashlib.md5("_".join(pdbs).encode()).hexdigest()  + hashlib.md5("_".join(allowed_gns).encode()).hexdigest()
-
-    receptor_slugs = Structure.objects.filter(pdb_code__index__in=pdbs).values("protein_conformation__protein__family__slug").annotate(structure_count=Count('pk')).order_by(
-                'protein_conformation__protein__family__slug',
-            ).distinct()
-    receptor_counts = {}
-    for count in receptor_slugs:
-        receptor_counts[count["protein_conformation__protein__family__slug"]] = count["structure_count"]
 
+    structures = list(Structure.objects.filter(pdb_code__index__in=pdbs).values_list("pk", "protein_conformation__protein__family__slug"))
+    receptor_counts = Counter([slug for pk, slug in structures])
     num_receptor_slugs = len(receptor_counts)
 
+    # Contacting GN pairs and the receptor slug of the structure they are found in
+    fingerprints = ContactFingerprints.load([pk for pk, slug in structures])
+    if fingerprints is not None:
+        # Interaction type filter + minimum interaction for VdW + Hyd
+        # intrasegment (only S-S interactions) intersegments(S-S + S-B interactions), including water-mediated interactions
+        contacts = fingerprints.interaction_mask(strict_types=['hydrophobic', 'van-der-waals'],
+            inter_segment_classes=option_classes(['scbb', 'scsc']), intra_segment_classes=option_classes(['scsc']),
+            water_mediated=True).any(axis=1)
+        contacts &= fingerprints.in_gns(allowed_gns)
+
+        gn1 = fingerprints.contacts['gn1'][contacts]
+        gn2 = fingerprints.contacts['gn2'][contacts]
+        slugs = np.array([slug for pk, slug in structures], dtype=object)[fingerprints.structure_index[contacts]]
+    else:
+        result_pairs = queryResidueContacts(pdbs, allowed_gns)
+        pair_ids = [pair_id for pair_id in result_pairs for slug in result_pairs[pair_id]]
+        gn1 = np.array([pair_id.split("_")[0] for pair_id in pair_ids], dtype=str)
+        gn2 = np.array([pair_id.split("_")[1] for pair_id in pair_ids], dtype=str)
+        slugs = np.array([slug for pair_id in result_pairs for slug in result_pairs[pair_id]], dtype=object)
+
+    # Count and normalize by receptor slug
+    contributions = np.array([100/receptor_counts[slug]/num_receptor_slugs for slug in slugs], dtype=float)
+
+    # Give collected results per GN or detailed results for a single GN
+    results = {}
+    if detail_gn == None:
+        gns = np.concatenate([gn1, gn2])
+        contributions = np.concatenate([contributions, contributions])
+        if len(gns):
+            unique_gns, gn_index = np.unique(gns, return_inverse=True)
+            totals = np.bincount(gn_index, weights=contributions)
+            for gn, total in zip(unique_gns.tolist(), totals.tolist()):
+                results[gn] = total
+    else:
+        # pairs are selected when the detail GN is part of the pair id (gn1_gn2)
+        pair_ids = np.array(["{}_{}".format(x, y) for x, y in zip(gn1.tolist(), gn2.tolist())], dtype=str)
+        detail = np.char.find(pair_ids, detail_gn) >= 0 if len(pair_ids) else np.zeros(0, dtype=bool)
+        if detail.any():
+            unique_pairs, pair_index = np.unique(pair_ids[detail], return_inverse=True)
+            totals = np.bincount(pair_index, weights=contributions[detail])
+            for pair_id, total in zip(unique_pairs.tolist(), totals.tolist()):
+                pair_gn1, pair_gn2 = pair_id.split("_")
+                other_gn = pair_gn1 if pair_gn1 != detail_gn else pair_gn2
+                results[other_gn] = total
+
+    return results
+
+# Contacting GN pairs from the database (for structures without a contact fingerprint)
+def queryResidueContacts(pdbs, allowed_gns):
+    cache_name = "Contact_freq_" + hashlib.md5("_".join(pdbs).encode()).hexdigest()  + hashlib.md5("_".join(allowed_gns).encode()).hexdigest()
+
     result_pairs = cache.get(cache_name)
-    #result_pairs = None
     if result_pairs == None:
 
         # Add interaction type filter + minimum interaction for VdW + Hyd
@@ -2996,39 +3034,7 @@ def calculateResidueContactFrequency(pdbs, allowed_gns, detail_gn = None):
         # Store in cache
         cache.set(cache_name, result_pairs, 60*60*24*7) # cache a week
 
-    # Give collected results per GN or detailed results for a single GN
-    if detail_gn == None:
-        results = {}
-        for pair_id in result_pairs.keys():
-            gn1, gn2 = pair_id.split("_")
-            slugs = result_pairs[pair_id]
-
-            for gn in [gn1, gn2]:
-                if gn not in results:
-                    results[gn] = 0
-
-            for slug in set(slugs):
-                structure_hits = sum([slug2 == slug for slug2 in slugs])
-                contribution = structure_hits/receptor_counts[slug]/num_receptor_slugs*100
-                results[gn1] += contribution
-                results[gn2] += contribution
-
-        return results
-    else:
-        results = {}
-        for pair_id in result_pairs.keys():
-            if detail_gn in pair_id:
-                gn1, gn2 = pair_id.split("_")
-                slugs = result_pairs[pair_id]
-
-                other_gn = gn1 if gn1 != detail_gn else gn2
-                results[other_gn] = 0
-                for slug in set(slugs):
-                    structure_hits = sum([slug2 == slug for slug2 in slugs])
-                    contribution = structure_hits/receptor_counts[slug]/num_receptor_slugs*100
-                    results[other_gn] += contribution
-
-        return results
+    return result_pairs
 
 
 # Collect all residue pairs
@@ -3036,8 +3042,14 @@ def collectResiduePairs(pdbs, allowed_gns):
     # Prepare list and caching
     pdbs = list(set(pdbs))
     pdbs.sort()
-    cache_name = "Contact_pairs_" + hashlib.md5("_".join(pdbs).encode()).hexdigest()  + hashlib.md5("_".join(allowed_gns).encode()).hexdigest()
 
+    structure_ids = list(Structure.objects.filter(pdb_code__index__in=pdbs).values_list("pk", flat=True))
+    fingerprints = ContactFingerprints.load(structure_ids)
+    if fingerprints is not None:
+        contacts = fingerprints.contacts[fingerprints.in_gns(allowed_gns)]
+        return sorted(set(zip(contacts['gn1'].tolist(), contacts['aa1'].tolist(), contacts['gn2'].tolist(), contacts['aa2'].tolist())))
+
+    cache_name = "Contact_pairs_" + hashlib.md5("_".join(pdbs).encode()).hexdigest()  + hashlib.md5("_".join(allowed_gns).encode()).hexdigest()
     pairs = cache.get(cache_name)
     #results = None
     if pairs == None:
@@ -1,6 +1,7 @@
 ﻿#!/usr/bin/env python
 import urllib
 from Bio import Phylo
+from io import StringIO
 import sys,os
 from collections import defaultdict
 
@@ -275,16 +276,14 @@ class PrepareTree:
 
 
 
-    def treeDo(self,d, infile,branches,family,Additional_info, famdict=None):
+    def treeDo(self, infile,branches,family,Additional_info, famdict=None):
+        """PhyloXML of a Newick tree with the annotations and colour charts of the proteins"""
         self.famdict=famdict
-        d = '/'.join(d.split('/'))
         z = infile
-        w = open(d+'/rong','w').write(z.replace('-',''))
-        raw = open(d+'/raw.xml','w')
-        Phylo.convert(d+'/rong','newick',raw,'phyloxml')
-        raw.close()
-        xml = open(d+'/raw.xml','r').readlines()
-        out = open(d+'/out.xml','w')
+        raw = StringIO()
+        Phylo.convert(StringIO(z.replace('-','')),'newick',raw,'phyloxml')
+        xml = raw.getvalue().splitlines(True)
+        out = []
         self.get_tree_data(Additional_info)
         if self.build !=False:
             self.rings['class']['include']=False
@@ -300,7 +299,7 @@ class PrepareTree:
         stylesflag=False
         for line in xml:
             if stylesflag == True:
-                out.write("<render>"+charts+"<styles>"+self.styles+"</styles></render>")
+                out.append("<render>"+charts+"<styles>"+self.styles+"</styles></render>")
                 stylesflag = False
             ################# Remove header trash #######################
             if 'phyloxml' in line:
@@ -344,10 +343,11 @@ class PrepareTree:
                 if flag2 != '':
                     line = line.strip('\n')+' <annotation><desc>'+self.prots[flag2[0]]['desc']+' ('+self.prots[flag2[0]]['species']+')'+'</desc><uri>/protein/'+self.prots[flag2[0]]['link']+'</uri> </annotation>'+flag2[1]
                     flag2=''
-            out.write(line)
+            out.append(line)
 
         self.box = self.drawColorPanel()
+        return ''.join(out)
 
 if __name__ == '__main__':
     tree = PrepareTree(False)
-    tree.treeDo(sys.argv[1],sys.argv[2])
+    print(tree.treeDo(open(sys.argv[1]).read(),False,{},{}))
@@ -0,0 +1,235 @@
+"""
+In-process phylogenetic tree building.
+
+Replaces the PHYLIP seqboot/protdist/neighbor/consense pipeline. Protein distances are calculated from the integer
+coded alignment (see common.alignment_matrix) for all pairs at once, with matrix products over one-hot encoded blocks
+of columns. Trees are built with neighbor-joining or UPGMA and written in Newick format like PHYLIP does. Bootstrap
+replicates (resampled alignment columns) are built on a pool of processes and summarized in an extended majority rule
+consensus tree, with the number of replicates that support a branch as its length (as in the consense output).
+"""
+from scipy.cluster.hierarchy import linkage
+
+from multiprocessing import Pool
+import os
+
+import numpy as np
+
+from common.alignment_matrix import GAP_CODE
+
+# distance of sequences that are too different to be compared (and of sequences without shared positions)
+MAX_DISTANCE = 10.0
+
+# random seed used to resample the alignment columns (the seed that was given to seqboot)
+BOOTSTRAP_SEED = 77
+
+# encoded alignment of the bootstrap worker processes
+bootstrap_codes = None
+
+
+def residue_mask(codes):
+    """Positions with a residue (not a gap or an unknown residue)"""
+    return (codes >= 0) & (codes != GAP_CODE)
+
+def identity_counts(codes, weights=None, block_size=256):
+    """Number of identical and compared positions of all pairs of rows of an encoded alignment
+
+    Only positions with a residue in both rows are compared. The optional weights give the number of times every
+    column is counted (used for bootstrap replicates). Returns (identical, compared) as NxN arrays.
+    """
+    num_rows, num_columns = codes.shape
+    present = residue_mask(codes)
+    letters = np.unique(codes[present])
+    if weights is None:
+        weights = np.ones(num_columns)
+
+    identical = np.zeros((num_rows, num_rows))
+    weighted = present * weights[None, :]
+    compared = weighted @ present.T.astype(np.float64)
+    for start in range(0, num_columns, block_size):
+        block = codes[:, start:start + block_size]
+        onehot = (block[:, :, None] == letters[None, None, :]) & present[:, start:start + block_size, None]
+        flat = onehot.reshape(num_rows, -1).astype(np.float64)
+        block_weights = np.repeat(weights[start:start + block_size], len(letters))
+        identical += (flat * block_weights[None, :]) @ flat.T
+    return identical, compared
+
+def kimura_distances(identical, compared):
+    """Kimura protein distances (the approximation of PAM distances of protdist): d = -ln(1 - p - 0.2p^2), where p
+    is the fraction of compared positions with different residues"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = 1 - identical / compared
+        similarity = 1 - p - 0.2 * p**2
+        distances = -np.log(np.maximum(similarity, np.exp(-MAX_DISTANCE)))
+    distances[compared == 0] = MAX_DISTANCE
+    np.fill_diagonal(distances, 0)
+    return distances
+
+def protein_distances(codes, weights=None):
+    return kimura_distances(*identity_counts(codes, weights))
+
+def newick_node(children):
+    """Newick string of an internal node from (newick, branch length) pairs of its children"""
+    return '(' + ','.join(['{}:{:.5f}'.format(newick, length) for newick, length in children]) + ')'
+
+def neighbor_joining(distances, names):
+    """Unrooted neighbor-joining tree (with a trifurcation at the base, like neighbor)
+
+    Returns the Newick string and the leaf sets (tuples of leaf indices) of the internal branches.
+    """
+    distances = np.array(distances, dtype=np.float64)
+    nodes = list(names)
+    leaves = [(i,) for i in range(len(names))]
+    clusters = []
+    while len(nodes) > 3:
+        n = len(nodes)
+        totals = distances.sum(axis=1)
+        q = (n - 2) * distances - totals[:, None] - totals[None, :]
+        np.fill_diagonal(q, np.inf)
+        i, j = np.unravel_index(np.argmin(q), q.shape)
+        i, j = min(i, j), max(i, j)
+        length_i = 0.5 * distances[i, j] + (totals[i] - totals[j]) / (2 * (n - 2))
+        length_j = distances[i, j] - length_i
+
+        # the joined node takes the place of i
+        joined = 0.5 * (distances[i] + distances[j] - distances[i, j])
+        distances[i, :] = joined
+        distances[:, i] = joined
+        distances[i, i] = 0
+        distances = np.delete(np.delete(distances, j, axis=0), j, axis=1)
+        nodes[i] = newick_node([(nodes[i], length_i), (nodes[j], length_j)])
+        leaves[i] = leaves[i] + leaves[j]
+        clusters.append(leaves[i])
+        del nodes[j]
+        del leaves[j]
+
+    if len(nodes) == 3:
+        d = distances
+        lengths = [(d[0, 1] + d[0, 2] - d[1, 2]) / 2, (d[0, 1] + d[1, 2] - d[0, 2]) / 2, (d[0, 2] + d[1, 2] - d[0, 1]) / 2]
+    elif len(nodes) == 2:
+        lengths = [distances[0, 1] / 2] * 2
+    else:
+        lengths = [0.0] * len(nodes)
+    return newick_node(zip(nodes, lengths)) + ';', clusters
+
+def upgma(distances, names):
+    """Rooted UPGMA tree
+
+    Returns the Newick string and the leaf sets (tuples of leaf indices) of the internal branches.
+    """
+    n = len(names)
+    if n < 2:
+        return newick_node([(name, 0.0) for name in names]) + ';', []
+    condensed = np.asarray(distances)[np.triu_indices(n, 1)]
+    merges = linkage(condensed, 'average')
+    nodes = list(names)
+    leaves = [(i,) for i in range(n)]
+    heights = [0.0] * n
+    for a, b, distance, count in merges:
+        a, b = int(a), int(b)
+        height = distance / 2
+        nodes.append(newick_node([(nodes[a], height - heights[a]), (nodes[b], height - heights[b])]))
+        leaves.append(leaves[a] + leaves[b])
+        heights.append(height)
+    return nodes[-1] + ';', leaves[n:-1]
+
+def build_tree(distances, names, method='nj'):
+    if method == 'upgma':
+        return upgma(distances, names)
+    return neighbor_joining(distances, names)
+
+def tree_splits(clusters, num_leaves):
+    """Unrooted splits of a tree, every split is given by the side that does not contain the first leaf"""
+    everything = frozenset(range(num_leaves))
+    splits = set()
+    for cluster in clusters:
+        split = frozenset(cluster)
+        if 0 in split:
+            split = everything - split
+        if 1 < len(split) < num_leaves - 1:
+            splits.add(split)
+    return splits
+
+def set_bootstrap_codes(codes):
+    global bootstrap_codes
+    bootstrap_codes = codes
+
+def replicate_splits(arguments):
+    """Splits of the trees of a number of bootstrap replicates (runs in the worker processes)"""
+    weights_list, method = arguments
+    num_leaves = len(bootstrap_codes)
+    names = [str(i) for i in range(num_leaves)]
+    replicates = []
+    for weights in weights_list:
+        tree, clusters = build_tree(protein_distances(bootstrap_codes, weights), names, method)
+        replicates.append(tree_splits(clusters, num_leaves))
+    return replicates
+
+def majority_rule_consensus(replicates, names):
+    """Extended majority rule consensus tree of the splits of a list of trees
+
+    Splits are added by decreasing frequency as long as they are compatible with the ones that were already added.
+    Branch lengths are the number of trees with the split (tips: the number of trees), as in the consense output.
+    """
+    num_leaves = len(names)
+    counts = {}
+    for splits in replicates:
+        for split in splits:
+            counts[split] = counts.get(split, 0) + 1
+
+    accepted = []
+    for split in sorted(counts, key=lambda split: (-counts[split], sorted(split))):
+        if len(accepted) == num_leaves - 3:
+            break
+        if all(split <= other or other <= split or not split & other for other in accepted):
+            accepted.append(split)
+
+    # build the nested groups from the smallest to the largest split, the remaining ones join at the root
+    total = len(replicates)
+    owner = list(range(num_leaves))
+    groups = dict([(i, ('{}:{:.1f}'.format(name, total), (i,))) for i, name in enumerate(names)])
+    for k, split in enumerate(sorted(accepted, key=len)):
+        key = num_leaves + k
+        children = sorted(set(owner[leaf] for leaf in split), key=lambda child: groups[child][1][0])
+        groups[key] = ('(' + ','.join([groups[child][0] for child in children]) + '):{:.1f}'.format(counts[split]),
+                       tuple(sorted(split)))
+        for leaf in split:
+            owner[leaf] = key
+    root = sorted(set(owner), key=lambda child: groups[child][1][0])
+    return '(' + ','.join([groups[child][0] for child in root]) + ');'
+
+def bootstrap_tree(codes, names, replicates, method='nj', processes=None, seed=BOOTSTRAP_SEED):
+    """Consensus tree of bootstrap replicates of the alignment, built on a pool of processes"""
+    num_columns = codes.shape[1]
+    random_state = np.random.RandomState(seed)
+    weights = [np.bincount(random_state.randint(0, num_columns, num_columns), minlength=num_columns).astype(np.float64)
+               for _ in range(replicates)]
+
+    # columns with less than two residues do not contribute to any distance
+    informative = residue_mask(codes).sum(axis=0) > 1
+    codes = codes[:, informative]
+    weights = [w[informative] for w in weights]
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, replicates))
+    if processes > 1:
+        chunks = [(chunk, method) for chunk in np.array_split(np.array(weights), processes)]
+        with Pool(processes, initializer=set_bootstrap_codes, initargs=(codes,)) as pool:
+            results = pool.map(replicate_splits, chunks)
+        replicate_trees = [splits for result in results for splits in result]
+    else:
+        set_bootstrap_codes(codes)
+        replicate_trees = replicate_splits((weights, method))
+    return majority_rule_consensus(replicate_trees, names)
+
+def phylogenetic_tree(codes, names, method='nj', bootstrap=0, processes=None):
+    """Newick tree of an encoded alignment (proteins x positions, see common.alignment_matrix)
+
+    @param method: 'nj' (neighbor-joining) or 'upgma'
+    @param bootstrap: number of bootstrap replicates, 0 for a single tree with distance based branch lengths
+    """
+    codes = np.asarray(codes)
+    if bootstrap:
+        return bootstrap_tree(codes, names, bootstrap, method, processes)
+    tree, clusters = build_tree(protein_distances(codes[:, residue_mask(codes).sum(axis=0) > 1]), names, method)
+    return tree
@@ -177,21 +177,28 @@ if DEBUG:
 #CACHE
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'BACKEND': 'common.cache_backend.ShardedCache',
         'LOCATION': '/tmp/django_cache',
         'OPTIONS': {
-            'MAX_ENTRIES': 10000000
+            'MAX_SIZE': 20 * 1024**3,
+            'SHARDS': 16,
+            'COMPRESS_MIN_SIZE': 16 * 1024,
         }
     },
     'alignments': {
-        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'BACKEND': 'common.cache_backend.ShardedCache',
         'LOCATION': '/tmp/django_cache_alignments',
         'OPTIONS': {
-            'MAX_ENTRIES': 1000
+            'MAX_SIZE': 5 * 1024**3,
+            'SHARDS': 4,
+            'COMPRESS_MIN_SIZE': 16 * 1024,
         }
     }
 }
 
+# number of alignment block residues kept in the memory of each process (common.alignment_cache)
+ALIGNMENT_BLOCK_CACHE_SIZE = 100000
+
 # Note that https://www.django-rest-framework.org/community/3.10-announcement
 # So, have to switch from CoreAPI to OpenAPI. Next line will work for now.
 # Uncomment when needed.
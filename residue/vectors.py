@@ -0,0 +1,167 @@
+"""
+Packed per-conformation residue vectors.
+
+The residues of each ProteinConformation are stored at build time as a compact structured array (one record per
+residue: sequence number, amino acid, segment id, generic number id, display generic number id) in a .npy file,
+which is memory-mapped when read. Alignments can be assembled from these vectors without hydrating Residue models.
+build_all removes the vectors of the previous build when it starts, alignments of conformations without vectors are
+read from the database.
+"""
+from django.conf import settings
+
+from protein.models import ProteinSegment
+from residue.models import Residue, ResidueGenericNumber
+
+import os
+import numpy as np
+
+RESIDUE_VECTOR_DTYPE = np.dtype([
+    ('sequence_number', np.int32),
+    ('amino_acid', 'S1'),
+    ('protein_segment', np.int32),
+    ('generic_number', np.int32),
+    ('display_generic_number', np.int32),
+])
+
+# value used for missing foreign keys
+NO_ID = -1
+
+
+def residue_vector_dir():
+    return os.sep.join([settings.BUILD_CACHE_DIR, 'residue_vectors'])
+
+def residue_vector_path(pconf_id):
+    return os.sep.join([residue_vector_dir(), '{}.npy'.format(pconf_id)])
+
+def pack_residues(pconf):
+    """Create the packed residue vector of a protein conformation from the database"""
+    rows = Residue.objects.filter(protein_conformation=pconf).order_by('sequence_number').values_list(
+        'sequence_number', 'amino_acid', 'protein_segment_id', 'generic_number_id', 'display_generic_number_id')
+    vector = np.zeros(len(rows), dtype=RESIDUE_VECTOR_DTYPE)
+    for i, (sequence_number, amino_acid, segment_id, gn_id, dgn_id) in enumerate(rows):
+        vector[i] = (sequence_number, amino_acid.encode('ascii', 'replace'),
+                     segment_id if segment_id else NO_ID,
+                     gn_id if gn_id else NO_ID,
+                     dgn_id if dgn_id else NO_ID)
+    return vector
+
+def save_residue_vector(pconf):
+    """Write the packed residue vector of a protein conformation to disk (atomically replacing an older version)"""
+    os.makedirs(residue_vector_dir(), exist_ok=True)
+    path = residue_vector_path(pconf.id)
+    tmp_path = path + '.tmp.npy'
+    np.save(tmp_path, pack_residues(pconf))
+    os.replace(tmp_path, path)
+    return path
+
+def load_residue_vector(pconf_id):
+    """Memory-map the packed residue vector of a protein conformation, returns None if it has not been built"""
+    path = residue_vector_path(pconf_id)
+    if not os.path.isfile(path):
+        return None
+    return np.load(path, mmap_mode='r')
+
+def delete_residue_vectors():
+    directory = residue_vector_dir()
+    if os.path.isdir(directory):
+        for filename in os.listdir(directory):
+            if filename.endswith('.npy'):
+                os.remove(os.sep.join([directory, filename]))
+
+
+class PackedResidue:
+    """Lightweight stand-in for a Residue object, created from a residue vector record"""
+    __slots__ = ('protein_conformation', 'protein_segment', 'generic_number', 'display_generic_number',
+                 'sequence_number', 'amino_acid')
+
+    def __init__(self, protein_conformation, protein_segment, generic_number, display_generic_number, sequence_number,
+                 amino_acid):
+        self.protein_conformation = protein_conformation
+        self.protein_segment = protein_segment
+        self.generic_number = generic_number
+        self.display_generic_number = display_generic_number
+        self.sequence_number = sequence_number
+        self.amino_acid = amino_acid
+
+    def __str__(self):
+        return self.amino_acid + str(self.sequence_number)
+
+
+class ResidueVectors:
+    """Residue vectors of a set of protein conformations, with Residue-like access to selected residues"""
+
+    def __init__(self, proteins, vectors):
+        self.proteins = proteins
+        self.vectors = vectors
+        self.segments = {}
+        self.generic_numbers = {}
+
+    @classmethod
+    def load(cls, proteins):
+        """Load the vectors of the given ProteinConformations, returns None if any of them is missing"""
+        vectors = []
+        for pc in proteins:
+            vector = load_residue_vector(pc.id)
+            if vector is None:
+                return None
+            vectors.append(vector)
+        return cls(proteins, vectors)
+
+    def _load_lookups(self, segment_ids, generic_number_ids):
+        missing_segments = set(segment_ids) - set(self.segments) - {NO_ID}
+        if missing_segments:
+            self.segments.update(ProteinSegment.objects.in_bulk(list(missing_segments)))
+        missing_gns = set(generic_number_ids) - set(self.generic_numbers) - {NO_ID}
+        if missing_gns:
+            self.generic_numbers.update(ResidueGenericNumber.objects.filter(
+                id__in=list(missing_gns)).select_related('scheme').in_bulk())
+
+    def _create_residues(self, selections):
+        """Create PackedResidues for the selected records, selections is a list of (protein index, mask)"""
+        segment_ids = set()
+        gn_ids = set()
+        for i, mask in selections:
+            records = self.vectors[i][mask]
+            segment_ids.update(np.unique(records['protein_segment']).tolist())
+            gn_ids.update(np.unique(records['generic_number']).tolist())
+            gn_ids.update(np.unique(records['display_generic_number']).tolist())
+        self._load_lookups(segment_ids, gn_ids)
+
+        residues = []
+        for i, mask in selections:
+            pc = self.proteins[i]
+            records = self.vectors[i][mask]
+            for sequence_number, amino_acid, segment_id, gn_id, dgn_id in records.tolist():
+                residues.append(PackedResidue(pc, self.segments.get(segment_id), self.generic_numbers.get(gn_id),
+                                              self.generic_numbers.get(dgn_id), sequence_number,
+                                              amino_acid.decode('ascii')))
+        # same order as the Residue model (sequence number)
+        residues.sort(key=lambda r: r.sequence_number)
+        return residues
+
+    def segment_ids(self, segment_slugs):
+        return [s.id for s in ProteinSegment.objects.filter(slug__in=list(segment_slugs))]
+
+    def count(self, segment_slugs):
+        """Number of residues in the selected segments"""
+        segment_ids = self.segment_ids(segment_slugs)
+        return sum(int(np.isin(vector['protein_segment'], segment_ids).sum()) for vector in self.vectors)
+
+    def residues(self, segment_slugs, only_aligned_segments=[]):
+        """Residues in the selected segments, segments in only_aligned_segments are limited to residues with a
+        generic number"""
+        segment_ids = self.segment_ids(segment_slugs)
+        only_aligned_ids = self.segment_ids(only_aligned_segments) if only_aligned_segments else []
+        selections = []
+        for i, vector in enumerate(self.vectors):
+            mask = np.isin(vector['protein_segment'], segment_ids)
+            if only_aligned_ids:
+                mask &= ~(np.isin(vector['protein_segment'], only_aligned_ids) & (vector['generic_number'] == NO_ID))
+            selections.append((i, mask))
+        return self._create_residues(selections)
+
+    def residues_by_generic_number(self, labels):
+        """Residues with one of the given generic number labels"""
+        gn_ids = list(ResidueGenericNumber.objects.filter(label__in=list(labels)).values_list('id', flat=True))
+        selections = [(i, np.isin(vector['generic_number'], gn_ids)) for i, vector in enumerate(self.vectors)]
+        return self._create_residues(selections)
@@ -10,6 +10,7 @@ Alignment = getattr(__import__(
     fromlist=['Alignment']
     ), 'Alignment')
 
+from common.alignment_matrix import AA_CODES, FEATURE_MATRIX
 from common.definitions import AA_ZSCALES, AMINO_ACIDS, AMINO_ACID_GROUPS, AMINO_ACID_GROUP_NAMES, AMINO_ACID_GROUP_PROPERTIES, ZSCALES
 from protein.models import Protein, ProteinConformation
 from residue.models import Residue
@@ -18,6 +19,7 @@ from signprot.models import SignprotComplex
 
 from collections import OrderedDict
 from copy import deepcopy
+from multiprocessing import Pool
 import numpy as np
 from operator import itemgetter
 import re
@@ -1137,6 +1139,31 @@ class SequenceSignature:
 
 
 
+# Codes for signature scoring: residues are coded as in the alignment matrix, with extra codes for unknown amino
+# acids (no features) and positions without a residue
+UNKNOWN_RESIDUE_CODE = len(AA_CODES)
+MISSING_RESIDUE_CODE = -1
+SIGNATURE_FEATURE_TABLE = np.vstack([FEATURE_MATRIX, np.zeros((1, FEATURE_MATRIX.shape[1]), dtype=FEATURE_MATRIX.dtype)]).astype(bool)
+GAP_FEATURES = [i for i, name in enumerate(AMINO_ACID_GROUP_NAMES.values()) if name == 'Gap']
+
+
+def signature_scores(codes, features, values):
+    """Score encoded receptors (proteins x signature positions) against a signature map.
+
+    Returns the score of each protein, and boolean matrices of the positions where the residue has the signature
+    feature and where a residue is present.
+    """
+    present = codes != MISSING_RESIDUE_CODE
+    has_feature = present & SIGNATURE_FEATURE_TABLE[np.where(present, codes, UNKNOWN_RESIDUE_CODE), features[None, :]]
+    is_gap_feature = np.isin(features, GAP_FEATURES)
+
+    # residue with a positive feature, residue lacking a negative feature, or a gap where a gap is the signature
+    contributions = np.where(has_feature & (values > 0), values, 0.0)
+    contributions += np.where(present & ~has_feature & (values < 0), -values, 0.0)
+    contributions += np.where(~present & is_gap_feature, values, 0.0)
+    return contributions.sum(axis=1), has_feature, present
+
+
 class SignatureMatch():
 
     def __init__(self, common_positions, numbering_schemes, segments, difference_matrix,
@@ -1170,6 +1197,7 @@ class SignatureMatch():
         ])
 
         self.find_relevant_gns()
+        self.prepare_signature_map()
 
         self.residue_to_feat = dict(
             [(x, set()) for x in AMINO_ACIDS.keys()]
@@ -1271,11 +1299,106 @@ class SignatureMatch():
         self.signature_consensus = signature
 
 
-    def score_protein_class(self, pclass_slug='001', signprot=False):
+    def prepare_signature_map(self):
+        """Precompute the preferred feature and its value for every relevant position, these do not depend on the
+        scored protein."""
+        self.signature_map = OrderedDict()
+        self.signature_positions = []
+        self.signature_segments = []
+        features = []
+        values = []
+        for segment in self.relevant_segments:
+            signature_map = np.absolute(self.signature_matrix_filtered[segment]).argmax(axis=0)
+            signature_map = self._assign_preferred_features(signature_map, segment, self.signature_matrix_filtered)
+            self.signature_map[segment] = signature_map
+            for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
+                feat = signature_map[idx]
+                self.signature_positions.append(pos)
+                self.signature_segments.append(segment)
+                features.append(feat)
+                values.append(self.signature_matrix_filtered[segment][feat][idx])
+        self.signature_features = np.array(features, dtype=int)
+        self.signature_values = np.array(values, dtype=float)
+
+    def encode_residues(self, pcfs, resi_dict_all=None):
+        """Encode the residues of protein conformations at the signature positions.
+
+        Returns a matrix of residue codes (proteins x signature positions) and a matrix with the amino acids.
+        """
+        position_columns = {}
+        for col, pos in enumerate(self.signature_positions):
+            position_columns.setdefault(pos, []).append(col)
+        rows = dict([(pcf.pk, i) for i, pcf in enumerate(pcfs)])
+
+        codes = np.full((len(pcfs), len(self.signature_positions)), MISSING_RESIDUE_CODE, dtype=np.int8)
+        amino_acids = np.full(codes.shape, '-', dtype='U1')
+        if resi_dict_all is None:
+            residues = Residue.objects.filter(
+                protein_conformation__in=pcfs,
+                generic_number__label__in=list(position_columns)
+                ).values_list('protein_conformation_id', 'generic_number__label', 'amino_acid')
+        else:
+            residues = [(pcf_id, pos, r.amino_acid) for pcf_id, resi_dict in resi_dict_all.items()
+                        for pos, r in resi_dict.items()]
+        for pcf_id, pos, amino_acid in residues:
+            if pcf_id in rows and pos in position_columns:
+                codes[rows[pcf_id], position_columns[pos]] = AA_CODES.get(amino_acid, UNKNOWN_RESIDUE_CODE)
+                amino_acids[rows[pcf_id], position_columns[pos]] = amino_acid
+        return codes, amino_acids
+
+    def score_encoded(self, codes, processes=1):
+        """Score encoded receptors, optionally split over a pool of processes"""
+        if processes > 1 and len(codes) > processes:
+            chunks = np.array_split(codes, processes)
+            with Pool(processes) as pool:
+                results = pool.starmap(signature_scores, [(chunk, self.signature_features, self.signature_values) for chunk in chunks])
+            return (np.concatenate([x[0] for x in results]), np.vstack([x[1] for x in results]),
+                    np.vstack([x[2] for x in results]))
+        return signature_scores(codes, self.signature_features, self.signature_values)
+
+    def signature_match(self, amino_acids, has_feature, present):
+        """Per segment display of how a single protein matches the signature"""
+        consensus_match = OrderedDict([(x, []) for x in self.relevant_segments])
+        feature_keys = list(AMINO_ACID_GROUPS.keys())
+        feature_names = list(AMINO_ACID_GROUP_NAMES.values())
+        for idx, pos in enumerate(self.signature_positions):
+            feat = self.signature_features[idx]
+            val = self.signature_values[idx]
+            if present[idx]:
+                if has_feature[idx]:
+                    color = "#808080" if val > 0 else "white"
+                else:
+                    color = "white" if val > 0 else "#808080"
+            elif feat in GAP_FEATURES:
+                color = "#808080" if val > 0 else "white"
+            else:
+                color = "white"
+            consensus_match[self.signature_segments[idx]].append([
+                feature_keys[feat],
+                feature_names[feat],
+                val,
+                color,
+                amino_acids[idx],
+                pos
+                ])
+        return consensus_match
+
+    def score_protein_conformations(self, pcfs, processes=1):
+        """Score a list of protein conformations in one vectorized pass"""
+        codes, amino_acids = self.encode_residues(pcfs)
+        scores, has_feature, present = self.score_encoded(codes, processes)
 
-        start = time.time()
         protein_scores = {}
         protein_signature_match = {}
+        for i, pcf in enumerate(pcfs):
+            score = float(scores[i])
+            protein_scores[pcf] = (score/100, score/self.norm*100)
+            protein_signature_match[pcf] = self.signature_match(amino_acids[i], has_feature[i], present[i])
+        return protein_scores, protein_signature_match
+
+    def score_protein_class(self, pclass_slug='001', signprot=False, processes=1):
+
+        start = time.time()
         class_proteins = Protein.objects.filter(
             species__common_name='Human',
             family__slug__startswith=pclass_slug
@@ -1295,30 +1418,7 @@ class SignatureMatch():
                 protein__sequence_type__slug='wt'
                 ).exclude(protein__entry_name__endswith='-consensus').prefetch_related('protein','protein__family__parent','protein__species')
 
-        relevant_gns_total = []
-        for segment in  self.relevant_segments:
-            for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
-                relevant_gns_total.append(pos)
-
-        resi = Residue.objects.filter(
-            protein_conformation__in=class_a_pcf,
-            generic_number__label__in=relevant_gns_total
-            ).prefetch_related('generic_number','protein_conformation')
-        resi_dict_all = {}
-        for r in resi:
-            if r.generic_number:
-                pcf = r.protein_conformation.pk
-                if pcf not in resi_dict_all:
-                    resi_dict_all[pcf] = {}
-                resi_dict_all[pcf][r.generic_number.label] = r
-
-        for pcf in class_a_pcf:
-            # p_start = time.time()
-            score, nscore, signature_match = self.score_protein(pcf, resi_dict_all)
-            protein_scores[pcf] = (score, nscore)
-            protein_signature_match[pcf] = signature_match
-            # p_end = time.time()
-            # print("Time elapsed for {}: ".format(pcf.protein.entry_name), p_end - p_start)
+        protein_scores, protein_signature_match = self.score_protein_conformations(list(class_a_pcf), processes)
         end = time.time()
         self.protein_report = OrderedDict(sorted(protein_scores.items(), key=lambda x: x[1][0], reverse=True))
         for prot in self.protein_report.items():
@@ -1327,11 +1427,9 @@ class SignatureMatch():
         print("Total time: ", end - start)
 
 
-    def score_protein_set(self, protein_set, signprot=False):
+    def score_protein_set(self, protein_set, signprot=False, processes=1):
 
         start = time.time()
-        protein_scores = {}
-        protein_signature_match = {}
 
         seq_type_slug=['wt']
         if signprot:
@@ -1345,30 +1443,7 @@ class SignatureMatch():
                 protein__sequence_type__slug__in=seq_type_slug
                 ).exclude(protein__entry_name__endswith='-consensus').prefetch_related('protein')
 
-        relevant_gns_total = []
-        for segment in  self.relevant_segments:
-            for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
-                relevant_gns_total.append(pos)
-
-        resi = Residue.objects.filter(
-            protein_conformation__in=pcfs,
-            generic_number__label__in=relevant_gns_total
-            ).prefetch_related('generic_number','protein_conformation')
-        resi_dict_all = {}
-        for r in resi:
-            if r.generic_number:
-                pcf = r.protein_conformation.pk
-                if pcf not in resi_dict_all:
-                    resi_dict_all[pcf] = {}
-                resi_dict_all[pcf][r.generic_number.label] = r
-
-        for pcf in pcfs:
-            # p_start = time.time()
-            score, nscore, signature_match = self.score_protein(pcf,resi_dict_all)
-            protein_scores[pcf] = (score, nscore)
-            protein_signature_match[pcf] = signature_match
-            # p_end = time.time()
-            # print("Time elapsed for {}: ".format(pcf.protein.entry_name), p_end - p_start)
+        protein_scores, protein_signature_match = self.score_protein_conformations(list(pcfs), processes)
         end = time.time()
         protein_report = OrderedDict(sorted(protein_scores.items(), key=lambda x: x[1][0], reverse=True))
         protein_signatures = OrderedDict()
@@ -1379,120 +1454,14 @@ class SignatureMatch():
 
         return (protein_report, protein_signatures, scored_proteins)
 
-    def score_protein(self, pcf,resi_dict_all):
-        prot_score = 0.0
-        #norm = 0.0
-        consensus_match = OrderedDict([(x, []) for x in self.relevant_segments])
-
-        if resi_dict_all == None:
-            relevant_gns_total = []
-            for segment in  self.relevant_segments:
-                for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
-                    relevant_gns_total.append(pos)
-            resi = Residue.objects.filter(
-                protein_conformation=pcf,
-                generic_number__label__in=relevant_gns_total
-                ).prefetch_related('generic_number')
-            resi_dict = {}
-            for r in resi:
-                if r.generic_number:
-                    resi_dict[r.generic_number.label] = r
+    def score_protein(self, pcf, resi_dict_all):
+        if resi_dict_all is None:
+            codes, amino_acids = self.encode_residues([pcf])
         else:
-            resi_dict = resi_dict_all[pcf.pk]
-        for segment in self.relevant_segments:
-            tmp = []
-            # signature_map = self.signature_matrix_filtered[segment].argmax(axis=0)
-            signature_map = np.absolute(self.signature_matrix_filtered[segment]).argmax(axis=0)
-            signature_map = self._assign_preferred_features(signature_map, segment, self.signature_matrix_filtered)
-
-            #norm += np.sum(np.amax(self.signature_matrix_filtered[segment], axis=0))
-
-            for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
-                feat = signature_map[idx]
-                feat_abr = list(AMINO_ACID_GROUPS.keys())[feat]
-                feat_name = list(AMINO_ACID_GROUP_NAMES.values())[feat]
-                val = self.signature_matrix_filtered[segment][feat][idx]
-                if pos in resi_dict:
-                    res = resi_dict[pos]
-                    if feat in self.residue_to_feat[res.amino_acid]:
-                        if val > 0:
-                            prot_score += val
-                        tmp.append([
-                            feat_abr,
-                            feat_name,
-                            val,
-                            #"green",
-                            "#808080",
-                            res.amino_acid, pos
-                            ]) if val > 0 else tmp.append([
-                                feat_abr,
-                                feat_name,
-                                val,
-                                "white",
-                                res.amino_acid,
-                                pos
-                                ])
-                    else:
-                        #David doesn't want the negative values in the score
-                        # prot_score -= val
-                        if val < 0:
-                            prot_score -= val #if a receptor does NOT have the negative property, add the score
-                        tmp.append([
-                            feat_abr,
-                            feat_name,
-                            val,
-                            # "red",
-                            "white",
-                            res.amino_acid,
-                            pos
-                            ]) if val > 0 else tmp.append([
-                                feat_abr,
-                                feat_name,
-                                val,
-                                # "green",
-                                "#808080",
-                                res.amino_acid,
-                                pos
-                                ])
-                else:
-                    if feat_name == 'Gap':
-                        tmp.append([
-                            feat_abr,
-                            feat_name,
-                            val,
-                            # "green",
-                            "#808080",
-                            '-',
-                            pos
-                            ]) if val > 0 else tmp.append([
-                                feat_abr,
-                                feat_name,
-                                val,
-                                "white",
-                                '-',
-                                pos
-                                ])
-                        prot_score += val
-                    else:
-                        #David doesn't want the negative values in the score
-                        #prot_score -= val
-                        tmp.append([
-                            feat_abr,
-                            feat_name,
-                            val,
-                            # "red",
-                            "white",
-                            '-',
-                            pos
-                            ]) if val > 0 else tmp.append([
-                                feat_abr,
-                                feat_name,
-                                val,
-                                "white",
-                                '-',
-                                pos
-                                ])
-            consensus_match[segment] = tmp
+            codes, amino_acids = self.encode_residues([pcf], {pcf.pk: resi_dict_all.get(pcf.pk, {})})
+        scores, has_feature, present = signature_scores(codes, self.signature_features, self.signature_values)
+        prot_score = float(scores[0])
+        consensus_match = self.signature_match(amino_acids[0], has_feature[0], present[0])
         return (prot_score/100, prot_score/self.norm*100, consensus_match)
 
 def signature_score_excel(workbook, scores, protein_signatures, signature_filtered, relevant_gn, relevant_segments, numbering_schemes, scores_positive=None, scores_negative=None, signatures_positive=None, signatures_negative=None):
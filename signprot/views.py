@@ -13,12 +13,13 @@ from common import definitions
 from common.diagrams_gpcr import DrawSnakePlot
 from common.diagrams_gprotein import DrawGproteinPlot
 from common.phylogenetic_tree import PhylogeneticTreeGenerator
+from common.reference_data import reference_data
 from common.tools import fetch_from_web_api
 from common.views import AbsTargetSelection
 from contactnetwork.models import InteractingResiduePair
 from mutation.models import MutationExperiment
 from protein.models import (Gene, Protein, ProteinAlias, ProteinConformation, ProteinFamily, ProteinGProtein,
-                            ProteinGProteinPair, ProteinSegment)
+                            ProteinGProteinPair)
 from residue.models import (Residue, ResidueGenericNumberEquivalent, ResiduePositionSet)
 from seqsign.sequence_signature import (SequenceSignature, SignatureMatch)
 from signprot.interactions import (get_entry_names, get_generic_numbers, get_ignore_info, get_protein_segments,
@@ -1137,7 +1138,7 @@ def interface_dataset():
 def InteractionMatrix(request):
     prot_conf_ids, dataset = interface_dataset()
 
-    gprotein_order = ProteinSegment.objects.filter(proteinfamily='Alpha').values('id', 'slug')
+    gprotein_order = [{'id': segment['id'], 'slug': segment['slug']} for segment in reference_data().segment_records(proteinfamily='Alpha')]
     receptor_order = ['N', '1', '12', '2', '23', '3', '34', '4', '45', '5', '56', '6', '67', '7', '78', '8', 'C']
 
     struc = SignprotComplex.objects.prefetch_related(
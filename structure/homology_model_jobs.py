@@ -0,0 +1,152 @@
+"""
+Persistent job table of the homology model build.
+
+Every model (receptor, state, signaling protein and whether it is a complex model) is a job. The hash of its inputs
+(receptor sequence, available template structures and build options) is stored with the result, so models that have
+been built from the same inputs are skipped and an interrupted build continues with the remaining jobs. Models that
+are uploaded to the database are only skipped while they are still in the database. Each job runs in a separate
+process with a timeout, which also keeps crashes (e.g. in MODELLER) from taking down the worker. The time spent in
+the modeling phases (see common.instrumentation) is recorded per job.
+"""
+from django.conf import settings
+from django.db import connection
+
+from common.instrumentation import start_request, finish_request
+
+from contextlib import closing
+from multiprocessing import Pipe, Process
+import json
+import os
+import sqlite3
+import time
+
+# timed sections of the model build, in the order they run
+PHASES = ['alignment', 'template_selection', 'loop_insertion', 'modeller', 'db_import']
+
+
+class ModelJob:
+
+    def __init__(self, receptor, state, signprot=None, input_hash='', complex_model=False):
+        self.receptor = receptor
+        self.state = state
+        self.signprot = signprot or ''
+        self.input_hash = input_hash
+        self.complex = complex_model
+
+    @property
+    def key(self):
+        return '|'.join([self.receptor, self.state, self.signprot, 'complex' if self.complex else ''])
+
+    def __str__(self):
+        return ' '.join([x for x in [self.receptor, self.state, self.signprot, 'complex' if self.complex else ''] if x])
+
+
+def job_table_path():
+    return os.sep.join([settings.BUILD_CACHE_DIR, 'homology_model_jobs.sqlite3'])
+
+
+class ModelJobTable:
+    """Jobs stored in an SQLite database, every call opens its own connection so the table can be used from the
+    worker processes"""
+
+    def __init__(self, path=None):
+        self.path = path or job_table_path()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.connect() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS jobs (key TEXT PRIMARY KEY, receptor TEXT, state TEXT,
+                signprot TEXT, input_hash TEXT, status TEXT, output TEXT, attempts INTEGER DEFAULT 0, started REAL,
+                finished REAL, seconds REAL, phases TEXT, error TEXT, run_id TEXT)''')
+
+    def connect(self):
+        return closing(sqlite3.connect(self.path, timeout=60))
+
+    def pending(self, jobs, imported=None):
+        """Jobs that have to be (re)built: not finished, built from other inputs or with a missing output file
+
+        @param imported: function telling whether the model of a job is in the database, finished jobs whose model is
+        not (e.g. after the database has been rebuilt) are built again
+        """
+        with self.connect() as db:
+            done = dict([(key, (input_hash, output)) for key, input_hash, output in
+                db.execute("SELECT key, input_hash, output FROM jobs WHERE status = 'done'")])
+        pending = []
+        for job in jobs:
+            if (job.key in done and done[job.key][0] == job.input_hash and os.path.isfile(done[job.key][1] or '')
+                    and (imported is None or imported(job))):
+                continue
+            pending.append(job)
+        return pending
+
+    def start(self, job, run_id):
+        with self.connect() as db, db:
+            db.execute('''INSERT OR IGNORE INTO jobs (key, receptor, state, signprot) VALUES (?, ?, ?, ?)''',
+                (job.key, job.receptor, job.state, job.signprot))
+            db.execute('''UPDATE jobs SET input_hash = ?, status = 'running', attempts = attempts + 1, started = ?,
+                finished = NULL, error = NULL, run_id = ? WHERE key = ?''', (job.input_hash, time.time(), run_id,
+                job.key))
+
+    def finish(self, job, output, error, seconds, phases):
+        with self.connect() as db, db:
+            db.execute('''UPDATE jobs SET status = ?, output = ?, error = ?, finished = ?, seconds = ?, phases = ?
+                WHERE key = ?''', ('failed' if error else 'done', output, error, time.time(), seconds,
+                json.dumps(phases), job.key))
+
+    def run_jobs(self, run_id):
+        """Finished jobs of a run as dicts"""
+        with self.connect() as db:
+            rows = db.execute('''SELECT key, status, seconds, phases, error FROM jobs WHERE run_id = ?
+                AND status != 'running' ''', (run_id,)).fetchall()
+        return [{'key': key, 'status': status, 'seconds': seconds, 'phases': json.loads(phases or '{}'),
+                 'error': error} for key, status, seconds, phases, error in rows]
+
+    def clear(self):
+        with self.connect() as db, db:
+            db.execute('DELETE FROM jobs')
+
+
+def job_process(target, job, sender):
+    start_request()
+    try:
+        result, error = target(job), None
+    except Exception as msg:
+        result, error = None, '{}: {}'.format(type(msg).__name__, msg)
+    stats = finish_request()
+    sender.send((result, error, dict(stats.sections)))
+    sender.close()
+    connection.close()
+
+def run_job(target, job, timeout=None):
+    """Run target(job) in a separate process, which is killed after timeout seconds
+
+    Returns (result, error, phases), where phases are the seconds spent in the timed sections of the job.
+    """
+    receiver, sender = Pipe(duplex=False)
+    # the process opens its own database connection
+    connection.close()
+    process = Process(target=job_process, args=(target, job, sender))
+    process.start()
+    sender.close()
+    try:
+        if receiver.poll(timeout or None):
+            result = receiver.recv()
+        else:
+            process.terminate()
+            result = (None, 'Timed out after {}s'.format(timeout), {})
+    except EOFError:
+        result = None
+    process.join()
+    if result is None:
+        result = (None, 'Job process exited with code {}'.format(process.exitcode), {})
+    return result
+
+def phase_report(jobs):
+    """Total and mean seconds per phase of finished jobs (see ModelJobTable.run_jobs)"""
+    report = {}
+    for phase in PHASES:
+        times = [job['phases'].get(phase, 0) for job in jobs]
+        report[phase] = {
+            'total': round(sum(times), 2),
+            'mean': round(sum(times) / len(times), 2) if times else 0,
+            'max': round(max(times), 2) if times else 0,
+        }
+    return report
@@ -6,8 +6,8 @@ Created on Wed Aug 19 15:48:26 2015
 """
 from django.core.management.base import BaseCommand
 
-import structure.structural_superposition as sp
 import structure.assign_generic_numbers_gpcr as as_gn
+from structure.structure_array import atom_coords, rmsd, rmsd_matrix, superpose_many, transform
 from residue.models import Residue
 
 import Bio.PDB as PDB
@@ -25,6 +25,8 @@ class Command(BaseCommand):
         parser.add_argument('-c', help='Specify chain ID. If not specified, the program will try to find one that matches.', type=str, default=False)
         parser.add_argument('--sp_7TM', help='Superposition on 7TM backbone coordinates.', action='store_true', default=False)
         parser.add_argument('--only_backbone', help='Calculate only the backbone atoms RMSD for the custom set.', action='store_true', default=False)
+        parser.add_argument('--matrix', help='Also calculate the 7TM backbone RMSD of all pairs of files.', action='store_true', default=False)
+        parser.add_argument('--proc', help='Number of processes for the superpositions.', type=int, default=1)
 
     def handle(self, *args, **options):
         v = Validation()
@@ -37,21 +39,21 @@ class Command(BaseCommand):
             seq_nums = options['n']
         if seq_nums==False:
             if options['c']==False:
-                v.run_RMSD_list(options['files'], options['p'], sp_7TM=options['sp_7TM'], only_backbone=options['only_backbone'])
+                v.run_RMSD_list(options['files'], options['p'], sp_7TM=options['sp_7TM'], only_backbone=options['only_backbone'], matrix=options['matrix'], processes=options['proc'])
             else:
-                v.run_RMSD_list(options['files'], options['p'], force_chain=options['c'], sp_7TM=options['sp_7TM'], only_backbone=options['only_backbone'])
+                v.run_RMSD_list(options['files'], options['p'], force_chain=options['c'], sp_7TM=options['sp_7TM'], only_backbone=options['only_backbone'], matrix=options['matrix'], processes=options['proc'])
         else:
             if options['c']==False:
-                v.run_RMSD_list(options['files'], options['p'], seq_nums=seq_nums, sp_7TM=options['sp_7TM'], only_backbone=options['only_backbone'])
+                v.run_RMSD_list(options['files'], options['p'], seq_nums=seq_nums, sp_7TM=options['sp_7TM'], only_backbone=options['only_backbone'], matrix=options['matrix'], processes=options['proc'])
             else:
-                v.run_RMSD_list(options['files'], options['p'], seq_nums=seq_nums, force_chain=options['c'], sp_7TM=options['sp_7TM'], only_backbone=options['only_backbone'])
+                v.run_RMSD_list(options['files'], options['p'], seq_nums=seq_nums, force_chain=options['c'], sp_7TM=options['sp_7TM'], only_backbone=options['only_backbone'], matrix=options['matrix'], processes=options['proc'])
 
 
 class Validation():
     def __init__(self):
         pass
 
-    def run_RMSD_list(self, files, receptor, seq_nums=None, force_chain=None, sp_7TM=False, only_backbone=False):
+    def run_RMSD_list(self, files, receptor, seq_nums=None, force_chain=None, sp_7TM=False, only_backbone=False, matrix=False, processes=1):
         """Calculates 3 RMSD values between a list of GPCR pdb files.
 
         It compares the files using sequence and generic numbers.
@@ -62,6 +64,8 @@ class Validation():
             @force_chain: Specify one letter chain name to use in the pdb files, str
             @sp_7TM: Superimpose only on 7TM backbone atoms (N, CA, C), boolean
             @only_backbone: Calculate RMSD for only the backbone atoms, boolean
+            @matrix: Also calculate the 7TM backbone RMSD of all pairs of files, boolean
+            @processes: Number of processes for the superpositions, int
         """
         parser = PDB.PDBParser(QUIET=True)
         count = 0
@@ -167,76 +171,95 @@ class Validation():
         print('TM_atom_num:',TM_atom_num)
         print('TM_backbone_atom_num:',len(TM_target_backbone_atom_list))
 
-        ### Running superposition and RMSD calculation
+        ### Running superposition and RMSD calculation, all models are superposed on the target at once
+        if seq_nums:
+            seq_nums = [int(s) for s in seq_nums]
+        else:
+            seq_nums = all_keep
+        models = atom_lists[1:]
+        target_coords = atom_coords(atom_lists[0])
+        if sp_7TM:
+            custom_superposed, custom_atoms_used_sp = self.superpose(atom_lists[0], models, list(TM_nums), processes)
+            custom_target_coords = target_coords[self.atom_mask(atom_lists[0], seq_nums, only_backbone)]
+        else:
+            custom_superposed, custom_atoms_used_sp = self.superpose(atom_lists[0], models, processes=processes)
+            custom_target_coords = target_coords
+        TM_model_atom_lists = [[i for i in m if i.get_parent().id[1] in TM_nums] for m in models]
+        TM_superposed, TM_atoms_used_sp = self.superpose(TM_target_atom_list, TM_model_atom_lists, list(TM_nums), processes)
+        TM_target_coords = atom_coords(TM_target_atom_list)
+        TM_target_backbone_coords = atom_coords(TM_target_backbone_atom_list)
+
         c = 2
-        for m in atom_lists[1:]:
+        for m, superposed, TM_model_atom_list, superposed2 in zip(models, custom_superposed, TM_model_atom_lists, TM_superposed):
             print('########################################')
             print('Model {}'.format(c-1))
-            if seq_nums:
-                seq_nums = [int(s) for s in seq_nums]
-            else:
-                seq_nums = all_keep
 
             ### Custom calculation
             if sp_7TM:
-                TM_superposed, atoms_used_sp = self.superpose(atom_lists[0], m, list(TM_nums))
-                superposed = self.fetch_atoms_with_seqnum(TM_superposed, seq_nums, only_backbone)
-                target_atoms = self.fetch_atoms_with_seqnum(atom_lists[0], seq_nums, only_backbone)
-                rmsd = self.calc_RMSD(target_atoms, superposed)
-            else:
-                superposed, atoms_used_sp = self.superpose(atom_lists[0], m)
-                target_atoms = atom_lists[0]
-            rmsd = self.calc_RMSD(target_atoms, superposed)
+                superposed = superposed[self.atom_mask(m, seq_nums, only_backbone)]
+            rmsd = self.calc_RMSD(custom_target_coords, superposed)
             print('Num atoms sent for superposition: ', len(atom_lists[0]), len(m))
-            print('Num atoms used for superposition: ', atoms_used_sp)
-            print('Num atoms used for RMSD: ', len(target_atoms), len(superposed))
+            print('Num atoms used for superposition: ', custom_atoms_used_sp)
+            print('Num atoms used for RMSD: ', len(custom_target_coords), len(superposed))
             print('Custom RMSD:', rmsd)
 
             ### 7TM all atoms calculation
-            TM_model_atom_list = [i for i in m if i.get_parent().id[1] in TM_nums]
-            superposed2, atoms_used_sp = self.superpose(TM_target_atom_list, TM_model_atom_list, list(TM_nums))
-            rmsd = self.calc_RMSD(TM_target_atom_list, superposed2)
+            rmsd = self.calc_RMSD(TM_target_coords, superposed2)
             print('Num atoms sent for superposition: ', len(TM_target_atom_list), len(TM_model_atom_list))
-            print('Num atoms used for superposition: ', atoms_used_sp)
-            print('Num atoms used for RMSD: ', len(TM_target_atom_list), len(superposed2))
+            print('Num atoms used for superposition: ', TM_atoms_used_sp)
+            print('Num atoms used for RMSD: ', len(TM_target_coords), len(superposed2))
             print('7TM all RMSD:', rmsd)
 
             ### 7TM only backbone (N, CA, C) calculation
-            superposed, atoms_used_sp = self.superpose(TM_target_atom_list, TM_model_atom_list, list(TM_nums))
-            superposed3 = self.fetch_atoms_with_seqnum(superposed, list(TM_nums), True)
-            rmsd = self.calc_RMSD(TM_target_backbone_atom_list, superposed3)
+            superposed3 = superposed2[self.atom_mask(TM_model_atom_list, list(TM_nums), True)]
+            rmsd = self.calc_RMSD(TM_target_backbone_coords, superposed3)
             print('Num atoms sent for superposition: ', len(TM_target_atom_list), len(TM_model_atom_list))
-            print('Num atoms used for superposition: ', atoms_used_sp)
-            print('Num atoms used for RMSD: ', len(TM_target_backbone_atom_list), len(superposed3))
+            print('Num atoms used for superposition: ', TM_atoms_used_sp)
+            print('Num atoms used for RMSD: ', len(TM_target_backbone_coords), len(superposed3))
             print('7TM backbone RMSD:', rmsd)
 
             c+=1
 
+        ### All pairs of files
+        if matrix:
+            backbones = [atom_coords(self.fit_atoms(m, list(TM_nums))) for m in atom_lists]
+            if len(set([len(b) for b in backbones]))>1:
+                raise ValueError('Different number of 7TM backbone atoms in the files: {}'.format([len(b) for b in backbones]))
+            print('########################################')
+            print('7TM backbone RMSD matrix:')
+            for f, row in zip(files, rmsd_matrix(np.array(backbones), processes)):
+                print(f, ' '.join(['{:.1f}'.format(value) for value in row]))
+
+    def atom_mask(self, atom_list, seq_nums, only_backbone=False):
+        """Mask of the atoms with the given residue sequence numbers. Only N, CA, C atoms of backbone when setting only_backbone to True."""
+        return np.array([i.get_parent().id[1] in seq_nums and (not only_backbone or i.id in ['N','CA','C']) for i in atom_list], dtype=bool)
+
     def fetch_atoms_with_seqnum(self, atom_list, seq_nums, only_backbone=False):
         """Gets atoms from list2 based on list1 resnums. Get only N, CA, C atoms of backbone when setting only_backbone to True."""
-        out_list = []
-        # print('Only backbone:', only_backbone)
-        for i in atom_list:
-            if i.get_parent().id[1] in seq_nums:
-                if only_backbone and i.id in ['N','CA','C']:
-                    out_list.append(i)
-                elif not only_backbone:
-                    out_list.append(i)
-        return out_list
-
-    def superpose(self, list1, list2, TM_keys=None):
-        """Superposition, supply TM_keys (list of sequence residue numbers) when superimposing on only those atoms."""
-        superpose = sp.RotamerSuperpose(list1, list2, TM_keys)
-        return superpose.run(), superpose.num_atoms_used_for_superposition
+        return [i for i, keep in zip(atom_list, self.atom_mask(atom_list, seq_nums, only_backbone)) if keep]
+
+    def fit_atoms(self, atom_list, TM_keys=None):
+        """Atoms used for the superposition (as in RotamerSuperpose): backbone atoms, only N, CA, C of residues in TM_keys when supplied."""
+        if not TM_keys:
+            return [atom for atom in atom_list if atom.get_name() in ['N','CA','C','O']]
+        return [atom for atom in atom_list if atom.get_name() in ['N','CA','C'] and atom.get_parent().get_full_id()[-1][1] in TM_keys]
+
+    def superpose(self, target_list, model_lists, TM_keys=None, processes=1):
+        """Superposition of all models on the target, supply TM_keys (list of sequence residue numbers) when superimposing on only those atoms.
+        Returns the superposed coordinates of the model atom lists and the number of atoms used."""
+        fixed = atom_coords(self.fit_atoms(target_list, TM_keys))
+        moving = [atom_coords(self.fit_atoms(m, TM_keys)) for m in model_lists]
+        for m in moving:
+            if m.shape!=fixed.shape:
+                raise ValueError('Different number of atoms for superposition: {} and {}'.format(len(fixed), len(m)))
+        rotations, translations, rmsds = superpose_many(fixed, np.array(moving).reshape(len(moving), -1, 3), processes=processes)
+        return [transform(atom_coords(m), rotation, translation) for m, rotation, translation in zip(model_lists, rotations, translations)], len(fixed)
 
     def calc_RMSD(self, list1, list2):
-        """Calculates RMSD between two atoms lists. The two lists have to have the same length."""
-        array1, array2 = np.array([0,0,0]), np.array([0,0,0])
-        for a1, a2 in zip(list1, list2):
-            array1 = np.vstack((array1, list(a1.get_coord())))
-            array2 = np.vstack((array2, list(a2.get_coord())))
-        rmsd = round(np.sqrt(sum(sum((array1[1:]-array2[1:])**2))/array1[1:].shape[0]),1)
-        return rmsd
+        """Calculates RMSD between two atom lists or coordinate arrays. The two lists have to have the same length."""
+        coords1, coords2 = [atom_coords(l) if isinstance(l, list) else l for l in [list1, list2]]
+        length = min(len(coords1), len(coords2))
+        return round(rmsd(coords1[:length], coords2[:length]),1)
 
     ### Deprecated
     def run_RMSD_list_archived(self, files, seq_nums=None, force_chain=None):
@@ -0,0 +1,118 @@
+"""
+Parsed structure cache.
+
+Parsing PDB text with Biopython is a measurable part of build and request time, and the same PdbData is parsed by many
+build steps and views. The first time a PdbData is parsed, its atoms are stored as a compact structured array (one
+record per atom: model, chain, residue id, atom name, coordinates etc.) in a .npy file in the build cache. Later requests
+load this array and either use it directly or build a Biopython structure from it, which skips the text parsing.
+
+Cache files are keyed by pdb code, PdbData id and a checksum of the PDB text, so changed PDB data is parsed again.
+The PDB header is not stored, use the parser directly when header records are needed.
+"""
+from django.conf import settings
+
+from Bio.PDB import PDBParser
+from Bio.PDB.StructureBuilder import StructureBuilder
+
+from io import StringIO
+import os
+import zlib
+import numpy as np
+
+ATOM_DTYPE = np.dtype([
+    ('model', np.int16),
+    ('chain', 'U4'),
+    ('hetero_flag', 'U1'),
+    ('resseq', np.int32),
+    ('icode', 'U1'),
+    ('resname', 'U4'),
+    ('segid', 'U4'),
+    ('name', 'U4'),
+    ('fullname', 'U4'),
+    ('altloc', 'U1'),
+    ('element', 'U2'),
+    ('serial_number', np.int32),
+    ('bfactor', np.float64),
+    ('occupancy', np.float64),
+    ('coord', np.float32, (3,)),
+])
+
+
+def parsed_structure_dir():
+    return os.sep.join([settings.BUILD_CACHE_DIR, 'parsed_structures'])
+
+def parsed_structure_path(pdb_code, pdb_data):
+    checksum = zlib.crc32(pdb_data.pdb.encode('utf-8'))
+    return os.sep.join([parsed_structure_dir(), '{}_{}_{:08x}.npy'.format(pdb_code, pdb_data.id, checksum)])
+
+def parse_pdb(pdb_text, structure_id='ref'):
+    return PDBParser(PERMISSIVE=True, QUIET=True).get_structure(structure_id, StringIO(pdb_text))
+
+def structure_to_atoms(structure):
+    """Flatten a Biopython structure (including all alternative locations) into an atom array"""
+    records = []
+    for model in structure:
+        for chain in model:
+            for residue in chain.get_unpacked_list():
+                hetero_flag, resseq, icode = residue.id
+                # unpacked lists contain every alternative location of disordered atoms
+                for a in residue.get_unpacked_list():
+                    records.append((model.serial_num, chain.id, hetero_flag[0], resseq, icode, residue.resname,
+                                    residue.segid, a.name, a.fullname, a.altloc, a.element or '',
+                                    a.serial_number if a.serial_number is not None else 0,
+                                    a.bfactor, a.occupancy if a.occupancy is not None else 0.0, a.coord))
+    return np.array(records, dtype=ATOM_DTYPE)
+
+def atoms_to_structure(atoms, structure_id='ref'):
+    """Build a Biopython structure from an atom array"""
+    builder = StructureBuilder()
+    builder.init_structure(structure_id)
+    current_model = current_chain = current_residue = current_segid = None
+    for model, chain, hetero_flag, resseq, icode, resname, segid, name, fullname, altloc, element, serial_number, \
+            bfactor, occupancy, coord in atoms.tolist():
+        if model != current_model:
+            builder.init_model(len(builder.get_structure()), model)
+            current_model = model
+            current_chain = current_residue = None
+        if chain != current_chain:
+            builder.init_chain(chain)
+            current_chain = chain
+            current_residue = None
+        if segid != current_segid:
+            builder.init_seg(segid)
+            current_segid = segid
+        residue = (hetero_flag, resseq, icode, resname)
+        if residue != current_residue:
+            builder.init_residue(resname, hetero_flag, resseq, icode)
+            current_residue = residue
+        builder.init_atom(name, np.array(coord, dtype=np.float32), bfactor, occupancy, altloc, fullname,
+                          serial_number, element)
+    return builder.get_structure()
+
+def get_structure_atoms(pdb_code, pdb_data):
+    """Atom array of a PdbData object, parsed and stored in the cache if it is not there yet"""
+    path = parsed_structure_path(pdb_code, pdb_data)
+    if os.path.isfile(path):
+        return np.load(path)
+
+    atoms = structure_to_atoms(parse_pdb(pdb_data.pdb))
+    try:
+        os.makedirs(parsed_structure_dir(), exist_ok=True)
+        tmp_path = '{}.{}.tmp.npy'.format(path, os.getpid())
+        np.save(tmp_path, atoms)
+        os.replace(tmp_path, path)
+    except OSError:
+        # the cache is an optimization only
+        pass
+    return atoms
+
+def get_parsed_structure(pdb_code, pdb_data, structure_id='ref'):
+    """Biopython structure of a PdbData object, built from the parsed structure cache"""
+    return atoms_to_structure(get_structure_atoms(pdb_code, pdb_data), structure_id)
+
+def delete_parsed_structures():
+    directory = parsed_structure_dir()
+    if os.path.isdir(directory):
+        for filename in os.listdir(directory):
+            if filename.endswith('.npy'):
+                os.remove(os.sep.join([directory, filename]))
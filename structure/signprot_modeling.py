@@ -2,6 +2,7 @@ from protein.models import Protein, ProteinConformation, ProteinSegment, Protein
 from residue.models import Residue
 from structure.models import *
 from structure.functions import update_template_source, compare_and_update_template_source
+from structure.parsed_structures import get_parsed_structure
 from common.alignment import GProteinAlignment
 from common.definitions import *
 from signprot.models import SignprotComplex
@@ -11,7 +12,6 @@ from structure.homology_modeling_functions import GPCRDBParsingPDB
 import Bio.PDB as PDB
 from collections import OrderedDict
 import pprint
-from io import StringIO
 import math
 from copy import deepcopy
 
@@ -504,7 +504,7 @@ class SignprotModeling():
                             self.trimmed_residues.append(key)
 
         # Add Beta and Gamma chains
-        p = PDB.PDBParser(QUIET=True).get_structure('structure', StringIO(self.main_structure.pdb_data.pdb))[0]
+        p = get_parsed_structure(self.main_structure.pdb_code.index, self.main_structure.pdb_data, 'structure')[0]
         beta = p[self.signprot_complex.beta_chain]
         gamma = p[self.signprot_complex.gamma_chain]
         self.a.reference_dict['Beta'] = OrderedDict()
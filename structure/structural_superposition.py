@@ -1,13 +1,14 @@
 import os,sys,math,logging
 from io import StringIO
 from collections import OrderedDict
-import numpy as np
 
 import Bio.PDB.Polypeptide as polypeptide
 from Bio.PDB import *
 from Bio.Seq import Seq
 from structure.functions import *
 from structure.assign_generic_numbers_gpcr import GenericNumbering
+from structure.structure_array import (ResidueView, atom_coords, backbone_coords, residue_arrays, rmsd, set_atom_coords,
+                                       stack_coordinates, superpose_many, superposition, transform, transform_residues)
 from protein.models import Protein
 from structure.models import Structure
 from interaction.models import ResidueFragmentInteraction
@@ -49,15 +50,26 @@ class ProteinSuperpose(object):
             logger.error("No structures to align!")
             return []
     
-        super_imposer = Superimposer()
+        # all structures are superposed in one batch
+        pairs = []
         for alt_struct in self.alt_structs:
             try:
                 ref, alt = self.selector.get_consensus_atom_sets(alt_struct.id)
-                super_imposer.set_atoms(ref, alt)
-                super_imposer.apply(alt_struct.get_atoms())
-                logger.info("RMS(reference, model {!s}) = {:f}".format(alt_struct.id, super_imposer.rms))
+                if not ref:
+                    raise ValueError("No matching atoms")
+                if len(ref) != len(alt):
+                    raise ValueError('Reference and structure atoms differ in size: {} and {}'.format(len(ref), len(alt)))
+                pairs.append((alt_struct, atom_coords(ref), atom_coords(alt)))
             except Exception as msg:
                 logger.error("Failed to superpose structures {} and {}\n{}".format(self.ref_struct.id, alt_struct.id, msg))
+        if pairs:
+            fixed = stack_coordinates([ref for alt_struct, ref, alt in pairs])[0]
+            moving, mask = stack_coordinates([alt for alt_struct, ref, alt in pairs])
+            rotations, translations, rmsds = superpose_many(fixed, moving, mask)
+            for (alt_struct, ref, alt), rotation, translation, rms in zip(pairs, rotations, translations, rmsds):
+                atoms = list(alt_struct.get_atoms())
+                set_atom_coords(atoms, transform(atom_coords(atoms), rotation, translation))
+                logger.info("RMS(reference, model {!s}) = {:f}".format(alt_struct.id, rms))
 
         return self.alt_structs
 
@@ -127,18 +139,28 @@ class FragmentSuperpose(object):
         else:
             fragments = self.get_all_fragments()
 
+        # the fragments are superposed in one batch
+        pairs = []
         for fragment in fragments:
             atom_sel = BackboneSelector(self.pdb_struct, fragment, use_similar)
             if atom_sel.get_ref_atoms() == []:
                 continue
-            super_imposer = Superimposer()
             try:
                 fragment_struct = PDBParser(PERMISSIVE=True, QUIET=True).get_structure('alt', StringIO(fragment.get_pdbdata()))[0]
-                super_imposer.set_atoms(atom_sel.get_ref_atoms(), atom_sel.get_alt_atoms())
-                super_imposer.apply(fragment_struct)
-                superposed_frags.append([fragment,fragment_struct])
+                ref, alt = atom_coords(atom_sel.get_ref_atoms()), atom_coords(atom_sel.get_alt_atoms())
+                if ref.shape != alt.shape:
+                    raise ValueError('Reference and fragment atoms differ in size: {} and {}'.format(len(ref), len(alt)))
+                pairs.append((fragment, fragment_struct, ref, alt))
             except Exception as msg:
                 logger.error('Failed to superpose fragment {!s} with structure {!s}\nDebug message: {!s}'.format(fragment, self.pdb_filename, msg))
+        if pairs:
+            fixed = stack_coordinates([ref for fragment, fragment_struct, ref, alt in pairs])[0]
+            moving, mask = stack_coordinates([alt for fragment, fragment_struct, ref, alt in pairs])
+            rotations, translations, rmsds = superpose_many(fixed, moving, mask)
+            for (fragment, fragment_struct, ref, alt), rotation, translation in zip(pairs, rotations, translations):
+                atoms = list(fragment_struct.get_atoms())
+                set_atom_coords(atoms, transform(atom_coords(atoms), rotation, translation))
+                superposed_frags.append([fragment,fragment_struct])
         logger.info("Number of superimposed fragments: {}".format(len(superposed_frags)))
         return superposed_frags
 
@@ -157,8 +179,8 @@ class FragmentSuperpose(object):
 class RotamerSuperpose(object):
     ''' Class to superimpose Atom objects on one-another. 
 
-        @param reference_atoms: list of Atom objects of rotamers to be superposed on \n
-        @param template_atoms: list of Atom objects of rotamers to be superposed
+        @param reference_atoms: list of Atom objects (or ResidueView) of rotamers to be superposed on \n
+        @param template_atoms: list of Atom objects (or ResidueView) of rotamers to be superposed
     '''
     def __init__(self, reference_atoms, template_atoms, TM_keys=None):
         self.reference_atoms = reference_atoms
@@ -170,23 +192,17 @@ class RotamerSuperpose(object):
     def run(self):
         ''' Run the superpositioning. 
         '''
-        super_imposer = Superimposer()
         try:
             if not self.TM_keys:
-                ref_backbone_atoms = [atom for atom in self.reference_atoms if atom.get_name() in ['N','CA','C','O']]
-                temp_backbone_atoms = [atom for atom in self.template_atoms if atom.get_name() in ['N','CA','C','O']]
+                ref_backbone = backbone_coords([self.reference_atoms], ['N','CA','C','O'])
+                temp_backbone = backbone_coords([self.template_atoms], ['N','CA','C','O'])
             else:
-                ref_backbone_atoms = [atom for atom in self.reference_atoms if atom.get_name() in ['N','CA','C'] and atom.get_parent().get_full_id()[-1][1] in self.TM_keys]
-                temp_backbone_atoms = [atom for atom in self.template_atoms if atom.get_name() in ['N','CA','C'] and atom.get_parent().get_full_id()[-1][1] in self.TM_keys]
-            self.num_atoms_used_for_superposition = len(ref_backbone_atoms)
-            super_imposer.set_atoms(ref_backbone_atoms, temp_backbone_atoms)
-            super_imposer.apply(self.template_atoms)
-            array1, array2 = np.array([0,0,0]), np.array([0,0,0])
-            for atom1, atom2 in zip(ref_backbone_atoms, temp_backbone_atoms):
-                array1 = np.vstack((array1, list(atom1.get_coord())))
-                array2 = np.vstack((array2, list(atom2.get_coord())))
-            diff = array1[1:]-array2[1:]
-            self.backbone_rmsd = np.sqrt(sum(sum(diff**2))/array1[1:].shape[0])
+                ref_backbone = atom_coords([atom for atom in self.reference_atoms if atom.get_name() in ['N','CA','C'] and atom.get_parent().get_full_id()[-1][1] in self.TM_keys])
+                temp_backbone = atom_coords([atom for atom in self.template_atoms if atom.get_name() in ['N','CA','C'] and atom.get_parent().get_full_id()[-1][1] in self.TM_keys])
+            self.num_atoms_used_for_superposition = len(ref_backbone)
+            rotation, translation = superposition(ref_backbone, temp_backbone)
+            transform_residues([self.template_atoms], rotation, translation)
+            self.backbone_rmsd = rmsd(ref_backbone, transform(temp_backbone, rotation, translation))
             return self.template_atoms
         except Exception as msg:
             if self.reference_atoms!='x':
@@ -197,7 +213,7 @@ class BulgeConstrictionSuperpose(object):
     ''' Class to superimpose bulge and constriction site.
 
         @param reference_dict: OrderedDict, dictionary of atoms to be superposed on, where keys are generic numbers 
-        and values are lists of atoms. \n
+        and values are lists of atoms (or ResidueViews). \n
         @param template_dict: OrderedDict, dictionary of atoms to be superposed. Same format as reference_dict.
     '''
     def __init__(self, reference_dict, template_dict):
@@ -205,25 +221,26 @@ class BulgeConstrictionSuperpose(object):
         self.reference_gns = list(reference_dict.keys())
         self.template_dict = template_dict
         self.template_gns = list(template_dict.keys())
-        self.starting_atom_type = template_dict[list(template_dict.keys())[0]][0].get_id()
+        self.starting_atom_type = residue_arrays(template_dict[list(template_dict.keys())[0]])[0][0]
         self.backbone_rmsd = None
 
     def run(self):
         ''' Run the superpositioning.
         '''
-        super_imposer = Superimposer()
-        ref_backbone_atoms = [atom for atom in self.reference_dict[self.reference_gns[0]] if atom.get_name() in 
-                                ['N','CA','C']] + [atom for atom in self.reference_dict[self.reference_gns[-1]] if 
-                                atom.get_name() in ['N','CA','C']]
-        temp_backbone_atoms= [atom for atom in self.template_dict[self.template_gns[0]] if atom.get_name() in 
-                                ['N','CA','C']] + [atom for atom in self.template_dict[self.template_gns[-1]] if 
-                                atom.get_name() in ['N','CA','C']]
-        all_template_atoms = []
-        for gn, atoms in self.template_dict.items():
-            all_template_atoms+=atoms
-        super_imposer.set_atoms(ref_backbone_atoms, temp_backbone_atoms)
-        super_imposer.apply(all_template_atoms)
-        return self.rebuild_dictionary(all_template_atoms)
+        ref_backbone = backbone_coords([self.reference_dict[self.reference_gns[0]],
+                                        self.reference_dict[self.reference_gns[-1]]])
+        temp_backbone = backbone_coords([self.template_dict[self.template_gns[0]],
+                                         self.template_dict[self.template_gns[-1]]])
+        return self.move_template(*superposition(ref_backbone, temp_backbone))
+
+    def move_template(self, rotation, translation):
+        ''' Move all template residues. ResidueViews are moved in place, lists of atoms are regrouped.
+        '''
+        residues = list(self.template_dict.values())
+        transform_residues(residues, rotation, translation)
+        if all([isinstance(residue, ResidueView) for residue in residues]):
+            return self.template_dict
+        return self.rebuild_dictionary([atom for atoms in residues for atom in atoms])
 
     def rebuild_dictionary(self, all_template_atoms):
         ''' Rebuild input ordered dictionary.
@@ -244,15 +261,11 @@ class BulgeConstrictionSuperpose(object):
             self.template_dict[gn] = temp_dict[gn_count]
         return self.template_dict
         
-    def calc_backbone_RMSD(self, ref_backbone_atoms, temp_backbone_atoms):
-        ''' Calculate backbone RMSD.
+    def calc_backbone_RMSD(self, ref_backbone, temp_backbone):
+        ''' Calculate backbone RMSD of two coordinate arrays.
         '''
-        array1, array2 = np.array([0,0,0]), np.array([0,0,0])
-        for atom1, atom2 in zip(ref_backbone_atoms, temp_backbone_atoms):
-            array1 = np.vstack((array1, list(atom1.get_coord())))
-            array2 = np.vstack((array2, list(atom2.get_coord())))
-        diff = array1[1:]-array2[1:]
-        return np.sqrt(sum(sum(diff**2))/array1[1:].shape[0])
+        length = min(len(ref_backbone), len(temp_backbone))
+        return rmsd(ref_backbone[:length], temp_backbone[:length])
 
 #==============================================================================  
 class LoopSuperpose(BulgeConstrictionSuperpose):
@@ -266,13 +279,7 @@ class LoopSuperpose(BulgeConstrictionSuperpose):
     def run(self):
         ''' Run the superpositioning.
         '''
-        super_imposer = Superimposer()
-        ref_backbone_atoms, temp_backbone_atoms, all_template_atoms = [], [], []
-        for gn, atoms in self.reference_dict.items():
-            for atom in atoms:
-                if atom.get_name() in ['N','CA','C']:
-                    ref_backbone_atoms.append(atom)
-        res_count=0
+        ref_backbone = backbone_coords(self.reference_dict.values())
         array_length = len(self.template_dict.keys())
         edge1 = 4
         edge2 = 4
@@ -281,16 +288,10 @@ class LoopSuperpose(BulgeConstrictionSuperpose):
                 edge2 = 3
             elif self.part==2:
                 edge1 = 3
-        for gn, atoms in self.template_dict.items():
-            res_count+=1
-            for atom in atoms:
-                if (res_count<=edge1 or array_length-edge2<res_count) and atom.get_name() in ['N','CA','C']:
-                    temp_backbone_atoms.append(atom)
-                all_template_atoms.append(atom)
-        self.backbone_rmsd = self.calc_backbone_RMSD(ref_backbone_atoms, temp_backbone_atoms)
-        super_imposer.set_atoms(ref_backbone_atoms, temp_backbone_atoms)
-        super_imposer.apply(all_template_atoms)        
-        return self.rebuild_dictionary(all_template_atoms)
+        temp_backbone = backbone_coords([atoms for res_count, atoms in enumerate(self.template_dict.values(), 1)
+                                         if res_count<=edge1 or array_length-edge2<res_count])
+        self.backbone_rmsd = self.calc_backbone_RMSD(ref_backbone, temp_backbone)
+        return self.move_template(*superposition(ref_backbone, temp_backbone))
         
 #============================================================================== 
 class OneSidedSuperpose(BulgeConstrictionSuperpose):
@@ -304,29 +305,19 @@ class OneSidedSuperpose(BulgeConstrictionSuperpose):
     def run(self):
         ''' Run the superpositioning.
         '''
-        super_imposer = Superimposer()
-        ref_backbone_atoms, temp_backbone_atoms, all_template_atoms = [], [], []
-        for gn, atoms in self.reference_dict.items():
-            for atom in atoms:
-                if atom.get_name() in ['N','CA','C']:
-                    ref_backbone_atoms.append(atom)
-        res_count = 0
+        ref_backbone = backbone_coords(self.reference_dict.values())
         if self.which_end==0:
             start = len(self.template_dict.keys())-self.num_frame
             end = start+self.num_frame
         elif self.which_end==1:
             start = 0
             end = self.num_frame-1        
-        for gn, atoms in self.template_dict.items():
-            for atom in atoms:
-                if start<=res_count<=end and atom.get_name() in ['N','CA','C']:
-                    temp_backbone_atoms.append(atom)
-                all_template_atoms.append(atom)
-            res_count+=1
-        super_imposer.set_atoms(ref_backbone_atoms, temp_backbone_atoms)
-        super_imposer.apply(all_template_atoms)
-        self.backbone_rmsd = self.calc_backbone_RMSD(ref_backbone_atoms, temp_backbone_atoms)
-        return self.rebuild_dictionary(all_template_atoms)
+        temp_backbone = backbone_coords([atoms for res_count, atoms in enumerate(self.template_dict.values())
+                                         if start<=res_count<=end])
+        rotation, translation = superposition(ref_backbone, temp_backbone)
+        superposed = self.move_template(rotation, translation)
+        self.backbone_rmsd = self.calc_backbone_RMSD(ref_backbone, transform(temp_backbone, rotation, translation))
+        return superposed
         
 #============================================================================== 
 class ECL2MidSuperpose(BulgeConstrictionSuperpose):
@@ -336,20 +327,8 @@ class ECL2MidSuperpose(BulgeConstrictionSuperpose):
     def run(self):
         ''' Run the superpositioning.
         '''
-        super_imposer = Superimposer()
-        ref_backbone_atoms, temp_backbone_atoms, all_template_atoms = [], [], []
-        for gn, atoms in self.reference_dict.items():
-            for atom in atoms:
-                if atom.get_name() in ['N','CA','C']:
-                    ref_backbone_atoms.append(atom)
-        res_count=0
-        for gn, atoms in self.template_dict.items():
-            res_count+=1
-            for atom in atoms:
-                if res_count<4 and atom.get_name() in ['N','CA','C']:
-                    temp_backbone_atoms.append(atom)
-                all_template_atoms.append(atom)
-        self.backbone_rmsd = self.calc_backbone_RMSD(ref_backbone_atoms, temp_backbone_atoms)
-        super_imposer.set_atoms(ref_backbone_atoms, temp_backbone_atoms)
-        super_imposer.apply(all_template_atoms)        
-        return self.rebuild_dictionary(all_template_atoms)
+        ref_backbone = backbone_coords(self.reference_dict.values())
+        temp_backbone = backbone_coords([atoms for res_count, atoms in enumerate(self.template_dict.values(), 1)
+                                         if res_count<4])
+        self.backbone_rmsd = self.calc_backbone_RMSD(ref_backbone, temp_backbone)
+        return self.move_template(*superposition(ref_backbone, temp_backbone))
@@ -0,0 +1,307 @@
+"""
+Coordinates of homology models as contiguous arrays.
+
+The modeling pipeline builds a model as nested OrderedDicts of segments -> generic numbers/residue numbers -> lists of
+Biopython atoms (see GPCRDBParsingPDB.pdb_array_creator). Every atom is a Python object, and through its parent
+residue it keeps the whole parsed template structure it was taken from in memory. StructureArray holds the same model
+as one coordinate array with per atom arrays and index tables by segment and key, segments and residues are views
+into these arrays. Entries that are not residues (the gap and break markers 'x', '-' and '/') are kept as they are.
+
+The modeling steps keep the layout of nested OrderedDicts, but the residues they take from templates (helix ends,
+loops, switched rotamers) are copied into a StructureArray and stored as ResidueViews (see residue_views), so the
+parsed template structures are released right away. A model can hold both, the functions below accept a ResidueView
+or a list of Biopython atoms as a residue.
+
+The superposition functions work on (n, 3) coordinate arrays and follow the convention of Bio.PDB.Superimposer
+(coords.dot(rotation) + translation), structure.structural_superposition uses them for the modeling superpositions.
+Many structures are superposed at once on stacks of coordinates (k, n, 3) with a batched SVD, optionally split over a
+pool of processes, sets of different lengths are padded and masked (see stack_coordinates).
+"""
+from collections import OrderedDict
+from collections.abc import Mapping
+from multiprocessing import Pool
+
+import numpy as np
+
+BACKBONE_ATOMS = ['N', 'CA', 'C']
+
+# coordinates of the rmsd_matrix worker processes
+matrix_coords = None
+
+
+def atom_coords(atoms):
+    """Coordinates of a list of Biopython atoms as an (n, 3) array"""
+    return np.array([atom.get_coord() for atom in atoms], dtype=np.float64).reshape(-1, 3)
+
+def set_atom_coords(atoms, coords):
+    for atom, coord in zip(atoms, coords):
+        atom.set_coord(coord)
+
+def stack_coordinates(coordinate_sets):
+    """Stack coordinate arrays of different lengths as a (k, n, 3) array padded with zeros, and the (k, n) mask of the
+    real coordinates"""
+    length = max([len(coords) for coords in coordinate_sets] + [0])
+    stack = np.zeros((len(coordinate_sets), length, 3))
+    mask = np.zeros((len(coordinate_sets), length), dtype=bool)
+    for i, coords in enumerate(coordinate_sets):
+        stack[i, :len(coords)] = coords
+        mask[i, :len(coords)] = True
+    return stack, mask
+
+def superpositions(fixed, moving, mask=None):
+    """Rotations (k, 3, 3) and translations (k, 3) superposing k sets of moving coordinates (k, n, 3) on the fixed
+    coordinates, either one set (n, 3) for all or one set per moving set (Kabsch algorithm in a batched SVD)"""
+    fixed = np.broadcast_to(fixed, moving.shape)
+    weights = np.ones(moving.shape[:2]) if mask is None else mask.astype(np.float64)
+    counts = weights.sum(axis=1)[:, None]
+    if not counts.all():
+        raise ValueError('No coordinates to superpose')
+    fixed_centers = np.einsum('kn,kni->ki', weights, fixed) / counts
+    moving_centers = np.einsum('kn,kni->ki', weights, moving) / counts
+    correlations = np.einsum('kn,kni,knj->kij', weights, moving - moving_centers[:, None],
+                             fixed - fixed_centers[:, None])
+    u, d, vt = np.linalg.svd(correlations)
+    # reflections
+    reflected = np.linalg.det(np.matmul(u, vt)) < 0
+    vt[reflected, 2] = -vt[reflected, 2]
+    rotations = np.matmul(u, vt)
+    translations = fixed_centers - np.einsum('ki,kij->kj', moving_centers, rotations)
+    return rotations, translations
+
+def superposition(fixed, moving):
+    """Rotation and translation superposing the moving coordinates on the fixed ones"""
+    if fixed.shape != moving.shape:
+        raise ValueError('Fixed and moving coordinates differ in size: {} and {}'.format(len(fixed), len(moving)))
+    rotations, translations = superpositions(fixed, moving[None])
+    return rotations[0], translations[0]
+
+def transform(coords, rotation, translation):
+    return np.dot(coords, rotation) + translation
+
+def transform_many(coords, rotations, translations):
+    return np.matmul(coords, rotations) + translations[:, None]
+
+def rmsd(coords1, coords2):
+    diff = coords1 - coords2
+    return np.sqrt((diff * diff).sum() / len(coords1))
+
+def rmsds(coords1, coords2, mask=None):
+    """RMSD of every pair of coordinate sets of two stacks"""
+    squared = ((coords1 - coords2) ** 2).sum(axis=-1)
+    if mask is None:
+        return np.sqrt(squared.mean(axis=-1))
+    return np.sqrt((squared * mask).sum(axis=-1) / mask.sum(axis=-1))
+
+def superpose_chunk(args):
+    fixed, moving, mask = args
+    rotations, translations = superpositions(fixed, moving, mask)
+    superposed = transform_many(moving, rotations, translations)
+    return rotations, translations, rmsds(np.broadcast_to(fixed, moving.shape), superposed, mask)
+
+def superpose_many(fixed, moving, mask=None, processes=1):
+    """Superpose k sets of moving coordinates on the fixed coordinates (see superpositions)
+
+    Returns the rotations, translations and the RMSDs after superposition. With processes > 1 the sets are split over
+    a pool of processes.
+    """
+    processes = max(1, min(processes or 1, len(moving)))
+    if processes == 1:
+        return superpose_chunk((fixed, moving, mask))
+    parts = np.array_split(np.arange(len(moving)), processes)
+    chunks = [(fixed[part] if fixed.ndim == 3 else fixed, moving[part], mask[part] if mask is not None else None)
+              for part in parts]
+    with Pool(processes) as pool:
+        results = pool.map(superpose_chunk, chunks)
+    return tuple([np.concatenate(values) for values in zip(*results)])
+
+def set_matrix_coords(coords):
+    global matrix_coords
+    matrix_coords = coords
+
+def matrix_rows(rows):
+    return np.array([superpose_chunk((matrix_coords[i], matrix_coords, None))[2] for i in rows]).reshape(
+        len(rows), len(matrix_coords))
+
+def rmsd_matrix(coords, processes=1):
+    """RMSDs after superposition of all pairs of k coordinate sets with the same atoms (k, n, 3), as a k x k array.
+    With processes > 1 the rows are split over a pool of processes."""
+    rows = np.arange(len(coords))
+    processes = max(1, min(processes or 1, len(coords)))
+    if processes == 1:
+        set_matrix_coords(coords)
+        return matrix_rows(rows)
+    with Pool(processes, initializer=set_matrix_coords, initargs=(coords,)) as pool:
+        results = pool.map(matrix_rows, np.array_split(rows, processes))
+    return np.vstack(results)
+
+def residue_arrays(residue):
+    """Atom names and coordinates of a residue, a ResidueView or a list of Biopython atoms"""
+    if isinstance(residue, ResidueView):
+        return residue.names, residue.coords
+    return np.array([atom.get_id() for atom in residue], dtype='U4'), atom_coords(residue)
+
+def residue_name(residue):
+    """Residue name (e.g. 'ALA') of a ResidueView or a list of Biopython atoms"""
+    if isinstance(residue, ResidueView):
+        return residue.resname
+    return residue[0].get_parent().get_resname()
+
+def backbone_coords(residues, atom_names=BACKBONE_ATOMS):
+    """Coordinates of the atoms with the given names of the residues, in the order of the residues and their atoms"""
+    coords = []
+    for residue in residues:
+        names, residue_coords = residue_arrays(residue)
+        coords.append(residue_coords[np.isin(names, atom_names)])
+    return np.concatenate(coords) if coords else np.zeros((0, 3))
+
+def transform_residues(residues, rotation, translation):
+    """Move residues in place, ResidueViews change the coordinates of their StructureArray"""
+    for residue in residues:
+        if isinstance(residue, ResidueView):
+            residue.coords[:] = transform(residue.coords, rotation, translation)
+        else:
+            set_atom_coords(residue, transform(atom_coords(residue), rotation, translation))
+
+def residue_views(residues):
+    """Copy residues (key -> residue or placeholder) into a StructureArray, as key -> ResidueView or placeholder"""
+    return StructureArray.from_pdb_array(OrderedDict([(None, residues)])).as_pdb_array()[None]
+
+def superpose_atoms(fixed_atoms, moving_atoms, atoms):
+    """Superpose moving_atoms on fixed_atoms and move atoms (all atoms of the moving structure) accordingly, in a
+    single transformation of their coordinates"""
+    rotation, translation = superposition(atom_coords(fixed_atoms), atom_coords(moving_atoms))
+    set_atom_coords(atoms, transform(atom_coords(atoms), rotation, translation))
+    return rotation, translation
+
+
+class StructureArray(Mapping):
+    """A model (segment -> key -> atoms) in contiguous arrays
+
+    coords, names, resnames, bfactors and occupancies are per atom. entries are the (segment, key) of the model in
+    order, the atoms of entry i are atom_starts[i]:atom_starts[i+1] (none for placeholders, the values of entries
+    that are not residues). segments are the first and last+1 entry of each segment.
+    """
+
+    def __init__(self, coords, names, resnames, bfactors, occupancies, entries, atom_starts, placeholders, segments):
+        self.coords = coords
+        self.names = names
+        self.resnames = resnames
+        self.bfactors = bfactors
+        self.occupancies = occupancies
+        self.entries = entries
+        self.atom_starts = atom_starts
+        self.placeholders = placeholders
+        self.segments = segments
+        self.index = dict([(entry, i) for i, entry in enumerate(entries)])
+
+    @classmethod
+    def from_pdb_array(cls, pdb_array):
+        """Convert the output of GPCRDBParsingPDB.pdb_array_creator (after modeling)"""
+        coords, names, resnames, bfactors, occupancies = [], [], [], [], []
+        entries, atom_starts, placeholders, segments = [], [0], {}, OrderedDict()
+        for segment, residues in pdb_array.items():
+            first = len(entries)
+            for key, atoms in residues.items():
+                if isinstance(atoms, str):
+                    placeholders[len(entries)] = atoms
+                elif isinstance(atoms, ResidueView):
+                    coords.extend(atoms.coords)
+                    names.extend(atoms.names.tolist())
+                    resnames.extend([atoms.resname] * len(atoms))
+                    bfactors.extend(atoms.bfactors.tolist())
+                    occupancies.extend(atoms.occupancies.tolist())
+                else:
+                    for atom in atoms:
+                        coords.append(atom.get_coord())
+                        names.append(atom.get_id())
+                        resnames.append(atom.get_parent().get_resname())
+                        bfactors.append(float(atom.get_bfactor()))
+                        occupancies.append(atom.get_occupancy())
+                entries.append((segment, key))
+                atom_starts.append(len(names))
+            segments[segment] = (first, len(entries))
+        return cls(np.array(coords, dtype=np.float64).reshape(-1, 3), np.array(names, dtype='U4'),
+                   np.array(resnames, dtype='U3'), np.array(bfactors, dtype=np.float64),
+                   np.array(occupancies, dtype=np.float64), entries, np.array(atom_starts, dtype=np.int64),
+                   placeholders, segments)
+
+    def __getitem__(self, segment):
+        if segment not in self.segments:
+            raise KeyError(segment)
+        return SegmentView(self, segment)
+
+    def as_pdb_array(self):
+        """The model as nested OrderedDicts of ResidueViews and placeholders, in the layout of
+        GPCRDBParsingPDB.pdb_array_creator"""
+        return OrderedDict([(segment, OrderedDict(self[segment].items())) for segment in self])
+
+    def __iter__(self):
+        return iter(self.segments)
+
+    def __len__(self):
+        return len(self.segments)
+
+    def segment_keys(self, segment):
+        first, last = self.segments[segment]
+        return [key for seg, key in self.entries[first:last]]
+
+    def atom_slice(self, segment, key=None):
+        """Atoms of a residue, or of a whole segment when key is None"""
+        if key is None:
+            first, last = self.segments[segment]
+        else:
+            first = self.index[(segment, key)]
+            last = first + 1
+        return slice(self.atom_starts[first], self.atom_starts[last])
+
+    def placeholder(self, segment, key):
+        """Value of an entry that is not a residue, None for residues"""
+        return self.placeholders.get(self.index[(segment, key)])
+
+
+class SegmentView(Mapping):
+    """Residues of a segment as key -> ResidueView (or the placeholder value)"""
+
+    def __init__(self, structure, segment):
+        self.structure = structure
+        self.segment = segment
+
+    def __getitem__(self, key):
+        if (self.segment, key) not in self.structure.index:
+            raise KeyError(key)
+        placeholder = self.structure.placeholder(self.segment, key)
+        if placeholder is not None:
+            return placeholder
+        return ResidueView(self.structure, self.structure.atom_slice(self.segment, key))
+
+    def __iter__(self):
+        return iter(self.structure.segment_keys(self.segment))
+
+    def __len__(self):
+        first, last = self.structure.segments[self.segment]
+        return last - first
+
+
+class ResidueView:
+    """Atoms of a residue, the arrays are views into the StructureArray. Slicing gives a view of some of the atoms
+    (e.g. residue[0:5] for the backbone and CB)."""
+
+    def __init__(self, structure, atoms):
+        self.structure = structure
+        self.atoms = atoms
+        self.coords = structure.coords[atoms]
+        self.names = structure.names[atoms]
+        self.bfactors = structure.bfactors[atoms]
+        self.occupancies = structure.occupancies[atoms]
+        self.resname = structure.resnames[atoms.start] if atoms.stop > atoms.start else ''
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            raise TypeError('ResidueView only supports slicing')
+        start, stop, step = index.indices(len(self))
+        if step != 1:
+            raise ValueError('ResidueView only supports contiguous slices')
+        return ResidueView(self.structure, slice(self.atoms.start + start, self.atoms.start + max(start, stop)))
+
+    def __len__(self):
+        return len(self.names)
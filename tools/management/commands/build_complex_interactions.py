@@ -4,6 +4,7 @@ from django.core.management import call_command
 from django.conf import settings
 from django.db import connection
 from signprot.models import SignprotComplex
+from common.cache_warming import invalidate_dependency
 
 from contactnetwork.cube import *
 
@@ -34,6 +35,9 @@ class Command(BaseBuild):
             self.logger.error(msg)
         self.logger.info('COMPLETED COMPLEX INTERACTIONS')
 
+        # cached products built from the G protein interactions are rebuilt
+        invalidate_dependency('interactions')
+
     def main_func(self, positions, iteration,count,lock):
         pdbs = self.pdbs
         while count.value<len(pdbs):
@@ -1,11 +1,13 @@
-from django.core.management.base import BaseCommand
-from django.db import connection
+from build.management.commands.base_build import Command as BaseBuild
 
 import contactnetwork.pdb as pdb
 from structure.models import Structure, StructureVectors
+from structure.parsed_structures import get_parsed_structure
 from residue.models import Residue
 from angles.models import ResidueAngle as Angle
 from contactnetwork.models import Distance, distance_scaling_factor
+from contactnetwork.distance_store import NO_DISTANCE, save_distance_map, delete_distance_maps
+from angles.angle_store import save_angle_table, delete_angle_tables
 
 import Bio.PDB
 import copy
@@ -27,7 +29,6 @@ from sklearn.decomposition import PCA
 from numpy.core.umath_tests import inner1d
 
 
-from multiprocessing import Queue, Process, Value, Lock
 
 SASA = True
 HSE  = True
@@ -35,6 +36,7 @@ extra_pca = True
 print_pdb = False
 GN_only = False
 incremental_update = False
+store_distance_rows = True # also store the distances as Distance rows next to the binary distance store
 
 # atom name dictionary
 # Based on https://github.com/fomightez/structurework/blob/master/spartan_fixer/SPARTAN08_Fixer_standalone.py
@@ -216,7 +218,7 @@ class NonHetSelect(Bio.PDB.Select):
     def accept_residue(self, residue):
         return 1 if residue.id[0] == " " else 0
 
-class Command(BaseCommand):
+class Command(BaseBuild):
 
     help = "Command to calculate all angles for residues in each TM helix."
 
@@ -229,36 +231,6 @@ class Command(BaseCommand):
 
     processes = 2
 
-    def prepare_input(self, proc, items, iteration=1):
-        q = Queue()
-        procs = list()
-        num_items = len(items)
-        num = Value('i', 0)
-        lock = Lock()
-
-        if not num_items:
-            return False
-
-        # make sure not to use more jobs than proteins (chunk size will be 0, which is not good)
-        if proc > num_items:
-            proc = num_items
-
-        chunk_size = int(num_items / proc)
-        connection.close()
-        for i in range(0, proc):
-            first = chunk_size * i
-            if i == proc - 1:
-                last = False
-            else:
-                last = chunk_size * (i + 1)
-
-            p = Process(target=self.main_func, args=([(first, last), iteration,num,lock]))
-            procs.append(p)
-            p.start()
-
-        for p in procs:
-            p.join()
-
     def add_arguments(self, parser):
         parser.add_argument('-p', '--proc',
             type=int,
@@ -285,6 +257,8 @@ class Command(BaseCommand):
         else:
             Angle.objects.all().delete()
             Distance.objects.all().delete()
+            delete_distance_maps()
+            delete_angle_tables()
             StructureVectors.objects.all().delete()
             print("All Angle, Distance, and StructureVector data cleaned")
             self.references = Structure.objects.all().prefetch_related('pdb_code','pdb_data','protein_conformation__protein','protein_conformation__state').order_by('protein_conformation__protein')
@@ -561,7 +535,7 @@ class Command(BaseCommand):
 #            print(pdb_code)
 
             try:
-                structure = self.load_pdb_var(pdb_code,reference.pdb_data.pdb)
+                structure = get_parsed_structure(pdb_code, reference.pdb_data, pdb_code)
                 pchain = structure[0][preferred_chain]
                 state_id = reference.protein_conformation.state.id
 
@@ -1228,26 +1202,34 @@ class Command(BaseCommand):
 
                 # triangular matrix for distances
                 up_ind = np.triu_indices(len(gns_ca_list), 1)
-                bulk_distances = []
-
-                for i1, i2 in zip(up_ind[0], up_ind[1]):
-                    key1 = gns_ids_list[i1]
-                    key2 = gns_ids_list[i2]
-                    res1 = full_resdict[str(key1)]
-                    res2 = full_resdict[str(key2)]
-
-                    ca_dist = int(np.linalg.norm(gns_ca_list[key1] - gns_ca_list[key2])*distance_scaling_factor)
-                    cb_dist = int(np.linalg.norm(gns_cb_list[key1] - gns_cb_list[key2])*distance_scaling_factor)
-                    center_dist = None
-                    if key1 in gns_center_list and key2 in gns_center_list:
-                        center_dist = int(np.linalg.norm(gns_center_list[key1] - gns_center_list[key2])*distance_scaling_factor)
-
-                    # residues in gn_reslist, structure in structure
-                    distance = Distance(distance = ca_dist, distance_cb = cb_dist, distance_helix_center = center_dist, res1=res1, res2=res2, gn1=res1.generic_number.label, gn2=res2.generic_number.label, gns_pair='_'.join([res1.generic_number.label, res2.generic_number.label]), structure=reference)
-                    bulk_distances.append(distance)
-
-                # Bulk insert
-                Distance.objects.bulk_create(bulk_distances, batch_size=5000)
+                ca_coords = np.array([gns_ca_list[key] for key in gns_ids_list])
+                cb_coords = np.array([gns_cb_list[key] for key in gns_ids_list])
+                center_coords = np.array([gns_center_list[key] if key in gns_center_list else [np.nan]*3 for key in gns_ids_list])
+
+                ca_dists = (np.linalg.norm(ca_coords[up_ind[0]] - ca_coords[up_ind[1]], axis=1)*distance_scaling_factor).astype(np.int32)
+                cb_dists = (np.linalg.norm(cb_coords[up_ind[0]] - cb_coords[up_ind[1]], axis=1)*distance_scaling_factor).astype(np.int32)
+                center_dists = np.linalg.norm(center_coords[up_ind[0]] - center_coords[up_ind[1]], axis=1)*distance_scaling_factor
+                center_dists = np.where(np.isnan(center_dists), NO_DISTANCE, center_dists).astype(np.int32)
+
+                # binary distance store
+                gn_labels = [full_resdict[str(key)].generic_number.label for key in gns_ids_list]
+                gn_amino_acids = [full_resdict[str(key)].amino_acid for key in gns_ids_list]
+                save_distance_map(reference.id, gn_labels, gn_amino_acids, np.vstack([ca_dists, cb_dists, center_dists]))
+
+                if store_distance_rows:
+                    bulk_distances = []
+                    for i1, i2, ca_dist, cb_dist, center_dist in zip(up_ind[0], up_ind[1], ca_dists.tolist(), cb_dists.tolist(), center_dists.tolist()):
+                        res1 = full_resdict[str(gns_ids_list[i1])]
+                        res2 = full_resdict[str(gns_ids_list[i2])]
+                        if center_dist == NO_DISTANCE:
+                            center_dist = None
+
+                        # residues in gn_reslist, structure in structure
+                        distance = Distance(distance = ca_dist, distance_cb = cb_dist, distance_helix_center = center_dist, res1=res1, res2=res2, gn1=gn_labels[i1], gn2=gn_labels[i2], gns_pair='_'.join([gn_labels[i1], gn_labels[i2]]), structure=reference)
+                        bulk_distances.append(distance)
+
+                    # Bulk insert
+                    Distance.objects.bulk_create(bulk_distances, batch_size=5000)
 
                 ### ANGLES
                 # Center axis to helix axis to CA
@@ -1261,7 +1243,7 @@ class Command(BaseCommand):
 
                 ### freeSASA (only for TM bundle)
                 # SASA calculations - results per atom
-                clean_structure = self.load_pdb_var(pdb_code,reference.pdb_data.pdb)
+                clean_structure = get_parsed_structure(pdb_code, reference.pdb_data, pdb_code)
                 clean_pchain = clean_structure[0][preferred_chain]
 
                 # PTM residues give an FreeSASA error - remove
@@ -1434,3 +1416,5 @@ class Command(BaseCommand):
         # Store the results
         # faster than updating: deleting and recreating
         Angle.objects.bulk_create(object_list,batch_size=5000)
+        for structure_id in set(angle.structure_id for angle in object_list):
+            save_angle_table(structure_id)